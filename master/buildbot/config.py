@@ -67,12 +67,15 @@ class MasterConfig(object):
         self.logCompressionMethod = 'bz2'
         self.logMaxTailSize = None
         self.logMaxSize = None
+        self.logFsync = False
+        self.buildSummaryBackend = 'sqlite'
         self.properties = properties.Properties()
         self.mergeRequests = None
         self.codebaseGenerator = None
         self.prioritizeBuilders = None
         self.slavePortnum = None
         self.multiMaster = False
+        self.notifications = None
         self.debugPassword = None
         self.manhole = None
         self.protocols = {}
@@ -86,12 +89,18 @@ class MasterConfig(object):
         self.db = dict(
             db_url='sqlite:///state.sqlite',
             db_poll_interval=None,
+            db_replica_url=None,
+            db_replica_max_lag=5,
+            db_slow_query_threshold=None,
+            db_lane_reservations=dict(critical=1),
         )
         self.metrics = None
         self.caches = dict(
             Builds=15,
             Changes=10,
         )
+        self.cacheEviction = {}
+        self.sharedCache = None
         self.schedulers = {}
         self.builders = []
         self.slaves = []
@@ -101,14 +110,17 @@ class MasterConfig(object):
         self.revlink = default_revlink_matcher
 
     _known_config_keys = set([
-        "buildbotURL", "buildCacheSize", "builders", "buildHorizon", "caches",
+        "buildbotURL", "buildCacheSize", "builders", "buildHorizon",
+        "buildSummaryBackend", "caches",
         "change_source", "codebaseGenerator", "changeCacheSize", "changeHorizon",
         'db', "db_poll_interval", "db_url", "debugPassword", "eventHorizon",
-        "logCompressionLimit", "logCompressionMethod", "logHorizon",
+        "logCompressionLimit", "logCompressionMethod", "logFsync", "logHorizon",
         "logMaxSize", "logMaxTailSize", "manhole", "mergeRequests", "metrics",
-        "multiMaster", "prioritizeBuilders", "projectName", "projectURL",
-        "properties", "protocols", "revlink", "schedulers", "slavePortnum",
-        "slaves", "status", "title", "titleURL", "user_managers", "validation"
+        "multiMaster", "notifications", "prioritizeBuilders", "projectName",
+        "projectURL", "properties", "protocols", "revlink", "schedulers",
+        "sharedCache", "slavePortnum", "slaves", "status", "title",
+        "titleURL",
+        "user_managers", "validation"
     ])
 
     @classmethod
@@ -207,6 +219,7 @@ class MasterConfig(object):
             config.check_status()
             config.check_horizons()
             config.check_ports()
+            config.check_notifications()
         finally:
             _errors = None
 
@@ -257,6 +270,14 @@ class MasterConfig(object):
 
         copy_int_param('logMaxSize')
         copy_int_param('logMaxTailSize')
+        copy_param('logFsync', check_type=bool, check_type_name='a boolean')
+
+        if 'buildSummaryBackend' in config_dict:
+            buildSummaryBackend = config_dict.get('buildSummaryBackend')
+            if buildSummaryBackend not in ('sqlite', 'jsonl', None):
+                error("c['buildSummaryBackend'] must be 'sqlite', 'jsonl', "
+                      "or None")
+            self.buildSummaryBackend = buildSummaryBackend
 
         properties = config_dict.get('properties', {})
         if not isinstance(properties, dict):
@@ -314,6 +335,16 @@ class MasterConfig(object):
         if 'multiMaster' in config_dict:
             self.multiMaster = config_dict["multiMaster"]
 
+        if 'notifications' in config_dict:
+            # local import to avoid circular imports
+            from buildbot import notifier
+            notifications = config_dict['notifications']
+            if (notifications is not None and not
+                    isinstance(notifications, notifier.NotificationTransport)):
+                error("c['notifications'] must be a NotificationTransport")
+            else:
+                self.notifications = notifications
+
         copy_str_param('debugPassword')
 
         if 'manhole' in config_dict:
@@ -346,7 +377,10 @@ class MasterConfig(object):
     def load_db(self, filename, config_dict):
         if 'db' in config_dict:
             db = config_dict['db']
-            if set(db.keys()) > set(['db_url', 'db_poll_interval']):
+            if set(db.keys()) - set(['db_url', 'db_poll_interval',
+                                     'db_replica_url', 'db_replica_max_lag',
+                                     'db_slow_query_threshold',
+                                     'db_lane_reservations']):
                 error("unrecognized keys in c['db']")
             self.db.update(db)
         if 'db_url' in config_dict:
@@ -364,6 +398,27 @@ class MasterConfig(object):
         else:
             self.db['db_poll_interval'] = db_poll_interval
 
+        db_replica_max_lag = self.db['db_replica_max_lag']
+        if (not isinstance(db_replica_max_lag, (int, float))
+                or db_replica_max_lag < 0):
+            error("c['db']['db_replica_max_lag'] must be a non-negative number")
+
+        db_slow_query_threshold = self.db['db_slow_query_threshold']
+        if db_slow_query_threshold is not None and (
+                not isinstance(db_slow_query_threshold, (int, float))
+                or db_slow_query_threshold < 0):
+            error("c['db']['db_slow_query_threshold'] must be None or a "
+                  "non-negative number")
+
+        db_lane_reservations = self.db['db_lane_reservations']
+        if (not isinstance(db_lane_reservations, dict)
+                or set(db_lane_reservations) - set(['critical', 'normal'])
+                or [ n for n in db_lane_reservations.values()
+                     if not isinstance(n, int) or n < 0 ]):
+            error("c['db']['db_lane_reservations'] must be a dictionary "
+                  "giving the number of threads reserved for the 'critical' "
+                  "and 'normal' lanes")
+
 
     def load_metrics(self, filename, config_dict):
         # we don't try to validate metrics keys
@@ -385,13 +440,17 @@ class MasterConfig(object):
             else:
                 valPairs = caches.items()
                 for (name, value) in valPairs:
+                    if isinstance(value, dict):
+                        value = self._load_cache_eviction(name, value)
+                        if value is None:
+                            continue
                     if not isinstance(value, int):
                         error("value for cache size '%s' must be an integer"
                               % name)
                     if value < 1:
                         error("'%s' cache size must be at least 1, got '%s'"
                               % (name, value))
-                self.caches.update(caches)
+                    self.caches[name] = value
 
         if 'buildCacheSize' in config_dict:
             if explicit:
@@ -404,6 +463,39 @@ class MasterConfig(object):
                 error(msg)
             self.caches['Changes'] = config_dict['changeCacheSize']
 
+        if 'sharedCache' in config_dict:
+            # local import to avoid circular imports
+            from buildbot.process import sharedcache
+            sharedCache = config_dict['sharedCache']
+            if (sharedCache is not None and not
+                    isinstance(sharedCache, sharedcache.SharedCache)):
+                error("c['sharedCache'] must be a SharedCache")
+            else:
+                self.sharedCache = sharedCache
+
+
+    def _load_cache_eviction(self, name, options):
+        # handle a dictionary of cache options, returning the cache size, if
+        # given
+        from buildbot.util import lru
+        for k in options:
+            if k not in ('size', 'bytes', 'ttl', 'policy'):
+                error("unknown option '%s' for cache '%s'" % (k, name))
+        max_bytes = options.get('bytes')
+        if max_bytes is not None and (not isinstance(max_bytes, (int, long))
+                                      or max_bytes < 1):
+            error("'%s' cache bytes must be a positive integer" % name)
+        ttl = options.get('ttl')
+        if ttl is not None and (not isinstance(ttl, (int, float))
+                                or ttl <= 0):
+            error("'%s' cache ttl must be a positive number" % name)
+        policy = options.get('policy', 'lru')
+        if policy not in lru.LRUCache.POLICIES:
+            error("'%s' cache policy must be one of %s"
+                  % (name, ', '.join(lru.LRUCache.POLICIES)))
+        self.cacheEviction[name] = dict(policy=policy, max_bytes=max_bytes,
+                                        ttl=ttl)
+        return options.get('size')
 
     def load_schedulers(self, filename, config_dict):
         if 'schedulers' not in config_dict:
@@ -638,6 +730,13 @@ class MasterConfig(object):
         if self.debugPassword:
             error("debug client is configured, but c['protocols'] not")
 
+    def check_notifications(self):
+        # notifications only tell a master to poll the database early, so
+        # polling must be configured
+        if (self.notifications is not None
+                and not self.db['db_poll_interval']):
+            error("c['notifications'] requires c['db']['db_poll_interval']")
+
 
 class BuilderConfig:
 
@@ -13,6 +13,10 @@
 #
 # Copyright Buildbot Team Members
 
+import inspect
+from twisted.python import context
+from buildbot.db import pool
+
 class DBConnectorComponent(object):
     # A fixed component of the DBConnector, handling one particular aspect of
     # the database.  Instances of subclasses are assigned to attributes of the
@@ -22,6 +26,16 @@ class DBConnectorComponent(object):
 
     connector = None
 
+    # methods whose names begin with 'get' only read from the database, so
+    # they can be sent to a read replica; subclasses list any exceptions here
+    primaryMethods = ()
+
+    # methods whose queries go in the critical or background lanes of the
+    # pool's queue; the queries of other methods go in the lane of their
+    # caller, or the normal lane
+    criticalMethods = ()
+    backgroundMethods = ()
+
     def __init__(self, connector):
         self.db = connector
 
@@ -31,6 +45,34 @@ class DBConnectorComponent(object):
             if isinstance(o, CachedMethod):
                 setattr(self, method, o.get_cached_method(self))
 
+        # tell the pool which component method is calling, and whether it is
+        # only reading
+        for method in dir(self.__class__):
+            if method.startswith('_') or hasattr(DBConnectorComponent, method):
+                continue
+            o = getattr(self, method)
+            if inspect.ismethod(o) or inspect.isfunction(o):
+                setattr(self, method,
+                        self._routed(o, method, self._isReading(method)))
+
+    def _isReading(self, name):
+        return name.startswith('get') and name not in self.primaryMethods
+
+    def _routed(self, meth, name, reading):
+        route = { pool.ROUTE : (self.__class__.__name__, name, reading) }
+        if name in self.criticalMethods:
+            route[pool.LANE] = 'critical'
+        elif name in self.backgroundMethods:
+            route[pool.LANE] = 'background'
+        def wrap(*args, **kwargs):
+            return context.call(route, meth, *args, **kwargs)
+        wrap.__name__ = meth.__name__
+        wrap.__module__ = meth.__module__
+        wrap.__doc__ = meth.__doc__
+        if hasattr(meth, 'cache'):
+            wrap.cache = meth.cache
+        return wrap
+
     _is_check_length_necessary = None
     def check_length(self, col, value):
         # for use by subclasses to check that 'value' will fit in 'col', where
@@ -63,8 +105,16 @@ class CachedMethod(object):
         meth = self.method
 
         meth_name = meth.__name__
+        # the miss function may be called after the shared cache store is
+        # consulted, outside of the caller's context, so it is routed itself
+        def miss_fn(key):
+            return meth(component, key)
+        miss_fn = component._routed(miss_fn, meth_name,
+                                    component._isReading(meth_name))
+        # the values of database caches are plain data, so they can be
+        # shared with other masters
         cache = component.db.master.caches.get_cache(self.cache_name,
-                lambda key : meth(component, key))
+                miss_fn, shared=True)
         def wrap(key, no_cache=0):
             if no_cache:
                 return meth(component, key)
@@ -77,3 +127,14 @@ class CachedMethod(object):
 
 def cached(cache_name):
     return lambda method : CachedMethod(cache_name, method)
+
+def in_context(fn):
+    """
+    Return a wrapper for C{fn} that calls it with the pool context (route and
+    lane) of the caller, for callbacks that query the database.  Callbacks
+    otherwise run in the context of whatever fires their Deferred.
+    """
+    ctx = dict([ (key, context.get(key)) for key in (pool.ROUTE, pool.LANE) ])
+    def wrap(*args, **kwargs):
+        return context.call(ctx, fn, *args, **kwargs)
+    return wrap
@@ -34,8 +34,8 @@ class BrDict(dict):
 def with_master_objectid(fn):
     def wrap(self, *args, **kwargs):
         d = self.db.master.getObjectId()
-        d.addCallback(lambda master_objectid :
-                fn(self, _master_objectid=master_objectid, *args, **kwargs))
+        d.addCallback(base.in_context(lambda master_objectid :
+                fn(self, _master_objectid=master_objectid, *args, **kwargs)))
         return d
     wrap.__name__ = fn.__name__
     wrap.__doc__ = fn.__doc__
@@ -44,6 +44,15 @@ def with_master_objectid(fn):
 class BuildRequestsConnectorComponent(base.DBConnectorComponent):
     # Documentation is in developer/database.rst
 
+    # the latest ids are where polling starts, so they must not be stale
+    primaryMethods = ('getLatestBuildRequestId',
+                      'getLatestBuildRequestUnclaimId')
+
+    # claims gate the start of builds, so they should not wait behind other
+    # queries; nor should giving back the claims of builds that did not start
+    criticalMethods = ('claimBuildRequests', 'tryClaimBuildRequests',
+                       'unclaimBuildRequests')
+
     @with_master_objectid
     def getBuildRequest(self, brid, _master_objectid=None):
         def thd(conn):
@@ -115,6 +124,66 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                      for row in res.fetchall() ]
         return self.db.pool.do(thd)
 
+    @with_master_objectid
+    def getBuildRequestsSince(self, brid, brids=None, _master_objectid=None):
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            claims_tbl = self.db.model.buildrequest_claims
+            from_clause = reqs_tbl.outerjoin(claims_tbl,
+                                             reqs_tbl.c.id == claims_tbl.c.brid)
+
+            def select(whereclause):
+                q = sa.select([ reqs_tbl, claims_tbl ],
+                        whereclause=whereclause).select_from(from_clause)
+                return [ self._brdictFromRow(row, _master_objectid)
+                         for row in conn.execute(q).fetchall() ]
+
+            rv = select(reqs_tbl.c.id > brid)
+
+            # we'll need to batch the brids into groups of 100, so that the
+            # parameter lists supported by the DBAPI aren't exhausted
+            iterator = iter(sorted(set(brids or []) - set([ br['brid']
+                                                            for br in rv ])))
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    break
+                rv.extend(select(reqs_tbl.c.id.in_(batch)))
+
+            rv.sort(key=lambda br : br['brid'])
+            return rv
+        return self.db.pool.do(thd)
+
+    def getLatestBuildRequestId(self):
+        def thd(conn):
+            reqs_tbl = self.db.model.buildrequests
+            q = sa.select([ sa.func.max(reqs_tbl.c.id) ])
+            return conn.scalar(q)
+        return self.db.pool.do(thd)
+
+    def getBuildRequestUnclaimsSince(self, unclaimid):
+        def thd(conn):
+            tbl = self.db.model.buildrequest_unclaims
+            q = sa.select([ tbl.c.id, tbl.c.brid ],
+                    whereclause=(tbl.c.id > unclaimid),
+                    order_by=[ tbl.c.id ])
+            return [ (row.id, row.brid) for row in conn.execute(q) ]
+        return self.db.pool.do(thd)
+
+    def getLatestBuildRequestUnclaimId(self):
+        def thd(conn):
+            tbl = self.db.model.buildrequest_unclaims
+            q = sa.select([ sa.func.max(tbl.c.id) ])
+            return conn.scalar(q)
+        return self.db.pool.do(thd)
+
+    def pruneBuildRequestUnclaims(self, old, _reactor=reactor):
+        def thd(conn):
+            tbl = self.db.model.buildrequest_unclaims
+            old_epoch = _reactor.seconds() - old
+            conn.execute(tbl.delete(tbl.c.unclaimed_at < old_epoch))
+        return self.db.pool.do(thd)
+
     @with_master_objectid
     def claimBuildRequests(self, brids, claimed_at=None, _reactor=reactor,
                             _master_objectid=None):
@@ -140,6 +209,69 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
 
         return self.db.pool.do(thd)
 
+    @with_master_objectid
+    def tryClaimBuildRequests(self, brids, claimed_at=None, _reactor=reactor,
+                            _master_objectid=None):
+        if claimed_at is not None:
+            claimed_at = datetime2epoch(claimed_at)
+        else:
+            claimed_at = _reactor.seconds()
+
+        def thd(conn):
+            tbl = self.db.model.buildrequest_claims
+
+            def insert(brids):
+                conn.execute(tbl.insert(), [ dict(brid=id,
+                        objectid=_master_objectid, claimed_at=claimed_at)
+                        for id in brids ])
+
+            transaction = conn.begin()
+
+            # find the requests that are already claimed, in batches of 100
+            # so that the parameter lists supported by the DBAPI aren't
+            # exhausted
+            claimed = set()
+            iterator = iter(brids)
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    break
+                q = sa.select([ tbl.c.brid ],
+                        whereclause=tbl.c.brid.in_(batch))
+                claimed.update([ row.brid for row in conn.execute(q) ])
+
+            unclaimed = []
+            for brid in brids:
+                if brid not in claimed:
+                    claimed.add(brid)
+                    unclaimed.append(brid)
+            if not unclaimed:
+                transaction.commit()
+                return []
+
+            try:
+                insert(unclaimed)
+                transaction.commit()
+                return unclaimed
+            except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+                transaction.rollback()
+
+            # another master claimed some of these requests in the meantime,
+            # so claim them one at a time
+            rv = []
+            for brid in unclaimed:
+                transaction = conn.begin()
+                try:
+                    insert([ brid ])
+                except (sa.exc.IntegrityError, sa.exc.ProgrammingError):
+                    transaction.rollback()
+                    continue
+                transaction.commit()
+                rv.append(brid)
+            return rv
+
+        return self.db.pool.do(thd)
+
     @with_master_objectid
     def reclaimBuildRequests(self, brids, _reactor=reactor,
                             _master_objectid=None):
@@ -171,7 +303,8 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         return self.db.pool.do(thd)
 
     @with_master_objectid
-    def unclaimBuildRequests(self, brids, _master_objectid=None):
+    def unclaimBuildRequests(self, brids, _reactor=reactor,
+                            _master_objectid=None):
         def thd(conn):
             transaction = conn.begin()
             claims_tbl = self.db.model.buildrequest_claims
@@ -186,10 +319,13 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
                     break # success!
 
                 try:
-                    q = claims_tbl.delete(
-                            (claims_tbl.c.brid.in_(batch))
+                    whereclause = ((claims_tbl.c.brid.in_(batch))
                             & (claims_tbl.c.objectid == _master_objectid))
-                    conn.execute(q)
+                    q = sa.select([ claims_tbl.c.brid ],
+                            whereclause=whereclause)
+                    unclaimed = [ row.brid for row in conn.execute(q) ]
+                    conn.execute(claims_tbl.delete(whereclause))
+                    self._journalUnclaims(conn, unclaimed, _reactor)
                 except:
                     transaction.rollback()
                     raise
@@ -247,13 +383,30 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
             claims_tbl = self.db.model.buildrequest_claims
             old_epoch = _reactor.seconds() - old
 
-            # select any expired requests, and delete each one individually
-            expired_brids = sa.select([ reqs_tbl.c.id ],
+            # select any expired requests, then delete their claims
+            transaction = conn.begin()
+            incomplete_brids = sa.select([ reqs_tbl.c.id ],
                         whereclause=(reqs_tbl.c.complete != 1))
-            res = conn.execute(claims_tbl.delete(
-                        (claims_tbl.c.claimed_at < old_epoch) &
-                        claims_tbl.c.brid.in_(expired_brids)))
-            return res.rowcount
+            q = sa.select([ claims_tbl.c.brid ],
+                        whereclause=((claims_tbl.c.claimed_at < old_epoch) &
+                                     claims_tbl.c.brid.in_(incomplete_brids)))
+            expired = [ row.brid for row in conn.execute(q) ]
+
+            # delete the claims in batches of 100, so that the parameter lists
+            # supported by the DBAPI aren't exhausted
+            count = 0
+            iterator = iter(expired)
+            while 1:
+                batch = list(itertools.islice(iterator, 100))
+                if not batch:
+                    break
+                res = conn.execute(claims_tbl.delete(
+                            (claims_tbl.c.claimed_at < old_epoch) &
+                            claims_tbl.c.brid.in_(batch)))
+                count += res.rowcount
+                self._journalUnclaims(conn, batch, _reactor)
+            transaction.commit()
+            return count
         d = self.db.pool.do(thd)
         def log_nonzero_count(count):
             if count != 0:
@@ -262,6 +415,16 @@ class BuildRequestsConnectorComponent(base.DBConnectorComponent):
         d.addCallback(log_nonzero_count)
         return d
 
+    def _journalUnclaims(self, conn, brids, _reactor):
+        # record the unclaimed requests, so that other masters polling with
+        # getBuildRequestUnclaimsSince will find them
+        if not brids:
+            return
+        tbl = self.db.model.buildrequest_unclaims
+        unclaimed_at = _reactor.seconds()
+        conn.execute(tbl.insert(), [ dict(brid=brid, unclaimed_at=unclaimed_at)
+                                     for brid in brids ])
+
     def _brdictFromRow(self, row, master_objectid):
         claimed = mine = False
         claimed_at = None
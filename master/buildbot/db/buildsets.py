@@ -172,20 +172,40 @@ class BuildsetsConnectorComponent(base.DBConnectorComponent):
         @returns: dictionary mapping property name to (value, source), via
         Deferred
         """
+        d = self.getBuildsetsProperties([ buildsetid ])
+        d.addCallback(lambda props : props[buildsetid])
+        return d
+
+    def getBuildsetsProperties(self, buildsetids):
+        """
+        Return the properties for several buildsets, as for
+        L{getBuildsetProperties}, fetched together.
+
+        @param buildsetids: buildset IDs
+
+        @returns: dictionary mapping buildset ID to a dictionary of
+        properties, via Deferred
+        """
         def thd(conn):
             bsp_tbl = self.db.model.buildset_properties
-            q = sa.select(
-                [ bsp_tbl.c.property_name, bsp_tbl.c.property_value ],
-                whereclause=(bsp_tbl.c.buildsetid == buildsetid))
-            l = []
-            for row in conn.execute(q):
-                try:
-                    properties = json.loads(row.property_value)
-                    l.append((row.property_name,
-                           tuple(properties)))
-                except ValueError:
-                    pass
-            return dict(l)
+            props = dict([ (bsid, {}) for bsid in buildsetids ])
+            # we'll need to batch the bsids into groups of 100, so that the
+            # parameter lists supported by the DBAPI aren't exhausted
+            remaining = props.keys()
+            while remaining:
+                batch, remaining = remaining[:100], remaining[100:]
+                q = sa.select(
+                    [ bsp_tbl.c.buildsetid, bsp_tbl.c.property_name,
+                      bsp_tbl.c.property_value ],
+                    whereclause=bsp_tbl.c.buildsetid.in_(batch))
+                for row in conn.execute(q):
+                    try:
+                        properties = json.loads(row.property_value)
+                        props[row.buildsetid][row.property_name] = \
+                                tuple(properties)
+                    except ValueError:
+                        pass
+            return props
         return self.db.pool.do(thd)
 
     def _row2dict(self, row):
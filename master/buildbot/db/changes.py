@@ -29,6 +29,11 @@ class ChDict(dict):
 class ChangesConnectorComponent(base.DBConnectorComponent):
     # Documentation is in developer/database.rst
 
+    # the latest changeid is where polling starts, so it must not be stale
+    primaryMethods = ('getLatestChangeid',)
+
+    backgroundMethods = ('pruneChanges',)
+
     def addChange(self, author=None, files=None, comments=None, is_dir=0,
             revision=None, when_timestamp=None, branch=None,
             category=None, revlink='', properties={}, repository='', codebase='',
@@ -137,24 +142,64 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
         d = self.db.pool.do(thd)
         return d
 
+    def getChanges(self, changeids):
+        # changes in the chdicts cache are taken from there, and the rest are
+        # fetched together and added to it
+        cache = self.getChange.cache
+        by_changeid = dict([ (changeid, cache.peek(changeid))
+                             for changeid in set(changeids) ])
+        missing = [ changeid for changeid, chdict in by_changeid.iteritems()
+                    if chdict is None ]
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            rows = []
+            # we'll need to batch the changeids into groups of 100, so that
+            # the parameter lists supported by the DBAPI aren't exhausted
+            remaining = missing
+            while remaining:
+                batch, remaining = remaining[:100], remaining[100:]
+                q = changes_tbl.select(
+                        whereclause=changes_tbl.c.changeid.in_(batch))
+                rows.extend(conn.execute(q).fetchall())
+            return self._chdicts_from_change_rows_thd(conn, rows)
+        if missing:
+            d = self.db.pool.do(thd)
+        else:
+            d = defer.succeed([])
+        def cache_chdicts(chdicts):
+            for chdict in chdicts:
+                cache.add(chdict['changeid'], chdict)
+                by_changeid[chdict['changeid']] = chdict
+            return [ by_changeid.get(changeid) for changeid in changeids ]
+        d.addCallback(cache_chdicts)
+        return d
+
     def getRecentChanges(self, count):
         def thd(conn):
-            # get the changeids from the 'changes' table
             changes_tbl = self.db.model.changes
-            q = sa.select([changes_tbl.c.changeid],
+            q = sa.select([ changes_tbl.c.changeid ],
                     order_by=[sa.desc(changes_tbl.c.changeid)],
                     limit=count)
-            rp = conn.execute(q)
-            changeids = [ row.changeid for row in rp ]
-            rp.close()
-            return list(reversed(changeids))
+            changeids = [ row.changeid for row in conn.execute(q) ]
+            changeids.reverse()
+            return changeids
         d = self.db.pool.do(thd)
+        d.addCallback(self.getChanges)
+        # skip any changes pruned in the meantime
+        d.addCallback(lambda chdicts :
+                [ chdict for chdict in chdicts if chdict is not None ])
+        return d
 
-        # then turn those into changes, using the cache
-        def get_changes(changeids):
-            return defer.gatherResults([ self.getChange(changeid)
-                                         for changeid in changeids ])
-        d.addCallback(get_changes)
+    def getChangesSince(self, changeid, limit=None):
+        def thd(conn):
+            changes_tbl = self.db.model.changes
+            q = changes_tbl.select(
+                    whereclause=(changes_tbl.c.changeid > changeid),
+                    order_by=[changes_tbl.c.changeid],
+                    limit=limit)
+            rows = conn.execute(q).fetchall()
+            return self._chdicts_from_change_rows_thd(conn, rows)
+        d = self.db.pool.do(thd)
         return d
 
     def getLatestChangeid(self):
@@ -206,30 +251,35 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
     def _chdict_from_change_row_thd(self, conn, ch_row):
         # This method must be run in a db.pool thread, and returns a chdict
         # given a row from the 'changes' table
+        return self._chdicts_from_change_rows_thd(conn, [ ch_row ])[0]
+
+    def _chdicts_from_change_rows_thd(self, conn, ch_rows):
+        # This method must be run in a db.pool thread, and returns a list of
+        # chdicts given rows from the 'changes' table; the files and
+        # properties of all of the changes are fetched together
         change_files_tbl = self.db.model.change_files
         change_properties_tbl = self.db.model.change_properties
 
-        chdict = ChDict(
-                changeid=ch_row.changeid,
-                author=ch_row.author,
-                files=[], # see below
-                comments=ch_row.comments,
-                is_dir=ch_row.is_dir,
-                revision=ch_row.revision,
-                when_timestamp=epoch2datetime(ch_row.when_timestamp),
-                branch=ch_row.branch,
-                category=ch_row.category,
-                revlink=ch_row.revlink,
-                properties={}, # see below
-                repository=ch_row.repository,
-                codebase=ch_row.codebase,
-                project=ch_row.project)
-
-        query = change_files_tbl.select(
-                whereclause=(change_files_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            chdict['files'].append(r.filename)
+        chdicts = []
+        by_changeid = {}
+        for ch_row in ch_rows:
+            chdict = ChDict(
+                    changeid=ch_row.changeid,
+                    author=ch_row.author,
+                    files=[], # see below
+                    comments=ch_row.comments,
+                    is_dir=ch_row.is_dir,
+                    revision=ch_row.revision,
+                    when_timestamp=epoch2datetime(ch_row.when_timestamp),
+                    branch=ch_row.branch,
+                    category=ch_row.category,
+                    revlink=ch_row.revlink,
+                    properties={}, # see below
+                    repository=ch_row.repository,
+                    codebase=ch_row.codebase,
+                    project=ch_row.project)
+            chdicts.append(chdict)
+            by_changeid[ch_row.changeid] = chdict
 
         # and properties must be given without a source, so strip that, but
         # be flexible in case users have used a development version where the
@@ -243,14 +293,33 @@ class ChangesConnectorComponent(base.DBConnectorComponent):
                 v,s = vs, "Change"
             return v, s
 
-        query = change_properties_tbl.select(
-                whereclause=(change_properties_tbl.c.changeid == ch_row.changeid))
-        rows = conn.execute(query)
-        for r in rows:
-            try:
-                v, s = split_vs(json.loads(r.property_value))
-                chdict['properties'][r.property_name] = (v,s)
-            except ValueError:
-                pass
+        # we'll need to batch the changeids into groups of 100, so that the
+        # parameter lists supported by the DBAPI aren't exhausted
+        changeids = by_changeid.keys()
+        while changeids:
+            batch, changeids = changeids[:100], changeids[100:]
+
+            if len(batch) == 1:
+                whereclause = (change_files_tbl.c.changeid == batch[0])
+            else:
+                whereclause = change_files_tbl.c.changeid.in_(batch)
+            query = change_files_tbl.select(whereclause=whereclause)
+            rows = conn.execute(query)
+            for r in rows:
+                by_changeid[r.changeid]['files'].append(r.filename)
+
+            if len(batch) == 1:
+                whereclause = (change_properties_tbl.c.changeid == batch[0])
+            else:
+                whereclause = change_properties_tbl.c.changeid.in_(batch)
+            query = change_properties_tbl.select(whereclause=whereclause)
+            rows = conn.execute(query)
+            for r in rows:
+                try:
+                    v, s = split_vs(json.loads(r.property_value))
+                    by_changeid[r.changeid]['properties'][r.property_name] = \
+                            (v,s)
+                except ValueError:
+                    pass
 
-        return chdict
+        return chdicts
@@ -57,6 +57,7 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         # not configured yet - we don't build an engine until the first
         # reconfig
         self.configured_url = None
+        self.configured_replica_url = None
 
         # set up components
         self._engine = None # set up in reconfigService
@@ -87,6 +88,24 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
         self._engine = enginestrategy.create_engine(db_url,
                                 basedir=self.basedir)
         self.pool = pool.DBThreadPool(self._engine, verbose=verbose)
+        self.pool.slow_query_threshold = \
+                self.master.config.db['db_slow_query_threshold']
+        self.pool.setLaneReservations(
+                self.master.config.db['db_lane_reservations'])
+
+        # send reads to the replica, if there is one
+        replica_url = self.configured_replica_url = \
+                self.master.config.db['db_replica_url']
+        if replica_url:
+            log.msg("Reading from database replica with URL %r"
+                    % (replica_url,))
+            replica_engine = enginestrategy.create_engine(replica_url,
+                                    basedir=self.basedir)
+            replica = pool.DBThreadPool(replica_engine, verbose=verbose)
+            replica.setLaneReservations(
+                    self.master.config.db['db_lane_reservations'])
+            self.pool.setReplica(replica,
+                    self.master.config.db['db_replica_max_lag'])
 
         # make sure the db is up to date, unless specifically asked not to
         if check_version:
@@ -106,6 +125,15 @@ class DBConnector(config.ReconfigurableServiceMixin, service.MultiService):
     def reconfigService(self, new_config):
         # double-check -- the master ensures this in config checks
         assert self.configured_url == new_config.db['db_url']
+        assert self.configured_replica_url == new_config.db['db_replica_url']
+
+        reservations = new_config.db['db_lane_reservations']
+        self.pool.setLaneReservations(reservations)
+        if self.pool.replica:
+            self.pool.max_lag = new_config.db['db_replica_max_lag']
+            self.pool.replica.setLaneReservations(reservations)
+        self.pool.slow_query_threshold = \
+                new_config.db['db_slow_query_threshold']
 
         return config.ReconfigurableServiceMixin.reconfigService(self,
                                                             new_config)
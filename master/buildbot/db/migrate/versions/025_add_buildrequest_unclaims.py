@@ -0,0 +1,39 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+
+def upgrade(migrate_engine):
+
+    metadata = sa.MetaData()
+    metadata.bind = migrate_engine
+
+    # autoload the buildrequests table, so the foreign key can refer to it
+    sa.Table('buildrequests', metadata, autoload=True)
+
+    buildrequest_unclaims = sa.Table('buildrequest_unclaims', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('brid', sa.Integer, sa.ForeignKey('buildrequests.id'),
+            nullable=False),
+        sa.Column('unclaimed_at', sa.Integer, nullable=False),
+    )
+    buildrequest_unclaims.create()
+
+    idx = sa.Index('buildrequest_unclaims_brid',
+            buildrequest_unclaims.c.brid)
+    idx.create()
+    idx = sa.Index('buildrequest_unclaims_unclaimed_at',
+            buildrequest_unclaims.c.unclaimed_at)
+    idx.create()
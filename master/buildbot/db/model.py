@@ -85,6 +85,16 @@ class Model(base.DBConnectorComponent):
         sa.Column('claimed_at', sa.Integer, nullable=False),
     )
 
+    # Each row in this table records that the claim on a build request was
+    # removed, so that masters can find requests that have become unclaimed
+    # without scanning all of the unclaimed requests.  Old rows are pruned.
+    buildrequest_unclaims = sa.Table('buildrequest_unclaims', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('brid', sa.Integer, sa.ForeignKey('buildrequests.id'),
+            nullable=False),
+        sa.Column('unclaimed_at', sa.Integer, nullable=False),
+    )
+
     # builds
 
     # This table contains basic information about each build.  Note that most
@@ -365,6 +375,9 @@ class Model(base.DBConnectorComponent):
     sa.Index('buildrequests_buildsetid', buildrequests.c.buildsetid)
     sa.Index('buildrequests_buildername', buildrequests.c.buildername)
     sa.Index('buildrequests_complete', buildrequests.c.complete)
+    sa.Index('buildrequest_unclaims_brid', buildrequest_unclaims.c.brid)
+    sa.Index('buildrequest_unclaims_unclaimed_at',
+            buildrequest_unclaims.c.unclaimed_at)
     sa.Index('builds_number', builds.c.number)
     sa.Index('builds_brid', builds.c.brid)
     sa.Index('buildsets_complete', buildsets.c.complete)
@@ -13,16 +13,20 @@
 #
 # Copyright Buildbot Team Members
 
+from __future__ import with_statement
+
 import time
 import traceback
 import inspect
 import shutil
 import os
+import threading
 import sqlalchemy as sa
 import tempfile
+from collections import deque
 from buildbot.process import metrics
 from twisted.internet import reactor, threads
-from twisted.python import threadpool, log
+from twisted.python import threadpool, log, context
 
 # set this to True for *very* verbose query debugging output; this can
 # be monkey-patched from master.cfg, too:
@@ -31,6 +35,17 @@ from twisted.python import threadpool, log
 debug = False
 _debug_id = 1
 
+# context key under which connector component methods give the names of their
+# component and method, and whether they only read from the database; see
+# DBConnectorComponent
+ROUTE = 'buildbot.db.pool.route'
+
+# context key giving the lane in which calls to DBThreadPool.do are queued
+LANE = 'buildbot.db.pool.lane'
+
+# the lanes of a DBThreadPool's queue, highest priority first
+LANES = ('critical', 'normal', 'background')
+
 def timed_do_fn(f):
     """Decorate a do function to log before, after, and elapsed time,
     with the name of the calling function.  This is not speedy!"""
@@ -78,10 +93,85 @@ def timed_do_fn(f):
     wrap.__doc__ = f.__doc__
     return wrap
 
+class LaneQueue(object):
+    """
+    The work queue of a L{DBThreadPool}, with a FIFO queue for each of
+    L{LANES}.  Threads take work from the highest-priority lane first.  Each
+    lane may have threads reserved for it and the lanes above it: work from
+    lower lanes does not start unless enough threads are left for those
+    reservations, although every lane may use at least one thread.
+
+    Work is given a lane by the L{LANE} key of the context in which it is
+    queued, defaulting to C{'normal'}.
+    """
+
+    def __init__(self, maxthreads, reservations={}):
+        self.cond = threading.Condition()
+        self.queues = dict([ (lane, deque()) for lane in LANES ])
+        self.stops = 0
+        self.running = set()
+        self.setLimits(maxthreads, reservations)
+
+    def setLimits(self, maxthreads, reservations):
+        # find the number of busy threads at which each lane must wait
+        with self.cond:
+            self.limits = {}
+            reserved = 0
+            for lane in LANES:
+                self.limits[lane] = max(1, maxthreads - reserved)
+                reserved += reservations.get(lane, 0)
+            self.cond.notifyAll()
+
+    def put(self, item):
+        with self.cond:
+            if item is threadpool.WorkerStop:
+                self.stops += 1
+            else:
+                lane = item[0].get(LANE)
+                self.queues.get(lane, self.queues['normal']).append(item)
+            self.cond.notifyAll()
+
+    def get(self):
+        # the calling thread has finished any work it took before
+        thread = threading.currentThread()
+        with self.cond:
+            self.running.discard(thread)
+            while True:
+                if self.stops:
+                    self.stops -= 1
+                    return threadpool.WorkerStop
+                busy = len(self.running)
+                for lane in LANES:
+                    if self.queues[lane] and busy < self.limits[lane]:
+                        self.running.add(thread)
+                        return self.queues[lane].popleft()
+                self.cond.wait()
+
+    def depth(self, lane):
+        return len(self.queues[lane])
+
+    def qsize(self):
+        return sum([ len(q) for q in self.queues.itervalues() ])
+
+    @property
+    def queue(self):
+        # for ThreadPool.dumpStats
+        return [ item for lane in LANES for item in self.queues[lane] ]
+
+
 class DBThreadPool(threadpool.ThreadPool):
 
     running = False
 
+    # the pool for a read replica of this pool's database, if any; see
+    # setReplica
+    replica = None
+    max_lag = 0
+
+    # queries that take longer than this many seconds to execute are logged
+    # with their SQL; None disables the log
+    slow_query_threshold = None
+
     # Some versions of SQLite incorrectly cache metadata about which tables are
     # and are not present on a per-connection basis.  This cache can be flushed
     # by querying the sqlite_master table.  We currently assume all versions of
@@ -112,7 +202,19 @@ class DBThreadPool(threadpool.ThreadPool):
                         minthreads=1,
                         maxthreads=pool_size,
                         name='DBThreadPool')
+        self.q = LaneQueue(self.max)
         self.engine = engine
+        # the time the last write finished, and the number of writes that
+        # have not finished yet, for routing reads to the replica
+        self._lastWrite = 0
+        self._writesInFlight = 0
+
+        # collect the SQL executed by each call to do(), for the slow-query
+        # log; the list for the current call is kept in a thread-local
+        self._local = threading.local()
+        if hasattr(sa, 'event'): # SQLAlchemy-0.7 and up
+            sa.event.listen(engine, 'before_cursor_execute',
+                            self._recordStatement)
         if engine.dialect.name == 'sqlite':
             vers = self.get_sqlite_version()
             if vers < (3,7):
@@ -158,6 +260,45 @@ class DBThreadPool(threadpool.ThreadPool):
             return # pool is already stopped
         reactor.removeSystemEventTrigger(self._stop_evt)
         self._stop()
+        if self.replica:
+            self.replica.shutdown()
+
+    def setReplica(self, replica, max_lag):
+        """
+        Send the reads made by connector components to the pool C{replica},
+        except that all reads are sent to this pool while any component is
+        writing and for C{max_lag} seconds after the write finishes, so that they see the write as long as the
+        replica is no more than C{max_lag} seconds behind.  A write by one
+        component often changes the tables read by others (adding a buildset
+        adds build requests, for example), so the writes are not tracked per
+        component.  Calls to L{do} from outside the connector components are
+        sent to this pool, but do not count as writes.
+        """
+        self.replica = replica
+        self.max_lag = max_lag
+
+    def setLaneReservations(self, reservations):
+        """
+        Reserve threads for the higher-priority lanes of the pool's queue.
+        C{reservations} gives the number of threads reserved for each lane,
+        which calls in lower lanes cannot use.
+        """
+        self.q.setLimits(self.max, reservations)
+
+    def _route(self, route):
+        # choose the pool for a call to do(), counting the writes in flight;
+        # _writeDone notes when they finish
+        if route is None:
+            return self
+        if not route[2]:
+            self._writesInFlight += 1
+            return self
+        if self._writesInFlight or \
+                time.time() - self._lastWrite < self.max_lag:
+            metrics.MetricCountEvent.log('DBThreadPool.primary-reads', 1)
+            return self
+        metrics.MetricCountEvent.log('DBThreadPool.replica-reads', 1)
+        return self.replica
 
     # Try about 170 times over the space of a day, with the last few tries
     # being about an hour apart.  This is designed to span a reasonable amount
@@ -216,9 +357,78 @@ class DBThreadPool(threadpool.ThreadPool):
             break
         return rv
 
+    def __timed_thd(self, times, statements, callable, args, kwargs):
+        # run __thd, noting when it starts and finishes, and the statements it
+        # executes if statements is a list
+        times.append(time.time())
+        self._local.statements = statements
+        try:
+            return self.__thd(False, callable, args, kwargs)
+        finally:
+            self._local.statements = None
+            times.append(time.time())
+
+    def _recordStatement(self, conn, cursor, statement, parameters, context,
+                         executemany):
+        statements = getattr(self._local, 'statements', None)
+        if statements is not None:
+            statements.append(statement)
+
+    def _writeDone(self, res, times):
+        # a write is only visible to the replica once it has committed, so
+        # the replica's lag is measured from when it finished
+        self._writesInFlight -= 1
+        self._lastWrite = max(self._lastWrite, times[-1])
+        return res
+
+    def _queryDone(self, res, pool, lane, route, times, statements):
+        # record the time the query spent waiting for a thread, and executing
+        metrics.MetricCountEvent.log('DBThreadPool.lane.%s.queued' % lane,
+                                     pool.q.depth(lane), absolute=True)
+        if len(times) != 3:
+            return res # the query never ran
+        queued, started, finished = times
+        metrics.MetricHistogramEvent.log('DBThreadPool.lane.%s.wait' % lane,
+                                         started - queued)
+        if route is None:
+            name = 'unknown'
+        else:
+            name = '%s.%s' % route[:2]
+        metrics.MetricHistogramEvent.log('DBThreadPool.wait.' + name,
+                                         started - queued)
+        metrics.MetricHistogramEvent.log('DBThreadPool.execute.' + name,
+                                         finished - started)
+        threshold = self.slow_query_threshold
+        if threshold is not None and finished - started > threshold:
+            metrics.MetricCountEvent.log('DBThreadPool.slow-queries', 1)
+            log.msg("slow database query in %s: %.3fs executing after "
+                    "%.3fs waiting for a thread:\n  %s"
+                    % (name, finished - started, started - queued,
+                       "\n  ".join(statements or [ '(SQL not available)' ])))
+        return res
+
     def do(self, callable, *args, **kwargs):
-        return threads.deferToThreadPool(reactor, self,
-                self.__thd, False, callable, args, kwargs)
+        route = context.get(ROUTE)
+        lane = context.get(LANE)
+        if lane not in LANES:
+            lane = 'normal'
+        pool = self
+        writing = False
+        if self.replica:
+            pool = self._route(route)
+            writing = route is not None and not route[2]
+        times = [ time.time() ]
+        statements = None
+        if self.slow_query_threshold is not None:
+            statements = []
+        d = threads.deferToThreadPool(reactor, pool, pool.__timed_thd,
+                times, statements, callable, args, kwargs)
+        metrics.MetricCountEvent.log('DBThreadPool.lane.%s.queued' % lane,
+                                     pool.q.depth(lane), absolute=True)
+        if writing:
+            d.addBoth(self._writeDone, times)
+        d.addBoth(self._queryDone, pool, lane, route, times, statements)
+        return d
 
     def do_with_engine(self, callable, *args, **kwargs):
         return threads.deferToThreadPool(reactor, self,
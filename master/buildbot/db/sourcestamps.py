@@ -14,7 +14,6 @@
 # Copyright Buildbot Team Members
 
 import base64
-import sqlalchemy as sa
 from twisted.internet import defer
 from twisted.python import log
 from buildbot.db import base
@@ -78,23 +77,59 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
         return self.db.pool.do(thd)
 
     @base.cached("sssetdicts")
-    @defer.inlineCallbacks
     def getSourceStamps(self,sourcestampsetid):
-        def getSourceStampIds(sourcestampsetid):
-            def thd(conn):
-                tbl = self.db.model.sourcestamps
-                q = sa.select([tbl.c.id],
-                       whereclause=(tbl.c.sourcestampsetid == sourcestampsetid))
-                res = conn.execute(q)
-                return [ row.id for row in res.fetchall() ]
-            return self.db.pool.do(thd)
-        ssids = yield getSourceStampIds(sourcestampsetid)
-
-        sslist=SsList()
-        for ssid in ssids:
-            sourcestamp = yield self.getSourceStamp(ssid)
-            sslist.append(sourcestamp)
-        defer.returnValue(sslist)
+        d = self._fetchSourceStampsForSets([ sourcestampsetid ])
+        d.addCallback(lambda sslists : sslists[sourcestampsetid])
+        return d
+
+    def getSourceStampsForSets(self, sourcestampsetids):
+        # sets in the sssetdicts cache are taken from there, and the rest are
+        # fetched together and added to it
+        cache = self.getSourceStamps.cache
+        sslists = dict([ (setid, cache.peek(setid))
+                         for setid in sourcestampsetids ])
+        missing = [ setid for setid, sslist in sslists.iteritems()
+                    if sslist is None ]
+        if missing:
+            d = self._fetchSourceStampsForSets(missing)
+        else:
+            d = defer.succeed({})
+        def cache_sslists(fetched):
+            for setid, sslist in fetched.iteritems():
+                cache.add(setid, sslist)
+                sslists[setid] = sslist
+            return sslists
+        d.addCallback(cache_sslists)
+        return d
+
+    def _fetchSourceStampsForSets(self, sourcestampsetids):
+        # fetch the sourcestamps of the given sets, adding each to the ssdicts
+        # cache
+        def thd(conn):
+            tbl = self.db.model.sourcestamps
+            sslists = dict([ (setid, SsList())
+                             for setid in sourcestampsetids ])
+            rows = []
+            # we'll need to batch the setids into groups of 100, so that the
+            # parameter lists supported by the DBAPI aren't exhausted
+            remaining = sslists.keys()
+            while remaining:
+                batch, remaining = remaining[:100], remaining[100:]
+                q = tbl.select(whereclause=tbl.c.sourcestampsetid.in_(batch))
+                rows.extend(conn.execute(q).fetchall())
+            rows.sort(key=lambda row : row.id)
+            for ssdict in self._ssdicts_from_rows_thd(conn, rows):
+                sslists[ssdict['sourcestampsetid']].append(ssdict)
+            return sslists
+        d = self.db.pool.do(thd)
+        def cache_ssdicts(sslists):
+            cache = self.getSourceStamp.cache
+            for sslist in sslists.itervalues():
+                for ssdict in sslist:
+                    cache.add(ssdict['ssid'], ssdict)
+            return sslists
+        d.addCallback(cache_ssdicts)
+        return d
 
     @base.cached("ssdicts")
     def getSourceStamp(self, ssid):
@@ -105,41 +140,60 @@ class SourceStampsConnectorComponent(base.DBConnectorComponent):
             row = res.fetchone()
             if not row:
                 return None
-            ssdict = SsDict(ssid=ssid, branch=row.branch, sourcestampsetid=row.sourcestampsetid,
+            res.close()
+            return self._ssdicts_from_rows_thd(conn, [ row ])[0]
+        return self.db.pool.do(thd)
+
+    def _ssdicts_from_rows_thd(self, conn, rows):
+        # This method must be run in a db.pool thread, and returns a list of
+        # ssdicts given rows from the 'sourcestamps' table; the patches and
+        # change ids of all of the sourcestamps are fetched together
+        ssdicts = []
+        by_ssid = {}
+        by_patchid = {}
+        for row in rows:
+            ssdict = SsDict(ssid=row.id, branch=row.branch,
+                    sourcestampsetid=row.sourcestampsetid,
                     revision=row.revision, patch_body=None, patch_level=None,
                     patch_author=None, patch_comment=None, patch_subdir=None,
                     repository=row.repository, codebase=row.codebase,
                     project=row.project,
                     changeids=set([]))
-            patchid = row.patchid
-            res.close()
-
-            # fetch the patch, if necessary
-            if patchid is not None:
-                tbl = self.db.model.patches
-                q = tbl.select(whereclause=(tbl.c.id == patchid))
-                res = conn.execute(q)
-                row = res.fetchone()
-                if row:
+            ssdicts.append(ssdict)
+            by_ssid[row.id] = ssdict
+            if row.patchid is not None:
+                by_patchid.setdefault(row.patchid, []).append(ssdict)
+
+        # we'll need to batch the ids into groups of 100, so that the
+        # parameter lists supported by the DBAPI aren't exhausted
+
+        # fetch the patches, if necessary
+        tbl = self.db.model.patches
+        remaining = by_patchid.keys()
+        while remaining:
+            batch, remaining = remaining[:100], remaining[100:]
+            q = tbl.select(whereclause=tbl.c.id.in_(batch))
+            for row in conn.execute(q):
+                body = base64.b64decode(row.patch_base64)
+                for ssdict in by_patchid.pop(row.id):
                     # note the subtle renaming here
                     ssdict['patch_level'] = row.patchlevel
                     ssdict['patch_subdir'] = row.subdir
                     ssdict['patch_author'] = row.patch_author
                     ssdict['patch_comment'] = row.patch_comment
-                    body = base64.b64decode(row.patch_base64)
                     ssdict['patch_body'] = body
-                else:
-                    log.msg('patchid %d, referenced from ssid %d, not found'
-                            % (patchid, ssid))
-                res.close()
-
-            # fetch change ids
-            tbl = self.db.model.sourcestamp_changes
-            q = tbl.select(whereclause=(tbl.c.sourcestampid == ssid))
-            res = conn.execute(q)
-            for row in res:
-                ssdict['changeids'].add(row.changeid)
-            res.close()
-
-            return ssdict
-        return self.db.pool.do(thd)
+        for patchid, missing in by_patchid.iteritems():
+            for ssdict in missing:
+                log.msg('patchid %d, referenced from ssid %d, not found'
+                        % (patchid, ssdict['ssid']))
+
+        # fetch change ids
+        tbl = self.db.model.sourcestamp_changes
+        remaining = by_ssid.keys()
+        while remaining:
+            batch, remaining = remaining[:100], remaining[100:]
+            q = tbl.select(whereclause=tbl.c.sourcestampid.in_(batch))
+            for row in conn.execute(q):
+                by_ssid[row.sourcestampid]['changeids'].add(row.changeid)
+
+        return ssdicts
@@ -27,6 +27,11 @@ class ObjDict(dict):
 class StateConnectorComponent(base.DBConnectorComponent):
     # Documentation is in developer/database.rst
 
+    # getObjectId inserts the object if it is not found
+    primaryMethods = ('getObjectId',)
+
+    backgroundMethods = ('setState',)
+
     def getObjectId(self, name, class_name):
         # defer to a cached method that only takes one parameter (a tuple)
         return self._getObjectId((name, class_name)
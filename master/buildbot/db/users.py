@@ -205,6 +205,7 @@ class UsersConnectorComponent(base.DBConnectorComponent):
 
             transaction.commit()
         d = self.db.pool.do(thd)
+        d.addCallback(self._invalidateUser, uid)
         return d
 
     def removeUser(self, uid):
@@ -217,6 +218,13 @@ class UsersConnectorComponent(base.DBConnectorComponent):
                     ]:
                 conn.execute(tbl.delete(whereclause=(tbl.c.uid==uid)))
         d = self.db.pool.do(thd)
+        d.addCallback(self._invalidateUser, uid)
+        return d
+
+    def _invalidateUser(self, res, uid):
+        # drop the cached usdict, here and in any shared cache
+        d = self.db.master.caches.invalidate("usdicts", uid)
+        d.addCallback(lambda _ : res)
         return d
 
     def identifierToUid(self, identifier):
@@ -315,11 +315,15 @@ class IBuilderStatus(Interface):
         """Return a list of ISlaveStatus objects for the buildslaves that are
         used by this builder."""
 
-    def getPendingBuildRequestStatuses():
+    def getPendingBuildRequestStatuses(preload=False):
         """
         Get a L{IBuildRequestStatus} implementations for all unclaimed build
         requests.
 
+        @param preload: if true, load the build requests' source stamps and
+        properties for all of the requests at once, for callers that will
+        examine each of them
+
         @returns: list of objects via Deferred
         """
 
@@ -346,6 +350,11 @@ class IBuilderStatus(Interface):
         longer available. Older builds are likely to have less information
         stored: Logs are the first to go, then Steps."""
 
+    def getBuildAsync(number):
+        """Like getBuild, but return a Deferred firing with the
+        IBuildStatus object.  Builds that are not in memory are loaded from
+        disk in a thread, rather than blocking the reactor."""
+
     def getEvent(number):
         """Return an IStatusEvent object for a recent Event. Builders
         connecting and disconnecting are events, as are ping attempts.
@@ -391,9 +400,19 @@ class IBuilderStatus(Interface):
                            to find some that match the search parameters,
                            especially if there aren't any matching builds.
                            This argument imposes a hard limit on the number
-                           of builds that will be examined.
+                           of builds that will be examined.  Builds which
+                           the builder's build summaries show do not match
+                           are skipped without being examined.
         """
 
+    def generateFinishedBuildsAsync(branches=[],
+                                    num_builds=None,
+                                    max_buildnum=None, finished_before=None,
+                                    max_search=200,
+                                    ):
+        """Like generateFinishedBuilds, but return a Deferred firing with a
+        list of the builds, which are loaded as by getBuildAsync."""
+
     def subscribe(receiver):
         """Register an IStatusReceiver to receive new status events. The
         receiver will be given builderChangedState, buildStarted, and
@@ -491,6 +510,9 @@ class IBuildStatus(Interface):
         """Convenience method. Returns None if the previous build is
         unavailable."""
 
+    def getPreviousBuildAsync():
+        """Like getPreviousBuild, but returns a Deferred."""
+
     def getSteps():
         """Return a list of IBuildStepStatus objects. For invariant builds
         (those which always use the same set of Steps), this should always
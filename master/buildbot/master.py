@@ -25,6 +25,7 @@ from twisted.application import service
 
 import buildbot
 import buildbot.pbmanager
+from buildbot import util
 from buildbot.util import subscription, epoch2datetime
 from buildbot.status.master import Status
 from buildbot.changes import changes
@@ -66,6 +67,18 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
     # database poll operation.
     WARNING_UNCLAIMED_COUNT = 10000
 
+    # age in seconds at which entries in the journal of unclaimed build
+    # requests are pruned; this must be much longer than the polling interval
+    UNCLAIM_JOURNAL_AGE = 60*60
+
+    # time in seconds for which a missing buildrequest id is looked for
+    # again, in case its transaction has not yet committed
+    MISSING_BUILDREQUEST_TIMEOUT = 5*60
+
+    # number of changes fetched from the database at a time when polling for
+    # new changes
+    CHANGE_POLL_PAGE_SIZE = 100
+
     def __init__(self, basedir, configFileName="master.cfg", umask=None):
         service.MultiService.__init__(self)
         self.setName("buildmaster")
@@ -81,8 +94,13 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
 
         # loop for polling the db
         self.db_loop = None
+        self._pollChanges = util.SerializedInvocation(
+                lambda : self.pollDatabaseChanges())
+        # transport for notifications from other masters
+        self.notifications = None
         # db configured values
         self.configured_db_url = None
+        self.configured_db_replica_url = None
         self.configured_poll_interval = None
 
         # configuration / reconfiguration handling
@@ -105,6 +123,10 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         self._complete_buildset_subs = \
                 subscription.SubscriptionPoint("buildset_completion")
 
+        # ids of new build requests that have been delivered from a
+        # notification, so the database poll need not deliver them again
+        self._notified_brids = set()
+
         # local cache for this master's object ID
         self._object_id = None
 
@@ -300,10 +322,17 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
     def reconfigService(self, new_config):
         if self.configured_db_url is None:
             self.configured_db_url = new_config.db['db_url']
+            self.configured_db_replica_url = new_config.db['db_replica_url']
         elif (self.configured_db_url != new_config.db['db_url']):
             config.error(
                 "Cannot change c['db']['db_url'] after the master has started",
             )
+        elif (self.configured_db_replica_url
+                != new_config.db['db_replica_url']):
+            config.error(
+                "Cannot change c['db']['db_replica_url'] after the master "
+                "has started",
+            )
 
         # adjust the db poller
         if (self.configured_poll_interval
@@ -316,8 +345,24 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
                 self.db_loop = task.LoopingCall(self.pollDatabase)
                 self.db_loop.start(self.configured_poll_interval, now=False)
 
-        return config.ReconfigurableServiceMixin.reconfigService(self,
-                                            new_config)
+        # adjust the notification transport
+        d = defer.succeed(None)
+        if self.notifications != new_config.notifications:
+            old_transport = self.notifications
+            self.notifications = new_config.notifications
+            if old_transport is not None:
+                old_transport.master = None
+                d.addCallback(lambda _ :
+                        defer.maybeDeferred(old_transport.disownServiceParent))
+            if self.notifications is not None:
+                self.notifications.master = self
+                d.addCallback(lambda _ :
+                        self.notifications.setServiceParent(self))
+
+        d.addCallback(lambda _ :
+            config.ReconfigurableServiceMixin.reconfigService(self,
+                                            new_config))
+        return d
 
 
     ## informational methods
@@ -502,6 +547,11 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
             # only deliver messages immediately if we're not polling
             if not self.config.db['db_poll_interval']:
                 self._change_subs.deliver(change)
+            elif self.notifications is not None:
+                # tell the other masters, and poll for the change here,
+                # rather than waiting for the next poll
+                self.notifications.send('change', changeid=change.number)
+                self._pollChanges()
             return change
         d.addCallback(notify)
         return d
@@ -528,11 +578,17 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
             log.msg("added buildset %d to database" % bsid)
             # note that buildset additions are only reported on this master
             self._new_buildset_subs.deliver(bsid=bsid, **kwargs)
-            # only deliver messages immediately if we're not polling
-            if not self.config.db['db_poll_interval']:
+            # only deliver messages immediately if we're not polling, or
+            # if the other masters can be told about them
+            if (not self.config.db['db_poll_interval']
+                    or self.notifications is not None):
                 for bn, brid in brids.iteritems():
                     self.buildRequestAdded(bsid=bsid, brid=brid,
                                            buildername=bn)
+                    if self.notifications is not None:
+                        self._buildRequestNotified(brid)
+                        self.notifications.send('buildrequest', bsid=bsid,
+                                                brid=brid, buildername=bn)
             return (bsid,brids)
         d.addCallback(notify)
         return d
@@ -593,7 +649,7 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         return self._complete_buildset_subs.subscribe(callback)
 
-    def buildRequestAdded(self, bsid, brid, buildername):
+    def buildRequestAdded(self, bsid, brid, buildername, submitted_at=None):
         """
         Notifies the master that a build request is available to be claimed;
         this may be a brand new build request, or a build request that was
@@ -602,15 +658,20 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         @param bsid: containing buildset id
         @param brid: buildrequest ID
         @param buildername: builder named by the build request
+        @param submitted_at: time the request was submitted, if known; it is
+        always given for requests that may have been unclaimed
         """
-        self._new_buildrequest_subs.deliver(
-                dict(bsid=bsid, brid=brid, buildername=buildername))
+        notif = dict(bsid=bsid, brid=brid, buildername=buildername)
+        if submitted_at is not None:
+            notif['submitted_at'] = submitted_at
+        self._new_buildrequest_subs.deliver(notif)
 
     def subscribeToBuildRequests(self, callback):
         """
         Request that C{callback} be invoked with a dictionary with keys C{brid}
-        (the build request id), C{bsid} (buildset id) and C{buildername}
-        whenever a new build request is added to the database.  Note that, due
+        (the build request id), C{bsid} (buildset id), C{buildername} and, if
+        known, C{submitted_at} whenever a new build request is added to the
+        database.  Note that, due
         to the delayed nature of subscriptions, the build request may already
         be claimed by the time C{callback} is invoked.
 
@@ -619,6 +680,31 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         return self._new_buildrequest_subs.subscribe(callback)
 
 
+    ## notifications from other masters
+
+    def notificationReceived(self, kind, msg):
+        """
+        Called by the notification transport with each message received from
+        another master.
+
+        @param kind: the kind of notification: C{'change'} or
+        C{'buildrequest'}
+        @param msg: dictionary of the notification's details
+        """
+        if kind == 'change':
+            # poll, rather than delivering the change directly, so that
+            # changes are delivered once, in order
+            self._pollChanges()
+        elif kind == 'buildrequest':
+            self._buildRequestNotified(msg['brid'])
+            self.buildRequestAdded(msg['bsid'], msg['brid'],
+                                   msg['buildername'])
+
+    def _buildRequestNotified(self, brid):
+        # requests that the poll has already passed will not be seen by it
+        if self._last_seen_brid is None or brid > self._last_seen_brid:
+            self._notified_brids.add(brid)
+
     ## database polling
 
     def pollDatabase(self):
@@ -628,7 +714,7 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
         # simultaneously.  Each particular poll method handles errors itself,
         # although catastrophic errors are handled here
         d = defer.gatherResults([
-            self.pollDatabaseChanges(),
+            self._pollChanges(),
             self.pollDatabaseBuildRequests(),
             # also unclaim
         ])
@@ -672,30 +758,44 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
             timer.stop()
             return
 
+        # fetch the new changes a page at a time, writing back the state
+        # after each page, so that a large backlog of changes is neither
+        # loaded all at once nor redelivered after a restart
         while True:
-            changeid = self._last_processed_change + 1
-            chdict = yield self.db.changes.getChange(changeid)
+            chdicts = yield self.db.changes.getChangesSince(
+                    self._last_processed_change,
+                    limit=self.CHANGE_POLL_PAGE_SIZE)
 
-            # if there's no such change, we've reached the end and can
-            # stop polling
-            if not chdict:
-                break
+            complete = len(chdicts) < self.CHANGE_POLL_PAGE_SIZE
+            for chdict in chdicts:
+                # if a changeid is missing, it may belong to a transaction
+                # that has not committed yet, so stop polling there
+                if chdict['changeid'] != self._last_processed_change + 1:
+                    complete = True
+                    break
 
-            change = yield changes.Change.fromChdict(self, chdict)
+                change = yield changes.Change.fromChdict(self, chdict)
 
-            self._change_subs.deliver(change)
+                self._change_subs.deliver(change)
 
-            self._last_processed_change = changeid
-            need_setState = True
+                self._last_processed_change = chdict['changeid']
+                need_setState = True
 
-        # write back the updated state, if it's changed
-        if need_setState:
-            yield self._setState('last_processed_change',
-                            self._last_processed_change)
+            # write back the updated state, if it's changed
+            if need_setState:
+                yield self._setState('last_processed_change',
+                                self._last_processed_change)
+                need_setState = False
+
+            if complete:
+                break
         timer.stop()
 
-    _last_unclaimed_brids_set = None
+    _last_seen_brid = None
+    _last_seen_unclaimid = None
+    _missing_brids = None
     _last_claim_cleanup = 0
+    _last_unclaim_prune = 0
     @defer.inlineCallbacks
     def pollDatabaseBuildRequests(self):
         # deal with cleaning up unclaimed requests, and (if necessary)
@@ -712,35 +812,104 @@ class BuildMaster(config.ReconfigurableServiceMixin, service.MultiService):
 
             self._last_claim_cleanup = reactor.seconds()
 
-        # _last_unclaimed_brids_set tracks the state of unclaimed build
-        # requests; whenever it sees a build request which was not claimed on
-        # the last poll, it notifies the subscribers.  It only tracks that
-        # state within the master instance, though; on startup, it notifies for
+        # prune the journal of unclaimed requests
+        if (reactor.seconds() - self._last_unclaim_prune
+                >= self.RECLAIM_BUILD_INTERVAL):
+            yield self.db.buildrequests.pruneBuildRequestUnclaims(
+                                            self.UNCLAIM_JOURNAL_AGE)
+            self._last_unclaim_prune = reactor.seconds()
+
+        # Rather than fetching all of the unclaimed build requests on every
+        # poll, this looks only at the requests added since the last poll
+        # (those with larger ids) and the requests listed in the journal of
+        # unclaimed requests since the last poll.  It only tracks that state
+        # within the master instance, though; on startup, it notifies for
         # all unclaimed requests in the database.
 
-        last_unclaimed = self._last_unclaimed_brids_set or set()
-        if len(last_unclaimed) > self.WARNING_UNCLAIMED_COUNT:
-            log.msg("WARNING: %d unclaimed buildrequests - is a scheduler "
-                    "producing builds for which no builder is running?"
-                    % len(last_unclaimed))
+        if self._last_seen_brid is None:
+            yield self._pollAllBuildRequests()
+            timer.stop()
+            return
 
-        # get the current set of unclaimed buildrequests
-        now_unclaimed_brdicts = \
-            yield self.db.buildrequests.getBuildRequests(claimed=False)
-        now_unclaimed = set([ brd['brid'] for brd in now_unclaimed_brdicts ])
+        unclaims = yield self.db.buildrequests.getBuildRequestUnclaimsSince(
+                                            self._last_seen_unclaimid)
+        if unclaims:
+            self._last_seen_unclaimid = unclaims[-1][0]
+
+        # ids are assigned when a request is inserted, but the request may
+        # not be visible until some time later, when its transaction
+        # commits; so look for any missing ids again on the next poll, until
+        # they are too old to be waiting for a transaction
+        now = reactor.seconds()
+        for brid, missing_since in self._missing_brids.items():
+            if now - missing_since > self.MISSING_BUILDREQUEST_TIMEOUT:
+                del self._missing_brids[brid]
+
+        brdicts = yield self.db.buildrequests.getBuildRequestsSince(
+                self._last_seen_brid,
+                brids=set(self._missing_brids) |
+                      set([ brid for _, brid in unclaims ]))
+
+        seen = set()
+        for brd in brdicts:
+            seen.add(brd['brid'])
+            self._missing_brids.pop(brd['brid'], None)
+        if seen:
+            last_seen_brid = max(max(seen), self._last_seen_brid)
+            for brid in xrange(self._last_seen_brid + 1, last_seen_brid):
+                if brid not in seen:
+                    self._missing_brids[brid] = now
+            self._last_seen_brid = last_seen_brid
+
+        # new requests that were delivered from a notification are skipped,
+        # but those that have been unclaimed since are delivered again
+        unclaimed = set([ brid for _, brid in unclaims ])
+        for brd in brdicts:
+            if brd['brid'] in self._notified_brids:
+                self._notified_brids.discard(brd['brid'])
+                if brd['brid'] not in unclaimed:
+                    continue
+            if not brd['claimed'] and not brd['complete']:
+                self.buildRequestAdded(brd['buildsetid'], brd['brid'],
+                                       brd['buildername'], brd['submitted_at'])
+        self._forgetNotifiedBuildRequests()
+        timer.stop()
+
+    def _forgetNotifiedBuildRequests(self):
+        # forget any notified requests that the poll will not see, e.g.,
+        # because they were claimed and completed before it ran
+        self._notified_brids = set([ brid for brid in self._notified_brids
+                                     if brid > self._last_seen_brid
+                                     or brid in self._missing_brids ])
 
-        # and store that for next time
-        self._last_unclaimed_brids_set = now_unclaimed
+    @defer.inlineCallbacks
+    def _pollAllBuildRequests(self):
+        # note the latest ids before fetching the unclaimed requests, so that
+        # nothing is missed by the next poll
+        last_seen_unclaimid = \
+            yield self.db.buildrequests.getLatestBuildRequestUnclaimId()
+        last_seen_brid = yield self.db.buildrequests.getLatestBuildRequestId()
 
-        # see what's new, and notify if anything is
-        new_unclaimed = now_unclaimed - last_unclaimed
-        if new_unclaimed:
-            brdicts = dict((brd['brid'], brd) for brd in now_unclaimed_brdicts)
-            for brid in new_unclaimed:
-                brd = brdicts[brid]
+        now_unclaimed_brdicts = \
+            yield self.db.buildrequests.getBuildRequests(claimed=False)
+        if len(now_unclaimed_brdicts) > self.WARNING_UNCLAIMED_COUNT:
+            log.msg("WARNING: %d unclaimed buildrequests - is a scheduler "
+                    "producing builds for which no builder is running?"
+                    % len(now_unclaimed_brdicts))
+
+        self._last_seen_unclaimid = last_seen_unclaimid or 0
+        self._last_seen_brid = last_seen_brid or 0
+        self._missing_brids = {}
+
+        # requests added since the latest id was noted are left for the next
+        # poll
+        for brd in now_unclaimed_brdicts:
+            if brd['brid'] in self._notified_brids:
+                continue
+            if brd['brid'] <= self._last_seen_brid:
                 self.buildRequestAdded(brd['buildsetid'], brd['brid'],
-                                       brd['buildername'])
-        timer.stop()
+                                       brd['buildername'], brd['submitted_at'])
+        self._forgetNotifiedBuildRequests()
 
     ## state maintenance (private)
 
@@ -0,0 +1,280 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Transports that carry notifications between the masters of a cluster, so
+that new changes and build requests are noticed without waiting for the next
+database poll.  The database remains the source of truth: a notification
+only tells the receiving master to look, and any notifications that are lost
+are made up for by the database poll.
+"""
+
+from twisted.python import log
+from twisted.internet import reactor, protocol, endpoints
+from twisted.protocols import basic
+from twisted.application import service, strports
+from buildbot import util
+from buildbot.process import metrics
+from buildbot.util.eventual import eventually
+
+class NotificationTransport(util.ComparableMixin, service.MultiService):
+    """
+    Base class for notification transports.  Subclasses implement L{send},
+    and call L{messageReceived} for each message sent by another master.
+
+    A message is a dictionary with a C{kind} key, which must be serializable
+    as JSON.
+
+    @ivar master: the master to which received messages are given
+    """
+
+    compare_attrs = []
+
+    master = None
+
+    def __init__(self):
+        service.MultiService.__init__(self)
+        self.setName('notifications')
+
+    def send(self, kind, **kwargs):
+        """
+        Send a message of the given kind to the other masters.  Delivery is
+        not guaranteed.
+        """
+        raise NotImplementedError
+
+    def messageReceived(self, msg):
+        msg = dict(msg)
+        kind = msg.pop('kind', None)
+        metrics.MetricCountEvent.log('NotificationTransport.received', 1)
+        if self.master is not None and kind is not None:
+            try:
+                self.master.notificationReceived(kind, msg)
+            except Exception:
+                log.err(None, "while handling %s notification" % (kind,))
+
+
+class LoopbackHub(object):
+    """
+    Connects L{LoopbackTransport}s in the same process, for testing.
+    """
+
+    def __init__(self):
+        self.transports = []
+
+
+class LoopbackTransport(NotificationTransport):
+    """
+    I deliver messages to the other running transports attached to the same
+    L{LoopbackHub}, in a later reactor iteration.
+    """
+
+    compare_attrs = [ 'hub' ]
+
+    def __init__(self, hub):
+        NotificationTransport.__init__(self)
+        self.hub = hub
+
+    def startService(self):
+        NotificationTransport.startService(self)
+        self.hub.transports.append(self)
+
+    def stopService(self):
+        # transports on the same hub compare equal, so compare identities
+        self.hub.transports = [ t for t in self.hub.transports
+                                if t is not self ]
+        return NotificationTransport.stopService(self)
+
+    def send(self, kind, **kwargs):
+        msg = dict(kind=kind, **kwargs)
+        metrics.MetricCountEvent.log('NotificationTransport.sent', 1)
+        for transport in self.hub.transports:
+            if transport is not self:
+                eventually(transport.messageReceived, msg)
+
+
+class NotificationProtocol(basic.LineReceiver):
+    # messages are JSON objects, one per line
+
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.factory.protocolConnected(self)
+
+    def connectionLost(self, reason):
+        self.factory.protocolDisconnected(self)
+
+    def lineReceived(self, line):
+        try:
+            msg = util.json.loads(line)
+        except ValueError:
+            log.msg("invalid notification %r from %s"
+                    % (line, self.transport.getPeer()))
+            return
+        if isinstance(msg, dict):
+            self.factory.messageReceived(self, msg)
+
+    def sendMessage(self, msg):
+        self.sendLine(util.json.dumps(msg))
+
+
+def _secretsMatch(given, secret):
+    # compare in constant time, so that the secret cannot be guessed from
+    # how long a comparison takes
+    if not isinstance(given, basestring):
+        return False
+    if isinstance(given, unicode):
+        given = given.encode('utf-8')
+    if len(given) != len(secret):
+        return False
+    result = 0
+    for a, b in zip(given, secret):
+        result |= ord(a) ^ ord(b)
+    return result == 0
+
+
+class BrokerFactory(protocol.ServerFactory):
+    """
+    I pass each message received from a connected master on to all of the
+    other connected masters.  A master must first send a message giving the
+    shared secret; until then, its messages are not relayed, and it is sent
+    none.
+    """
+
+    protocol = NotificationProtocol
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.connections = []
+
+    def protocolConnected(self, proto):
+        pass
+
+    def protocolDisconnected(self, proto):
+        self.connections = [ p for p in self.connections if p is not proto ]
+
+    def messageReceived(self, sender, msg):
+        if sender not in self.connections:
+            if _secretsMatch(msg.get('secret'), self.secret):
+                self.connections.append(sender)
+            else:
+                log.msg("notification broker: bad secret from %s"
+                        % (sender.transport.getPeer(),))
+                sender.transport.loseConnection()
+            return
+        for proto in self.connections:
+            if proto is not sender:
+                proto.sendMessage(msg)
+
+
+class BrokerClientFactory(protocol.ClientFactory):
+
+    protocol = NotificationProtocol
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def protocolConnected(self, proto):
+        proto.sendMessage(dict(secret=self.transport.secret))
+        self.transport.connectionMade(proto)
+
+    def protocolDisconnected(self, proto):
+        self.transport.connectionLost(proto)
+
+    def messageReceived(self, proto, msg):
+        self.transport.messageReceived(msg)
+
+
+class BrokerTransport(NotificationTransport):
+    """
+    I exchange messages with the other masters through a broker, which all
+    of the masters connect to.  One of the masters also runs the broker, by
+    giving it a C{listen} port.
+
+    @param connect: client endpoint description of the broker, such as
+    C{'tcp:host=master1:port=9990'} or C{'unix:path=/var/run/bb.sock'}
+
+    @param secret: a secret shared by all of the masters; the broker ignores
+    connections that do not give it
+
+    @param listen: if given, a strports description of the port on which to
+    run the broker, such as C{'tcp:9990'} or C{'unix:/var/run/bb.sock'}
+    """
+
+    compare_attrs = [ 'connect', 'secret', 'listen' ]
+
+    # seconds to wait before reconnecting to the broker
+    retryDelay = 10
+
+    _reactor = reactor # for tests
+
+    def __init__(self, connect, secret, listen=None):
+        NotificationTransport.__init__(self)
+        self.connect = connect
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        self.listen = listen
+        self.connection = None
+        self._retry = None
+        if listen:
+            svc = strports.service(listen, BrokerFactory(secret))
+            svc.setServiceParent(self)
+
+    def startService(self):
+        NotificationTransport.startService(self)
+        self._connect()
+
+    def stopService(self):
+        if self._retry and self._retry.active():
+            self._retry.cancel()
+        self._retry = None
+        if self.connection:
+            self.connection.transport.loseConnection()
+        return NotificationTransport.stopService(self)
+
+    def _connect(self):
+        self._retry = None
+        if not self.running:
+            return
+        endpoint = endpoints.clientFromString(self._reactor, self.connect)
+        d = endpoint.connect(BrokerClientFactory(self))
+        def failed(f):
+            log.msg("could not connect to notification broker at %s: %s"
+                    % (self.connect, f.getErrorMessage()))
+            self._reconnect()
+        d.addErrback(failed)
+
+    def _reconnect(self):
+        if self.running and not self._retry:
+            self._retry = self._reactor.callLater(self.retryDelay,
+                                                  self._connect)
+
+    def connectionMade(self, proto):
+        self.connection = proto
+
+    def connectionLost(self, proto):
+        if self.connection is proto:
+            self.connection = None
+            log.msg("lost connection to notification broker at %s"
+                    % (self.connect,))
+            self._reconnect()
+
+    def send(self, kind, **kwargs):
+        if self.connection is None:
+            metrics.MetricCountEvent.log('NotificationTransport.dropped', 1)
+            return
+        metrics.MetricCountEvent.log('NotificationTransport.sent', 1)
+        self.connection.sendMessage(dict(kind=kind, **kwargs))
@@ -310,6 +310,16 @@ class BotMaster(config.ReconfigurableServiceMixin, service.MultiService):
         """
         self.brd.maybeStartBuildsOn([buildername])
 
+    def buildRequestsChanged(self, buildername):
+        """
+        Call this when a particular builder's unclaimed build requests change
+        without a notification of a new request: when one is cancelled, or
+        is unclaimed to be built again.
+
+        @param buildername: the name of the builder
+        """
+        self.brd.buildRequestsChanged(buildername)
+
     def maybeStartBuildsForSlave(self, slave_name):
         """
         Call this when something suggests that a particular slave may now be
@@ -100,7 +100,8 @@ class Builder(config.ReconfigurableServiceMixin,
         self.builder_status.setDescription(builder_config.description)
         self.builder_status.setCategory(builder_config.category)
         self.builder_status.setSlavenames(self.config.slavenames)
-        self.builder_status.setCacheSize(new_config.caches['Builds'])
+        self.builder_status.setCacheSize(new_config.caches['Builds'],
+                **new_config.cacheEviction.get('Builds', {}))
 
         return defer.succeed(None)
 
@@ -470,7 +471,10 @@ class Builder(config.ReconfigurableServiceMixin,
 
     def _resubmit_buildreqs(self, build):
         brids = [br.id for br in build.requests]
-        return self.master.db.buildrequests.unclaimBuildRequests(brids)
+        d = self.master.db.buildrequests.unclaimBuildRequests(brids)
+        d.addCallback(lambda _ :
+                self.botmaster.buildRequestsChanged(self.name))
+        return d
 
     def setExpectations(self, progress):
         """Mark the build as successful and update expectations for the next
@@ -598,11 +602,8 @@ class BuilderControl:
                 claimed=False)
 
         # convert those into BuildRequest objects
-        buildrequests = [ ]
-        for brdict in brdicts:
-            br = yield buildrequest.BuildRequest.fromBrdict(
-                    self.control.master, brdict)
-            buildrequests.append(br)
+        buildrequests = yield buildrequest.BuildRequest.fromBrdicts(
+                self.control.master, brdicts)
 
         # and return the corresponding control objects
         defer.returnValue([ buildrequest.BuildRequestControl(self.original, r)
@@ -92,7 +92,54 @@ class BuildRequest(object):
 
     @classmethod
     @defer.inlineCallbacks
-    def _make_br(cls, brid, brdict, master):
+    def fromBrdicts(cls, master, brdicts):
+        """
+        Construct new L{BuildRequest}s from a list of dictionaries, as
+        L{fromBrdict} does.  The buildset properties, sourcestamps and changes
+        for all of the requests are loaded from the database together, rather
+        than request by request.
+
+        @param master: current build master
+        @param brdicts: build request dictionaries
+
+        @returns: list of L{BuildRequest}s, in the same order, via Deferred
+        """
+        if not brdicts:
+            defer.returnValue([])
+            return
+
+        bsids = sorted(set([ brdict['buildsetid'] for brdict in brdicts ]))
+        buildsets = yield defer.gatherResults([
+                master.db.buildsets.getBuildset(bsid) for bsid in bsids ])
+        buildsets = dict(zip(bsids, buildsets))
+        buildset_properties = \
+            yield master.db.buildsets.getBuildsetsProperties(bsids)
+
+        setids = set([ bs['sourcestampsetid'] for bs in buildsets.values() ])
+        sslists = yield master.db.sourcestamps.getSourceStampsForSets(setids)
+
+        changeids = set()
+        for sslist in sslists.values():
+            for ssdict in sslist:
+                changeids.update(ssdict['changeids'])
+        chdicts = yield master.db.changes.getChanges(sorted(changeids))
+        chdicts = dict([ (chdict['changeid'], chdict)
+                         for chdict in chdicts if chdict ])
+
+        preloaded = dict(buildsets=buildsets,
+                buildset_properties=buildset_properties,
+                sslists=sslists, chdicts=chdicts)
+        cache = master.caches.get_cache("BuildRequests", cls._make_br)
+        breqs = yield defer.gatherResults([
+                cache.get(brdict['brid'], brdict=brdict, master=master,
+                          _preloaded=preloaded)
+                for brdict in brdicts ])
+        defer.returnValue(breqs)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _make_br(cls, brid, brdict, master, _preloaded=None):
+        # _preloaded, if given, holds the data loaded by fromBrdicts
         buildrequest = cls()
         buildrequest.id = brid
         buildrequest.bsid = brdict['buildsetid']
@@ -103,17 +150,31 @@ class BuildRequest(object):
         buildrequest.master = master
 
         # fetch the buildset to get the reason
-        buildset = yield master.db.buildsets.getBuildset(brdict['buildsetid'])
+        if _preloaded:
+            buildset = _preloaded['buildsets'][brdict['buildsetid']]
+        else:
+            buildset = yield master.db.buildsets.getBuildset(
+                                                    brdict['buildsetid'])
         assert buildset # schema should guarantee this
         buildrequest.reason = buildset['reason']
 
         # fetch the buildset properties, and convert to Properties
-        buildset_properties = yield master.db.buildsets.getBuildsetProperties(brdict['buildsetid'])
+        if _preloaded:
+            buildset_properties = \
+                _preloaded['buildset_properties'][brdict['buildsetid']]
+        else:
+            buildset_properties = yield \
+                master.db.buildsets.getBuildsetProperties(brdict['buildsetid'])
 
         buildrequest.properties = properties.Properties.fromDict(buildset_properties)
 
         # fetch the sourcestamp dictionary
-        sslist = yield  master.db.sourcestamps.getSourceStamps(buildset['sourcestampsetid'])
+        if _preloaded:
+            sslist = _preloaded['sslists'][buildset['sourcestampsetid']]
+            chdicts = _preloaded['chdicts']
+        else:
+            sslist = yield  master.db.sourcestamps.getSourceStamps(buildset['sourcestampsetid'])
+            chdicts = None
         assert len(sslist) > 0, "Empty sourcestampset: db schema enforces set to exist but cannot enforce a non empty set"
 
         # and turn it into a SourceStamps
@@ -123,7 +184,8 @@ class BuildRequest(object):
 
         dlist = []
         for ssdict in sslist:
-            d = sourcestamp.SourceStamp.fromSsdict(master, ssdict)
+            d = sourcestamp.SourceStamp.fromSsdict(master, ssdict,
+                                                   _chdicts=chdicts)
             d.addCallback(store_source)
             dlist.append(d)
 
@@ -230,6 +292,7 @@ class BuildRequest(object):
         # references.
         yield self.master.db.buildrequests.completeBuildRequests([self.id],
                                                                 FAILURE)
+        self.master.botmaster.buildRequestsChanged(self.buildername)
 
         # and let the master know that the enclosing buildset may be complete
         yield self.master.maybeBuildsetComplete(self.bsid)
@@ -19,12 +19,152 @@ from twisted.python.failure import Failure
 from twisted.internet import defer
 from twisted.application import service
 
+from buildbot import util
 from buildbot.process import metrics
 from buildbot.process.buildrequest import BuildRequest
-from buildbot.db.buildrequests import AlreadyClaimedError
+from buildbot.process.builder import Builder
+from buildbot.util.eventual import eventually
 
 import random
 
+class BuildRequestQueue(object):
+    """
+    I track the unclaimed build requests for a builder, grouped by the
+    attributes that decide whether the default C{mergeRequests} function can
+    merge them: the codebase, repository, branch and project of each of the
+    request's sourcestamps.  Requests in different groups are never merged,
+    so a merge only needs L{BuildRequest} objects for one group.
+
+    I outlive the build choosers, so each request's group is looked up once,
+    when the request is first seen.  The unclaimed requests are fetched from
+    the database once, and then kept up to date as requests are added and
+    claimed; they are fetched again only after L{invalidate}.
+    """
+
+    def __init__(self, master, buildername):
+        self.master = master
+        self.buildername = buildername
+        self.loaded = False # true if brdicts holds the unclaimed requests
+        self.brdicts = {}   # brid -> brdict
+        self.added = set()  # brids added since brdicts was loaded
+        self.keys = {}      # brid -> merge key
+        self.groups = {}    # merge key -> set of brids
+        self.bsKeys = {}    # buildsetid -> merge key
+
+    @defer.inlineCallbacks
+    def getUnclaimedBrdicts(self):
+        """
+        Return (via Deferred) a new list of the builder's unclaimed brdicts,
+        oldest first.
+        """
+        if not self.loaded:
+            self.loaded = True
+            self.added.clear()
+            brdicts = yield self.master.db.buildrequests.getBuildRequests(
+                        buildername=self.buildername, claimed=False)
+            if not self.loaded:
+                # invalidated while loading; the next caller loads again
+                defer.returnValue(self._sorted(brdicts))
+                return
+            self.update(brdicts)
+        if self.added:
+            added, self.added = self.added, set()
+            brdicts = yield defer.gatherResults([
+                    self.master.db.buildrequests.getBuildRequest(brid)
+                    for brid in added ])
+            for brd in brdicts:
+                if brd and not brd['claimed'] and not brd['complete']:
+                    self.brdicts[brd['brid']] = brd
+        defer.returnValue(self._sorted(self.brdicts.values()))
+
+    def add(self, brid):
+        # the request is fetched when the requests are next needed
+        if self.loaded:
+            self.added.add(brid)
+
+    def invalidate(self):
+        self.loaded = False
+        self.added.clear()
+
+    def _sorted(self, brdicts):
+        # sort by submitted_at, so the first is the oldest
+        return sorted(brdicts, key=lambda brd : (brd['submitted_at'],
+                                                 brd['brid']))
+
+    def update(self, brdicts):
+        # forget the requests that are no longer unclaimed
+        self.brdicts = dict([ (brd['brid'], brd) for brd in brdicts ])
+        brids = set(self.brdicts)
+        for brid in self.keys.keys():
+            if brid not in brids:
+                self._forget(brid)
+        bsids = set([ brd['buildsetid'] for brd in brdicts ])
+        for bsid in self.bsKeys.keys():
+            if bsid not in bsids:
+                del self.bsKeys[bsid]
+
+    def remove(self, brid):
+        self.brdicts.pop(brid, None)
+        self.added.discard(brid)
+        if brid in self.keys:
+            self._forget(brid)
+
+    def getOldestSubmitTime(self):
+        if not self.brdicts:
+            return None
+        return min([ brd['submitted_at'] for brd in self.brdicts.itervalues() ])
+
+    @defer.inlineCallbacks
+    def getMergeCandidates(self, breq, brdicts):
+        """
+        Return the brdicts in C{brdicts} that are in the same group as
+        C{breq}, in the same order.
+        """
+        key = yield self._getKey(breq.id, breq.bsid)
+        for brd in [ brd for brd in brdicts if brd['brid'] not in self.keys ]:
+            yield self._getKey(brd['brid'], brd['buildsetid'])
+        group = self.groups.get(key, ())
+        defer.returnValue([ brd for brd in brdicts if brd['brid'] in group ])
+
+    @defer.inlineCallbacks
+    def _getKey(self, brid, bsid):
+        if brid in self.keys:
+            defer.returnValue(self.keys[brid])
+            return
+        key = self.bsKeys.get(bsid)
+        if key is None:
+            key = yield self._getBuildsetKey(bsid)
+            self.bsKeys[bsid] = key
+        # another lookup may have added this request in the meantime
+        if brid not in self.keys:
+            self.keys[brid] = key
+            self.groups.setdefault(key, set()).add(brid)
+        defer.returnValue(key)
+
+    @defer.inlineCallbacks
+    def _getBuildsetKey(self, bsid):
+        buildset = yield self.master.db.buildsets.getBuildset(bsid)
+        if not buildset:
+            defer.returnValue(('buildset', bsid))
+            return
+        sslist = yield self.master.db.sourcestamps.getSourceStamps(
+                                            buildset['sourcestampsetid'])
+        if [ ssdict for ssdict in sslist if ssdict['patch_body'] ]:
+            # patched sourcestamps only merge with themselves
+            defer.returnValue(('patch', buildset['sourcestampsetid']))
+            return
+        defer.returnValue(tuple(sorted([ (ssdict['codebase'],
+                    ssdict['repository'], ssdict['branch'], ssdict['project'])
+                    for ssdict in sslist ])))
+
+    def _forget(self, brid):
+        key = self.keys.pop(brid)
+        group = self.groups[key]
+        group.discard(brid)
+        if not group:
+            del self.groups[key]
+
+
 class BuildChooserBase(object):
     #
     # WARNING: This API is experimental and in active development.
@@ -44,11 +184,14 @@ class BuildChooserBase(object):
     #   * bc.mergeRequests(breq) - perform a merge for this breq and return
     #       the list of breqs consumed by the merge (including breq itself)
 
-    def __init__(self, bldr, master):
+    def __init__(self, bldr, master, queue=None):
         self.bldr = bldr
         self.master = master
         self.breqCache = {}
         self.unclaimedBrdicts = None
+        if queue is None:
+            queue = BuildRequestQueue(master, bldr.name)
+        self.queue = queue
 
     @defer.inlineCallbacks
     def chooseNextBuild(self):
@@ -90,11 +233,8 @@ class BuildChooserBase(object):
         # the self.unclaimedBrdicts to None before calling."""
 
         if self.unclaimedBrdicts is None:
-            brdicts = yield self.master.db.buildrequests.getBuildRequests(
-                        buildername=self.bldr.name, claimed=False)
-            # sort by submitted_at, so the first is the oldest
-            brdicts.sort(key=lambda brd : brd['submitted_at'])
-            self.unclaimedBrdicts = brdicts
+            # sorted by submitted_at, so the first is the oldest
+            self.unclaimedBrdicts = yield self.queue.getUnclaimedBrdicts()
         defer.returnValue(self.unclaimedBrdicts)
 
     @defer.inlineCallbacks
@@ -136,11 +276,25 @@ class BuildChooserBase(object):
         if breq.id in self.breqCache:
             del self.breqCache[breq.id]
 
-    def _getUnclaimedBuildRequests(self):
-        # Retrieve the list of BuildRequest objects for all unclaimed builds
-        return defer.gatherResults([
+    def _getUnclaimedBuildRequests(self, brdicts=None):
+        # Retrieve the list of BuildRequest objects for all unclaimed builds,
+        # or for the given brdicts
+        if brdicts is None:
+            brdicts = self.unclaimedBrdicts
+
+        # load the requests that aren't cached yet all at once
+        uncached = [ brdict for brdict in brdicts
+                     if brdict['brid'] not in self.breqCache ]
+        d = BuildRequest.fromBrdicts(self.master, uncached)
+        def cache_breqs(breqs):
+            for brdict, breq in zip(uncached, breqs):
+                if breq:
+                    self.breqCache[brdict['brid']] = breq
+        d.addCallback(cache_breqs)
+        d.addCallback(lambda _ : defer.gatherResults([
             self._getBuildRequestForBrdict(brdict)
-              for brdict in self.unclaimedBrdicts ])
+              for brdict in brdicts ]))
+        return d
 
 class BasicBuildChooser(BuildChooserBase):
     # BasicBuildChooser generates build pairs via the configuration points:
@@ -165,8 +319,8 @@ class BasicBuildChooser(BuildChooserBase):
     # to None, the behavior will instead refuse to ever assign to a slave that
     # fails the generic test.
 
-    def __init__(self, bldr, master):
-        BuildChooserBase.__init__(self, bldr, master)
+    def __init__(self, bldr, master, queue=None):
+        BuildChooserBase.__init__(self, bldr, master, queue)
 
         self.nextSlave = self.bldr.config.nextSlave
         if not self.nextSlave:
@@ -184,6 +338,9 @@ class BasicBuildChooser(BuildChooserBase):
         self.nextBuild = self.bldr.config.nextBuild
 
         self.mergeRequestsFn = self.bldr.getMergeRequestsFn()
+        # the default function only merges requests in the same queue group
+        self.mergeByGroup = \
+                self.mergeRequestsFn == Builder._defaultMergeRequestFn
 
     @defer.inlineCallbacks
     def popNextBuild(self):
@@ -234,8 +391,12 @@ class BasicBuildChooser(BuildChooserBase):
             defer.returnValue(mergedRequests)
             return
 
-        # we'll need BuildRequest objects, so get those first
-        unclaimedBreqs = yield self._getUnclaimedBuildRequests()
+        # we'll need BuildRequest objects, so get those first; if only the
+        # requests in breq's group can be merged, don't bother with the rest
+        brdicts = self.unclaimedBrdicts
+        if self.mergeByGroup:
+            brdicts = yield self.queue.getMergeCandidates(breq, brdicts)
+        unclaimedBreqs = yield self._getUnclaimedBuildRequests(brdicts)
 
         # gather the mergeable requests
         for req in unclaimedBreqs:
@@ -327,10 +488,18 @@ class BuildRequestDistributor(service.Service):
     are still working on the previous build request, then this class will
     correctly re-prioritize invocations of builders' C{maybeStartBuild}
     methods.
+
+    Up to C{maxParallelBuilders} builders are worked on at once, so a builder
+    that is slow to start its builds (e.g., while a latent slave substantiates)
+    does not hold up the others.  Builders that share a slave are never worked
+    on at the same time, and a builder is never passed over for a lower-priority
+    builder that shares one of its slaves.
     """
 
     BuildChooser = BasicBuildChooser
 
+    maxParallelBuilders = 4
+
     def __init__(self, botmaster):
         self.botmaster = botmaster
         self.master = botmaster.master
@@ -346,13 +515,54 @@ class BuildRequestDistributor(service.Service):
 
         self._pendingMSBOCalls = []
 
+        # time at which each pending builder was added
+        self._pendingSince = {}
+
+        # slave names of each builder being worked on, and the Deferreds for
+        # that work; the activity loop waits on _wakeup for that work to
+        # finish or for new builders to be added
+        self._activeBuilders = {}
+        self._activeCalls = []
+        self._wakeup = None
+
+        # claims waiting to be made, as (brids, Deferred); the claims of all
+        # builders being worked on are made together, one batch at a time
+        self._pendingClaims = []
+        self._claiming = False
+
+        # BuildRequestQueue for each builder, kept between build choosers
+        self._queues = {}
+
+        # submitted_at of the oldest unclaimed request for each builder (None
+        # if it has no requests), kept up to date as requests are added and
+        # claimed, so that the default sorter need not query the database;
+        # builders not in this dictionary must be looked up.  Other masters
+        # claim requests without telling us, so with multiMaster the times
+        # are looked up again on each pass.
+        self._oldestRequestTimes = {}
+        self.buildrequest_sub = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self.buildrequest_sub = \
+            self.master.subscribeToBuildRequests(self._buildRequestAdded)
+
     @defer.inlineCallbacks
     def stopService(self):
+        if self.buildrequest_sub:
+            self.buildrequest_sub.unsubscribe()
+            self.buildrequest_sub = None
+
         # Lots of stuff happens asynchronously here, so we need to let it all
         # quiesce.  First, let the parent stopService succeed between
         # activities; then the loop will stop calling itself, since
         # self.running is false.
         yield self.activity_lock.run(service.Service.stopService, self)
+        self._wake()
+
+        # let the builders that are being worked on finish
+        if self._activeCalls:
+            yield defer.DeferredList(self._activeCalls)
 
         # now let any outstanding calls to maybeStartBuildsOn to finish, so
         # they don't get interrupted in mid-stride.  This tends to be
@@ -396,15 +606,27 @@ class BuildRequestDistributor(service.Service):
                 # while acquiring the lock
                 existing_pending = set(self._pending_builders)
 
+                now = util.now()
+                for name in new_builders:
+                    self._pendingSince.setdefault(name, now)
+
+                if self.master.config.multiMaster:
+                    self._oldestRequestTimes.clear()
+
                 # then sort the new, expanded set of builders
                 self._pending_builders = \
                     yield self._sortBuilders(
                             list(existing_pending | new_builders))
+                metrics.MetricCountEvent.log(
+                        'BuildRequestDistributor.pending_builders',
+                        len(self._pending_builders), absolute=True)
 
                 # start the activity loop, if we aren't already
                 # working on that.
                 if not self.active:
                     self._activityLoop()
+                else:
+                    self._wake()
             except Exception:
                 log.err(Failure(),
                         "while attempting to start builds on %s" % self.name)
@@ -412,20 +634,53 @@ class BuildRequestDistributor(service.Service):
         return self.pending_builders_lock.run(
                 resetPendingBuildersList, new_builders)
 
+    def _buildRequestAdded(self, notif):
+        # a request can only make a builder's oldest request older if it was
+        # submitted earlier, i.e., it was unclaimed after a timeout; those are
+        # found by polling, which gives their submitted_at.  Notifications
+        # without it are for brand new requests.
+        buildername = notif['buildername']
+        queue = self._queues.get(buildername)
+        if queue is not None:
+            queue.add(notif['brid'])
+        if buildername not in self._oldestRequestTimes:
+            return
+        oldest = self._oldestRequestTimes[buildername]
+        if oldest is None:
+            # the new request is the oldest
+            del self._oldestRequestTimes[buildername]
+            return
+        submitted_at = notif.get('submitted_at')
+        if submitted_at is not None and submitted_at < oldest:
+            self._oldestRequestTimes[buildername] = submitted_at
+
+    def buildRequestsChanged(self, buildername):
+        # forget the builder's unclaimed requests and oldest request time,
+        # which may now be wrong; they are looked up again when next needed
+        self._oldestRequestTimes.pop(buildername, None)
+        queue = self._queues.get(buildername)
+        if queue is not None:
+            queue.invalidate()
+
     @defer.inlineCallbacks
     def _defaultSorter(self, master, builders):
         timer = metrics.Timer("BuildRequestDistributor._defaultSorter()")
         timer.start()
-        # perform an asynchronous schwarzian transform, transforming None
-        # into sys.maxint so that it sorts to the end
-        def xform(bldr):
+        # look up the oldest request time of any builders we know nothing
+        # about yet; the rest are kept up to date as requests come and go
+        def lookup(bldr):
             d = defer.maybeDeferred(lambda :
                     bldr.getOldestRequestTime())
-            d.addCallback(lambda time :
-                (((time is None) and None or time),bldr))
+            @d.addCallback
+            def store(time):
+                self._oldestRequestTimes[bldr.name] = time
             return d
-        xformed = yield defer.gatherResults(
-                [ xform(bldr) for bldr in builders ])
+        yield defer.gatherResults([ lookup(bldr) for bldr in builders
+                        if bldr.name not in self._oldestRequestTimes ])
+
+        # perform a schwarzian transform, comparing None to the end of the list
+        xformed = [ (self._oldestRequestTimes.get(bldr.name), bldr)
+                    for bldr in builders ]
 
         # sort the transformed list synchronously, comparing None to the end of
         # the list
@@ -483,36 +738,101 @@ class BuildRequestDistributor(service.Service):
             yield self.pending_builders_lock.acquire()
 
             # bail out if we shouldn't keep looping
-            if not self.running or not self._pending_builders:
+            if not self.running or \
+                    not (self._pending_builders or self._activeBuilders):
                 self.pending_builders_lock.release()
                 self.activity_lock.release()
                 break
 
-            bldr_name = self._pending_builders.pop(0)
+            bldr_name = self._popNextBuilder()
+            wakeup = None
+            if bldr_name is None:
+                # wait until a builder is finished or new builders are added
+                wakeup = self._wakeup = defer.Deferred()
             self.pending_builders_lock.release()
 
-            # get the actual builder object
-            bldr = self.botmaster.builders.get(bldr_name)
-            try:
-                if bldr:
-                    yield self._maybeStartBuildsOnBuilder(bldr)
-            except Exception:
-                log.err(Failure(),
-                        "from maybeStartBuild for builder '%s'" % (bldr_name,))
+            if bldr_name is not None:
+                self._startBuilder(bldr_name)
 
             self.activity_lock.release()
 
+            if wakeup:
+                yield wakeup
+
         timer.stop()
 
         self.active = False
         self._quiet()
 
+    def _popNextBuilder(self):
+        # pop the first pending builder that can be worked on now, or return
+        # None; the slaves of the builders being worked on are off limits, as
+        # are those of the pending builders that are passed over
+        if len(self._activeBuilders) >= self.maxParallelBuilders:
+            return None
+        busy = set()
+        for slavenames in self._activeBuilders.itervalues():
+            busy.update(slavenames)
+        for i, bldr_name in enumerate(self._pending_builders):
+            bldr = self.botmaster.builders.get(bldr_name)
+            slavenames = bldr and set(bldr.config.slavenames) or set()
+            if bldr_name not in self._activeBuilders and not (busy & slavenames):
+                del self._pending_builders[i]
+                metrics.MetricCountEvent.log(
+                        'BuildRequestDistributor.pending_builders',
+                        len(self._pending_builders), absolute=True)
+                return bldr_name
+            busy.update(slavenames)
+        return None
+
+    def _startBuilder(self, bldr_name):
+        # get the actual builder object
+        bldr = self.botmaster.builders.get(bldr_name)
+        since = self._pendingSince.pop(bldr_name, None)
+        if not bldr:
+            self._queues.pop(bldr_name, None)
+            self._oldestRequestTimes.pop(bldr_name, None)
+            return
+
+        start = util.now()
+        if since is not None:
+            metrics.MetricTimeEvent.log(
+                    'BuildRequestDistributor.%s.wait' % bldr_name,
+                    start - since)
+
+        self._activeBuilders[bldr_name] = set(bldr.config.slavenames)
+        metrics.MetricCountEvent.log('BuildRequestDistributor.active_builders',
+                len(self._activeBuilders), absolute=True)
+
+        d = defer.maybeDeferred(self._maybeStartBuildsOnBuilder, bldr)
+        self._activeCalls.append(d)
+        d.addErrback(log.err,
+                "from maybeStartBuild for builder '%s'" % (bldr_name,))
+        @d.addCallback
+        def done(_):
+            del self._activeBuilders[bldr_name]
+            self._activeCalls.remove(d)
+            metrics.MetricCountEvent.log(
+                    'BuildRequestDistributor.active_builders',
+                    len(self._activeBuilders), absolute=True)
+            metrics.MetricTimeEvent.log(
+                    'BuildRequestDistributor.%s.time' % bldr_name,
+                    util.now() - start)
+            self._wake()
+
+    def _wake(self):
+        # wake up the activity loop, if it is waiting
+        if self._wakeup:
+            d, self._wakeup = self._wakeup, None
+            d.callback(None)
+
     @defer.inlineCallbacks
     def _maybeStartBuildsOnBuilder(self, bldr):
         # create a chooser to give us our next builds
         # this object is temporary and will go away when we're done
 
         bc = self.createBuildChooser(bldr, self.master)
+        unclaimed = False
 
         while 1:
             slave, breqs = yield bc.chooseNextBuild()
@@ -521,25 +841,100 @@ class BuildRequestDistributor(service.Service):
 
             # claim brid's
             brids = [ br.id for br in breqs ]
-            try:
-                yield self.master.db.buildrequests.claimBuildRequests(brids)
-            except AlreadyClaimedError:
-                # some brids were already claimed, so start over
+            claimed = yield self._claimBuildRequests(brids)
+            for brid in brids:
+                if brid not in claimed:
+                    bc.queue.remove(brid) # claimed elsewhere
+            if breqs[0].id not in claimed:
+                # the chosen request was claimed elsewhere, so give back any
+                # requests merged with it, and start over
+                if claimed:
+                    yield self.master.db.buildrequests.unclaimBuildRequests(
+                                                                    claimed)
                 bc = self.createBuildChooser(bldr, self.master)
                 continue
 
+            # requests merged with it that were claimed elsewhere are simply
+            # left out of the build
+            brids = claimed
+            breqs = [ br for br in breqs if br.id in claimed ]
+            for brid in brids:
+                bc.queue.remove(brid)
+
             buildStarted = yield bldr.maybeStartBuild(slave, breqs)
 
             if not buildStarted:
                 yield self.master.db.buildrequests.unclaimBuildRequests(brids)
+                for brid in brids:
+                    bc.queue.add(brid)
+                unclaimed = True
 
                 # and try starting builds again.  If we still have a working slave,
                 # then this may re-claim the same buildrequests
                 self.botmaster.maybeStartBuildsForBuilder(self.name)
 
+        # if the chooser fetched the builder's requests, its queue now holds
+        # those that are still unclaimed, unless some were handed back
+        if unclaimed:
+            self._oldestRequestTimes.pop(bldr.name, None)
+        elif bc.unclaimedBrdicts is not None:
+            self._oldestRequestTimes[bldr.name] = \
+                    bc.queue.getOldestSubmitTime()
+
+    def _claimBuildRequests(self, brids):
+        # claim as many of brids as possible, along with the requests chosen
+        # by the other builders being worked on, and return (via Deferred)
+        # the list of claimed brids
+        d = defer.Deferred()
+        self._pendingClaims.append((brids, d))
+        if not self._claiming:
+            self._claiming = True
+            if len(self._activeBuilders) > 1:
+                # give the other builders a chance to add their claims
+                eventually(self._makeClaims)
+            else:
+                self._makeClaims()
+        return d
+
+    @defer.inlineCallbacks
+    def _makeClaims(self):
+        while self._pendingClaims:
+            pending, self._pendingClaims = self._pendingClaims, []
+            brids = [ brid for claim, _ in pending for brid in claim ]
+            try:
+                claimed = yield \
+                    self.master.db.buildrequests.tryClaimBuildRequests(brids)
+            except Exception:
+                f = Failure()
+                for _, d in pending:
+                    d.errback(f)
+                continue
+
+            metrics.MetricCountEvent.log('BuildRequestDistributor.claimed',
+                    len(claimed))
+            if len(claimed) < len(brids):
+                metrics.MetricCountEvent.log(
+                        'BuildRequestDistributor.claim_conflicts',
+                        len(brids) - len(claimed))
+            claimed = set(claimed)
+            for claim, d in pending:
+                d.callback([ brid for brid in claim if brid in claimed ])
+        self._claiming = False
+
     def createBuildChooser(self, bldr, master):
-        # just instantiate the build chooser requested
-        return self.BuildChooser(bldr, master)
+        # just instantiate the build chooser requested, and hand it the
+        # builder's queue afterward, so that choosers taking only (bldr,
+        # master) still work
+        queue = self._queues.get(bldr.name)
+        if queue is None:
+            queue = self._queues[bldr.name] = BuildRequestQueue(master,
+                                                                bldr.name)
+        elif self.master.config.multiMaster:
+            # other masters claim requests without telling us
+            queue.invalidate()
+        bc = self.BuildChooser(bldr, master)
+        bc.queue = queue
+        return bc
 
     def _quiet(self):
         # shim for tests
@@ -13,15 +13,63 @@
 #
 # Copyright Buildbot Team Members
 
+from twisted.python import log
+from twisted.internet import defer
 from buildbot.util import lru
 from buildbot import config
 from twisted.application import service
 
-class CacheManager(config.ReconfigurableServiceMixin, service.Service):
+class SharedTier(object):
+    """
+    The second tier of a shared cache: a miss function for the cache's
+    L{AsyncLRUCache} that looks in the configured shared cache store before
+    calling the cache's own miss function, and stores what that returns for
+    the other masters.
+    """
+
+    def __init__(self, manager, cache_name, miss_fn):
+        self.manager = manager
+        self.cache_name = cache_name
+        self.miss_fn = miss_fn
+        self.hits = self.misses = 0
+
+    @defer.inlineCallbacks
+    def __call__(self, key, **miss_fn_kwargs):
+        store = self.manager.shared_cache
+        if store is None:
+            result = yield self.miss_fn(key, **miss_fn_kwargs)
+            defer.returnValue(result)
+            return
+
+        version = value = None
+        try:
+            version, value = yield store.lookup(self.cache_name, key)
+        except Exception:
+            log.err(None, "while looking up %r in shared cache %s"
+                          % (key, self.cache_name))
+        if value is not None:
+            self.hits += 1
+            defer.returnValue(value)
+            return
+
+        self.misses += 1
+        result = yield self.miss_fn(key, **miss_fn_kwargs)
+        if result is not None and version is not None:
+            d = store.store(self.cache_name, key, version, result)
+            d.addErrback(log.err, "while storing %r in shared cache %s"
+                                  % (key, self.cache_name))
+        defer.returnValue(result)
+
+
+class CacheManager(config.ReconfigurableServiceMixin, service.MultiService):
     """
     A manager for a collection of caches, each for different types of objects
     and with potentially-overlapping key spaces.
 
+    Caches of plain, picklable values can also be shared with the other
+    masters, through the shared cache store configured in
+    C{c['sharedCache']}.
+
     There is generally only one instance of this class, available at
     C{master.caches}.
     """
@@ -32,11 +80,15 @@ class CacheManager(config.ReconfigurableServiceMixin, service.Service):
     DEFAULT_CACHE_SIZE = 1
 
     def __init__(self):
+        service.MultiService.__init__(self)
         self.setName('caches')
         self.config = {}
+        self.eviction = {}
         self._caches = {}
+        self._tiers = {}
+        self.shared_cache = None
 
-    def get_cache(self, cache_name, miss_fn):
+    def get_cache(self, cache_name, miss_fn, shared=False, sizeof=None):
         """
         Get an L{AsyncLRUCache} object with the given name.  If such an object
         does not exist, it will be created.  Since the cache is permanent, this
@@ -47,6 +99,10 @@ class CacheManager(config.ReconfigurableServiceMixin, service.Service):
         object it stores)
         @param miss_fn: miss function for the cache; see L{AsyncLRUCache}
         constructor.
+        @param shared: if true, the cache's values may be shared with other
+        masters, so they must be picklable and must not refer to this master
+        @param sizeof: function estimating the size of a value in bytes, for
+        caches limited in bytes; defaults to L{lru.estimateSize}
         @returns: L{AsyncLRUCache} instance
         """
         try:
@@ -54,20 +110,70 @@ class CacheManager(config.ReconfigurableServiceMixin, service.Service):
         except KeyError:
             max_size = self.config.get(cache_name, self.DEFAULT_CACHE_SIZE)
             assert max_size >= 1
-            c = self._caches[cache_name] = lru.AsyncLRUCache(miss_fn, max_size)
+            if shared:
+                miss_fn = self._tiers[cache_name] = \
+                        SharedTier(self, cache_name, miss_fn)
+            c = self._caches[cache_name] = lru.AsyncLRUCache(miss_fn, max_size,
+                                        sizeof=sizeof or lru.estimateSize,
+                                        **self.eviction.get(cache_name, {}))
             return c
 
+    def invalidate(self, cache_name, key):
+        """
+        Invalidate a cached value, here and in the shared cache store, after
+        the object has been changed in the database.
+
+        @returns: Deferred
+        """
+        if cache_name in self._caches:
+            self._caches[cache_name].remove(key)
+        if cache_name in self._tiers and self.shared_cache is not None:
+            d = self.shared_cache.invalidate(cache_name, key)
+            d.addErrback(log.err, "while invalidating %r in shared cache %s"
+                                  % (key, cache_name))
+            return d
+        return defer.succeed(None)
+
     def reconfigService(self, new_config):
         self.config = new_config.caches
+        self.eviction = new_config.cacheEviction
         for name, cache in self._caches.iteritems():
             cache.set_max_size(new_config.caches.get(name,
                                                 self.DEFAULT_CACHE_SIZE))
+            cache.set_eviction(**self.eviction.get(name, {}))
+
+        # adjust the shared cache store
+        d = defer.succeed(None)
+        if self.shared_cache != new_config.sharedCache:
+            old_store = self.shared_cache
+            self.shared_cache = new_config.sharedCache
+            if old_store is not None:
+                d.addCallback(lambda _ :
+                        defer.maybeDeferred(old_store.disownServiceParent))
+            if self.shared_cache is not None:
+                d.addCallback(lambda _ :
+                        self.shared_cache.setServiceParent(self))
 
-        return config.ReconfigurableServiceMixin.reconfigService(self,
-                                                            new_config)
+        d.addCallback(lambda _ :
+            config.ReconfigurableServiceMixin.reconfigService(self,
+                                                            new_config))
+        return d
 
     def get_metrics(self):
-        return dict([
-            (n, dict(hits=c.hits, refhits=c.refhits,
-                     misses=c.misses, max_size=c.max_size))
-            for n, c in self._caches.iteritems()])
+        def rate(hits, misses):
+            if hits + misses:
+                return float(hits) / (hits + misses)
+            return 0.0
+        metrics = {}
+        for n, c in self._caches.iteritems():
+            m = metrics[n] = dict(hits=c.hits, refhits=c.refhits,
+                     misses=c.misses, max_size=c.max_size,
+                     hit_rate=rate(c.hits, c.misses))
+            if c.max_bytes is not None:
+                m.update(dict(bytes=c.total_bytes, max_bytes=c.max_bytes))
+            tier = self._tiers.get(n)
+            if tier:
+                m.update(dict(shared_hits=tier.hits,
+                              shared_misses=tier.misses,
+                              shared_hit_rate=rate(tier.hits, tier.misses)))
+        return metrics
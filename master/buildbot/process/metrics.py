@@ -33,6 +33,7 @@ Basic architecture:
           \/
     MetricWatcher
 """
+import bisect
 from collections import deque
 
 from twisted.python import log
@@ -66,6 +67,11 @@ class MetricTimeEvent(MetricEvent):
         self.timer = timer
         self.elapsed = elapsed
 
+class MetricHistogramEvent(MetricEvent):
+    def __init__(self, histogram, value):
+        self.histogram = histogram
+        self.value = value
+
 ALARM_OK, ALARM_WARN, ALARM_CRIT = range(3)
 ALARM_TEXT = ["OK", "WARN", "CRIT"]
 
@@ -154,6 +160,45 @@ class AveragingFiniteList(FiniteList):
 
         return self.average
 
+class Histogram(object):
+    # a count of values in each of a fixed set of buckets, whose upper bounds
+    # suit timings in seconds; values above the last bound go in a final
+    # overflow bucket
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1, 2, 5, 10, 20, 50)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0
+        return float(self.total) / self.count
+
+    def percentile(self, pct):
+        # the upper bound of the bucket holding the given percentile, or the
+        # largest value if that is smaller
+        needed = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= needed:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                break
+        return self.max
+
 class MetricHandler(object):
     def __init__(self, metrics):
         self.metrics = metrics
@@ -241,6 +286,40 @@ class MetricTimeHandler(MetricHandler):
             retval[timer] = self.get(timer)
         return dict(timers=retval)
 
+class MetricHistogramHandler(MetricHandler):
+    _histograms = None
+    def reset(self):
+        self._histograms = defaultdict(Histogram)
+
+    def handle(self, eventDict, metric):
+        self._histograms[metric.histogram].add(metric.value)
+
+    def keys(self):
+        return self._histograms.keys()
+
+    def get(self, histogram):
+        return self._histograms[histogram]
+
+    def report(self):
+        retval = []
+        for name in sorted(self.keys()):
+            h = self.get(name)
+            retval.append("Histogram %s: count=%i mean=%.3g p50=%.3g "
+                          "p90=%.3g p99=%.3g max=%.3g"
+                          % (name, h.count, h.mean, h.percentile(50),
+                             h.percentile(90), h.percentile(99), h.max))
+        return "\n".join(retval)
+
+    def asDict(self):
+        retval = {}
+        for name in sorted(self.keys()):
+            h = self.get(name)
+            retval[name] = dict(count=h.count, mean=h.mean, max=h.max,
+                    p50=h.percentile(50), p90=h.percentile(90),
+                    p99=h.percentile(99),
+                    buckets=zip(h.BOUNDS + (None,), h.buckets))
+        return dict(histograms=retval)
+
 class MetricAlarmHandler(MetricHandler):
     _alarms = None
     def reset(self):
@@ -387,6 +466,8 @@ class MetricLogObserver(config.ReconfigurableServiceMixin,
         self.registerHandler(MetricCountEvent, MetricCountHandler(self))
         self.registerHandler(MetricTimeEvent, MetricTimeHandler(self))
         self.registerHandler(MetricAlarmEvent, MetricAlarmHandler(self))
+        self.registerHandler(MetricHistogramEvent,
+                             MetricHistogramHandler(self))
 
         # Make sure our changes poller is behaving
         self.getHandler(MetricTimeEvent).addWatcher(PollerWatcher(self))
@@ -0,0 +1,331 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Cache stores shared by the masters of a cluster, used as a second tier behind
+the per-master caches in L{buildbot.process.cache}, so that an object loaded
+from the database by one master need not be loaded again by the others.
+
+Each entry is stored with the version of its key.  Writers invalidate a key
+by changing its version, so an entry stored by a reader that raced with the
+write is never returned.
+"""
+
+import os
+import errno
+import hashlib
+import cPickle
+from twisted.python import log
+from twisted.internet import defer, reactor, protocol
+from twisted.protocols import memcache
+from twisted.application import service
+from buildbot import util
+
+class SharedCache(util.ComparableMixin, service.MultiService):
+    """
+    Base class for shared cache stores.  Subclasses implement the primitive
+    operations C{_getMultiple}, C{_add}, C{_set} and C{_increment}, all of
+    which take and return strings, via Deferred.
+
+    Values are pickled, so the store must only be writable by trusted
+    masters.
+
+    @param prefix: prefix for all keys, to allow several clusters to share
+    a store
+    """
+
+    compare_attrs = [ 'prefix' ]
+
+    _reactor = reactor # for tests
+
+    def __init__(self, prefix='buildbot'):
+        service.MultiService.__init__(self)
+        self.setName('sharedcache')
+        self.prefix = prefix
+
+    def lookup(self, cache_name, key):
+        """
+        Look up a key in the store.
+
+        @returns: tuple (version, value) via Deferred; value is None if the
+        key is not stored at its current version.  The version is None if it
+        could not be determined, in which case the value must not be stored.
+        """
+        vkey, ekey = self._keys(cache_name, key)
+        d = self._getMultiple([ vkey, ekey ])
+        def check(found):
+            if vkey not in found:
+                d = self._initVersion(vkey)
+                d.addCallback(lambda version : (version, None))
+                return d
+            version = found[vkey]
+            if ekey in found:
+                try:
+                    entry_version, value = cPickle.loads(found[ekey])
+                except Exception:
+                    log.msg("invalid shared cache entry for %r in %s"
+                            % (key, cache_name))
+                    return (version, None)
+                if entry_version == version:
+                    return (version, value)
+            return (version, None)
+        d.addCallback(check)
+        return d
+
+    def store(self, cache_name, key, version, value):
+        """
+        Store a value for a key, at the version returned by L{lookup} before
+        the value was loaded.
+        """
+        vkey, ekey = self._keys(cache_name, key)
+        return self._set(ekey, cPickle.dumps((version, value), 2))
+
+    def invalidate(self, cache_name, key):
+        """
+        Invalidate any stored value for a key; call this after writing the
+        object to the database.
+        """
+        vkey, ekey = self._keys(cache_name, key)
+        d = self._increment(vkey)
+        def check(version):
+            if version is None:
+                return self._initVersion(vkey)
+        d.addCallback(check)
+        return d
+
+    def _keys(self, cache_name, key):
+        # keys can be any hashable object, so use a digest of the repr
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return ('%s:v:%s:%s' % (self.prefix, cache_name, digest),
+                '%s:e:%s:%s' % (self.prefix, cache_name, digest))
+
+    def _initVersion(self, vkey):
+        # start each version at a different value, so that entries left behind
+        # by an earlier version that has since been evicted are not taken to
+        # be current.  If another master adds the version first, use theirs.
+        d = self._add(vkey, str(int(self._reactor.seconds() * 1000)))
+        d.addCallback(lambda _ : self._getMultiple([ vkey ]))
+        d.addCallback(lambda found : found.get(vkey))
+        return d
+
+    # primitive operations
+
+    def _getMultiple(self, keys):
+        """Return a dictionary of the given keys that are present"""
+        raise NotImplementedError
+
+    def _add(self, key, value):
+        """Set a key if it is not present, returning True if it was set"""
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+    def _increment(self, key):
+        """Increment a key, returning the new value, or None if the key is
+        not present"""
+        raise NotImplementedError
+
+
+class _MemCacheProtocol(memcache.MemCacheProtocol):
+
+    store = None
+
+    def connectionLost(self, reason):
+        memcache.MemCacheProtocol.connectionLost(self, reason)
+        if self.store:
+            self.store._connectionLost(self)
+
+
+class MemcachedSharedCache(SharedCache):
+    """
+    I keep the shared cache in a memcached server.  While the server is not
+    reachable, every lookup misses and nothing is stored.
+
+    @param host: memcached host
+    @param port: memcached port
+    """
+
+    compare_attrs = [ 'host', 'port', 'prefix' ]
+
+    # seconds to wait before reconnecting to the server
+    retryDelay = 10
+
+    def __init__(self, host='localhost', port=11211, prefix='buildbot'):
+        SharedCache.__init__(self, prefix=prefix)
+        self.host = host
+        self.port = port
+        self.protocol = None
+        self._retry = None
+
+    def startService(self):
+        SharedCache.startService(self)
+        self._connect()
+
+    def stopService(self):
+        if self._retry and self._retry.active():
+            self._retry.cancel()
+        self._retry = None
+        if self.protocol:
+            self.protocol.store = None
+            self.protocol.transport.loseConnection()
+            self.protocol = None
+        return SharedCache.stopService(self)
+
+    def _connect(self):
+        self._retry = None
+        if not self.running:
+            return
+        cc = protocol.ClientCreator(self._reactor, _MemCacheProtocol)
+        d = cc.connectTCP(self.host, self.port)
+        def connected(proto):
+            if not self.running:
+                proto.transport.loseConnection()
+                return
+            proto.store = self
+            self.protocol = proto
+        def failed(f):
+            log.msg("could not connect to memcached at %s:%d: %s"
+                    % (self.host, self.port, f.getErrorMessage()))
+            self._reconnect()
+        d.addCallbacks(connected, failed)
+
+    def _reconnect(self):
+        if self.running and not self._retry:
+            self._retry = self._reactor.callLater(self.retryDelay,
+                                                  self._connect)
+
+    def _connectionLost(self, proto):
+        if self.protocol is proto:
+            self.protocol = None
+            log.msg("lost connection to memcached at %s:%d"
+                    % (self.host, self.port))
+            self._reconnect()
+
+    def _getMultiple(self, keys):
+        if not self.protocol:
+            return defer.succeed({})
+        d = self.protocol.getMultiple(keys)
+        d.addCallback(lambda res : dict([ (k, v)
+                for k, (flags, v) in res.iteritems() if v is not None ]))
+        return d
+
+    def _add(self, key, value):
+        if not self.protocol:
+            return defer.succeed(False)
+        return self.protocol.add(key, value)
+
+    def _set(self, key, value):
+        if not self.protocol:
+            return defer.succeed(None)
+        return self.protocol.set(key, value)
+
+    def _increment(self, key):
+        if not self.protocol:
+            return defer.succeed(None)
+        d = self.protocol.increment(key)
+        d.addCallback(lambda res : res is not False and str(res) or None)
+        return d
+
+
+class DirectorySharedCache(SharedCache):
+    """
+    I keep the shared cache in files in a directory, which should be on a
+    memory-backed filesystem such as C{/dev/shm} that all of the masters can
+    reach.  Files are read and written synchronously.  Entries are not
+    expired, so the directory grows with the number of objects cached.
+
+    @param basedir: directory in which to keep the cache
+    """
+
+    compare_attrs = [ 'basedir', 'prefix' ]
+
+    def __init__(self, basedir, prefix='buildbot'):
+        SharedCache.__init__(self, prefix=prefix)
+        self.basedir = basedir
+
+    def startService(self):
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        return SharedCache.startService(self)
+
+    def _path(self, key):
+        return os.path.join(self.basedir, key.replace(':', '-'))
+
+    def _read(self, key):
+        try:
+            f = open(self._path(key), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _write(self, key, value):
+        # write to a temporary file, so that readers never see part of a value
+        path = self._path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            f.write(value)
+        finally:
+            f.close()
+        return tmp
+
+    def _getMultiple(self, keys):
+        found = {}
+        for key in keys:
+            value = self._read(key)
+            if value is not None:
+                found[key] = value
+        return defer.succeed(found)
+
+    def _add(self, key, value):
+        tmp = self._write(key, value)
+        try:
+            try:
+                # link is atomic, and fails if the key exists
+                os.link(tmp, self._path(key))
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    return defer.succeed(False)
+                raise
+        finally:
+            os.unlink(tmp)
+        return defer.succeed(True)
+
+    def _set(self, key, value):
+        tmp = self._write(key, value)
+        os.rename(tmp, self._path(key))
+        return defer.succeed(None)
+
+    def _increment(self, key):
+        import fcntl
+        # increments are serialized with a lock on a separate file, since the
+        # value's file is replaced on every write
+        lockfile = open(os.path.join(self.basedir, 'increment.lock'), 'w')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            value = self._read(key)
+            if value is None:
+                return defer.succeed(None)
+            value = str(int(value) + 1)
+            self._set(key, value)
+            return defer.succeed(value)
+        finally:
+            lockfile.close()
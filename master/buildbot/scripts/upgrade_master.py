@@ -19,6 +19,8 @@ import os
 import sys
 import traceback
 from twisted.internet import defer
+from cPickle import load
+from twisted.persisted import styles
 from twisted.python import util, runtime
 from buildbot import config as config_module
 from buildbot import monkeypatches
@@ -26,6 +28,7 @@ from buildbot.db import connector
 from buildbot.master import BuildMaster
 from buildbot.util import in_reactor
 from buildbot.scripts import base
+from buildbot.status import buildsummary
 
 def checkBasedir(config):
     if not config['quiet']:
@@ -147,6 +150,35 @@ def upgradeDatabase(config, master_cfg):
     yield db.setup(check_version=False, verbose=not config['quiet'])
     yield db.model.upgrade()
 
+def upgradeBuildSummaries(config, master_cfg):
+    backend = master_cfg.buildSummaryBackend
+    if backend is None:
+        return
+    if not config['quiet']:
+        print "upgrading build summaries (%s)" % (backend,)
+
+    def loadBuild(builddir, number):
+        with open(os.path.join(builddir, str(number)), "rb") as f:
+            build = load(f)
+        styles.doUpgrade()
+        return build
+
+    for builder_config in master_cfg.builders:
+        builddir = os.path.join(config['basedir'], builder_config.builddir)
+        if not os.path.isdir(builddir):
+            continue
+        store = buildsummary.openStore(backend, builddir)
+        try:
+            migrated, failed = buildsummary.migrateBuilder(store, builddir,
+                    lambda number : loadBuild(builddir, number))
+        finally:
+            store.close()
+        if not config['quiet']:
+            print " %s: %d builds summarized" % (builder_config.name, migrated)
+        if failed:
+            print " %s: could not summarize builds %s" % (builder_config.name,
+                    ", ".join(map(str, failed)))
+
 @in_reactor
 @defer.inlineCallbacks
 def upgradeMaster(config, _noMonkey=False):
@@ -173,6 +205,7 @@ def upgradeMaster(config, _noMonkey=False):
 
     upgradeFiles(config)
     yield upgradeDatabase(config, master_cfg)
+    upgradeBuildSummaries(config, master_cfg)
 
     if not config['quiet']:
         print "upgrade complete"
@@ -78,7 +78,7 @@ class SourceStamp(util.ComparableMixin, styles.Versioned):
     implements(interfaces.ISourceStamp)
 
     @classmethod
-    def fromSsdict(cls, master, ssdict):
+    def fromSsdict(cls, master, ssdict, _chdicts=None):
         """
         Class method to create a L{SourceStamp} from a dictionary as returned
         by L{SourceStampConnectorComponent.getSourceStamp}.
@@ -91,10 +91,13 @@ class SourceStamp(util.ComparableMixin, styles.Versioned):
         # try to fetch from the cache, falling back to _make_ss if not
         # found
         cache = master.caches.get_cache("SourceStamps", cls._make_ss)
-        return cache.get(ssdict['ssid'], ssdict=ssdict, master=master)
+        return cache.get(ssdict['ssid'], ssdict=ssdict, master=master,
+                         _chdicts=_chdicts)
 
     @classmethod
-    def _make_ss(cls, ssid, ssdict, master):
+    def _make_ss(cls, ssid, ssdict, master, _chdicts=None):
+        # _chdicts, if given, maps changeid to chdict for changes that have
+        # already been loaded, such as by BuildRequest.fromBrdicts
         sourcestamp = cls(_fromSsdict=True)
         sourcestamp.ssid = ssid
         sourcestamp.branch = ssdict['branch']
@@ -114,17 +117,18 @@ class SourceStamp(util.ComparableMixin, styles.Versioned):
         if ssdict['changeids']:
             # sort the changeids in order, oldest to newest
             sorted_changeids = sorted(ssdict['changeids'])
-            @defer.inlineCallbacks
-            def gci(id):
-                chdict = yield master.db.changes.getChange(id)
-                if chdict:
-                    change = yield Change.fromChdict(master, chdict)
-                    defer.returnValue(change)
-                else:
-                    # change isn't in the DB, so ignore it
-                    return
-            d = defer.gatherResults([ gci(id)
-                                for id in sorted_changeids ])
+            if _chdicts is not None:
+                d = defer.succeed([ _chdicts.get(id)
+                                    for id in sorted_changeids ])
+            else:
+                # fetch all of the changes at once
+                d = master.db.changes.getChanges(sorted_changeids)
+            def make_changes(chdicts):
+                # changes that aren't in the DB are ignored
+                return defer.gatherResults([ Change.fromChdict(master, chdict)
+                                             for chdict in chdicts
+                                             if chdict ])
+            d.addCallback(make_changes)
         else:
             d = defer.succeed([])
         def got_changes(changes):
@@ -88,6 +88,11 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
             return None
         return self.builder.getBuild(self.number-1)
 
+    def getPreviousBuildAsync(self):
+        if self.number == 0:
+            return defer.succeed(None)
+        return self.builder.getBuildAsync(self.number-1)
+
     def getAllGotRevisions(self):
         all_got_revisions = self.properties.getProperty('got_revision', {})
         # For backwards compatibility all_got_revisions is a string if codebases
@@ -98,6 +103,8 @@ class BuildStatus(styles.Versioned, properties.PropertiesMixin):
 
     def getSourceStamps(self, absolute=False):
         sourcestamps = []
+        if self.sources is None:
+            return sourcestamps
         if not absolute:
             sourcestamps.extend(self.sources)
         else:
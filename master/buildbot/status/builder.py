@@ -16,16 +16,19 @@
 from __future__ import with_statement
 
 
-import os, re, itertools
-from cPickle import load, dump
+import os, re, threading
+from cPickle import loads, dump
 
 from zope.interface import implements
 from twisted.python import log, runtime
 from twisted.persisted import styles
+from twisted.internet import defer, reactor, threads
 from buildbot import interfaces, util
-from buildbot.util.lru import LRUCache
+from buildbot.util.lru import LRUCache, AsyncLRUCache, estimateSize
 from buildbot.status.event import Event
 from buildbot.status.build import BuildStatus
+from buildbot.status.pruner import BuildPruner
+from buildbot.status import buildsummary
 from buildbot.status.buildrequest import BuildRequestStatus
 
 # user modules expect these symbols to be present here
@@ -34,6 +37,40 @@ from buildbot.status.results import EXCEPTION, RETRY, Results, worst_status
 _hush_pyflakes = [ SUCCESS, WARNINGS, FAILURE, SKIPPED,
                    EXCEPTION, RETRY, Results, worst_status ]
 
+# twisted.persisted.styles keeps a global registry of unpickled objects
+# awaiting upgrade, so only one build may be unpickled and upgraded at a time
+_unpickleLock = threading.Lock()
+
+def _unpickle(filename):
+    """Unpickle the file C{filename} and upgrade the objects in it.  The file
+    is read before taking L{_unpickleLock}, so that a caller in the reactor
+    thread waits at most for another thread's unpickling, and not for its
+    disk reads.
+
+    @returns: (object, upgraded) tuple
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    with _unpickleLock:
+        obj = loads(data)
+
+        # (bug #1068) if we need to upgrade, we probably need to rewrite this
+        # pickle, too.  We determine this by looking at the list of Versioned
+        # objects that have been unpickled, and (after doUpgrade) checking to
+        # see if any of them set wasUpgraded.  The Versioneds'
+        # upgradeToVersionNN methods all set this.
+        versioneds = styles.versionedsToUpgrade
+        styles.doUpgrade()
+        upgraded = True in [ hasattr(o, 'wasUpgraded')
+                             for o in versioneds.values() ]
+    return obj, upgraded
+
+def buildSize(build):
+    # most of a build's memory is in its steps, which estimateSize would only
+    # count shallowly
+    return estimateSize(build) + sum([ estimateSize(step)
+                                       for step in build.getSteps() ])
+
 class BuilderStatus(styles.Versioned):
     """I handle status information for a single process.build.Builder object.
     That object sends status changes to me (frequently as Events), and I
@@ -61,6 +98,11 @@ class BuilderStatus(styles.Versioned):
     category = None
     currentBigState = "offline" # or idle/waiting/interlocked/building
     basedir = None # filled in by our parent
+    summaryStore = None
+    lazyPickle = None # see setLazyPickle
+    pruner = None
+    # number of build summaries eventGenerator reads from the index at once
+    eventPageSize = 100
 
     def __init__(self, buildername, category, master, description):
         self.name = buildername
@@ -78,7 +120,9 @@ class BuilderStatus(styles.Versioned):
         self.currentBuilds = []
         self.nextBuild = None
         self.watchers = []
-        self.buildCache = LRUCache(self.cacheMiss)
+        self.buildCache = LRUCache(self.cacheMiss, sizeof=buildSize)
+        self.buildAsyncCache = AsyncLRUCache(self.asyncCacheMiss,
+                                             sizeof=buildSize)
 
     # persistence
 
@@ -90,12 +134,16 @@ class BuilderStatus(styles.Versioned):
         d = styles.Versioned.__getstate__(self)
         d['watchers'] = []
         del d['buildCache']
+        d.pop('buildAsyncCache', None)
         for b in self.currentBuilds:
             b.saveYourself()
             # TODO: push a 'hey, build was interrupted' event
         del d['currentBuilds']
         d.pop('pendingBuilds', None)
         del d['currentBigState']
+        d.pop('summaryStore', None)
+        d.pop('lazyPickle', None)
+        d.pop('pruner', None)
         del d['basedir']
         del d['status']
         del d['nextBuildNumber']
@@ -106,7 +154,9 @@ class BuilderStatus(styles.Versioned):
         # when loading, re-initialize the transient stuff. Remember that
         # upgradeToVersion1 and such will be called after this finishes.
         styles.Versioned.__setstate__(self, d)
-        self.buildCache = LRUCache(self.cacheMiss)
+        self.buildCache = LRUCache(self.cacheMiss, sizeof=buildSize)
+        self.buildAsyncCache = AsyncLRUCache(self.asyncCacheMiss,
+                                             sizeof=buildSize)
         self.currentBuilds = []
         self.watchers = []
         self.slavenames = []
@@ -122,19 +172,79 @@ class BuilderStatus(styles.Versioned):
             del self.nextBuildNumber # determineNextBuildNumber chooses this
         self.wasUpgraded = True
 
+    def setLazyPickle(self, filename):
+        """Arrange for this builder's saved state (its events) to be loaded
+        from the builder pickle C{filename} the first time it is needed,
+        rather than now.  This is called by the top-level Status object, so
+        that master startup does not need to read every builder pickle.
+        """
+        self.lazyPickle = filename
+
+    def _loadLazyPickle(self):
+        filename = self.lazyPickle
+        if filename is None:
+            return
+        self.lazyPickle = None
+        log.msg("loading status pickle from %s" % filename)
+        try:
+            saved, upgraded = _unpickle(filename)
+        except IOError:
+            return
+        except:
+            log.msg("error while loading status pickle %s" % filename)
+            log.err()
+            return
+        self.events = saved.events + self.events
+        if upgraded:
+            log.msg("re-writing upgraded builder pickle")
+            self.saveYourself()
+
     def determineNextBuildNumber(self):
-        """Scan our directory of saved BuildStatus instances to determine
-        what our self.nextBuildNumber should be. Set it one larger than the
-        highest-numbered build we discover. This is called by the top-level
-        Status object shortly after we are created or loaded from disk.
+        """Determine what our self.nextBuildNumber should be.  This is read
+        from the file written by saveNextBuildNumber if possible; otherwise,
+        scan our directory of saved BuildStatus instances and set it one
+        larger than the highest-numbered build we discover. This is called by
+        the top-level Status object shortly after we are created or loaded
+        from disk.
         """
-        existing_builds = [int(f)
-                           for f in os.listdir(self.basedir)
-                           if re.match("^\d+$", f)]
+        filename = os.path.join(self.basedir, "next_build_number")
+        try:
+            with open(filename, "r") as f:
+                number = int(f.read())
+        except (IOError, ValueError):
+            pass
+        else:
+            # trust the file unless a build with that number exists, which
+            # means it is stale
+            if number >= 0 and \
+                    not os.path.exists(self.makeBuildFilename(number)):
+                self.nextBuildNumber = number
+                return
+
+        existing_builds = [int(name)
+                           for name in os.listdir(self.basedir)
+                           if re.match("^\d+$", name)]
         if existing_builds:
             self.nextBuildNumber = max(existing_builds) + 1
         else:
             self.nextBuildNumber = 0
+        self.saveNextBuildNumber()
+
+    def saveNextBuildNumber(self):
+        filename = os.path.join(self.basedir, "next_build_number")
+        tmpfilename = filename + ".tmp"
+        try:
+            with open(tmpfilename, "w") as f:
+                f.write("%d\n" % self.nextBuildNumber)
+            if runtime.platformType  == 'win32':
+                # windows cannot rename a file on top of an existing one
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            os.rename(tmpfilename, filename)
+        except:
+            log.msg("unable to save next build number for builder %s"
+                    % self.name)
+            log.err()
 
     def saveYourself(self):
         for b in self.currentBuilds:
@@ -142,6 +252,9 @@ class BuilderStatus(styles.Versioned):
                 # interrupted build, need to save it anyway.
                 # BuildStatus.saveYourself will mark it as interrupted.
                 b.saveYourself()
+        if self.lazyPickle is not None:
+            # nothing has changed since the pickle was written
+            return
         filename = os.path.join(self.basedir, "builder")
         tmpfilename = filename + ".tmp"
         try:
@@ -158,8 +271,12 @@ class BuilderStatus(styles.Versioned):
 
     # build cache management
 
-    def setCacheSize(self, size):
-        self.buildCache.set_max_size(size)
+    def setCacheSize(self, size, **eviction):
+        """Set the size of the build caches, and the other eviction options
+        accepted by L{LRUCache.set_eviction}"""
+        for cache in (self.buildCache, self.buildAsyncCache):
+            cache.set_max_size(size)
+            cache.set_eviction(**eviction)
 
     def makeBuildFilename(self, number):
         return os.path.join(self.basedir, "%d" % number)
@@ -168,50 +285,151 @@ class BuilderStatus(styles.Versioned):
         return self.buildCache.get(number)
 
     def loadBuildFromFile(self, number):
+        build, upgraded = self._unpickleBuild(number)
+        return self._setupLoadedBuild(build, upgraded)
+
+    def _unpickleBuild(self, number):
+        # this does no more than read and upgrade the pickle, so that it can
+        # be run in a thread; see getBuildAsync
         filename = self.makeBuildFilename(number)
         try:
             log.msg("Loading builder %s's build %d from on-disk pickle"
                 % (self.name, number))
-            with open(filename, "rb") as f:
-                build = load(f)
-            build.setProcessObjects(self, self.master)
-
-            # (bug #1068) if we need to upgrade, we probably need to rewrite
-            # this pickle, too.  We determine this by looking at the list of
-            # Versioned objects that have been unpickled, and (after doUpgrade)
-            # checking to see if any of them set wasUpgraded.  The Versioneds'
-            # upgradeToVersionNN methods all set this.
-            versioneds = styles.versionedsToUpgrade
-            styles.doUpgrade()
-            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds.values() ]:
-                log.msg("re-writing upgraded build pickle")
-                build.saveYourself()
-
-            # check that logfiles exist
-            build.checkLogfiles()
-            return build
+            return _unpickle(filename)
         except IOError:
             raise IndexError("no such build %d" % number)
         except EOFError:
             raise IndexError("corrupted build pickle %d" % number)
 
+    def _setupLoadedBuild(self, build, upgraded):
+        build.setProcessObjects(self, self.master)
+        if upgraded:
+            log.msg("re-writing upgraded build pickle")
+            build.saveYourself()
+
+        # check that logfiles exist
+        build.checkLogfiles()
+        return build
+
+    def _getLoadedBuild(self, number):
+        # find a build that is in memory already, without loading it
+        for b in self.currentBuilds:
+            if b.number == number:
+                return b
+        for cache in (self.buildCache, self.buildAsyncCache):
+            build = cache.weakrefs.get(number)
+            if build is not None:
+                return build
+        return None
+
+    # build summaries
+
+    def getSummaryStore(self):
+        """
+        Get the L{buildsummary.BuildSummaryStore} for this builder, opening it
+        if necessary, or None if build summaries are disabled.
+        """
+        backend = self.master.config.buildSummaryBackend
+        store = self.summaryStore
+        if store is not None and store.backend != backend:
+            store.close()
+            store = self.summaryStore = None
+        if store is None and backend is not None:
+            try:
+                store = buildsummary.openStore(backend, self.basedir)
+            except Exception:
+                log.msg("unable to open build summaries for builder %s"
+                        % self.name)
+                log.err()
+                return None
+            self.summaryStore = store
+        return store
+
+    def addBuildSummary(self, build):
+        store = self.getSummaryStore()
+        if store is None:
+            return
+        try:
+            store.addBuild(buildsummary.summarizeBuild(build))
+        except Exception:
+            log.msg("unable to save summary of build %s-#%d"
+                    % (self.name, build.getNumber()))
+            log.err()
+
+    def getBuildSummary(self, number, fields=None):
+        """
+        Get a summary of a finished build as a dictionary (see
+        L{buildsummary.summarizeBuild}), containing only C{fields} if given.
+        This avoids unpickling the build when the summary has already been
+        stored; otherwise the build is loaded and its summary is stored for
+        next time.
+
+        @returns: dictionary, or None if the build does not exist or is not
+        finished
+        """
+        if number < 0:
+            number = self.nextBuildNumber + number
+        store = self.getSummaryStore()
+        if store is not None:
+            summary = store.getBuild(number, fields)
+            if summary is not None:
+                return summary
+        build = self.getBuild(number)
+        if build is None or not build.isFinished():
+            return None
+        summary = buildsummary.summarizeBuild(build)
+        if store is not None:
+            try:
+                store.addBuild(summary)
+            except Exception:
+                log.err()
+        if fields is not None:
+            summary = dict([ (f, summary[f]) for f in fields ])
+        return summary
+
     def cacheMiss(self, number, **kwargs):
         # If kwargs['val'] exists, this is a new value being added to
         # the cache.  Just return it.
         if 'val' in kwargs:
             return kwargs['val']
 
-        # first look in currentBuilds
-        for b in self.currentBuilds:
-            if b.number == number:
-                return b
+        # first look for a build already in memory
+        build = self._getLoadedBuild(number)
+        if build is not None:
+            return build
 
         # then fall back to loading it from disk
         return self.loadBuildFromFile(number)
 
+    def asyncCacheMiss(self, number):
+        build = self._getLoadedBuild(number)
+        if build is not None:
+            return defer.succeed(build)
+
+        # unpickle in a thread if the status object has a pool for the
+        # purpose; otherwise, do it synchronously
+        pool = getattr(getattr(self, 'status', None), 'loadPool', None)
+        if pool is not None:
+            d = threads.deferToThreadPool(reactor, pool,
+                                          self._unpickleBuild, number)
+        else:
+            d = defer.maybeDeferred(self._unpickleBuild, number)
+        d.addCallback(lambda res : self._setupLoadedBuild(*res))
+        # share the build with the synchronous cache; if that cache loaded
+        # the same build in the meantime, use its copy
+        d.addCallback(lambda build : self.buildCache.get(number, val=build))
+        return d
+
     def prune(self, events_only=False):
+        """
+        Prune old events and, unless C{events_only} is true, old builds.
+        Builds are pruned in the background; see L{BuildPruner}.
+
+        @returns: Deferred that fires when build pruning is complete, or None
+        """
         # begin by pruning our own events
         eventHorizon = self.master.config.eventHorizon
+        self._loadLazyPickle()
         self.events = self.events[-eventHorizon:]
 
         if events_only:
@@ -236,33 +454,13 @@ class BuilderStatus(styles.Versioned):
         if earliest_build == 0:
             return
 
-        # skim the directory and delete anything that shouldn't be there anymore
-        build_re = re.compile(r"^([0-9]+)$")
-        build_log_re = re.compile(r"^([0-9]+)-.*$")
         # if the directory doesn't exist, bail out here
         if not os.path.exists(self.basedir):
             return
 
-        for filename in os.listdir(self.basedir):
-            num = None
-            mo = build_re.match(filename)
-            is_logfile = False
-            if mo:
-                num = int(mo.group(1))
-            else:
-                mo = build_log_re.match(filename)
-                if mo:
-                    num = int(mo.group(1))
-                    is_logfile = True
-
-            if num is None: continue
-            if num in self.buildCache.cache: continue
-
-            if (is_logfile and num < earliest_log) or num < earliest_build:
-                pathname = os.path.join(self.basedir, filename)
-                log.msg("pruning '%s'" % pathname)
-                try: os.unlink(pathname)
-                except OSError: pass
+        if self.pruner is None:
+            self.pruner = BuildPruner(self)
+        return self.pruner.prune(earliest_build, earliest_log)
 
     # IBuilderStatus methods
     def getName(self):
@@ -283,16 +481,22 @@ class BuilderStatus(styles.Versioned):
     def getSlaves(self):
         return [self.status.getSlave(name) for name in self.slavenames]
 
-    def getPendingBuildRequestStatuses(self):
+    @defer.inlineCallbacks
+    def getPendingBuildRequestStatuses(self, preload=False):
         db = self.status.master.db
-        d = db.buildrequests.getBuildRequests(claimed=False,
+        brdicts = yield db.buildrequests.getBuildRequests(claimed=False,
                                               buildername=self.name)
-        def make_statuses(brdicts):
-            return [BuildRequestStatus(self.name, brdict['brid'],
+        statuses = [BuildRequestStatus(self.name, brdict['brid'],
                                        self.status)
                     for brdict in brdicts]
-        d.addCallback(make_statuses)
-        return d
+        if preload:
+            # late binding to avoid an import cycle
+            from buildbot.process import buildrequest
+            breqs = yield buildrequest.BuildRequest.fromBrdicts(
+                                            self.status.master, brdicts)
+            for brstatus, breq in zip(statuses, breqs):
+                brstatus._buildrequest = breq
+        defer.returnValue(statuses)
 
     def getCurrentBuilds(self):
         return self.currentBuilds
@@ -321,7 +525,21 @@ class BuilderStatus(styles.Versioned):
         except IndexError:
             return None
 
+    def getBuildAsync(self, number):
+        if number < 0:
+            number = self.nextBuildNumber + number
+        if number < 0 or number >= self.nextBuildNumber:
+            return defer.succeed(None)
+
+        d = self.buildAsyncCache.get(number)
+        def noSuchBuild(f):
+            f.trap(IndexError)
+            return None
+        d.addErrback(noSuchBuild)
+        return d
+
     def getEvent(self, number):
+        self._loadLazyPickle()
         try:
             return self.events[number]
         except IndexError:
@@ -340,39 +558,145 @@ class BuilderStatus(styles.Versioned):
                                filter_fn=None):
         got = 0
         branches = set(branches)
-        for Nb in itertools.count(1):
-            if Nb > self.nextBuildNumber:
-                break
-            if Nb > max_search:
-                break
-            build = self.getBuild(-Nb)
-            if build is None:
-                continue
-            if max_buildnum is not None:
-                if build.getNumber() > max_buildnum:
-                    continue
-            if not build.isFinished():
+        for number, indexed in self._finishedBuildCandidates(branches,
+                max_buildnum, finished_before, results, max_search,
+                num_builds):
+            build = self.getBuild(number)
+            if not indexed and build is not None and build.isFinished():
+                self.addBuildSummary(build)
+            if not self._isWantedFinishedBuild(build, branches, max_buildnum,
+                                    finished_before, results, filter_fn):
                 continue
-            if finished_before is not None:
-                start, end = build.getTimes()
-                if end >= finished_before:
-                    continue
-            # if we were asked to filter on branches, and none of the
-            # sourcestamps match, skip this build
-            if branches and not branches & self._getBuildBranches(build):
-                continue
-            if results is not None:
-                if build.getResults() not in results:
-                    continue
-            if filter_fn is not None:
-                if not filter_fn(build):
-                    continue
             got += 1
             yield build
             if num_builds is not None:
                 if got >= num_builds:
                     return
 
+    @defer.inlineCallbacks
+    def generateFinishedBuildsAsync(self, branches=[],
+                                    num_builds=None,
+                                    max_buildnum=None,
+                                    finished_before=None,
+                                    results=None,
+                                    max_search=200,
+                                    filter_fn=None):
+        builds = []
+        branches = set(branches)
+        for number, indexed in self._finishedBuildCandidates(branches,
+                max_buildnum, finished_before, results, max_search,
+                num_builds):
+            build = yield self.getBuildAsync(number)
+            if not indexed and build is not None and build.isFinished():
+                self.addBuildSummary(build)
+            if not self._isWantedFinishedBuild(build, branches, max_buildnum,
+                                    finished_before, results, filter_fn):
+                continue
+            builds.append(build)
+            if num_builds is not None:
+                if len(builds) >= num_builds:
+                    break
+        defer.returnValue(builds)
+
+    def _queryBuildIndex(self, top, limit, fields=None, **filters):
+        # use the build summaries to find the most recent builds numbered no
+        # higher than top that match the given filters (see
+        # BuildSummaryStore.findBuilds), without loading them.  Returns
+        # (bottom, set of the build numbers from bottom through top in the
+        # index, dictionary of up to limit matching summaries keyed by
+        # number), where bottom is the lowest number the results cover; or
+        # None if there is no index
+        store = self.getSummaryStore()
+        if store is None:
+            return None
+        try:
+            wanted = store.findBuilds(fields=fields, max_buildnum=top,
+                                      limit=limit, **filters)
+            bottom = 0
+            if len(wanted) == limit:
+                bottom = wanted[-1]['number']
+            known = store.getBuildNumbers(min_buildnum=bottom,
+                                          max_buildnum=top)
+        except Exception:
+            log.msg("unable to query build summaries for builder %s"
+                    % self.name)
+            log.err()
+            return None
+        return bottom, known, dict([ (summary['number'], summary)
+                                     for summary in wanted ])
+
+    def _walkBuildIndex(self, top, pageSize, fields=None, **filters):
+        # generate (number, summary) for each build from top down to 0, most
+        # recent first.  The summary is the build's summary if it matches the
+        # filters, False if the index shows that it does not, or None if the
+        # build is not in the index.  The index is queried for pageSize
+        # matching builds at a time, as the generator is consumed.
+        while top >= 0:
+            index = self._queryBuildIndex(top, pageSize, fields, **filters)
+            if index is None:
+                for number in xrange(top, -1, -1):
+                    yield number, None
+                return
+            bottom, known, wanted = index
+            for number in xrange(top, bottom - 1, -1):
+                if number in wanted:
+                    yield number, wanted[number]
+                elif number in known:
+                    yield number, False
+                else:
+                    yield number, None
+            top = bottom - 1
+
+    def _finishedBuildCandidates(self, branches, max_buildnum,
+                                 finished_before, results, max_search,
+                                 num_builds=None):
+        # generate (number, indexed) for the builds that generateFinishedBuilds
+        # must load, most recent first.  Builds which the summary index shows
+        # do not match the filters are skipped without being loaded, and do
+        # not count toward max_search.  Builds not in the index are loaded and
+        # checked as usual; indexed is False for these.
+        top = self.nextBuildNumber - 1
+        if max_buildnum is not None:
+            top = min(top, max_buildnum)
+        pageSize = max_search
+        if num_builds:
+            pageSize = min(pageSize, num_builds)
+        searched = 0
+        for number, summary in self._walkBuildIndex(top, max(1, pageSize),
+                branches=branches, results=results,
+                finished_before=finished_before):
+            if summary is False:
+                continue
+            if searched >= max_search:
+                return
+            searched += 1
+            yield number, summary is not None
+
+    def _isWantedFinishedBuild(self, build, branches, max_buildnum,
+                               finished_before, results, filter_fn):
+        if build is None:
+            return False
+        if max_buildnum is not None:
+            if build.getNumber() > max_buildnum:
+                return False
+        if not build.isFinished():
+            return False
+        if finished_before is not None:
+            start, end = build.getTimes()
+            if end >= finished_before:
+                return False
+        # if we were asked to filter on branches, and none of the
+        # sourcestamps match, skip this build
+        if branches and not branches & self._getBuildBranches(build):
+            return False
+        if results is not None:
+            if build.getResults() not in results:
+                return False
+        if filter_fn is not None:
+            if not filter_fn(build):
+                return False
+        return True
+
     def eventGenerator(self, branches=[], categories=[], committers=[], minTime=0):
         """This function creates a generator which will provide all of this
         Builder's status events, starting with the most recent and
@@ -390,13 +714,21 @@ class BuilderStatus(styles.Versioned):
         eventIndex = -1
         e = self.getEvent(eventIndex)
         branches = set(branches)
-        for Nb in range(1, self.nextBuildNumber+1):
-            b = self.getBuild(-Nb)
+        # the summary index lets us skip builds on other branches, and find
+        # the first build that is too old, without loading them
+        lastBuild = self.nextBuildNumber - 1
+        for number, summary in self._walkBuildIndex(lastBuild,
+                self.eventPageSize, fields=['started'], branches=branches):
+            if summary is False:
+                continue
+            if summary and summary['started'] < minTime:
+                break
+            b = self.getBuild(number)
             if not b:
                 # HACK: If this is the first build we are looking at, it is
                 # possible it's in progress but locked before it has written a
                 # pickle; in this case keep looking.
-                if Nb == 1:
+                if number == lastBuild:
                     continue
                 break
             if b.getTimes()[0] < minTime:
@@ -451,6 +783,7 @@ class BuilderStatus(styles.Versioned):
         e = Event()
         e.started = util.now()
         e.text = text
+        self._loadLazyPickle()
         self.events.append(e)
         self.prune(events_only=True)
         return e # they are free to mangle it further
@@ -462,6 +795,7 @@ class BuilderStatus(styles.Versioned):
         e.started = util.now()
         e.finished = 0
         e.text = text
+        self._loadLazyPickle()
         self.events.append(e)
         self.prune(events_only=True)
         return e # for consistency, but they really shouldn't touch it
@@ -492,10 +826,9 @@ class BuilderStatus(styles.Versioned):
         Steps). Create a BuildStatus object that it can use."""
         number = self.nextBuildNumber
         self.nextBuildNumber += 1
-        # TODO: self.saveYourself(), to make sure we don't forget about the
-        # build number we've just allocated. This is not quite as important
-        # as it was before we switch to determineNextBuildNumber, but I think
-        # it may still be useful to have the new build save itself.
+        # make sure we don't forget about the build number we've just
+        # allocated, even before the build saves itself
+        self.saveNextBuildNumber()
         s = BuildStatus(self, self.master, number)
         s.waitUntilFinished().addCallback(self._buildFinished)
         return s
@@ -530,6 +863,7 @@ class BuilderStatus(styles.Versioned):
     def _buildFinished(self, s):
         assert s in self.currentBuilds
         s.saveYourself()
+        self.addBuildSummary(s)
         self.currentBuilds.remove(s)
 
         name = self.getName()
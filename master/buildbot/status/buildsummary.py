@@ -0,0 +1,558 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+"""
+Compact, non-pickle storage for summaries of finished builds.
+
+A build summary is a dictionary holding the parts of a L{BuildStatus} that
+status displays need for build lists and history views, without the steps'
+logs, test results or upgrade machinery of the full pickle.  Summaries are
+stored per-builder by one of the backends in C{BACKENDS}, selected by
+C{c['buildSummaryBackend']}.  The full pickles remain the authoritative
+record; summaries can always be regenerated from them.
+
+The stores also serve as an index of a builder's history: L{findBuilds}
+selects builds by branch, results, finish time and number without loading
+any pickles.  They also record the filenames of each build's logs, so that
+old builds can be pruned without listing the builder's directory.
+"""
+
+from __future__ import with_statement
+
+import os
+import heapq
+import sqlite3
+from twisted.python import log, runtime
+from twisted.internet import defer, threads
+from buildbot.util import json
+
+SUMMARY_VERSION = 1
+
+# the keys of a summary dictionary
+FIELDS = ('number', 'reason', 'results', 'text', 'started', 'finished',
+          'slavename', 'blamelist', 'sourcestamps', 'properties', 'steps',
+          'logs')
+
+# fields whose values are lists or dictionaries, and are stored as JSON
+JSON_FIELDS = ('text', 'blamelist', 'sourcestamps', 'properties', 'steps',
+               'logs')
+
+# fields that findBuilds filters on
+FILTER_FIELDS = ('number', 'results', 'finished', 'sourcestamps')
+
+def _jsonable(value):
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return str(value)
+    return value
+
+def summarizeBuild(build):
+    """
+    Summarize a finished L{BuildStatus}.
+
+    @returns: dictionary with keys C{FIELDS}
+    """
+    started, finished = build.getTimes()
+    return dict(
+        number=build.getNumber(),
+        reason=build.getReason(),
+        results=build.getResults(),
+        text=list(build.getText()),
+        started=started,
+        finished=finished,
+        slavename=build.getSlavename(),
+        blamelist=list(build.getResponsibleUsers()),
+        sourcestamps=[ dict(branch=ss.branch, revision=ss.revision,
+                            repository=ss.repository, codebase=ss.codebase,
+                            project=ss.project)
+                       for ss in build.getSourceStamps() ],
+        properties=[ [ name, _jsonable(value), source ]
+                     for name, value, source
+                     in build.getProperties().asList() ],
+        steps=[ dict(name=step.getName(), text=list(step.getText()),
+                     results=_jsonable(step.getResults()),
+                     started=step.getTimes()[0], finished=step.getTimes()[1])
+                for step in build.getSteps() ],
+        logs=[ l.filename for step in build.getSteps()
+               for l in step.getLogs() if l.filename ],
+    )
+
+def getBranches(summary):
+    """Get the set of branches built by the build with the given summary."""
+    return set([ ss['branch'] for ss in summary['sourcestamps'] ])
+
+def matchesFilters(summary, branches=None, results=None,
+                   finished_before=None, max_buildnum=None):
+    """
+    Determine whether a summary containing at least C{FILTER_FIELDS} matches
+    the given filters; see L{BuildSummaryStore.findBuilds}.
+    """
+    if max_buildnum is not None and summary['number'] > max_buildnum:
+        return False
+    if results is not None and summary['results'] not in results:
+        return False
+    if finished_before is not None:
+        if summary['finished'] is None or \
+                summary['finished'] >= finished_before:
+            return False
+    if branches and not set(branches) & getBranches(summary):
+        return False
+    return True
+
+class BuildSummaryStore(object):
+    """
+    Base class for per-builder summary stores.  Subclasses store summaries
+    in the builder's base directory.
+    """
+
+    backend = None
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+
+    def addBuild(self, summary):
+        """Add or replace the summary of a build."""
+        raise NotImplementedError
+
+    def getBuild(self, number, fields=None):
+        """
+        Get the summary of a build, or None if it is not stored.
+
+        @param fields: if given, a list of the fields to return; the store
+        will avoid loading other fields where it can
+        @returns: dictionary
+        """
+        raise NotImplementedError
+
+    def hasBuild(self, number):
+        return self.getBuild(number, fields=['number']) is not None
+
+    def getBuildNumbers(self, min_buildnum=None, max_buildnum=None):
+        """Get the set of numbers of the builds with usable summaries,
+        optionally only those numbered from C{min_buildnum} through
+        C{max_buildnum}."""
+        raise NotImplementedError
+
+    def findBuilds(self, branches=None, results=None, finished_before=None,
+                   max_buildnum=None, fields=None, limit=None):
+        """
+        Find the summaries of builds matching all of the given filters,
+        most recent first.
+
+        @param branches: if given, only builds of one of these branches
+        @param results: if given, only builds with one of these results
+        @param finished_before: if given, only builds that finished before
+        this time
+        @param max_buildnum: if given, only builds numbered no higher than
+        this
+        @param fields: the fields to return, as for L{getBuild}; C{number} is
+        always included
+        @param limit: if given, return only this many of the most recent
+        matching builds
+        @returns: list of dictionaries
+        """
+        raise NotImplementedError
+
+    def getLogs(self, numbers):
+        """
+        Get the C{logs} field of the summaries of the given builds, as a
+        dictionary keyed by build number; builds without a summary are left
+        out.  Unlike the other methods, this may be called from any thread.
+
+        @returns: dictionary
+        """
+        raise NotImplementedError
+
+    def removeBuildsBefore(self, number):
+        """
+        Remove summaries of all builds numbered less than C{number}.  The
+        summaries are gone as soon as this returns, but the store may
+        reclaim their space later.
+
+        @returns: Deferred that fires when the store has been updated
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _findFields(self, fields):
+        fields = list(self._checkFields(fields or ['number']))
+        if 'number' not in fields:
+            fields.insert(0, 'number')
+        return fields
+
+    def _checkFields(self, fields):
+        if fields is None:
+            return FIELDS
+        for f in fields:
+            if f not in FIELDS:
+                raise KeyError("no such summary field %r" % (f,))
+        return fields
+
+class SQLiteBuildSummaryStore(BuildSummaryStore):
+    """
+    Stores summaries in C{builds.sqlite} in the builder's directory, one row
+    per build and one column per summary field, so that only the requested
+    columns are read and decoded.
+
+    The database is a cache of data that is also in the build pickles, so it
+    is written without fsync'ing.
+    """
+
+    backend = 'sqlite'
+    filename = 'builds.sqlite'
+
+    def __init__(self, basedir):
+        BuildSummaryStore.__init__(self, basedir)
+        self.path = os.path.join(basedir, self.filename)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS builds (
+            number INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            reason TEXT,
+            results INTEGER,
+            text TEXT,
+            started REAL,
+            finished REAL,
+            slavename TEXT,
+            blamelist TEXT,
+            sourcestamps TEXT,
+            properties TEXT,
+            steps TEXT,
+            logs TEXT)""")
+        # the logs column was added after the table was first created
+        columns = [ row[1] for row in
+                    self.conn.execute("PRAGMA table_info(builds)") ]
+        if 'logs' not in columns:
+            self.conn.execute("ALTER TABLE builds ADD COLUMN logs TEXT")
+        self.conn.commit()
+
+    def addBuild(self, summary):
+        values = [ summary['number'], SUMMARY_VERSION ]
+        for f in FIELDS[1:]:
+            v = summary[f]
+            if f in JSON_FIELDS:
+                v = json.dumps(v)
+            values.append(v)
+        self.conn.execute("INSERT OR REPLACE INTO builds (number, version, %s)"
+                " VALUES (%s)" % (", ".join(FIELDS[1:]),
+                                  ", ".join("?" * len(values))),
+                values)
+        self.conn.commit()
+
+    def getBuild(self, number, fields=None):
+        fields = self._checkFields(fields)
+        row = self.conn.execute("SELECT version, %s FROM builds"
+                " WHERE number = ?" % (", ".join(fields),),
+                (number,)).fetchone()
+        if row is None or row[0] > SUMMARY_VERSION:
+            return None
+        return self._rowToSummary(fields, row[1:])
+
+    def getBuildNumbers(self, min_buildnum=None, max_buildnum=None):
+        where = [ "version <= ?" ]
+        args = [ SUMMARY_VERSION ]
+        if min_buildnum is not None:
+            where.append("number >= ?")
+            args.append(min_buildnum)
+        if max_buildnum is not None:
+            where.append("number <= ?")
+            args.append(max_buildnum)
+        return set([ row[0] for row in
+                     self.conn.execute("SELECT number FROM builds WHERE %s"
+                                       % " AND ".join(where), args) ])
+
+    def findBuilds(self, branches=None, results=None, finished_before=None,
+                   max_buildnum=None, fields=None, limit=None):
+        fields = self._findFields(fields)
+        columns = fields[:]
+        if branches and 'sourcestamps' not in columns:
+            columns.append('sourcestamps')
+        where = [ "version <= ?" ]
+        args = [ SUMMARY_VERSION ]
+        if results is not None:
+            if not results:
+                return []
+            where.append("results IN (%s)" % ", ".join("?" * len(results)))
+            args.extend(results)
+        if finished_before is not None:
+            where.append("finished < ?")
+            args.append(finished_before)
+        if max_buildnum is not None:
+            where.append("number <= ?")
+            args.append(max_buildnum)
+        rows = self.conn.execute("SELECT %s FROM builds WHERE %s"
+                " ORDER BY number DESC" % (", ".join(columns),
+                                           " AND ".join(where)), args)
+        # branches are filtered here, so the rows are read only until enough
+        # have matched
+        summaries = []
+        for row in rows:
+            if limit is not None and len(summaries) >= limit:
+                break
+            summary = self._rowToSummary(columns, row)
+            if branches and not set(branches) & getBranches(summary):
+                continue
+            if len(columns) > len(fields):
+                del summary['sourcestamps']
+            summaries.append(summary)
+        return summaries
+
+    def getLogs(self, numbers):
+        # the store's connection belongs to the reactor thread
+        logs = {}
+        conn = sqlite3.connect(self.path)
+        try:
+            numbers = list(numbers)
+            while numbers:
+                # stay well under sqlite's limit on query parameters
+                chunk, numbers = numbers[:500], numbers[500:]
+                rows = conn.execute("SELECT number, logs FROM builds"
+                        " WHERE version <= ? AND number IN (%s)"
+                        % ", ".join("?" * len(chunk)),
+                        [ SUMMARY_VERSION ] + chunk)
+                for number, value in rows:
+                    if value is not None:
+                        value = json.loads(value)
+                    logs[number] = value
+        finally:
+            conn.close()
+        return logs
+
+    def _rowToSummary(self, fields, row):
+        summary = {}
+        for f, v in zip(fields, row):
+            if f in JSON_FIELDS and v is not None:
+                v = json.loads(v)
+            summary[f] = v
+        return summary
+
+    def removeBuildsBefore(self, number):
+        # the connection cannot be used from other threads, but deleting a
+        # range of the primary key does not scan the table
+        self.conn.execute("DELETE FROM builds WHERE number < ?", (number,))
+        self.conn.commit()
+        return defer.succeed(None)
+
+    def close(self):
+        self.conn.close()
+
+class JSONLinesBuildSummaryStore(BuildSummaryStore):
+    """
+    Stores summaries in C{builds.jsonl} in the builder's directory, as an
+    append-only file with one JSON object per line.  The offset of each
+    build's latest line, and the fields used by findBuilds, are kept in
+    memory.  Removing builds drops them from memory at once, then rewrites
+    the file without them in a thread.
+    """
+
+    backend = 'jsonl'
+    filename = 'builds.jsonl'
+
+    def __init__(self, basedir):
+        BuildSummaryStore.__init__(self, basedir)
+        self.path = os.path.join(basedir, self.filename)
+        self.offsets = {}
+        self.index = {}
+        self.compacting = defer.DeferredLock()
+        self.f = open(self.path, "a+b")
+        self.f.seek(0)
+        offset = 0
+        while True:
+            line = self.f.readline()
+            if not line:
+                break
+            if line.endswith("\n"):
+                try:
+                    record = json.loads(line)
+                    number = record['number']
+                except (ValueError, KeyError, TypeError):
+                    log.msg("ignoring corrupt line in %s" % self.path)
+                else:
+                    self.offsets[number] = offset
+                    self._indexRecord(record)
+            offset += len(line)
+
+    def _indexRecord(self, record):
+        if record.get('version', 0) > SUMMARY_VERSION:
+            self.index.pop(record['number'], None)
+            return
+        self.index[record['number']] = dict([ (f, record.get(f))
+                                              for f in FILTER_FIELDS ])
+
+    def addBuild(self, summary):
+        record = dict(version=SUMMARY_VERSION)
+        for f in FIELDS:
+            record[f] = summary[f]
+        self.f.seek(0, 2)
+        self.offsets[summary['number']] = self.f.tell()
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self._indexRecord(record)
+
+    def getBuild(self, number, fields=None):
+        fields = self._checkFields(fields)
+        if number not in self.offsets:
+            return None
+        self.f.seek(self.offsets[number])
+        record = json.loads(self.f.readline())
+        if record['version'] > SUMMARY_VERSION:
+            return None
+        return dict([ (f, record.get(f)) for f in fields ])
+
+    def getBuildNumbers(self, min_buildnum=None, max_buildnum=None):
+        return set([ n for n in self.index
+                     if (min_buildnum is None or n >= min_buildnum)
+                     and (max_buildnum is None or n <= max_buildnum) ])
+
+    def findBuilds(self, branches=None, results=None, finished_before=None,
+                   max_buildnum=None, fields=None, limit=None):
+        fields = self._findFields(fields)
+        numbers = [ n for n, summary in self.index.iteritems()
+                    if matchesFilters(summary, branches, results,
+                                      finished_before, max_buildnum) ]
+        if limit is not None:
+            numbers = heapq.nlargest(limit, numbers)
+        else:
+            numbers.sort(reverse=True)
+        summaries = []
+        for n in numbers:
+            if set(fields) <= set(FILTER_FIELDS):
+                summary = self.index[n]
+                summaries.append(dict([ (f, summary[f]) for f in fields ]))
+            else:
+                summaries.append(self.getBuild(n, fields))
+        return summaries
+
+    def getLogs(self, numbers):
+        # read with a separate file object, checking that each line is the
+        # expected build's, in case the file is rewritten meanwhile
+        logs = {}
+        offsets = self.offsets
+        with open(self.path, "rb") as f:
+            for n in numbers:
+                offset = offsets.get(n)
+                if offset is None:
+                    continue
+                f.seek(offset)
+                try:
+                    record = json.loads(f.readline())
+                except ValueError:
+                    continue
+                if record.get('number') != n or \
+                        record.get('version', 0) > SUMMARY_VERSION:
+                    continue
+                logs[n] = record.get('logs')
+        return logs
+
+    def removeBuildsBefore(self, number):
+        removed = [ n for n in self.offsets if n < number ]
+        if not removed:
+            return defer.succeed(None)
+        for n in removed:
+            del self.offsets[n]
+            self.index.pop(n, None)
+        return self.compacting.run(self._compact)
+
+    @defer.inlineCallbacks
+    def _compact(self):
+        # lines appended while the thread runs are copied over afterward;
+        # lines already in the file are never changed, so the thread can
+        # read them with its own file object
+        tmppath = self.path + ".tmp"
+        self.f.seek(0, 2)
+        end = self.f.tell()
+        kept = sorted([ (off, n) for n, off in self.offsets.iteritems()
+                        if off < end ])
+        try:
+            offsets = yield threads.deferToThread(self._copyLines,
+                                                  tmppath, kept)
+            if self.f.closed:
+                os.unlink(tmppath)
+                return
+            with open(tmppath, "ab") as tmp:
+                tmp.seek(0, 2)
+                tail = tmp.tell()
+                self.f.seek(end)
+                tmp.write(self.f.read())
+            # lines of builds removed meanwhile are left for the next rewrite
+            copied, offsets = offsets, {}
+            for n, off in self.offsets.iteritems():
+                if off < end:
+                    offsets[n] = copied[n]
+                else:
+                    offsets[n] = tail + off - end
+            self.f.close()
+            if runtime.platformType == 'win32':
+                os.unlink(self.path)
+            os.rename(tmppath, self.path)
+            self.f = open(self.path, "a+b")
+            self.offsets = offsets
+        except Exception:
+            log.err(None, "while rewriting %s" % self.path)
+
+    def _copyLines(self, tmppath, kept):
+        # runs in a thread
+        offsets = {}
+        with open(self.path, "rb") as src:
+            with open(tmppath, "wb") as tmp:
+                for off, n in kept:
+                    src.seek(off)
+                    offsets[n] = tmp.tell()
+                    tmp.write(src.readline())
+        return offsets
+
+    def close(self):
+        self.f.close()
+
+BACKENDS = {
+    'sqlite' : SQLiteBuildSummaryStore,
+    'jsonl' : JSONLinesBuildSummaryStore,
+}
+
+def openStore(backend, basedir):
+    """
+    Open the summary store for the builder with base directory C{basedir},
+    using the named backend.
+    """
+    return BACKENDS[backend](basedir)
+
+def migrateBuilder(store, basedir, loadBuild):
+    """
+    Add summaries for all of the build pickles in a builder's directory that
+    are not already in C{store}.  C{loadBuild} is called with a build number
+    and should return the unpickled L{BuildStatus}.
+
+    @returns: tuple (number of builds migrated, list of failed build numbers)
+    """
+    numbers = sorted([ int(f) for f in os.listdir(basedir) if f.isdigit() ])
+    migrated = 0
+    failed = []
+    for number in numbers:
+        if store.hasBuild(number):
+            continue
+        try:
+            build = loadBuild(number)
+            store.addBuild(summarizeBuild(build))
+        except Exception:
+            log.msg("unable to summarize build %d in %s" % (number, basedir))
+            log.err()
+            failed.append(number)
+            continue
+        migrated += 1
+    return migrated, failed
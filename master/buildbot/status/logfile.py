@@ -14,13 +14,18 @@
 # Copyright Buildbot Team Members
 
 import os
-from cStringIO import StringIO
+import bz2
+import mmap
+import zlib
+import struct
+from bisect import bisect_right
 from bz2 import BZ2File
 from gzip import GzipFile
 
 from zope.interface import implements
 from twisted.python import log, runtime
 from twisted.internet import defer, threads, reactor
+from buildbot import util
 from buildbot.util import netstrings
 from buildbot.util.eventual import eventually
 from buildbot import interfaces
@@ -29,6 +34,11 @@ STDOUT = interfaces.LOG_CHANNEL_STDOUT
 STDERR = interfaces.LOG_CHANNEL_STDERR
 HEADER = interfaces.LOG_CHANNEL_HEADER
 ChunkTypes = ["stdout", "stderr", "header"]
+TEXT_CHANNELS = (STDOUT, STDERR)
+
+# suffixes of the files that may be kept on disk for a logfile, including
+# its index and compressed forms
+LOGFILE_SUFFIXES = ('', '.idx', '.idx.tmp', '.blk', '.blk.tmp', '.bz2', '.gz')
 
 class LogFileScanner(netstrings.NetstringParser):
     def __init__(self, chunk_cb, channels=[]):
@@ -41,6 +51,376 @@ class LogFileScanner(netstrings.NetstringParser):
         if not self.channels or (channel in self.channels):
             self.chunk_cb((channel, line[1:]))
 
+class LogIndexScanner(netstrings.NetstringParser):
+    """
+    Parse netstring log data, calling C{chunk_cb(offset, text, channel)} for
+    each chunk, where C{offset} is the position of the chunk's text in the
+    data.  Chunks are contiguous and written without leading zeroes, so the
+    offsets are tracked from the lengths of the strings received.
+    """
+    def __init__(self, chunk_cb):
+        self.chunk_cb = chunk_cb
+        self.pos = 0
+        netstrings.NetstringParser.__init__(self)
+
+    def stringReceived(self, line):
+        size = len(line)
+        # skip the length, the colon and the channel
+        offset = self.pos + len(str(size)) + 2
+        self.chunk_cb(offset, line[1:], int(line[0]))
+        self.pos += len(str(size)) + size + 2 # and the trailing comma
+
+class LogChunkIndex:
+    """
+    A sidecar index for a L{LogFile}, stored next to the log as
+    C{<logfilename>.idx}.  The index contains one fixed-size record for each
+    netstring chunk in the log, so readers can find the chunk containing a
+    particular line (or the last few lines) with a binary search instead of
+    parsing the whole log.
+
+    Each record is a tuple (offset, length, channel, line, newlines,
+    textOffset, textLine):
+
+     - offset: position of the chunk's text in the (uncompressed) log data
+     - length: length of the chunk's text
+     - channel: channel of the chunk
+     - line: number of newlines in the log before this chunk
+     - newlines: number of newlines in this chunk
+     - textOffset: number of stdout and stderr bytes in the log before this
+       chunk; that is, the chunk's position in L{LogFile.getText}
+     - textLine: number of newlines in stdout and stderr before this chunk;
+       that is, the chunk's line in L{LogFile.getText}
+
+    Offsets refer to the uncompressed netstring stream, so the index remains
+    valid after the log is compressed.
+    """
+
+    MAGIC = "BBLI"
+    VERSION = 2
+    HEADER = struct.Struct("!4sB")
+    RECORD = struct.Struct("!QIBQIQQ")
+    READSIZE = 64*1024 # for build
+
+    def __init__(self, filename, f):
+        self.filename = filename
+        self.f = f
+
+    @classmethod
+    def create(cls, filename):
+        """Create a new, empty index file, overwriting any existing file."""
+        f = open(filename, "w+b")
+        f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION))
+        return cls(filename, f)
+
+    @classmethod
+    def load(cls, filename):
+        """Open an existing index file for reading, or return None if the
+        file is missing or is not a usable index."""
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+        hdr = f.read(cls.HEADER.size)
+        if len(hdr) != cls.HEADER.size or \
+                cls.HEADER.unpack(hdr) != (cls.MAGIC, cls.VERSION):
+            f.close()
+            return None
+        return cls(filename, f)
+
+    @classmethod
+    def build(cls, filename, datafile):
+        """
+        Build an index for the netstring log data in C{datafile}, which is
+        read from the beginning.  This is used to upgrade logs written before
+        indexes existed.  The index is written to a temporary file and
+        renamed into place once it is complete.
+
+        The data is read in a single forward pass, since seeking backwards
+        in a compressed file means decompressing it again from the start.
+        This blocks, so L{LogFile} runs it in a thread.
+
+        @returns: L{LogChunkIndex} instance, or None if it cannot be written
+        """
+        tmpfilename = filename + ".tmp"
+        idx = None
+        try:
+            idx = cls.create(tmpfilename)
+            counts = [ 0, 0, 0 ] # line, textOffset, textLine
+            def indexChunk(offset, text, channel):
+                line, textOffset, textLine = counts
+                newlines = text.count("\n")
+                idx.append(offset, len(text), channel, line, newlines,
+                           textOffset, textLine)
+                counts[0] += newlines
+                if channel in TEXT_CHANNELS:
+                    counts[1] += len(text)
+                    counts[2] += newlines
+            scanner = LogIndexScanner(indexChunk)
+            datafile.seek(0)
+            while True:
+                data = datafile.read(cls.READSIZE)
+                if not data:
+                    break
+                # a truncated chunk at the end is left in the parser
+                scanner.feed(data)
+            idx.f.close()
+            if runtime.platformType  == 'win32':
+                if os.path.exists(filename):
+                    os.unlink(filename)
+            os.rename(tmpfilename, filename)
+        except (IOError, OSError, ValueError):
+            log.msg("unable to build log index %s" % filename)
+            log.err()
+            if idx is not None:
+                idx.f.close()
+            if os.path.exists(tmpfilename):
+                _tryremove(tmpfilename, 1, 5)
+            return None
+        return cls.load(filename)
+
+    def append(self, offset, length, channel, line, newlines, textOffset,
+               textLine):
+        self.f.seek(0, 2)
+        self.f.write(self.RECORD.pack(offset, length, channel, line,
+                                      newlines, textOffset, textLine))
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        self.f.seek(0, 2)
+        return (self.f.tell() - self.HEADER.size) // self.RECORD.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        self.f.seek(self.HEADER.size + i * self.RECORD.size)
+        rec = self.f.read(self.RECORD.size)
+        if len(rec) != self.RECORD.size:
+            raise IndexError("log index record %d out of range" % i)
+        return self.RECORD.unpack(rec)
+
+    def getNewlineCount(self, textLines=False):
+        """Return the total number of newlines in the indexed log, or only
+        in its stdout and stderr if C{textLines} is true."""
+        n = len(self)
+        if not n:
+            return 0
+        rec = self[n-1]
+        return self._endLine(rec, textLines)
+
+    def _endLine(self, rec, textLines):
+        # the number of newlines before the end of this record
+        offset, length, channel, line, newlines, textOffset, textLine = rec
+        if not textLines:
+            return line + newlines
+        if channel in TEXT_CHANNELS:
+            return textLine + newlines
+        return textLine
+
+    def getTextLength(self):
+        """Return the number of stdout and stderr bytes in the indexed
+        log."""
+        n = len(self)
+        if not n:
+            return 0
+        offset, length, channel, line, newlines, textOffset, textLine = \
+                self[n-1]
+        if channel in TEXT_CHANNELS:
+            return textOffset + length
+        return textOffset
+
+    def findTextOffset(self, textOffset):
+        """
+        Return the number of the first record containing stdout or stderr
+        text at or after position C{textOffset} of L{LogFile.getText}, or
+        C{len(self)} if the text is shorter than that.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            rec = self[mid]
+            end = rec[5]
+            if rec[2] in TEXT_CHANNELS:
+                end += rec[1]
+            if end <= textOffset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def findLine(self, line, textLines=False):
+        """
+        Return the number of the first record containing text from line
+        C{line} (counting from zero), or C{len(self)} if the log has fewer
+        lines.  Line N begins just after the Nth newline in the log, or in
+        its stdout and stderr if C{textLines} is true.
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._endLine(self[mid], textLines) < line:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+class LogBlockCompressor:
+    """
+    I write log data to a block-compressed container.  The data is split into
+    blocks of C{BLOCKSIZE} bytes, each of which is compressed independently,
+    so that readers (L{LogBlockFile}) can decompress just the blocks they
+    need.  Blocks are compressed as soon as they are full, so a log can be
+    compressed incrementally while it is still being written.
+
+    The container consists of a header (magic, version, and compression
+    method), the compressed blocks, a block index with one record per block
+    giving (dataOffset, dataLength, fileOffset, compressedLength), and a
+    footer giving the position of the block index and the number of blocks.
+    """
+
+    MAGIC = "BBLB"
+    VERSION = 1
+    BLOCKSIZE = 64*1024
+    HEADER = struct.Struct("!4sBc")
+    BLOCK = struct.Struct("!QIQI")
+    FOOTER = struct.Struct("!QI4s")
+    METHODS = { 'bz2' : 'b', 'gz' : 'z' }
+
+    def __init__(self, filename, method):
+        self.filename = filename
+        self.method = method
+        if method == 'bz2':
+            self.compress = bz2.compress
+        else:
+            self.compress = zlib.compress
+        self.f = open(filename, "wb")
+        self.f.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                      self.METHODS[method]))
+        self.fileOffset = self.HEADER.size
+        self.dataOffset = 0
+        self.buffer = []
+        self.buffered = 0
+        self.blocks = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered < self.BLOCKSIZE:
+            return
+        data = "".join(self.buffer)
+        offset = 0
+        while len(data) - offset >= self.BLOCKSIZE:
+            self._writeBlock(data[offset:offset+self.BLOCKSIZE])
+            offset += self.BLOCKSIZE
+        data = data[offset:]
+        self.buffer = [ data ]
+        self.buffered = len(data)
+
+    def _writeBlock(self, data):
+        compressed = self.compress(data)
+        self.blocks.append((self.dataOffset, len(data),
+                            self.fileOffset, len(compressed)))
+        self.f.write(compressed)
+        self.dataOffset += len(data)
+        self.fileOffset += len(compressed)
+
+    def close(self):
+        """Compress any remaining data and write the block index."""
+        if self.buffered:
+            self._writeBlock("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+        self.f.write("".join([ self.BLOCK.pack(*b) for b in self.blocks ]))
+        self.f.write(self.FOOTER.pack(self.fileOffset, len(self.blocks),
+                                      self.MAGIC))
+        self.f.close()
+
+class LogBlockFile:
+    """
+    A read-only file-like object for a container written by
+    L{LogBlockCompressor}.  Seeking is cheap, and reads only decompress the
+    blocks containing the requested data.  The most recently decompressed
+    block is cached, so sequential reads decompress each block once.
+    """
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        try:
+            self._readIndex(filename)
+        except:
+            self.f.close()
+            raise
+        self.pos = 0
+        self.cachedBlock = None
+        self.cachedData = None
+
+    def _readIndex(self, filename):
+        c = LogBlockCompressor
+        hdr = self.f.read(c.HEADER.size)
+        if len(hdr) != c.HEADER.size:
+            raise IOError("%s is not a block-compressed log" % filename)
+        magic, version, method = c.HEADER.unpack(hdr)
+        if magic != c.MAGIC or version != c.VERSION:
+            raise IOError("%s is not a block-compressed log" % filename)
+        if method == c.METHODS['bz2']:
+            self.decompress = bz2.decompress
+        else:
+            self.decompress = zlib.decompress
+        self.f.seek(-c.FOOTER.size, 2)
+        indexOffset, count, magic = c.FOOTER.unpack(self.f.read(c.FOOTER.size))
+        if magic != c.MAGIC:
+            raise IOError("%s is truncated" % filename)
+        self.f.seek(indexOffset)
+        index = self.f.read(count * c.BLOCK.size)
+        if len(index) != count * c.BLOCK.size:
+            raise IOError("%s is truncated" % filename)
+        self.blocks = [ c.BLOCK.unpack_from(index, i * c.BLOCK.size)
+                        for i in xrange(count) ]
+        self.starts = [ b[0] for b in self.blocks ]
+        if self.blocks:
+            self.size = self.blocks[-1][0] + self.blocks[-1][1]
+        else:
+            self.size = 0
+
+    def _getBlock(self, i):
+        if i != self.cachedBlock:
+            dataOffset, dataLength, fileOffset, compLength = self.blocks[i]
+            self.f.seek(fileOffset)
+            self.cachedData = self.decompress(self.f.read(compLength))
+            self.cachedBlock = i
+        return self.cachedData
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, offset)
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.pos
+        pieces = []
+        while size > 0 and self.pos < self.size:
+            i = bisect_right(self.starts, self.pos) - 1
+            data = self._getBlock(i)
+            start = self.pos - self.starts[i]
+            piece = data[start:start+size]
+            pieces.append(piece)
+            self.pos += len(piece)
+            size -= len(piece)
+        return "".join(pieces)
+
+    def close(self):
+        self.f.close()
+
 class LogFileProducer:
     """What's the plan?
 
@@ -86,8 +466,16 @@ class LogFileProducer:
         consumer.registerProducer(self, True)
 
     def getChunks(self):
-        f = self.logfile.getFile()
         offset = 0
+        m = self.logfile._mapFile()
+        if m is not None:
+            # send what has been written so far from a memory map, then
+            # follow the file for anything written in the meantime
+            for chunk in self.logfile._generateMappedChunks(m, 0, len(m),
+                                            None, [], False, False):
+                yield chunk
+            offset = len(m)
+        f = self.logfile.getFile()
         chunks = []
         p = LogFileScanner(chunks.append)
         f.seek(offset)
@@ -202,6 +590,28 @@ class LogFile:
     BUFFERSIZE = 2048
     filename = None # relative to the Builder's basedir
     openfile = None
+    index = None
+    compressor = None
+    indexedLines = 0
+    indexedTextLength = 0
+    indexedTextLines = 0
+    # merged chunks are buffered, and written to the file together once
+    # writeBufferSize bytes are waiting, flushInterval seconds have passed
+    # since the last write, or the log is read
+    writeBufferSize = 64*1024
+    flushInterval = 1.0
+    pendingChunks = ()
+    pendingLength = 0
+    lastFlush = 0
+    flushTimer = None # flushes the buffer once flushInterval has passed
+    _reactor = reactor # for tests
+    syncing = None # Deferred while an fsync is running in a thread
+    syncAgain = False
+    # the compressor's work runs in threads, one operation at a time, under
+    # this lock
+    compressing = None
+    compressorFailed = False
+    indexing = None # Deferred while the index is built by buildIndex
 
     def __init__(self, parent, name, logfilename):
         """
@@ -226,8 +636,14 @@ class LogFile:
         dirname = os.path.dirname(fn)
         if not os.path.exists(dirname):
             os.makedirs(dirname)
+        if os.path.exists(fn + ".blk.tmp"):
+            # left behind by a master that stopped while compressing
+            _tryremove(fn + ".blk.tmp", 1, 5)
         self.openfile = open(fn, "w+")
+        self.index = LogChunkIndex.create(self.getIndexFilename())
         self.runEntries = []
+        self.pendingChunks = []
+        self.lastFlush = util.now()
         self.watchers = []
         self.finishedWatchers = []
         self.tailBuffer = []
@@ -240,6 +656,70 @@ class LogFile:
         """
         return os.path.join(self.step.build.builder.basedir, self.filename)
 
+    def getIndexFilename(self):
+        """
+        Get the filename of the L{LogChunkIndex} for this log file.
+
+        @returns: filename
+        """
+        return self.getFilename() + '.idx'
+
+    def getIndex(self):
+        """
+        Get the L{LogChunkIndex} for this log file.  Logs written before
+        indexes existed are indexed in a thread on first use (see
+        L{buildIndex}), and readers scan the log until the index is in
+        place.  Pass the index to L{_releaseReader} when done.
+
+        @returns: L{LogChunkIndex} instance, or None if no index is available
+        """
+        if self.index is not None:
+            self._flushWrites()
+            return self.index
+        idx = LogChunkIndex.load(self.getIndexFilename())
+        if idx is None and self.finished and self.hasContents():
+            self.buildIndex()
+        return idx
+
+    def buildIndex(self):
+        """
+        Build and save the L{LogChunkIndex} for a finished log written before
+        indexes existed, in a thread.  If the index cannot be built, it is not
+        tried again until this log is reloaded.
+
+        @returns: Deferred that fires when the index is in place
+        """
+        if self.indexing is not None:
+            return self.indexing
+        fn = self.getIndexFilename()
+        log.msg("building log index %s" % fn)
+        f = self.getFile()
+        def build():
+            try:
+                idx = LogChunkIndex.build(fn, f)
+            finally:
+                self._releaseReader(f)
+            if idx is None:
+                return False
+            idx.close()
+            return True
+        d = self.indexing = threads.deferToThread(build)
+        def done(built):
+            if built:
+                # later readers load the new index
+                self.indexing = None
+        d.addCallback(done)
+        d.addErrback(log.err, "while building log index %s" % fn)
+        return d
+
+    def _releaseReader(self, *readers):
+        # close the indexes and files opened for reading by getIndex and
+        # _getReadFile, but not those this log is writing
+        for r in readers:
+            if r is not None and r is not self.index \
+                    and r is not self.openfile:
+                r.close()
+
     def hasContents(self):
         """
         Return true if this logfile's contents are available.  For a newly
@@ -249,7 +729,8 @@ class LogFile:
 
         @returns: boolean
         """
-        return os.path.exists(self.getFilename() + '.bz2') or \
+        return os.path.exists(self.getFilename() + '.blk') or \
+            os.path.exists(self.getFilename() + '.bz2') or \
             os.path.exists(self.getFilename() + '.gz') or \
             os.path.exists(self.getFilename())
 
@@ -302,10 +783,16 @@ class LogFile:
         """
         if self.openfile:
             # this is the filehandle we're using to write to the log, so
-            # don't close it!
+            # don't close it!  Readers must see everything merged so far.
+            self._flushWrites()
             return self.openfile
         # otherwise they get their own read-only handle
-        # try a compressed log first
+        # try a compressed log first; block-compressed logs support cheap
+        # seeks, while whole-file bz2 and gz logs are from older versions
+        try:
+            return LogBlockFile(self.getFilename() + ".blk")
+        except IOError:
+            pass
         try:
             return BZ2File(self.getFilename() + ".bz2", "r")
         except IOError:
@@ -336,6 +823,30 @@ class LogFile:
         # data, you must insure that nothing will be added to the log during
         # yield() calls.
 
+        return self._getChunks(channels, onlyText, buffers=False)
+
+    def getChunkBuffers(self, channels=[], onlyText=False):
+        """
+        Like L{getChunks}, but for an uncompressed log, the text of each chunk
+        is a read-only C{buffer} into a memory map of the log file, rather
+        than a copy.  Buffers can be searched with regular expressions, or
+        converted to strings with C{str}; they remain valid after the log is
+        compressed or deleted.
+        """
+        return self._getChunks(channels, onlyText, buffers=True)
+
+    def _getChunks(self, channels, onlyText, buffers):
+        leftover = None
+        if self.runEntries and (not channels or
+                                (self.runEntries[0][0] in channels)):
+            leftover = (self.runEntries[0][0],
+                        "".join([c[1] for c in self.runEntries]))
+
+        m = self._mapFile()
+        if m is not None:
+            return self._generateMappedChunks(m, 0, len(m), leftover,
+                                              channels, onlyText, buffers)
+
         f = self.getFile()
         if not self.finished:
             offset = 0
@@ -345,17 +856,76 @@ class LogFile:
             offset = 0
             remaining = None
 
-        leftover = None
-        if self.runEntries and (not channels or
-                                (self.runEntries[0][0] in channels)):
-            leftover = (self.runEntries[0][0],
-                        "".join([c[1] for c in self.runEntries]))
-
         # freeze the state of the LogFile by passing a lot of parameters into
         # a generator
         return self._generateChunks(f, offset, remaining, leftover,
                                     channels, onlyText)
 
+    def _mapFile(self):
+        """
+        Map the uncompressed log file into memory, so that chunks can be
+        sliced out of it without copying the file through read buffers and
+        the netstring parser.  Only the part of the file written so far is
+        mapped.
+
+        @returns: read-only mmap object, or None if the log is compressed,
+        empty, or cannot be mapped
+        """
+        if self.openfile:
+            self._flushWrites()
+            f = self.openfile
+            f.flush()
+        else:
+            fn = self.getFilename()
+            for suffix in ('.blk', '.bz2', '.gz'):
+                if os.path.exists(fn + suffix):
+                    return None
+            try:
+                f = open(fn, "rb")
+            except IOError:
+                return None
+        try:
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    return None
+                return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                return None
+        finally:
+            # the map remains valid after the file is closed
+            if f is not self.openfile:
+                f.close()
+
+    def _generateMappedChunks(self, m, pos, end, leftover, channels,
+                              onlyText, buffers):
+        while pos < end:
+            colon = m.find(":", pos, end)
+            if colon < 0 or colon + 1 >= end:
+                break
+            size = int(m[pos:colon]) - 1
+            channel = int(m[colon+1])
+            start = colon + 2
+            if start + size >= end:
+                break # incomplete netstring
+            pos = start + size + 1
+            if channels and channel not in channels:
+                continue
+            if buffers:
+                text = buffer(m, start, size)
+            else:
+                text = m[start:start+size]
+            if onlyText:
+                yield text
+            else:
+                yield (channel, text)
+
+        if leftover:
+            if onlyText:
+                yield leftover[1]
+            else:
+                yield leftover
+
     def _generateChunks(self, f, offset, remaining, leftover,
                         channels, onlyText):
         chunks = []
@@ -391,12 +961,224 @@ class LogFile:
             else:
                 yield leftover
 
+    def getLineCount(self, textLines=False):
+        """
+        Return the number of lines in the log, including header lines unless
+        C{textLines} is true, in which case only the lines of stdout and
+        stderr (as in L{getText}) are counted.  A partial line at the end of
+        the log counts as a line.
+
+        @returns: integer
+        """
+        if not self.finished:
+            self._merge()
+        if textLines:
+            channels = TEXT_CHANNELS
+        else:
+            channels = []
+        idx = self.getIndex()
+        if idx is None:
+            count = 0
+            text = ''
+            for text in self.getChunks(channels, onlyText=True):
+                count += text.count("\n")
+        else:
+            try:
+                count = idx.getNewlineCount(textLines)
+                text = ''
+                # find the last record that is counted
+                i = len(idx) - 1
+                while i >= 0 and channels and idx[i][2] not in channels:
+                    i -= 1
+                if i >= 0:
+                    offset, length = idx[i][:2]
+                    f = self._getReadFile()
+                    try:
+                        f.seek(offset + length - 1)
+                        text = f.read(1)
+                    finally:
+                        self._releaseReader(f)
+            finally:
+                self._releaseReader(idx)
+        if text and not text.endswith("\n"):
+            count += 1
+        return count
+
+    def getLineChunks(self, first, last=None, channels=[], onlyText=False,
+                      textLines=False):
+        """
+        Generate the chunks containing lines C{first} (inclusive) through
+        C{last} (exclusive) of the log, counting from zero and including
+        header lines.  If C{textLines} is true, lines are counted in stdout
+        and stderr only, and header chunks are not generated.  The chunks at
+        either end are trimmed at line boundaries.  If C{last} is None,
+        chunks are generated through the end of the log.
+
+        The log index is used to seek directly to the first line, so this
+        does not need to read the part of the log before it.  Like
+        L{getChunks}, this only delivers the log as it existed when called.
+        """
+        if not self.finished:
+            self._merge()
+        if textLines:
+            channels = [ c for c in channels or TEXT_CHANNELS
+                         if c in TEXT_CHANNELS ]
+        idx = self.getIndex()
+        if idx is None:
+            if textLines:
+                chunks = self.getChunks(TEXT_CHANNELS)
+            else:
+                chunks = self.getChunks()
+            records = self._scannedRecords(chunks)
+        else:
+            records = self._indexedRecords(idx, self._getReadFile(), first,
+                                           channels, textLines)
+        return self._generateLineChunks(records, first, last, channels,
+                                        onlyText)
+
+    def getTailChunks(self, lines, channels=[], onlyText=False,
+                      textLines=False):
+        """
+        Generate the chunks containing the last C{lines} lines of the log,
+        as for L{getLineChunks}.
+        """
+        first = max(0, self.getLineCount(textLines) - lines)
+        return self.getLineChunks(first, None, channels, onlyText, textLines)
+
+    def getTextLength(self):
+        """
+        Return the length of the string L{getText} would return, without
+        building that string.
+
+        @returns: integer
+        """
+        if not self.finished:
+            self._merge()
+        idx = self.getIndex()
+        if idx is None:
+            length = 0
+            for text in self.getChunks(TEXT_CHANNELS, onlyText=True):
+                length += len(text)
+            return length
+        try:
+            return idx.getTextLength()
+        finally:
+            self._releaseReader(idx)
+
+    def getTextRangeChunks(self, start, end=None):
+        """
+        Generate strings containing bytes C{start} (inclusive) through C{end}
+        (exclusive) of L{getText}.  If C{end} is None, generate through the
+        end of the log.  The log index is used to seek directly to C{start}.
+        """
+        if not self.finished:
+            self._merge()
+        idx = self.getIndex()
+        if idx is None:
+            pieces = self._scannedTextPieces(
+                    self.getChunks(TEXT_CHANNELS, onlyText=True))
+        else:
+            pieces = self._indexedTextPieces(idx, self._getReadFile(), start)
+        return self._generateTextRange(pieces, start, end)
+
+    def _getReadFile(self):
+        # a memory map supports seek and read, without a read buffer
+        m = self._mapFile()
+        if m is not None:
+            return m
+        return self.getFile()
+
+    def _indexedTextPieces(self, idx, f, start):
+        # the index and file are released when the generator is closed
+        try:
+            for i in xrange(idx.findTextOffset(start), len(idx)):
+                offset, length, channel, line, newlines, textOffset, _ = \
+                        idx[i]
+                if channel not in TEXT_CHANNELS:
+                    continue
+                f.seek(offset)
+                yield textOffset, f.read(length)
+        finally:
+            self._releaseReader(idx, f)
+
+    def _scannedTextPieces(self, texts):
+        textOffset = 0
+        for text in texts:
+            yield textOffset, text
+            textOffset += len(text)
+
+    def _generateTextRange(self, pieces, start, end):
+        for textOffset, text in pieces:
+            if end is not None and textOffset >= end:
+                break
+            if textOffset + len(text) <= start:
+                continue
+            first = max(0, start - textOffset)
+            if end is not None:
+                text = text[first:end - textOffset]
+            elif first:
+                text = text[first:]
+            if text:
+                yield text
+
+    def _indexedRecords(self, idx, f, first, channels, textLines=False):
+        # the index and file are released when the generator is closed
+        try:
+            for i in xrange(idx.findLine(first, textLines), len(idx)):
+                offset, length, channel, line, newlines, textOffset, \
+                        textLine = idx[i]
+                if textLines:
+                    # other channels take up no lines
+                    if channel not in TEXT_CHANNELS:
+                        continue
+                    line = textLine
+                text = None
+                if not channels or channel in channels:
+                    f.seek(offset)
+                    text = f.read(length)
+                yield channel, line, newlines, text
+        finally:
+            self._releaseReader(idx, f)
+
+    def _scannedRecords(self, chunks):
+        line = 0
+        for channel, text in chunks:
+            newlines = text.count("\n")
+            yield channel, line, newlines, text
+            line += newlines
+
+    def _generateLineChunks(self, records, first, last, channels, onlyText):
+        for channel, line, newlines, text in records:
+            if last is not None and line >= last:
+                break
+            if line + newlines < first:
+                continue
+            if channels and channel not in channels:
+                continue
+            start, end = 0, len(text)
+            if line < first:
+                start = _afterNewline(text, first - line)
+            if last is not None and line + newlines >= last:
+                end = _afterNewline(text, last - line)
+            if start > 0 or end < len(text):
+                text = text[start:end]
+            if not text:
+                continue
+            if onlyText:
+                yield text
+            else:
+                yield (channel, text)
+
     def readlines(self):
         """Return an iterator that produces newline-terminated lines,
         excluding header chunks."""
-        alltext = "".join(self.getChunks([STDOUT], onlyText=True))
-        io = StringIO(alltext)
-        return io.readlines()
+        lines = [ line + "\n" for line in
+                  splitLines(self.getChunks([STDOUT], onlyText=True)) ]
+        # the last line has no newline, and is omitted if it is empty
+        lines[-1] = lines[-1][:-1]
+        if not lines[-1]:
+            lines.pop()
+        return lines
 
     def subscribe(self, receiver, catchup):
         if self.finished:
@@ -419,25 +1201,141 @@ class LogFile:
     # interface used by the build steps to add things to the log
 
     def _merge(self):
-        # merge all .runEntries (which are all of the same type) into a
-        # single chunk for .entries
+        # merge all .runEntries (which are all of the same type) into chunks
+        # waiting to be written
         if not self.runEntries:
             return
         channel = self.runEntries[0][0]
         text = "".join([c[1] for c in self.runEntries])
         assert channel < 10, "channel number must be a single decimal digit"
-        f = self.openfile
-        f.seek(0, 2)
         offset = 0
         while offset < len(text):
             size = min(len(text)-offset, self.chunkSize)
-            f.write("%d:%d" % (1 + size, channel))
-            f.write(text[offset:offset+size])
-            f.write(",")
+            self.pendingChunks.append((channel, text[offset:offset+size]))
             offset += size
+        self.pendingLength += len(text)
         self.runEntries = []
         self.runLength = 0
 
+        delay = self.lastFlush + self.flushInterval - util.now()
+        if self.pendingLength >= self.writeBufferSize or delay <= 0:
+            self._flushWrites()
+        elif self.flushTimer is None:
+            # don't leave the chunks unwritten if no more entries arrive
+            self.flushTimer = self._reactor.callLater(delay,
+                                                      self._flushTimerFired)
+
+    def _flushTimerFired(self):
+        self.flushTimer = None
+        if self.openfile is None:
+            return
+        self._merge()
+        self._flushWrites()
+
+    def _flushWrites(self, sync=True):
+        # write all pending chunks to the end of the file, with a single write
+        if self.flushTimer is not None:
+            self.flushTimer.cancel()
+            self.flushTimer = None
+        if not self.pendingChunks:
+            return
+        f = self.openfile
+        f.seek(0, 2)
+        pos = f.tell()
+        written = []
+        for channel, chunk in self.pendingChunks:
+            header = "%d:%d" % (1 + len(chunk), channel)
+            written.extend([header, chunk, ","])
+            self._indexChunk(pos + len(header), chunk, channel)
+            pos += len(header) + len(chunk) + 1
+        data = "".join(written)
+        f.write(data)
+        self.pendingChunks = []
+        self.pendingLength = 0
+        self.lastFlush = util.now()
+
+        if self.compressor is not None:
+            self._runCompressor(self.compressor.write, data)
+        else:
+            self._maybeStartCompressor(pos)
+        if sync and self.master.config.logFsync:
+            self._syncWrites(f)
+
+    def _syncWrites(self, f):
+        # flush the file and fsync it in a thread, so that the reactor does
+        # not wait for the disk; at most one sync runs at a time
+        if self.syncing is not None:
+            self.syncAgain = True
+            return
+        def sync():
+            f.flush()
+            os.fsync(f.fileno())
+        self.syncing = threads.deferToThread(sync)
+        self.syncing.addErrback(log.err, "while syncing %s"
+                                         % self.getFilename())
+        def done(_):
+            self.syncing = None
+            if self.syncAgain:
+                self.syncAgain = False
+                self._syncWrites(f)
+        self.syncing.addCallback(done)
+
+    def _maybeStartCompressor(self, size):
+        # once the log is big enough that it will be compressed when the step
+        # finishes, start compressing it block-by-block as it is written
+        config = self.master.config
+        method = config.logCompressionMethod
+        limit = config.logCompressionLimit
+        if method not in LogBlockCompressor.METHODS or limit is False:
+            return
+        if size <= limit:
+            return
+        # the data written so far is read back with a separate handle, in
+        # the compressor's thread
+        self.openfile.flush()
+        filename = self.getFilename()
+        compressor = self.compressor = LogBlockCompressor(
+                filename + ".blk.tmp", method)
+        self.compressing = defer.DeferredLock()
+        def readBack():
+            f = open(filename, "rb")
+            try:
+                remaining = size
+                while remaining > 0:
+                    data = f.read(min(remaining, 1024*1024))
+                    if not data:
+                        break
+                    compressor.write(data)
+                    remaining -= len(data)
+            finally:
+                f.close()
+        self._runCompressor(readBack)
+
+    def _runCompressor(self, fn, *args):
+        # run a compressor operation in a thread, after any earlier ones; once
+        # one fails, the rest are skipped and compressLog compresses the whole
+        # log instead
+        def run():
+            if not self.compressorFailed:
+                fn(*args)
+        d = self.compressing.run(threads.deferToThread, run)
+        def failed(f):
+            self.compressorFailed = True
+            log.err(f, "while compressing %s" % self.getFilename())
+        d.addErrback(failed)
+        return d
+
+    def _indexChunk(self, offset, text, channel):
+        newlines = text.count("\n")
+        if self.index is not None:
+            self.index.append(offset, len(text), channel, self.indexedLines,
+                              newlines, self.indexedTextLength,
+                              self.indexedTextLines)
+        self.indexedLines += newlines
+        if channel in TEXT_CHANNELS:
+            self.indexedTextLength += len(text)
+            self.indexedTextLines += newlines
+
     def addEntry(self, channel, text, _no_watchers=False):
         """
         Add an entry to the logfile.  The C{channel} is one of L{STDOUT},
@@ -551,11 +1449,32 @@ class LogFile:
             self.tailBuffer = []
 
         if self.openfile:
+            self._flushWrites(sync=False)
             # we don't do an explicit close, because there might be readers
             # shareing the filehandle. As soon as they stop reading, the
             # filehandle will be released and automatically closed.
-            self.openfile.flush()
+            if self.master.config.logFsync:
+                self._syncWrites(self.openfile)
+            else:
+                self.openfile.flush()
             self.openfile = None
+        if self.index is not None:
+            # as with openfile, readers may still be using the index
+            self.index.flush()
+            self.index = None
+        if self.compressor is not None:
+            # compress the last block and move the result into place, even if
+            # compressLog is not called
+            self._runCompressor(self.compressor.close)
+            def install():
+                if not self.compressorFailed:
+                    self._installCompressedLog()
+            d = self.compressing.run(install)
+            def failed(f):
+                self.compressorFailed = True
+                log.err(f, "while compressing %s" % self.getFilename())
+            d.addErrback(failed)
+            self.compressor = None
         self.finished = True
         watchers = self.finishedWatchers
         self.finishedWatchers = []
@@ -564,46 +1483,55 @@ class LogFile:
         self.watchers = []
 
 
+    def _installCompressedLog(self):
+        # replace the log with its compressed version, once the compressor
+        # has finished with it
+        compressed = self.getFilename() + ".blk.tmp"
+        filename = self.getFilename() + '.blk'
+        if runtime.platformType  == 'win32':
+            # windows cannot rename a file on top of an existing one, so
+            # fall back to delete-first. There are ways this can fail and
+            # lose the builder's history, so we avoid using it in the
+            # general (non-windows) case
+            if os.path.exists(filename):
+                os.unlink(filename)
+        os.rename(compressed, filename)
+        _tryremove(self.getFilename(), 1, 5)
+
     def compressLog(self):
+        if self.compressing is not None and not self.compressorFailed:
+            # the log was compressed as it was written, and finish put the
+            # result in place; wait for that to complete
+            d = self.compressing.run(defer.succeed, None)
+            def check(_):
+                if self.compressorFailed:
+                    return self._compressWholeLog()
+            d.addCallback(check)
+            return d
+        return self._compressWholeLog()
+
+    def _compressWholeLog(self):
+        compressed = self.getFilename() + ".blk.tmp"
         logCompressionMethod = self.master.config.logCompressionMethod
         # bail out if there's no compression support
-        if logCompressionMethod == "bz2":
-            compressed = self.getFilename() + ".bz2.tmp"
-        elif logCompressionMethod == "gz":
-            compressed = self.getFilename() + ".gz.tmp"
-        else:
+        if logCompressionMethod not in LogBlockCompressor.METHODS:
             return defer.succeed(None)
 
         def _compressLog():
             infile = self.getFile()
-            if logCompressionMethod == "bz2":
-                cf = BZ2File(compressed, 'w')
-            elif logCompressionMethod == "gz":
-                cf = GzipFile(compressed, 'w')
+            cf = LogBlockCompressor(compressed, logCompressionMethod)
             bufsize = 1024*1024
-            while True:
-                buf = infile.read(bufsize)
-                cf.write(buf)
-                if len(buf) < bufsize:
-                    break
-            cf.close()
+            try:
+                while True:
+                    buf = infile.read(bufsize)
+                    cf.write(buf)
+                    if len(buf) < bufsize:
+                        break
+                cf.close()
+            finally:
+                self._releaseReader(infile)
         d = threads.deferToThread(_compressLog)
-
-        def _renameCompressedLog(rv):
-            if logCompressionMethod == "bz2":
-                filename = self.getFilename() + '.bz2'
-            else:
-                filename = self.getFilename() + '.gz'
-            if runtime.platformType  == 'win32':
-                # windows cannot rename a file on top of an existing one, so
-                # fall back to delete-first. There are ways this can fail and
-                # lose the builder's history, so we avoid using it in the
-                # general (non-windows) case
-                if os.path.exists(filename):
-                    os.unlink(filename)
-            os.rename(compressed, filename)
-            _tryremove(self.getFilename(), 1, 5)
-        d.addCallback(_renameCompressedLog)
+        d.addCallback(lambda _ : self._installCompressedLog())
 
         def _cleanupFailedCompress(failure):
             log.msg("failed to compress %s" % self.getFilename())
@@ -626,6 +1554,19 @@ class LogFile:
             del d['finished']
         if d.has_key('openfile'):
             del d['openfile']
+        if d.has_key('index'):
+            del d['index']
+        if d.has_key('compressor'):
+            del d['compressor']
+        d.pop('pendingChunks', None)
+        d.pop('pendingLength', None)
+        d.pop('lastFlush', None)
+        d.pop('flushTimer', None)
+        d.pop('syncing', None)
+        d.pop('syncAgain', None)
+        d.pop('compressing', None)
+        d.pop('compressorFailed', None)
+        d.pop('indexing', None)
         return d
 
     def __setstate__(self, d):
@@ -681,6 +1622,34 @@ class HTMLLogFile:
         return d
 
 
+def splitLines(texts):
+    """
+    Generate the same strings as C{"".join(texts).split("\\n")}, but without
+    joining the texts, so that a log can be processed line-by-line while
+    only one chunk is in memory.  Lines that span several texts are joined.
+
+    @param texts: iterable of strings, e.g., from L{LogFile.getChunks}
+    """
+    partial = []
+    for text in texts:
+        pieces = text.split("\n")
+        if len(pieces) > 1:
+            partial.append(pieces[0])
+            yield "".join(partial)
+            for piece in pieces[1:-1]:
+                yield piece
+            partial = []
+        if pieces[-1]:
+            partial.append(pieces[-1])
+    yield "".join(partial)
+
+def _afterNewline(text, n):
+    """Return the position just after the C{n}th newline in C{text}"""
+    pos = 0
+    for i in xrange(n):
+        pos = text.index("\n", pos) + 1
+    return pos
+
 def _tryremove(filename, timeout, retries):
     """Try to remove a file, and if failed, try again in timeout.
     Increases the timeout by a factor of 4, and only keeps trying for
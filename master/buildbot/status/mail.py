@@ -154,7 +154,7 @@ def defaultMessage(mode, name, build, results, master_status):
     return { 'body' : text, 'type' : 'plain' }
 
 def defaultGetPreviousBuild(current_build):
-        return current_build.getPreviousBuild()
+        return current_build.getPreviousBuildAsync()
 
 class MailNotifier(base.StatusReceiverMultiService):
     """This is a status notifier which sends email to a list of recipients
@@ -313,7 +313,8 @@ class MailNotifier(base.StatusReceiverMultiService):
         @type previousBuildGetter: func
         @param previousBuildGetter: function taking a BuildStatus instance
                                     returning a BuildStatus of the build
-                                    previous to the one passed in. This allows
+                                    previous to the one passed in, or a
+                                    Deferred firing with it. This allows
                                     to implement a relative ordering between
                                     builds other than the default one, which is
                                     chronological.
@@ -430,15 +431,26 @@ class MailNotifier(base.StatusReceiverMultiService):
         pass
 
     def isMailNeeded(self, build, results):
+        """
+        Decide whether to send mail about C{build}.
+
+        @returns: boolean via Deferred
+        """
         # here is where we actually do something.
         builder = build.getBuilder()
         if self.builders is not None and builder.name not in self.builders:
-            return False # ignore this build
+            return defer.succeed(False) # ignore this build
         if self.categories is not None and \
                builder.category not in self.categories:
-            return False # ignore this build
+            return defer.succeed(False) # ignore this build
+
+        # the previous build is loaded asynchronously, so that it is in memory
+        # by the time the message formatter looks at it
+        d = defer.maybeDeferred(self.getPreviousBuild, build)
+        d.addCallback(self._isMailNeeded, results)
+        return d
 
-        prev = self.getPreviousBuild(build)
+    def _isMailNeeded(self, prev, results):
         if "change" in self.mode:
             if prev and prev.getResults() != results:
                 return True
@@ -457,23 +469,32 @@ class MailNotifier(base.StatusReceiverMultiService):
         return False
 
     def buildFinished(self, name, build, results):
-        if ( not self.buildSetSummary and
-             self.isMailNeeded(build, results) ):
-            # for testing purposes, buildMessage returns a Deferred that fires
-            # when the mail has been sent. To help unit tests, we return that
-            # Deferred here even though the normal IStatusReceiver.buildFinished
-            # signature doesn't do anything with it. If that changes (if
-            # .buildFinished's return value becomes significant), we need to
-            # rearrange this.
-            return self.buildMessage(name, [build], results)
-        return None
-    
+        if self.buildSetSummary:
+            return None
+        # for testing purposes, buildMessage returns a Deferred that fires
+        # when the mail has been sent. To help unit tests, we return a
+        # Deferred firing with that here even though the normal
+        # IStatusReceiver.buildFinished signature doesn't do anything with it.
+        # If that changes (if .buildFinished's return value becomes
+        # significant), we need to rearrange this.
+        d = defer.maybeDeferred(self.isMailNeeded, build, results)
+        def send(needed):
+            if needed:
+                return self.buildMessage(name, [build], results)
+        d.addCallback(send)
+        return d
+
+    @defer.inlineCallbacks
     def _gotBuilds(self, res, buildset):
         builds = []
         for (builddictlist, builder) in res:
             for builddict in builddictlist:
-                build = builder.getBuild(builddict['number'])
-                if build is not None and self.isMailNeeded(build, build.results):
+                build = yield builder.getBuildAsync(builddict['number'])
+                if build is None:
+                    continue
+                needed = yield defer.maybeDeferred(self.isMailNeeded,
+                                                   build, build.results)
+                if needed:
                     builds.append(build)
 
         if builds:
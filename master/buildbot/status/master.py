@@ -16,9 +16,7 @@
 from __future__ import with_statement
 
 import os, urllib
-from cPickle import load
-from twisted.python import log
-from twisted.persisted import styles
+from twisted.python import log, threadpool
 from twisted.internet import defer
 from twisted.application import service
 from zope.interface import implements
@@ -48,6 +46,10 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         self._build_request_sub = None
         self._change_sub = None
 
+        # threads used to load historical builds from disk; see
+        # BuilderStatus.getBuildAsync
+        self.loadPool = None
+
     # service management
 
     def startService(self):
@@ -65,6 +67,10 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
             self.master.subscribeToChanges(
                 self.changeAdded)
 
+        self.loadPool = threadpool.ThreadPool(minthreads=0, maxthreads=2,
+                                              name='BuildLoaderThreadPool')
+        self.loadPool.start()
+
         return service.MultiService.startService(self)
 
     @defer.inlineCallbacks
@@ -104,6 +110,9 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         if self._change_sub:
             self._change_sub.unsubscribe()
             self._change_sub = None
+        if self.loadPool:
+            self.loadPool.stop()
+            self.loadPool = None
 
         return service.MultiService.stopService(self)
 
@@ -331,42 +340,16 @@ class Status(config.ReconfigurableServiceMixin, service.MultiService):
         @rtype: L{BuilderStatus}
         """
         filename = os.path.join(self.basedir, basedir, "builder")
-        log.msg("trying to load status pickle from %s" % filename)
-        builder_status = None
-        try:
-            with open(filename, "rb") as f:
-                builder_status = load(f)
-            builder_status.master = self.master
-
-            # (bug #1068) if we need to upgrade, we probably need to rewrite
-            # this pickle, too.  We determine this by looking at the list of
-            # Versioned objects that have been unpickled, and (after doUpgrade)
-            # checking to see if any of them set wasUpgraded.  The Versioneds'
-            # upgradeToVersionNN methods all set this.
-            versioneds = styles.versionedsToUpgrade
-            styles.doUpgrade()
-            if True in [ hasattr(o, 'wasUpgraded') for o in versioneds.values() ]:
-                log.msg("re-writing upgraded builder pickle")
-                builder_status.saveYourself()
-
-        except IOError:
+        builder_status = builder.BuilderStatus(name, category, self.master,
+                                               description)
+        if os.path.exists(filename):
+            # the saved state is only loaded when it is first needed
+            builder_status.setLazyPickle(filename)
+        else:
             log.msg("no saved status pickle, creating a new one")
-        except:
-            log.msg("error while loading status pickle, creating a new one")
-            log.msg("error follows:")
-            log.err()
-        if not builder_status:
-            builder_status = builder.BuilderStatus(name, category, self.master,
-                                                   description)
             builder_status.addPointEvent(["builder", "created"])
         log.msg("added builder %s in category %s" % (name, category))
-        # an unpickled object might not have category set from before,
-        # so set it here to make sure
-        builder_status.category = category
-        builder_status.description = description
-        builder_status.master = self.master
         builder_status.basedir = os.path.join(self.basedir, basedir)
-        builder_status.name = name # it might have been updated
         builder_status.status = self
 
         if not os.path.isdir(builder_status.basedir):
@@ -0,0 +1,291 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os, re, errno, time
+from twisted.python import log, runtime
+from twisted.internet import defer, reactor, threads, task
+from buildbot.process import metrics
+from buildbot.status.logfile import LOGFILE_SUFFIXES
+
+class BuildPruner(object):
+    """
+    I delete the pickles and logfiles of a builder's old builds.
+
+    Rather than listing the builder's directory on every prune, I remember
+    how far pruning has progressed (in C{prune_horizon}) and delete
+    build-number ranges from there up to the new horizons.  The logfiles of
+    each build are found in the builder's build summaries; only builds
+    without a summary require a directory listing, which is made at most
+    once per run.  Builds that are loaded in memory are skipped, and
+    remembered with the horizons, so that each is tried again on later runs
+    while the horizons move on.
+
+    The work is done in batches of C{batchSize} builds, in a thread, with a
+    pause of C{batchInterval} seconds between batches, so a large change in
+    the horizons does not stall the master.
+    """
+
+    batchSize = 50
+    batchInterval = 0.1
+
+    filename = 'prune_horizon'
+
+    _reactor = reactor # for tests
+
+    def __init__(self, builder_status):
+        self.builder_status = builder_status
+        self.earliest_build = self.earliest_log = 0
+        # all build pickles before pruned_builds, and all logfiles before
+        # pruned_logs, have been deleted, except for those of the builds in
+        # skipped, which maps build number to whether the build's pickle is
+        # to be deleted, or only its logfiles; None until loaded
+        self.pruned_builds = self.pruned_logs = self.skipped = None
+        self.running = None
+        # for the current run: the next build whose pickle, and whose logs,
+        # are to be deleted; the skipped builds still to be retried; the
+        # skipped builds once the current batch is deleted; and the
+        # builder's logfiles by build number, once the directory is listed
+        self.next_build = self.next_log = None
+        self.retry = self.next_skipped = None
+        self.listing = None
+
+    def prune(self, earliest_build, earliest_log):
+        """
+        Delete the pickles of builds before C{earliest_build} and the
+        logfiles of builds before C{earliest_log}.  If pruning is already in
+        progress, it continues to the new horizons.
+
+        @returns: Deferred that fires when pruning is complete
+        """
+        self.earliest_build = earliest_build
+        self.earliest_log = max(earliest_log, earliest_build)
+        if self.running is None:
+            self.running = self._run()
+            def done(x):
+                self.running = None
+                return x
+            self.running.addBoth(done)
+        return self.running
+
+    @defer.inlineCallbacks
+    def _run(self):
+        basedir = self.builder_status.basedir
+        try:
+            if self.pruned_builds is None:
+                self.pruned_builds, self.pruned_logs, self.skipped = \
+                    yield threads.deferToThread(self._loadState, basedir)
+            self.next_build, self.next_log = \
+                    self.pruned_builds, self.pruned_logs
+            self.retry = sorted(self.skipped.items())
+            self.next_skipped = self.skipped.copy()
+            self.listing = None
+            store = self.builder_status.getSummaryStore()
+
+            while True:
+                batch = self._nextBatch()
+                state = self._batchState()
+                if not batch:
+                    # but remember any builds that were skipped
+                    if state != (self.pruned_builds, self.pruned_logs,
+                                 self.skipped):
+                        yield threads.deferToThread(self._saveState,
+                                                    basedir, state)
+                        self.pruned_builds, self.pruned_logs, self.skipped = \
+                                state
+                    break
+                start = time.time()
+                count = yield threads.deferToThread(self._deleteBatch,
+                        basedir, store, batch, state)
+                self.pruned_builds, self.pruned_logs, self.skipped = state
+
+                metrics.MetricCountEvent.log('BuildPruner.builds',
+                        len([ n for n, b in batch if b ]))
+                metrics.MetricCountEvent.log('BuildPruner.files', count)
+                metrics.MetricCountEvent.log(
+                        'BuildPruner.%s.remaining' % self.builder_status.name,
+                        self._remaining(), absolute=True)
+                metrics.MetricTimeEvent.log('BuildPruner.batch',
+                        time.time() - start)
+                log.msg("pruned %d files for builds %d-%d of builder %s"
+                        % (count, batch[0][0], batch[-1][0],
+                           self.builder_status.name))
+
+                yield task.deferLater(self._reactor, self.batchInterval,
+                                      lambda : None)
+        except Exception:
+            log.err(None, "while pruning builder %s"
+                          % (self.builder_status.name,))
+        self.listing = None
+
+        store = self.builder_status.getSummaryStore()
+        if store is not None and self.pruned_builds:
+            try:
+                yield store.removeBuildsBefore(self.pruned_builds)
+            except Exception:
+                log.err()
+
+    def _remaining(self):
+        return max(0, self.earliest_build - self.pruned_builds) + \
+               max(0, self.earliest_log - max(self.pruned_logs,
+                                              self.earliest_build)) + \
+               len(self.skipped)
+
+    def _nextBatch(self):
+        # return a list of (number, delete_pickle) for the next builds to
+        # prune, skipping any build that is currently loaded
+        cache = self.builder_status.buildCache.cache
+        batch = []
+        # builds skipped by earlier runs come first
+        while self.retry and len(batch) < self.batchSize:
+            n, delete_pickle = self.retry.pop(0)
+            if n in cache:
+                continue
+            if not delete_pickle and n < self.earliest_build:
+                continue # its pickle will be deleted below, with its logs
+            del self.next_skipped[n]
+            batch.append((n, delete_pickle))
+        n = self.next_build
+        while n < self.earliest_build and len(batch) < self.batchSize:
+            if n in cache:
+                self.next_skipped[n] = True
+            else:
+                self.next_skipped.pop(n, None)
+                batch.append((n, True))
+            n += 1
+        self.next_build = n
+        n = max(n, self.next_log)
+        while n < self.earliest_log and len(batch) < self.batchSize:
+            if n in cache:
+                self.next_skipped[n] = False
+            else:
+                batch.append((n, False))
+            n += 1
+        self.next_log = n
+        return batch
+
+    def _batchState(self):
+        # the state once the batch returned by _nextBatch is deleted
+        return (self.next_build, max(self.next_log, self.next_build),
+                self.next_skipped.copy())
+
+    # the following methods run in a thread
+
+    def _loadState(self, basedir):
+        path = os.path.join(basedir, self.filename)
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+            pruned_builds, pruned_logs = map(int, lines[0].split())
+            # the following lines list the skipped builds
+            skipped = {}
+            for line in lines[1:]:
+                num, what = line.split()
+                skipped[int(num)] = (what == 'build')
+            return pruned_builds, pruned_logs, skipped
+        except (IOError, ValueError, IndexError):
+            pass
+
+        # find where a previous prune left off by listing the directory once
+        build_re = re.compile(r"^([0-9]+)$")
+        build_log_re = re.compile(r"^([0-9]+)-.*$")
+        pruned_builds = pruned_logs = None
+        for filename in os.listdir(basedir):
+            mo = build_re.match(filename)
+            if mo:
+                num = int(mo.group(1))
+                if pruned_builds is None or num < pruned_builds:
+                    pruned_builds = num
+                continue
+            mo = build_log_re.match(filename)
+            if mo:
+                num = int(mo.group(1))
+                if pruned_logs is None or num < pruned_logs:
+                    pruned_logs = num
+        if pruned_builds is None:
+            pruned_builds = self.builder_status.nextBuildNumber
+        if pruned_logs is None:
+            pruned_logs = self.builder_status.nextBuildNumber
+        # pruning builds also prunes their logfiles
+        return min(pruned_builds, pruned_logs), pruned_logs, {}
+
+    def _saveState(self, basedir, state):
+        path = os.path.join(basedir, self.filename)
+        tmppath = path + ".tmp"
+        pruned_builds, pruned_logs, skipped = state
+        with open(tmppath, "w") as f:
+            f.write("%d %d\n" % (pruned_builds, pruned_logs))
+            for num, delete_pickle in sorted(skipped.items()):
+                f.write("%d %s\n" % (num, delete_pickle and 'build' or 'logs'))
+        if runtime.platformType == 'win32':
+            # windows cannot rename a file on top of an existing one
+            if os.path.exists(path):
+                os.unlink(path)
+        os.rename(tmppath, path)
+
+    def _getLogFilenames(self, basedir, store, batch):
+        # return a dictionary mapping build number to a list of logfile
+        # names, from the build summaries or, for builds without one, from a
+        # listing of the builder directory
+        logs = {}
+        if store is not None:
+            try:
+                logs = store.getLogs([ n for n, _ in batch ])
+            except Exception:
+                log.err()
+        for n, _ in batch:
+            if logs.get(n) is None:
+                if self.listing is None:
+                    self.listing = self._listLogfiles(basedir)
+                logs[n] = self.listing.get(n, [])
+        return logs
+
+    def _listLogfiles(self, basedir):
+        # list each logfile once, by its base name, whatever files it is
+        # kept in; _deleteBatch adds the suffixes back
+        suffixes = sorted(LOGFILE_SUFFIXES, key=len, reverse=True)
+        listing = {}
+        for filename in os.listdir(basedir):
+            num = filename.split('-', 1)[0]
+            if num.isdigit() and filename != num:
+                for suffix in suffixes:
+                    if suffix and filename.endswith(suffix):
+                        filename = filename[:-len(suffix)]
+                        break
+                names = listing.setdefault(int(num), [])
+                if filename not in names:
+                    names.append(filename)
+        return listing
+
+    def _deleteBatch(self, basedir, store, batch, state):
+        logs = self._getLogFilenames(basedir, store, batch)
+        count = 0
+        for n, delete_pickle in batch:
+            filenames = []
+            if delete_pickle:
+                filenames.append(str(n))
+            for logname in logs[n]:
+                filenames.extend([ logname + suffix
+                                   for suffix in LOGFILE_SUFFIXES ])
+            for filename in filenames:
+                try:
+                    os.unlink(os.path.join(basedir, filename))
+                    count += 1
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        log.msg("could not prune '%s': %s" % (filename, e))
+        self._saveState(basedir, state)
+        return count
@@ -310,16 +310,14 @@ class StatusResourceBuilder(HtmlResource, BuildLineMixin):
                 if prop_match(x.getProperties())]
 
         cxt['pending'] = []
-        statuses = yield b.getPendingBuildRequestStatuses()
+        statuses = yield b.getPendingBuildRequestStatuses(preload=True)
         for pb in statuses:
             changes = []
 
             source = yield pb.getSourceStamp()
             submitTime = yield pb.getSubmitTime()
-            bsid = yield pb.getBsid()
-
-            properties = yield \
-                    pb.master.db.buildsets.getBuildsetProperties(bsid)
+            properties = yield pb.getBuildProperties()
+            properties = properties.asDict()
             if not prop_match(properties):
                 continue
 
@@ -343,10 +341,11 @@ class StatusResourceBuilder(HtmlResource, BuildLineMixin):
         numbuilds = cxt['numbuilds'] = int(req.args.get('numbuilds', [self.numbuilds])[0])
         maxsearch = int(req.args.get('maxsearch', [200])[0])
         recent = cxt['recent'] = []
-        for build in b.generateFinishedBuilds(
+        builds = yield b.generateFinishedBuildsAsync(
                 num_builds=int(numbuilds),
                 max_search=maxsearch,
-                filter_fn=lambda b: prop_match(b.getProperties())):
+                filter_fn=lambda b: prop_match(b.getProperties()))
+        for build in builds:
             recent.append(self.get_line_values(req, build, False))
 
         sl = cxt['slaves'] = []
@@ -445,7 +444,7 @@ class StopChangeMixin(object):
             build_controls = dict((x.brid, x) for x in brcontrols)
 
             build_req_statuses = yield \
-                    builder_status.getPendingBuildRequestStatuses()
+                    builder_status.getPendingBuildRequestStatuses(preload=True)
 
             for build_req in build_req_statuses:
                 ss = yield build_req.getSourceStamp()
@@ -600,8 +599,8 @@ class BuildersResource(HtmlResource):
             bs.append(bld)
 
             builder = status.getBuilder(bn)
-            builds = list(builder.generateFinishedBuilds(map_branches(branches),
-                                                         num_builds=1))
+            builds = yield builder.generateFinishedBuildsAsync(
+                                map_branches(branches), num_builds=1)
             if builds:
                 b = builds[0]
                 bld['build_url'] = (bld['link'] + "/builds/%d" % b.getNumber())
@@ -121,18 +121,20 @@ class ConsoleStatusResource(HtmlResource):
     ## Data gathering functions
     ##
 
+    @defer.inlineCallbacks
     def getHeadBuild(self, builder):
         """Get the most recent build for the given builder.
         """
-        build = builder.getBuild(-1)
+        build = yield builder.getBuildAsync(-1)
 
         # HACK: Work around #601, the head build may be None if it is
         # locked.
         if build is None:
-            build = builder.getBuild(-2)
+            build = yield builder.getBuildAsync(-2)
 
-        return build
+        defer.returnValue(build)
 
+    @defer.inlineCallbacks
     def fetchChangesFromHistory(self, status, max_depth, max_builds, debugInfo):
         """Look at the history of the builders and try to fetch as many changes
         as possible. We need this when the main source does not contain enough
@@ -153,17 +155,17 @@ class ConsoleStatusResource(HtmlResource):
                 break
             
             builder = status.getBuilder(builderName)
-            build = self.getHeadBuild(builder)
+            build = yield self.getHeadBuild(builder)
             depth = 0
             while build and depth < max_depth and build_count < max_builds:
                 depth += 1
                 build_count += 1
                 sourcestamp = build.getSourceStamps()[0]
                 allChanges.extend(sourcestamp.changes[:])
-                build = build.getPreviousBuild()
+                build = yield build.getPreviousBuildAsync()
 
         debugInfo["source_fetch_len"] = len(allChanges)
-        return allChanges                
+        defer.returnValue(allChanges)
 
     @defer.inlineCallbacks
     def getAllChanges(self, request, status, numChanges, debugInfo):
@@ -222,6 +224,7 @@ class ConsoleStatusResource(HtmlResource):
                         logs.append(dict(url=logurl, name=logname))
         return details
 
+    @defer.inlineCallbacks
     def getBuildsForRevision(self, request, builder, builderName, codebase,
                              lastRevision, numBuilds, debugInfo):
         """Return the list of all the builds for a given builder that we will
@@ -230,7 +233,7 @@ class ConsoleStatusResource(HtmlResource):
         last change we are interested in."""
 
         builds = []
-        build = self.getHeadBuild(builder)
+        build = yield self.getHeadBuild(builder)
         number = 0
         while build and number < numBuilds:
             debugInfo["builds_scanned"] += 1
@@ -243,11 +246,12 @@ class ConsoleStatusResource(HtmlResource):
                 builds.append(devBuild)
                 number += 1
 
-            build = build.getPreviousBuild()
+            build = yield build.getPreviousBuildAsync()
 
-        return builds
+        defer.returnValue(builds)
 
     
+    @defer.inlineCallbacks
     def getAllBuildsForRevision(self, status, request, codebase, lastRevision,
                                 numBuilds, categories, builders, debugInfo):
         """Returns a dictionary of builds we need to inspect to be able to
@@ -294,7 +298,7 @@ class ConsoleStatusResource(HtmlResource):
             # Append this builder to the dictionary of builders.
             builderList[category].append(builderName)
             # Set the list of builds for this builder.
-            allBuilds[builderName] = self.getBuildsForRevision(request,
+            allBuilds[builderName] = yield self.getBuildsForRevision(request,
                                                                builder,
                                                                builderName,
                                                                codebase,
@@ -302,7 +306,7 @@ class ConsoleStatusResource(HtmlResource):
                                                                numBuilds,
                                                                debugInfo)
 
-        return (builderList, allBuilds)
+        defer.returnValue((builderList, allBuilds))
 
 
     ##
@@ -334,6 +338,7 @@ class ConsoleStatusResource(HtmlResource):
             
         return cs
 
+    @defer.inlineCallbacks
     def displaySlaveLine(self, status, builderList, debugInfo):
         """Display a line the shows the current status for all the builders we
         care about."""
@@ -367,9 +372,10 @@ class ConsoleStatusResource(HtmlResource):
                 else:
                     # If not offline, then display the result of the last
                     # finished build.
-                    build = self.getHeadBuild(status.getBuilder(builder))
+                    build = yield self.getHeadBuild(
+                            status.getBuilder(builder))
                     while build and not build.isFinished():
-                        build = build.getPreviousBuild()
+                        build = yield build.getPreviousBuildAsync()
 
                     if build:
                         s["color"] = getResultsClass(build.getResults(), None,
@@ -377,7 +383,7 @@ class ConsoleStatusResource(HtmlResource):
 
                 slaves[category].append(s)
 
-        return slaves
+        defer.returnValue(slaves)
 
     def isCodebaseInBuild(self, build, codebase):
         """Check if codebase is used in build"""
@@ -511,6 +517,7 @@ class ConsoleStatusResource(HtmlResource):
                 except DoesNotPassFilter:
                     pass
 
+    @defer.inlineCallbacks
     def displayPage(self, request, status, builderList, allBuilds, codebase,
                     revisions, categories, repository, project, branch,
                     debugInfo):
@@ -530,7 +537,8 @@ class ConsoleStatusResource(HtmlResource):
 
         if builderList:
             subs["categories"] = self.displayCategories(builderList, debugInfo)
-            subs['slaves'] = self.displaySlaveLine(status, builderList, debugInfo)
+            subs['slaves'] = yield self.displaySlaveLine(status, builderList,
+                                                         debugInfo)
         else:
             subs["categories"] = []
 
@@ -566,7 +574,7 @@ class ConsoleStatusResource(HtmlResource):
         # Display the footer of the page.
         #
         debugInfo["load_time"] = time.time() - debugInfo["load_time"]
-        return subs
+        defer.returnValue(subs)
 
 
     def content(self, request, cxt):
@@ -623,6 +631,7 @@ class ConsoleStatusResource(HtmlResource):
         # Get all changes we can find.  This is a DB operation, so it must use
         # a deferred.
         d = self.getAllChanges(request, status, numRevs, debugInfo)
+        @defer.inlineCallbacks
         def got_changes(allChanges):
             debugInfo["source_all"] = len(allChanges)
 
@@ -649,7 +658,8 @@ class ConsoleStatusResource(HtmlResource):
                 lastRevision = revisions[len(revisions) - 1].revision
                 debugInfo["last_revision"] = lastRevision
 
-                (builderList, allBuilds) = self.getAllBuildsForRevision(status,
+                (builderList, allBuilds) = yield self.getAllBuildsForRevision(
+                                                    status,
                                                     request,
                                                     codebase,
                                                     lastRevision,
@@ -660,15 +670,16 @@ class ConsoleStatusResource(HtmlResource):
 
             debugInfo["added_blocks"] = 0
 
-            cxt.update(self.displayPage(request, status, builderList,
-                                        allBuilds, codebase, revisions,
-                                        categories, repository, project,
-                                        branch, debugInfo))
+            subs = yield self.displayPage(request, status, builderList,
+                                          allBuilds, codebase, revisions,
+                                          categories, repository, project,
+                                          branch, debugInfo)
+            cxt.update(subs)
 
             templates = request.site.buildbot_service.templates
             template = templates.get_template("console.html")
             data = template.render(cxt)
-            return data
+            defer.returnValue(data)
         d.addCallback(got_changes)
         return d
 
@@ -99,22 +99,25 @@ class GridStatusMixin(object):
     def clearRecentBuildsCache(self):
         self.__recentBuildsCache__ = {}
 
+    @defer.inlineCallbacks
     def getRecentBuilds(self, builder, numBuilds, branch):
         cache = getattr(self, '__recentBuildsCache__', {})
         key = (builder.getName(), branch, numBuilds)
         try:
-            return cache[key]
+            defer.returnValue(cache[key])
         except KeyError:
             # cache miss, get the value and store it in the cache
-            result = [b for b in self.__getRecentBuilds(builder, numBuilds, branch)]
+            result = yield self.__getRecentBuilds(builder, numBuilds, branch)
             cache[key] = result
-            return result
+            defer.returnValue(result)
 
+    @defer.inlineCallbacks
     def __getRecentBuilds(self, builder, numBuilds, branch):
         """
         get a list of most recent builds on given builder
         """
-        build = builder.getBuild(-1)
+        builds = []
+        build = yield builder.getBuildAsync(-1)
         num = 0
         while build and num < numBuilds:
             start = build.getTimes()[0]
@@ -133,11 +136,12 @@ class GridStatusMixin(object):
 
             if okay_build:
                 num += 1
-                yield build
+                builds.append(build)
 
-            build = build.getPreviousBuild()
-        return
+            build = yield build.getPreviousBuildAsync()
+        defer.returnValue(builds)
 
+    @defer.inlineCallbacks
     def getRecentSourcestamps(self, status, numBuilds, categories, branch):
         """
         get a list of the most recent NUMBUILDS SourceStamp tuples, sorted
@@ -149,7 +153,8 @@ class GridStatusMixin(object):
             builder = status.getBuilder(bn)
             if categories and builder.category not in categories:
                 continue
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
+            builds = yield self.getRecentBuilds(builder, numBuilds, branch)
+            for build in builds:
                 ss = build.getSourceStamps(absolute=True)
                 key = self.getSourceStampKey(ss)
                 start = build.getTimes()[0]
@@ -160,7 +165,7 @@ class GridStatusMixin(object):
         sourcestamps = sorted(sourcestamps.itervalues(), key = lambda stamp: stamp[1])
         sourcestamps = [stamp[0] for stamp in sourcestamps][-numBuilds:]
 
-        return sourcestamps
+        defer.returnValue(sourcestamps)
 
 class GridStatusResource(HtmlResource, GridStatusMixin):
     # TODO: docs
@@ -181,7 +186,8 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
+        stamps = yield self.getRecentSourcestamps(status, numBuilds,
+                                                  categories, branch)
 
         cxt['refresh'] = self.get_reload_time(request)
 
@@ -202,7 +208,8 @@ class GridStatusResource(HtmlResource, GridStatusMixin):
             if categories and builder.category not in categories:
                 continue
 
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
+            recent = yield self.getRecentBuilds(builder, numBuilds, branch)
+            for build in recent:
                 ss = build.getSourceStamps(absolute=True)
                 key = self.getSourceStampKey(ss)
 
@@ -249,7 +256,8 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
 
         # and the data we want to render
         status = self.getStatus(request)
-        stamps = self.getRecentSourcestamps(status, numBuilds, categories, branch)
+        stamps = yield self.getRecentSourcestamps(status, numBuilds,
+                                                  categories, branch)
 
         cxt.update({'categories': categories,
                     'branch': branch,
@@ -273,7 +281,8 @@ class TransposedGridStatusResource(HtmlResource, GridStatusMixin):
             if categories and builder.category not in categories:
                 continue
 
-            for build in self.getRecentBuilds(builder, numBuilds, branch):
+            recent = yield self.getRecentBuilds(builder, numBuilds, branch)
+            for build in recent:
                 #TODO: support multiple sourcestamps
                 ss = build.getSourceStamps(absolute=True)
                 key = self.getSourceStampKey(ss)
@@ -14,16 +14,20 @@
 # Copyright Buildbot Team Members
 
 
+import urllib
+
 from zope.interface import implements
 from twisted.python import components
 from twisted.spread import pb
-from twisted.web import server
+from twisted.internet.interfaces import IPushProducer
+from twisted.web import server, http
 from twisted.web.resource import Resource, NoResource
 
 from buildbot import interfaces
 from buildbot.status import logfile
 from buildbot.status.web.base import IHTMLLog, HtmlResource, path_to_root
 from buildbot.util.ansicodes import parse_ansi_sgr
+from buildbot.util.eventual import eventually
 
 class ChunkConsumer:
     implements(interfaces.IStatusLogConsumer)
@@ -47,7 +51,112 @@ class ChunkConsumer:
     def finish(self):
         self.textlog.finished()
 
+class ChunkProducer:
+    """
+    I send a part of a log, given as a generator of chunks, to a request.  A
+    batch of chunks is written each time through the reactor, until the
+    request's transport has buffered enough and pauses me, so that a large
+    range is neither read into memory at once nor sent while the reactor
+    waits.
+    """
+    implements(IPushProducer)
+
+    BATCHSIZE = 32
+    paused = False
+
+    def __init__(self, req, textlog, chunks):
+        self.req = req
+        self.textlog = textlog
+        self.chunks = iter(chunks)
+        req.registerProducer(self, True)
+        req.notifyFinish().addErrback(lambda _ : self.stopProducing())
+        self.resumeProducing()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        eventually(self._produce)
+
+    def stopProducing(self):
+        # the client went away, so let go of the log and the request
+        self.paused = True
+        self._closeChunks()
+        if self.req is not None:
+            self.req.unregisterProducer()
+            self.req = None
+            self.textlog.req = None
+            self.textlog.template = None
+
+    def _closeChunks(self):
+        # closing the generator releases the log files it is reading
+        if self.chunks is not None:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+            self.chunks = None
+
+    def _produce(self):
+        if self.chunks is None or self.paused:
+            return
+        try:
+            for i in xrange(self.BATCHSIZE):
+                formatted = self.textlog.content([self.chunks.next()])
+                if isinstance(formatted, unicode):
+                    formatted = formatted.encode('utf-8')
+                self.req.write(formatted)
+                if self.paused:
+                    return
+        except StopIteration:
+            self.chunks = None
+            self._finish()
+            return
+        except Exception:
+            self._closeChunks()
+            self._finish()
+            raise
+        eventually(self._produce)
+
+    def _finish(self):
+        self.req.unregisterProducer()
+        self.req = None
+        self.textlog.finished()
+
+def parseByteRange(header, length):
+    """
+    Parse an HTTP Range header for an entity of the given length.  Only a
+    single byte range is supported.
+
+    @returns: (start, end) tuple, with C{end} exclusive, or None if the header
+    should be ignored
+    @raises ValueError: if the range is not satisfiable
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            start, end = max(0, length - int(last)), length
+        else:
+            start = int(first)
+            end = length
+            if last:
+                end = min(end, int(last) + 1)
+    except ValueError:
+        return None
+    if start >= end:
+        raise ValueError("unsatisfiable range")
+    return start, end
+
 # /builders/$builder/builds/$buildnum/steps/$stepname/logs/$logname
+#
+# Query arguments select part of the log:
+#   ?tail=N      the last N lines
+#   ?lines=A-B   lines A through B (counting from 1, inclusive); B is optional
+# The text view also honors a single HTTP byte Range for finished logs.
 class TextLog(Resource):
     # a new instance of this Resource is created for each client who views
     # it, so we can afford to track the request in the Resource.
@@ -117,19 +226,119 @@ class TextLog(Resource):
         else:
             req.setHeader("Cache-Control", "no-cache")
 
+        try:
+            chunks, navlinks = self._getRequestedChunks(req)
+        except ValueError, e:
+            self.req = None
+            req.setResponseCode(http.BAD_REQUEST)
+            req.setHeader("content-type", "text/plain")
+            return "Invalid log range: %s" % (e,)
+
         if not self.asText:
             self.template = req.site.buildbot_service.templates.get_template("logs.html")                
             
+            texturl = req.childLink("text")
+            kwargs = {}
+            if navlinks is not None:
+                texturl += "?" + urllib.urlencode(self._getRangeArgs(req))
+                kwargs['navlinks'] = navlinks
             data = self.template.module.page_header(
                     pageTitle = "Log File contents",
-                    texturl = req.childLink("text"),
-                    path_to_root = path_to_root(req))
+                    texturl = texturl,
+                    path_to_root = path_to_root(req),
+                    **kwargs)
             data = data.encode('utf-8')                   
             req.write(data)
 
-        self.original.subscribeConsumer(ChunkConsumer(req, self))
+        if chunks is None:
+            self.original.subscribeConsumer(ChunkConsumer(req, self))
+            return server.NOT_DONE_YET
+
+        # a part of the log, which the log index lets us read without
+        # scanning the rest of the log; it may still be large, so it is
+        # streamed as the client reads it
+        ChunkProducer(req, self, chunks)
         return server.NOT_DONE_YET
 
+    def _getRangeArgs(self, req):
+        return [ (arg, req.args[arg][0]) for arg in ('tail', 'lines')
+                 if arg in req.args ]
+
+    def _getRequestedChunks(self, req):
+        """
+        Get the chunks selected by the request's query arguments or Range
+        header, along with links to the neighboring parts of the log for the
+        HTML view.
+
+        @returns: (chunks, navlinks); chunks is None if the whole log should
+        be sent
+        @raises ValueError: if the requested range is invalid
+        """
+        # the text view leaves out headers, so its lines are numbered as in
+        # the log's stdout and stderr
+        if self.asText:
+            channels = list(logfile.TEXT_CHANNELS)
+        else:
+            channels = []
+        textLines = self.asText
+
+        if 'tail' in req.args:
+            count = int(req.args['tail'][0])
+            if count < 1:
+                raise ValueError("tail must be positive")
+            chunks = self.original.getTailChunks(count, channels,
+                                                 textLines=textLines)
+            navlinks = [ ("whole log", "?") ]
+            return chunks, navlinks
+
+        if 'lines' in req.args:
+            first, _, last = req.args['lines'][0].partition("-")
+            first = int(first)
+            if last:
+                last = int(last)
+            else:
+                last = None
+            if first < 1 or (last is not None and last < first):
+                raise ValueError("invalid line range")
+            chunks = self.original.getLineChunks(first - 1, last, channels,
+                                                 textLines=textLines)
+            navlinks = []
+            if last is not None:
+                size = last - first + 1
+                if first > 1:
+                    navlinks.append(("previous %d lines" % size,
+                        "?lines=%d-%d" % (max(1, first - size), first - 1)))
+                navlinks.append(("next %d lines" % size,
+                        "?lines=%d-%d" % (last + 1, last + size)))
+            navlinks.append(("whole log", "?"))
+            return chunks, navlinks
+
+        range_header = req.getHeader("range")
+        if self.asText and self.original.isFinished():
+            req.setHeader("accept-ranges", "bytes")
+            if range_header:
+                return self._getByteRangeChunks(req, range_header), None
+
+        return None, None
+
+    def _getByteRangeChunks(self, req, range_header):
+        length = self.original.getTextLength()
+        try:
+            byterange = parseByteRange(range_header, length)
+        except ValueError:
+            req.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            req.setHeader("content-range", "bytes */%d" % length)
+            return []
+        if byterange is None:
+            return None
+        start, end = byterange
+        req.setResponseCode(http.PARTIAL_CONTENT)
+        req.setHeader("content-range",
+                      "bytes %d-%d/%d" % (start, end - 1, length))
+        req.setHeader("content-length", str(end - start))
+        return ((logfile.STDOUT, text)
+                for text in self.original.getTextRangeChunks(start, end))
+
     def _setContentType(self, req):
         if self.asText:
             req.setHeader("content-type", "text/plain; charset=utf-8")
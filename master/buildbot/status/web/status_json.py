@@ -21,8 +21,10 @@ import os
 import re
 
 from twisted.internet import defer
+from twisted.python import context
 from twisted.web import html, resource, server
 
+from buildbot.db import pool
 from buildbot.status.web.base import HtmlResource
 from buildbot.util import json
 
@@ -120,6 +122,12 @@ def FilterOut(data):
         return data
 
 
+def backgroundAsDict(res, request):
+    """Calls res.asDict, putting the database queries it starts in the
+    background lane, behind those of the rest of the master."""
+    return context.call({ pool.LANE : 'background' }, res.asDict, request)
+
+
 class JsonResource(resource.Resource):
     """Base class for json data."""
 
@@ -231,8 +239,8 @@ class JsonResource(resource.Resource):
                 # some asDict methods return a Deferred, so handle that
                 # properly
                 if hasattr(child, 'asDict'):
-                    child_dict = yield defer.maybeDeferred(lambda :
-                                                child.asDict(request))
+                    child_dict = yield defer.maybeDeferred(backgroundAsDict,
+                                                child, request)
                 else:
                     child_dict = {
                         'error' : 'Not available',
@@ -242,7 +250,7 @@ class JsonResource(resource.Resource):
                 request.prepath = prepath
                 request.postpath = postpath
         else:
-            data = yield defer.maybeDeferred(lambda : self.asDict(request))
+            data = yield defer.maybeDeferred(backgroundAsDict, self, request)
 
         if filter_out:
             data = FilterOut(data)
@@ -267,8 +275,8 @@ class JsonResource(resource.Resource):
             for name in self.children:
                 child = self.getChildWithDefault(name, request)
                 if isinstance(child, JsonResource):
-                    data[name] = yield defer.maybeDeferred(lambda :
-                                            child.asDict(request))
+                    data[name] = yield defer.maybeDeferred(backgroundAsDict,
+                                            child, request)
                 # else silently pass over non-json resources.
             defer.returnValue(data)
         else:
@@ -360,7 +368,7 @@ class BuilderPendingBuildsJsonResource(JsonResource):
 
     def asDict(self, request):
         # buildbot.status.builder.BuilderStatus
-        d = self.builder_status.getPendingBuildRequestStatuses()
+        d = self.builder_status.getPendingBuildRequestStatuses(preload=True)
         def to_dict(statuses):
             return defer.gatherResults(
                 [ b.asDict_async() for b in statuses ])
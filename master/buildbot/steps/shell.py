@@ -22,7 +22,7 @@ from twisted.python.deprecate import deprecatedModuleAttribute
 from twisted.python.versions import Version
 from buildbot.process import buildstep
 from buildbot.status.results import SUCCESS, WARNINGS, FAILURE
-from buildbot.status.logfile import STDOUT, STDERR
+from buildbot.status.logfile import STDOUT, STDERR, splitLines
 from buildbot import config
 from buildbot.util import flatten
 
@@ -32,6 +32,74 @@ from buildbot.process.properties import WithProperties
 _hush_pyflakes = [WithProperties]
 del _hush_pyflakes
 
+# inline flags and backreferences change meaning when a pattern is combined
+# with others into one regular expression
+_uncombinableRe = re.compile(r"\(\?[iLmsux]|\\[0-9]|\(\?P=")
+
+# Python's re module supports at most 100 groups in an expression, so
+# patterns with more groups than this between them are combined in chunks
+_maxCombinedGroups = 90
+
+class _CombinedChunks(object):
+    # the combination of patterns with too many groups for one expression:
+    # an expression for each chunk of the patterns, searched in turn
+
+    def __init__(self, regexps):
+        self.regexps = regexps
+
+    def search(self, string):
+        for regexp in self.regexps:
+            match = regexp.search(string)
+            if match:
+                return match
+        return None
+
+def combinePatterns(searchPatterns, matchPatterns=()):
+    """
+    Combine regular expressions, given as strings or compiled expressions,
+    into one alternation.  The result's C{search} succeeds on a string if any
+    of C{searchPatterns} would succeed with C{search}, or any of
+    C{matchPatterns} with C{match}, so it can be used to rule out strings
+    with a single scan.  Group numbers in the result do not correspond to
+    those in the patterns.
+
+    @returns: compiled regular expression (or an object with a compatible
+    C{search} method, if the patterns have too many groups between them for
+    one expression), or None if the patterns cannot be combined safely (for
+    example, because they use flags or backreferences)
+    """
+    sources = []
+    for patterns, template in ((searchPatterns, "(?:%s)"),
+                               (matchPatterns, "^(?:%s)")):
+        for pattern in patterns:
+            if not isinstance(pattern, basestring):
+                if pattern.flags:
+                    return None
+                pattern = pattern.pattern
+            if _uncombinableRe.search(pattern):
+                return None
+            sources.append(template % (pattern,))
+    if not sources:
+        return None
+    try:
+        chunks = []
+        chunk, groups = [], 0
+        for source in sources:
+            n = re.compile(source).groups
+            if chunk and groups + n > _maxCombinedGroups:
+                chunks.append(chunk)
+                chunk, groups = [], 0
+            chunk.append(source)
+            groups += n
+        chunks.append(chunk)
+        regexps = [ re.compile("|".join(c)) for c in chunks ]
+    except (re.error, UnicodeError, AssertionError):
+        # AssertionError is raised for a single pattern with too many groups
+        return None
+    if len(regexps) == 1:
+        return regexps[0]
+    return _CombinedChunks(regexps)
+
 class ShellCommand(buildstep.LoggingBuildStep):
     """I run a single shell command on the buildslave. I return FAILURE if
     the exit code of that command is non-zero, SUCCESS otherwise. To change
@@ -424,6 +492,7 @@ class WarningCountingShellCommand(ShellCommand):
 
         self.suppressions = []
         self.directoryStack = []
+        self._indexSuppressions()
 
     def addSuppression(self, suppressionList):
         """
@@ -481,19 +550,100 @@ class WarningCountingShellCommand(ShellCommand):
                     file = "%s/%s" % (currentDirectory, file)
 
             # Skip adding the warning if any suppression matches.
-            for fileRe, warnRe, start, end in self.suppressions:
-                if not (file == None or fileRe == None or fileRe.match(file)):
-                    continue
-                if not (warnRe == None or warnRe.search(text)):
-                    continue
-                if not ((start == None and end == None) or
-                        (lineNo != None and start <= lineNo and end >= lineNo)):
-                    continue
+            if self.isSuppressed(file, lineNo, text):
                 return
 
         warnings.append(line)
         self.warnCount += 1
 
+    def isSuppressed(self, file, lineNo, text):
+        """
+        Return true if any suppression matches a warning with the given file,
+        line number and text.
+        """
+        for suppressAll, textRe, textRes, ranged in \
+                self._getFileSuppressions(file):
+            if suppressAll:
+                return True
+            if textRe is not None and textRe.search(text):
+                return True
+            for warnRe in textRes:
+                if warnRe.search(text):
+                    return True
+            for warnRe, start, end in ranged:
+                if not (lineNo != None and start <= lineNo and end >= lineNo):
+                    continue
+                if warnRe == None or warnRe.search(text):
+                    return True
+        return False
+
+    def _indexSuppressions(self):
+        # Group the suppressions by file regexp.  Each group is a tuple
+        # (fileRe, (suppressAll, textRe, textRes, ranged)): suppressAll is
+        # true if a suppression in the group matches every warning, textRe
+        # combines the text patterns of the suppressions without line ranges
+        # (or is None, with the patterns in textRes if they cannot be
+        # combined), and ranged lists (warnRe, start, end) for suppressions
+        # with line ranges.
+        groups = {}
+        order = []
+        for fileRe, warnRe, start, end in self.suppressions:
+            if fileRe == None:
+                key = None
+            else:
+                key = (fileRe.pattern, fileRe.flags)
+            if key not in groups:
+                groups[key] = (fileRe, [False, [], []])
+                order.append(key)
+            group = groups[key][1]
+            if start == None and end == None:
+                if warnRe == None:
+                    group[0] = True
+                else:
+                    group[1].append(warnRe)
+            else:
+                group[2].append((warnRe, start, end))
+
+        self._allFileSuppressions = []
+        self._fileSuppressions = []
+        for key in order:
+            fileRe, (suppressAll, textRes, ranged) = groups[key]
+            textRe = combinePatterns(textRes)
+            if textRe is not None:
+                textRes = []
+            group = (suppressAll, textRe, textRes, ranged)
+            if key is None:
+                self._allFileSuppressions.append(group)
+            else:
+                self._fileSuppressions.append((fileRe, group))
+        # rules out files that no file regexp matches with a single scan
+        self._anyFileRe = combinePatterns([],
+                [ r for r, _ in self._fileSuppressions ])
+        self._suppressionCache = {}
+        self._suppressionCount = len(self.suppressions)
+
+    def _getFileSuppressions(self, file):
+        # get the suppression groups that apply to warnings in the given
+        # file, matching each distinct file regexp once per file
+        if self._suppressionCount != len(self.suppressions):
+            self._indexSuppressions()
+        try:
+            return self._suppressionCache[file]
+        except KeyError:
+            pass
+        if file == None:
+            groups = self._allFileSuppressions + \
+                    [ group for _, group in self._fileSuppressions ]
+        elif self._anyFileRe is not None and \
+                not self._anyFileRe.search(file):
+            groups = self._allFileSuppressions
+        else:
+            groups = self._allFileSuppressions + \
+                    [ group for r, group in self._fileSuppressions
+                      if r.match(file) ]
+        self._suppressionCache[file] = groups
+        return groups
+
     def start(self):
         if self.suppressionFile == None:
             return ShellCommand.start(self)
@@ -543,6 +693,32 @@ class WarningCountingShellCommand(ShellCommand):
 
         self.warnCount = 0
 
+        # Check if each line in the output from this command matched our
+        # warnings regular expressions. If did, bump the warnings count and
+        # add the line to the collection of lines with warnings.  The lines
+        # are those of log.getText(), but split a chunk at a time so that the
+        # whole log is never in memory.
+        warnings = self.findWarnings(splitLines(
+                log.getChunks([STDOUT, STDERR], onlyText=True)))
+
+        # If there were any warnings, make the log if lines with warnings
+        # available
+        if self.warnCount:
+            self.addCompleteLog("warnings (%d)" % self.warnCount,
+                    "\n".join(warnings) + "\n")
+
+        warnings_stat = self.step_status.getStatistic('warnings', 0)
+        self.step_status.setStatistic('warnings', warnings_stat + self.warnCount)
+
+        old_count = self.getProperty("warnings-count", 0)
+        self.setProperty("warnings-count", old_count + self.warnCount, "WarningCountingShellCommand")
+
+    def findWarnings(self, lines):
+        """
+        Match lines against warningPattern, tracking the current directory
+        and applying suppressions, and return the lines that are warnings.
+        Each warning also increments C{warnCount}.
+        """
         # Now compile a regular expression from whichever warning pattern we're
         # using
         wre = self.warningPattern
@@ -559,13 +735,16 @@ class WarningCountingShellCommand(ShellCommand):
                 and isinstance(directoryLeaveRe, basestring)):
             directoryLeaveRe = re.compile(directoryLeaveRe)
 
-        # Check if each line in the output from this command matched our
-        # warnings regular expressions. If did, bump the warnings count and
-        # add the line to the collection of lines with warnings
+        # most lines match none of the patterns, so rule those out with a
+        # single scan of each line
+        anyRe = combinePatterns(
+                [ r for r in (directoryEnterRe, directoryLeaveRe) if r ],
+                [ wre ])
+
         warnings = []
-        # TODO: use log.readlines(), except we need to decide about stdout vs
-        # stderr
-        for line in log.getText().split("\n"):
+        for line in lines:
+            if anyRe is not None and not anyRe.search(line):
+                continue
             if directoryEnterRe:
                 match = directoryEnterRe.search(line)
                 if match:
@@ -580,18 +759,7 @@ class WarningCountingShellCommand(ShellCommand):
             match = wre.match(line)
             if match:
                 self.maybeAddWarning(warnings, line, match)
-
-        # If there were any warnings, make the log if lines with warnings
-        # available
-        if self.warnCount:
-            self.addCompleteLog("warnings (%d)" % self.warnCount,
-                    "\n".join(warnings) + "\n")
-
-        warnings_stat = self.step_status.getStatistic('warnings', 0)
-        self.step_status.setStatistic('warnings', warnings_stat + self.warnCount)
-
-        old_count = self.getProperty("warnings-count", 0)
-        self.setProperty("warnings-count", old_count + self.warnCount, "WarningCountingShellCommand")
+        return warnings
 
 
     def evaluateCommand(self, cmd):
@@ -23,6 +23,7 @@ class FakeBotMaster(service.MultiService):
         self.locks = {}
         self.builders = {}
         self.buildsStartedForSlaves = []
+        self.buildRequestsChangedFor = []
 
     def getLockByID(self, lockid):
         if not lockid in self.locks:
@@ -40,4 +41,7 @@ class FakeBotMaster(service.MultiService):
         return self.builders.get(slavename, [])
 
     def maybeStartBuildsForSlave(self, slavename):
-        self.buildsStartedForSlaves.append(slavename)
\ No newline at end of file
+        self.buildsStartedForSlaves.append(slavename)
+
+    def buildRequestsChanged(self, buildername):
+        self.buildRequestsChangedFor.append(buildername)
\ No newline at end of file
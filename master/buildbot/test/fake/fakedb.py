@@ -105,6 +105,18 @@ class BuildRequestClaim(Row):
 
     required_columns = ('brid', 'objectid', 'claimed_at')
 
+class BuildRequestUnclaim(Row):
+    table = "buildrequest_unclaims"
+
+    defaults = dict(
+        id = None,
+        brid = None,
+        unclaimed_at = None
+    )
+
+    id_column = 'id'
+    required_columns = ('brid', 'unclaimed_at')
+
 class Change(Row):
     table = "changes"
 
@@ -397,23 +409,14 @@ class FakeChangesComponent(FakeDBComponent):
         except KeyError:
             return defer.succeed(None)
 
-        chdict = dict(
-                changeid=row.changeid,
-                author=row.author,
-                files=row.files,
-                comments=row.comments,
-                is_dir=row.is_dir,
-                revision=row.revision,
-                when_timestamp=_mkdt(row.when_timestamp),
-                branch=row.branch,
-                category=row.category,
-                revlink=row.revlink,
-                properties=row.properties,
-                repository=row.repository,
-                codebase=row.codebase,
-                project=row.project)
+        return defer.succeed(self._chdict(row))
 
-        return defer.succeed(chdict)
+    def getChangesSince(self, changeid, limit=None):
+        changeids = sorted([ id for id in self.changes if id > changeid ])
+        if limit is not None:
+            changeids = changeids[:limit]
+        chdicts = [ self._chdict(self.changes[id]) for id in changeids ]
+        return defer.succeed(chdicts)
 
     def getChangeUids(self, changeid):
         try:
@@ -427,17 +430,31 @@ class FakeChangesComponent(FakeDBComponent):
         chdicts = [ self._chdict(self.changes[id]) for id in ids[-count:] ]
         return defer.succeed(chdicts)
 
-    def getChanges(self):
-        chdicts = [ self._chdict(v) for v in self.changes.values() ]
+    def getChanges(self, changeids):
+        chdicts = [ changeid in self.changes
+                        and self._chdict(self.changes[changeid]) or None
+                    for changeid in changeids ]
         return defer.succeed(chdicts)
 
     def getChangesCount(self):
         return len(self.changes)
 
     def _chdict(self, row):
-        chdict = row.copy()
-        del chdict['uids']
-        chdict['when_timestamp'] = _mkdt(chdict['when_timestamp'])
+        chdict = dict(
+                changeid=row.changeid,
+                author=row.author,
+                files=row.files,
+                comments=row.comments,
+                is_dir=row.is_dir,
+                revision=row.revision,
+                when_timestamp=_mkdt(row.when_timestamp),
+                branch=row.branch,
+                category=row.category,
+                revlink=row.revlink,
+                properties=row.properties,
+                repository=row.repository,
+                codebase=row.codebase,
+                project=row.project)
         return chdict
 
     # assertions
@@ -651,12 +668,19 @@ class FakeSourceStampsComponent(FakeDBComponent):
             return None
 
     def getSourceStamps(self, sourcestampsetid):
+        return defer.succeed(self._getSourceStamps(sourcestampsetid))
+
+    def _getSourceStamps(self, sourcestampsetid):
         sslist = []
         for ssdict in self.sourcestamps.itervalues():
             if ssdict['sourcestampsetid'] == sourcestampsetid:
                 ssdictcpy = self._getSourceStamp(ssdict['id'])
                 sslist.append(ssdictcpy)
-        return defer.succeed(sslist)
+        return sslist
+
+    def getSourceStampsForSets(self, sourcestampsetids):
+        return defer.succeed(dict([ (setid, self._getSourceStamps(setid))
+                                    for setid in sourcestampsetids ]))
 
 class FakeBuildsetsComponent(FakeDBComponent):
 
@@ -748,6 +772,15 @@ class FakeBuildsetsComponent(FakeDBComponent):
         else:
             return defer.succeed({})
 
+    def getBuildsetsProperties(self, buildsetids):
+        props = {}
+        for bsid in buildsetids:
+            if bsid in self.buildsets:
+                props[bsid] = self.buildsets[bsid]['properties']
+            else:
+                props[bsid] = {}
+        return defer.succeed(props)
+
     # fake methods
 
     def fakeBuildsetCompletion(self, bsid, result):
@@ -961,6 +994,7 @@ class FakeBuildRequestsComponent(FakeDBComponent):
     def setUp(self):
         self.reqs = {}
         self.claims = {}
+        self.unclaims = {}
 
     def insertTestData(self, rows):
         for row in rows:
@@ -970,6 +1004,9 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             if isinstance(row, BuildRequestClaim):
                 self.claims[row.brid] = row
 
+            if isinstance(row, BuildRequestUnclaim):
+                self.unclaims[row.id] = row
+
     # component methods
 
     def getBuildRequest(self, brid):
@@ -1032,6 +1069,49 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                 objectid=self.MASTER_ID, claimed_at=claimed_at)
         return defer.succeed(None)
 
+    def getBuildRequestsSince(self, brid, brids=None):
+        brids = set(brids or [])
+        rv = [ self._brdictFromRow(br) for br in self.reqs.itervalues()
+               if br.id > brid or br.id in brids ]
+        rv.sort(key=lambda br : br['brid'])
+        return defer.succeed(rv)
+
+    def getLatestBuildRequestId(self):
+        if self.reqs:
+            return defer.succeed(max(self.reqs))
+        return defer.succeed(None)
+
+    def getBuildRequestUnclaimsSince(self, unclaimid):
+        return defer.succeed([ (id, self.unclaims[id].brid)
+                               for id in sorted(self.unclaims)
+                               if id > unclaimid ])
+
+    def getLatestBuildRequestUnclaimId(self):
+        if self.unclaims:
+            return defer.succeed(max(self.unclaims))
+        return defer.succeed(None)
+
+    def pruneBuildRequestUnclaims(self, old, _reactor=reactor):
+        old_epoch = _reactor.seconds() - old
+        for id, row in self.unclaims.items():
+            if row.unclaimed_at < old_epoch:
+                del self.unclaims[id]
+        return defer.succeed(None)
+
+    def tryClaimBuildRequests(self, brids, claimed_at=None, _reactor=reactor):
+        claimed_at = datetime2epoch(claimed_at)
+        if not claimed_at:
+            claimed_at = _reactor.seconds()
+
+        rv = []
+        for brid in brids:
+            if brid not in self.reqs or brid in self.claims:
+                continue
+            self.claims[brid] = BuildRequestClaim(brid=brid,
+                objectid=self.MASTER_ID, claimed_at=claimed_at)
+            rv.append(brid)
+        return defer.succeed(rv)
+
     def reclaimBuildRequests(self, brids, _reactor):
         for brid in brids:
             if brid in self.claims and self.claims[brid].objectid != self.MASTER_ID:
@@ -1043,10 +1123,12 @@ class FakeBuildRequestsComponent(FakeDBComponent):
                 objectid=self.MASTER_ID, claimed_at=_reactor.seconds())
         return defer.succeed(None)
 
-    def unclaimBuildRequests(self, brids):
+    def unclaimBuildRequests(self, brids, _reactor=reactor):
         for brid in brids:
             if brid in self.claims and self.claims[brid].objectid == self.MASTER_ID:
                 self.claims.pop(brid)
+                self._journalUnclaim(brid, _reactor)
+        return defer.succeed(None)
 
     def completeBuildRequests(self, brids, results, complete_at=None,
                             _reactor=reactor):
@@ -1075,6 +1157,12 @@ class FakeBuildRequestsComponent(FakeDBComponent):
             claim_row = self.claims.get(br.id)
             if claim_row and claim_row.claimed_at < old_epoch:
                 del self.claims[br.id]
+                self._journalUnclaim(br.id, _reactor)
+
+    def _journalUnclaim(self, brid, _reactor):
+        id = max(self.unclaims.keys() + [ 0 ]) + 1
+        self.unclaims[id] = BuildRequestUnclaim(id=id, brid=brid,
+                unclaimed_at=_reactor.seconds())
 
     # Code copied from buildrequests.BuildRequestConnectorComponent
     def _brdictFromRow(self, row):
@@ -1105,6 +1193,7 @@ class FakeBuildRequestsComponent(FakeDBComponent):
 
     def fakeUnclaimBuildRequest(self, brid):
         del self.claims[brid]
+        self._journalUnclaim(brid, self._reactor)
 
     # assertions
 
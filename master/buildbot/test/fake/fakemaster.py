@@ -37,12 +37,21 @@ class FakeCache(object):
         d.addCallback(mkref)
         return d
 
+    def peek(self, key):
+        return None
+
+    def add(self, key, value):
+        pass
+
 
 class FakeCaches(object):
 
-    def get_cache(self, name, miss_fn):
+    def get_cache(self, name, miss_fn, shared=False):
         return FakeCache(name, miss_fn)
 
+    def invalidate(self, cache_name, key):
+        return defer.succeed(None)
+
 
 class FakeStatus(object):
 
@@ -70,7 +79,7 @@ class FakeBuilderStatus(object):
     def setSlavenames(self, names):
         pass
 
-    def setCacheSize(self, size):
+    def setCacheSize(self, size, **eviction):
         pass
 
     def setBigState(self, state):
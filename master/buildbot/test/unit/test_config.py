@@ -24,8 +24,8 @@ from zope.interface import implements
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
-from buildbot import config, buildslave, interfaces, revlinks, locks
-from buildbot.process import properties, factory
+from buildbot import config, buildslave, interfaces, revlinks, locks, notifier
+from buildbot.process import properties, factory, sharedcache
 from buildbot.test.util import dirs, compat
 from buildbot.test.util.config import ConfigErrorsMixin
 from buildbot.changes import base as changes_base
@@ -44,12 +44,15 @@ global_defaults = dict(
     logCompressionMethod='bz2',
     logMaxTailSize=None,
     logMaxSize=None,
+    logFsync=False,
+    buildSummaryBackend='sqlite',
     properties=properties.Properties(),
     mergeRequests=None,
     prioritizeBuilders=None,
     protocols={},
     slavePortnum=None,
     multiMaster=False,
+    notifications=None,
     debugPassword=None,
     manhole=None,
 )
@@ -167,9 +170,15 @@ class MasterConfig(ConfigErrorsMixin, dirs.DirsMixin, unittest.TestCase):
             #validation,
             db=dict(
                 db_url='sqlite:///state.sqlite',
-                db_poll_interval=None),
+                db_poll_interval=None,
+                db_replica_url=None,
+                db_replica_max_lag=5,
+                db_slow_query_threshold=None,
+                db_lane_reservations=dict(critical=1)),
             metrics = None,
             caches = dict(Changes=10, Builds=15),
+            cacheEviction = {},
+            sharedCache = None,
             schedulers = {},
             builders = [],
             slaves = [],
@@ -425,6 +434,19 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
                 dict(logCompressionMethod='foo'))
         self.assertConfigError(self.errors, "must be 'bz2' or 'gz'")
 
+    def test_load_global_buildSummaryBackend(self):
+        self.do_test_load_global(dict(buildSummaryBackend='jsonl'),
+                                 buildSummaryBackend='jsonl')
+
+    def test_load_global_buildSummaryBackend_none(self):
+        self.do_test_load_global(dict(buildSummaryBackend=None),
+                                 buildSummaryBackend=None)
+
+    def test_load_global_buildSummaryBackend_invalid(self):
+        self.cfg.load_global(self.filename,
+                dict(buildSummaryBackend='pickle'))
+        self.assertConfigError(self.errors, "must be 'sqlite', 'jsonl'")
+
     def test_load_global_codebaseGenerator(self):
         func = lambda _: "dummy"
         self.do_test_load_global(dict(codebaseGenerator=func),
@@ -443,6 +465,13 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_global_logMaxTailSize(self):
         self.do_test_load_global(dict(logMaxTailSize=123), logMaxTailSize=123)
 
+    def test_load_global_logFsync(self):
+        self.do_test_load_global(dict(logFsync=True), logFsync=True)
+
+    def test_load_global_logFsync_invalid(self):
+        self.cfg.load_global(self.filename, dict(logFsync='yes'))
+        self.assertConfigError(self.errors, "c['logFsync'] must be a boolean")
+
     def test_load_global_properties(self):
         exp = properties.Properties()
         exp.setProperty('x', 10, self.filename)
@@ -493,6 +522,15 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_global_multiMaster(self):
         self.do_test_load_global(dict(multiMaster=1), multiMaster=1)
 
+    def test_load_global_notifications(self):
+        transport = notifier.LoopbackTransport(notifier.LoopbackHub())
+        self.do_test_load_global(dict(notifications=transport),
+                notifications=transport)
+
+    def test_load_global_notifications_invalid(self):
+        self.cfg.load_global(self.filename, dict(notifications='tcp:9990'))
+        self.assertConfigError(self.errors, "must be a NotificationTransport")
+
     def test_load_global_debugPassword(self):
         self.do_test_load_global(dict(debugPassword='xyz'),
                 debugPassword='xyz')
@@ -539,21 +577,84 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
     def test_load_db_defaults(self):
         self.cfg.load_db(self.filename, {})
         self.assertResults(
-            db=dict(db_url='sqlite:///state.sqlite', db_poll_interval=None))
+            db=dict(db_url='sqlite:///state.sqlite', db_poll_interval=None,
+                    db_replica_url=None, db_replica_max_lag=5,
+                    db_slow_query_threshold=None,
+                    db_lane_reservations=dict(critical=1)))
 
     def test_load_db_db_url(self):
         self.cfg.load_db(self.filename, dict(db_url='abcd'))
-        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                   db_replica_url=None, db_replica_max_lag=5,
+                                   db_slow_query_threshold=None,
+                                   db_lane_reservations=dict(critical=1)))
 
     def test_load_db_db_poll_interval(self):
         self.cfg.load_db(self.filename, dict(db_poll_interval=2))
         self.assertResults(
-            db=dict(db_url='sqlite:///state.sqlite', db_poll_interval=2))
+            db=dict(db_url='sqlite:///state.sqlite', db_poll_interval=2,
+                    db_replica_url=None, db_replica_max_lag=5,
+                    db_slow_query_threshold=None,
+                    db_lane_reservations=dict(critical=1)))
 
     def test_load_db_dict(self):
         self.cfg.load_db(self.filename,
             dict(db=dict(db_url='abcd', db_poll_interval=10)))
-        self.assertResults(db=dict(db_url='abcd', db_poll_interval=10))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=10,
+                                   db_replica_url=None, db_replica_max_lag=5,
+                                   db_slow_query_threshold=None,
+                                   db_lane_reservations=dict(critical=1)))
+
+    def test_load_db_replica(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_replica_url='efgh',
+                         db_replica_max_lag=0.5)))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                db_replica_url='efgh', db_replica_max_lag=0.5,
+                                db_slow_query_threshold=None,
+                                db_lane_reservations=dict(critical=1)))
+
+    def test_load_db_replica_max_lag_invalid(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_replica_max_lag=-1)))
+        self.assertConfigError(self.errors,
+                "c['db']['db_replica_max_lag'] must be a non-negative number")
+
+    def test_load_db_slow_query_threshold(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_slow_query_threshold=0.5)))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                db_replica_url=None, db_replica_max_lag=5,
+                                db_slow_query_threshold=0.5,
+                                db_lane_reservations=dict(critical=1)))
+
+    def test_load_db_slow_query_threshold_invalid(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd', db_slow_query_threshold='1s')))
+        self.assertConfigError(self.errors,
+                "c['db']['db_slow_query_threshold'] must be None or a "
+                "non-negative number")
+
+    def test_load_db_lane_reservations(self):
+        self.cfg.load_db(self.filename,
+            dict(db=dict(db_url='abcd',
+                    db_lane_reservations=dict(critical=2, normal=1))))
+        self.assertResults(db=dict(db_url='abcd', db_poll_interval=None,
+                                db_replica_url=None, db_replica_max_lag=5,
+                                db_slow_query_threshold=None,
+                                db_lane_reservations=dict(critical=2,
+                                                          normal=1)))
+
+    def test_load_db_lane_reservations_invalid(self):
+        for reservations in [ 2, dict(background=1), dict(critical=-1),
+                              dict(normal='one') ]:
+            self.errors = config.ConfigErrors()
+            self.patch(config, '_errors', self.errors)
+            self.cfg.load_db(self.filename,
+                dict(db=dict(db_url='abcd',
+                             db_lane_reservations=reservations)))
+            self.assertConfigError(self.errors,
+                    "c['db']['db_lane_reservations'] must be a dictionary")
 
     def test_load_db_unk_keys(self):
         self.cfg.load_db(self.filename,
@@ -630,6 +731,56 @@ class MasterConfig_loaders(ConfigErrorsMixin, unittest.TestCase):
         self.assertConfigError(self.errors,
                         "'Changes' cache size must be at least 1, got '-12'")
 
+    def test_load_caches_eviction(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(size=30, bytes=2**20),
+                                 Changes=dict(ttl=60, policy='2q'))))
+        self.assertResults(caches=dict(Changes=10, Builds=30),
+                cacheEviction=dict(
+                    Builds=dict(policy='lru', max_bytes=2**20, ttl=None),
+                    Changes=dict(policy='2q', max_bytes=None, ttl=60)))
+
+    def test_load_caches_eviction_unknown_option(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(bites=10))))
+        self.assertConfigError(self.errors,
+                "unknown option 'bites' for cache 'Builds'")
+
+    def test_load_caches_eviction_bad_bytes(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(bytes='1M'))))
+        self.assertConfigError(self.errors,
+                "'Builds' cache bytes must be a positive integer")
+
+    def test_load_caches_eviction_bad_ttl(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(ttl=0))))
+        self.assertConfigError(self.errors,
+                "'Builds' cache ttl must be a positive number")
+
+    def test_load_caches_eviction_bad_policy(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(policy='arc'))))
+        self.assertConfigError(self.errors,
+                "'Builds' cache policy must be one of lru, 2q")
+
+    def test_load_caches_eviction_bad_size(self):
+        self.cfg.load_caches(self.filename,
+                dict(caches=dict(Builds=dict(size=0))))
+        self.assertConfigError(self.errors,
+                "'Builds' cache size must be at least 1")
+
+    def test_load_caches_sharedCache(self):
+        store = sharedcache.DirectorySharedCache('/dev/shm/bb')
+        self.cfg.load_caches(self.filename, dict(sharedCache=store))
+        self.assertResults(sharedCache=store)
+
+    def test_load_caches_sharedCache_invalid(self):
+        self.cfg.load_caches(self.filename,
+                dict(sharedCache='localhost:11211'))
+        self.assertConfigError(self.errors,
+                "c['sharedCache'] must be a SharedCache")
+
     def test_load_schedulers_defaults(self):
         self.cfg.load_schedulers(self.filename, {})
         self.assertResults(schedulers={})
@@ -1000,6 +1151,18 @@ class MasterConfig_checkers(ConfigErrorsMixin, unittest.TestCase):
         self.assertConfigError(self.errors,
                 "debug client is configured, but c['protocols'] not")
 
+    def test_check_notifications_polling(self):
+        self.cfg.notifications = mock.Mock()
+        self.cfg.db['db_poll_interval'] = 60
+        self.cfg.check_notifications()
+        self.assertNoConfigErrors(self.errors)
+
+    def test_check_notifications_no_polling(self):
+        self.cfg.notifications = mock.Mock()
+        self.cfg.check_notifications()
+        self.assertConfigError(self.errors,
+                "c['notifications'] requires c['db']['db_poll_interval']")
+
     def test_check_ports_protocols_port_duplication(self):
         self.cfg.protocols = {"pb": {"port": 123}, "amp": {"port": 123}}
         self.cfg.check_ports()
@@ -15,9 +15,10 @@
 
 import sqlalchemy as sa
 import mock
-from buildbot.db import base
+from buildbot.db import base, pool
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.python import context
 
 class TestBase(unittest.TestCase):
 
@@ -47,6 +48,66 @@ class TestBase(unittest.TestCase):
         # run that again since the method gets stubbed out
         self.comp.check_length(self.tbl.c.str32, "long string" * 5)
 
+class TestRouting(unittest.TestCase):
+
+    class TestConnectorComponent(base.DBConnectorComponent):
+        primaryMethods = ('getOrAddThing',)
+        def route(self):
+            return context.get(pool.ROUTE)
+        getThing = getOrAddThing = addThing = route
+
+        criticalMethods = ('claimThing',)
+        backgroundMethods = ('pruneThings',)
+        def lane(self):
+            return context.get(pool.LANE)
+        getLane = claimThing = pruneThings = lane
+
+        def _getPrivate(self):
+            return context.get(pool.ROUTE)
+
+    def setUp(self):
+        self.comp = self.TestConnectorComponent(mock.Mock())
+
+    def test_get(self):
+        self.assertEqual(self.comp.getThing(),
+                         ('TestConnectorComponent', 'getThing', True))
+        self.assertEqual(self.comp.getThing.__name__, 'route')
+
+    def test_primaryMethods(self):
+        self.assertEqual(self.comp.getOrAddThing(),
+                         ('TestConnectorComponent', 'getOrAddThing', False))
+
+    def test_write(self):
+        self.assertEqual(self.comp.addThing(),
+                         ('TestConnectorComponent', 'addThing', False))
+
+    def test_private(self):
+        self.assertEqual(self.comp._getPrivate(), None)
+
+    def test_lanes(self):
+        self.assertEqual(self.comp.claimThing(), 'critical')
+        self.assertEqual(self.comp.pruneThings(), 'background')
+        self.assertEqual(self.comp.getLane(), None)
+
+    def test_lane_inherited(self):
+        lane = { pool.LANE : 'background' }
+        self.assertEqual(context.call(lane, self.comp.getLane), 'background')
+        self.assertEqual(context.call(lane, self.comp.claimThing),
+                         'critical')
+
+    def test_in_context(self):
+        # a callback fired outside the call still sees its route and lane
+        d = defer.Deferred()
+        def addCallback():
+            d.addCallback(base.in_context(lambda _ :
+                (context.get(pool.ROUTE), context.get(pool.LANE))))
+        lane = { pool.LANE : 'background' }
+        context.call(lane,
+                self.comp._routed(addCallback, 'getThing', True))
+        d.callback(None)
+        self.assertEqual(self.successResultOf(d),
+                (('TestConnectorComponent', 'getThing', True), 'background'))
+
 class TestCachedDecorator(unittest.TestCase):
 
     def setUp(self):
@@ -63,7 +124,7 @@ class TestCachedDecorator(unittest.TestCase):
             self.invocations.append(key)
             return defer.succeed(key * 2)
 
-    def get_cache(self, cache_name, miss_fn):
+    def get_cache(self, cache_name, miss_fn, shared=False):
         self.assertEqual(cache_name, "mycache")
         cache = mock.Mock(name="mycache")
         if self.cache_get_raises_exception:
@@ -93,6 +154,21 @@ class TestCachedDecorator(unittest.TestCase):
         self.assertEqual((res1, res2, comp.invocations),
                     ('foofoo', 'barbar', ['foo', 'bar']))
 
+    def test_cached_miss_routed(self):
+        # the miss function may be called outside of the caller's context,
+        # e.g., after consulting the shared cache store, so it is routed too
+        connector = mock.Mock(name="connector")
+        connector.master.caches.get_cache = self.get_cache
+        routes = []
+        def getThing(self, key):
+            routes.append(context.get(pool.ROUTE))
+        self.patch(self.TestConnectorComponent.getThing, 'method', getThing)
+        comp = self.TestConnectorComponent(connector)
+        # the fake cache's get is the miss function
+        comp.getThing.cache.get('foo')
+        self.assertEqual(routes,
+                [('TestConnectorComponent', 'getThing', True)])
+
     @defer.inlineCallbacks
     def test_cached_no_cache(self):
         # attach it to the connector
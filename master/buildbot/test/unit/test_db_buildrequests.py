@@ -15,8 +15,9 @@
 
 import datetime
 from twisted.trial import unittest
-from twisted.internet import task
-from buildbot.db import buildrequests
+from twisted.internet import task, defer
+from twisted.python import context
+from buildbot.db import buildrequests, pool
 from buildbot.test.util import interfaces, connector_component, db
 from buildbot.test.fake import fakedb, fakemaster
 from buildbot.util import UTC, epoch2datetime
@@ -224,6 +225,85 @@ class Tests(interfaces.InterfaceTests):
         d.addCallback(check)
         return d
 
+    def test_getBuildRequestsSince(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+            fakedb.BuildRequestClaim(brid=44, objectid=self.MASTER_ID,
+                    claimed_at=self.CLAIMED_AT_EPOCH),
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=46, buildsetid=self.BSID),
+            fakedb.BuildRequestClaim(brid=46, objectid=self.OTHER_MASTER_ID,
+                    claimed_at=self.CLAIMED_AT_EPOCH),
+            fakedb.BuildRequest(id=47, buildsetid=self.BSID,
+                complete=1, results=92,
+                complete_at=self.COMPLETE_AT_EPOCH),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequestsSince(45,
+                                                brids=[44, 46, 99]))
+        def check(brlist):
+            self.assertEqual([ (br['brid'], br['claimed'], br['mine'],
+                                br['complete']) for br in brlist ],
+                             [ (44, True, True, False),
+                               (46, True, False, False),
+                               (47, False, False, True) ])
+        d.addCallback(check)
+        return d
+
+    def test_getLatestBuildRequestId(self):
+        d = self.db.buildrequests.getLatestBuildRequestId()
+        def check_empty(brid):
+            self.assertEqual(brid, None)
+        d.addCallback(check_empty)
+        d.addCallback(lambda _ : self.insertTestData([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+        ]))
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getLatestBuildRequestId())
+        def check(brid):
+            self.assertEqual(brid, 45)
+        d.addCallback(check)
+        return d
+
+    def test_getBuildRequestUnclaimsSince(self):
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+            fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+            fakedb.BuildRequestUnclaim(id=5, brid=44, unclaimed_at=100),
+            fakedb.BuildRequestUnclaim(id=6, brid=45, unclaimed_at=101),
+            fakedb.BuildRequestUnclaim(id=7, brid=44, unclaimed_at=102),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequestUnclaimsSince(5))
+        def check(unclaims):
+            self.assertEqual(unclaims, [ (6, 45), (7, 44) ])
+        d.addCallback(check)
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getLatestBuildRequestUnclaimId())
+        def check_latest(unclaimid):
+            self.assertEqual(unclaimid, 7)
+        d.addCallback(check_latest)
+        return d
+
+    def test_pruneBuildRequestUnclaims(self):
+        clock = task.Clock()
+        clock.advance(200)
+        d = self.insertTestData([
+            fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+            fakedb.BuildRequestUnclaim(id=5, brid=44, unclaimed_at=100),
+            fakedb.BuildRequestUnclaim(id=6, brid=44, unclaimed_at=150),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildrequests.pruneBuildRequestUnclaims(60,
+                                                        _reactor=clock))
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequestUnclaimsSince(0))
+        def check(unclaims):
+            self.assertEqual(unclaims, [ (6, 44) ])
+        d.addCallback(check)
+        return d
+
     def test_getBuildRequests_combo(self):
         d = self.insertTestData([
             # 44: everything we want
@@ -444,6 +524,66 @@ class Tests(interfaces.InterfaceTests):
         d.addCallback(check)
         return d
 
+    def do_test_tryClaimBuildRequests(self, rows, now, brids, exp_claimed,
+                                      expected):
+        clock = task.Clock()
+        clock.advance(now)
+
+        d = self.insertTestData(rows)
+        d.addCallback(lambda _ :
+            self.db.buildrequests.tryClaimBuildRequests(brids=brids,
+                        _reactor=clock))
+        def check_claimed(claimed):
+            self.assertEqual(claimed, exp_claimed)
+        d.addCallback(check_claimed)
+        d.addCallback(lambda _ :
+                self.db.buildrequests.getBuildRequests())
+        def check(results):
+            self.assertEqual(
+                sorted([ (r['brid'], r['claimed_at'], r['mine'])
+                            for r in results ]),
+                sorted(expected))
+        d.addCallback(check)
+        return d
+
+    def test_tryClaimBuildRequests(self):
+        return self.do_test_tryClaimBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=45, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=46, buildsetid=self.BSID),
+                fakedb.BuildRequest(id=47, buildsetid=self.BSID),
+                fakedb.BuildRequestClaim(brid=45,
+                    objectid=self.OTHER_MASTER_ID,
+                    claimed_at=1300103810),
+            ], 1300305712, [ 46, 44, 45, 46 ], [ 46, 44 ],
+            [
+                (44, epoch2datetime(1300305712), True),
+                (45, epoch2datetime(1300103810), False),
+                (46, epoch2datetime(1300305712), True),
+                (47, None, False),
+            ])
+
+    def test_tryClaimBuildRequests_none_claimed(self):
+        return self.do_test_tryClaimBuildRequests([
+                fakedb.BuildRequest(id=44, buildsetid=self.BSID),
+                fakedb.BuildRequestClaim(brid=44,
+                    objectid=self.OTHER_MASTER_ID,
+                    claimed_at=1300103810),
+            ], 1300305712, [ 44 ], [],
+            [ (44, epoch2datetime(1300103810), False) ])
+
+    def test_tryClaimBuildRequests_stress(self):
+        return self.do_test_tryClaimBuildRequests(
+            [ fakedb.BuildRequest(id=id, buildsetid=self.BSID)
+              for id in range(1, 1001) ] +
+            [ fakedb.BuildRequestClaim(brid=500,
+                    objectid=self.OTHER_MASTER_ID, claimed_at=1300103810) ],
+            1300305712, range(1, 1001),
+            range(1, 500) + range(501, 1001),
+            [ (id, epoch2datetime(1300305712), True)
+              for id in range(1, 500) + range(501, 1001) ] +
+            [ (500, epoch2datetime(1300103810), False) ])
+
     def do_test_reclaimBuildRequests(self, rows, now, brids, expected=None,
                                   expfailure=None):
         clock = task.Clock()
@@ -615,7 +755,7 @@ class Tests(interfaces.InterfaceTests):
             ], 1300305712,
             expfailure=buildrequests.NotClaimedError)
 
-    def do_test_unclaimMethod(self, method, expected):
+    def do_test_unclaimMethod(self, method, expected, expected_unclaims):
         d = self.insertTestData([
             # 44: a complete build (should not be unclaimed)
             fakedb.BuildRequest(id=44, buildsetid=self.BSID,
@@ -660,6 +800,13 @@ class Tests(interfaces.InterfaceTests):
             self.assertEqual(sorted([ r['brid'] for r in results ]),
                                 sorted(expected))
         d.addCallback(check)
+        # and check that the unclaims were journaled
+        d.addCallback(lambda _ :
+            self.db.buildrequests.getBuildRequestUnclaimsSince(0))
+        def check_unclaims(unclaims):
+            self.assertEqual(sorted([ brid for _, brid in unclaims ]),
+                                sorted(expected_unclaims))
+        d.addCallback(check_unclaims)
         return d
 
     def test_unclaimExpiredRequests(self):
@@ -669,7 +816,7 @@ class Tests(interfaces.InterfaceTests):
         meth = self.db.buildrequests.unclaimExpiredRequests
         return self.do_test_unclaimMethod(
             lambda : meth(100, _reactor=clock),
-            [47, 49])
+            [47, 49], [49])
 
     def test_unclaimBuildRequests(self):
         to_unclaim = [
@@ -683,7 +830,7 @@ class Tests(interfaces.InterfaceTests):
         ]
         return self.do_test_unclaimMethod(
             lambda : self.db.buildrequests.unclaimBuildRequests(to_unclaim),
-            [45, 47, 48])
+            [45, 47, 48], [44, 45, 48])
 
 class TestFakeDB(unittest.TestCase, Tests):
     # Compatiblity with some checks in the "real" tests.
@@ -706,7 +853,8 @@ class TestRealDB(unittest.TestCase,
         d = self.setUpConnectorComponent(
             table_names=[ 'patches', 'changes', 'sourcestamp_changes',
                 'buildsets', 'buildset_properties', 'buildrequests',
-                'objects', 'buildrequest_claims', 'sourcestamps', 'sourcestampsets' ])
+                'objects', 'buildrequest_claims', 'buildrequest_unclaims',
+                'sourcestamps', 'sourcestampsets' ])
 
         @d.addCallback
         def finish_setup(_):
@@ -717,3 +865,38 @@ class TestRealDB(unittest.TestCase,
 
     def tearDown(self):
         return self.tearDownConnectorComponent()
+
+    def test_route_after_getObjectId(self):
+        # the query is routed even though the master's object id is only
+        # known later, in a callback
+        d = defer.Deferred()
+        self.db.master.getObjectId = lambda : d
+        routes = []
+        def do(thd):
+            routes.append(context.get(pool.ROUTE))
+            return defer.succeed([])
+        self.patch(self.db.pool, 'do', do)
+        self.db.buildrequests.getBuildRequests(claimed=False)
+        d.callback(self.MASTER_ID)
+        self.assertEqual(routes, [ ('BuildRequestsConnectorComponent',
+                                    'getBuildRequests', True) ])
+
+    def do_test_lane(self, method, *args):
+        d = defer.Deferred()
+        self.db.master.getObjectId = lambda : d
+        lanes = []
+        def do(thd):
+            lanes.append(context.get(pool.LANE))
+            return defer.succeed([])
+        self.patch(self.db.pool, 'do', do)
+        getattr(self.db.buildrequests, method)(*args)
+        d.callback(self.MASTER_ID)
+        self.assertEqual(lanes, [ 'critical' ])
+
+    def test_tryClaimBuildRequests_critical(self):
+        # the build request distributor's claims are queued in the critical
+        # lane
+        self.do_test_lane('tryClaimBuildRequests', [ 44 ])
+
+    def test_unclaimBuildRequests_critical(self):
+        self.do_test_lane('unclaimBuildRequests', [ 44 ])
@@ -154,6 +154,32 @@ class TestBuildsetsConnectorComponent(
         "returns an empty dict even if no such buildset exists"
         return self.do_test_getBuildsetProperties(91, [], dict())
 
+    def test_getBuildsetsProperties(self):
+        d = self.insertTestData([
+            fakedb.Buildset(id=91, sourcestampsetid=234, complete=0,
+                    results=-1, submitted_at=0),
+            fakedb.Buildset(id=92, sourcestampsetid=234, complete=0,
+                    results=-1, submitted_at=0),
+            fakedb.Buildset(id=93, sourcestampsetid=234, complete=0,
+                    results=-1, submitted_at=0),
+            fakedb.BuildsetProperty(buildsetid=91, property_name='prop1',
+                    property_value='["one", "fake1"]'),
+            fakedb.BuildsetProperty(buildsetid=91, property_name='prop2',
+                    property_value='["two", "fake2"]'),
+            fakedb.BuildsetProperty(buildsetid=93, property_name='prop1',
+                    property_value='["three", "fake3"]'),
+        ])
+        d.addCallback(lambda _ :
+                self.db.buildsets.getBuildsetsProperties([91, 92, 93, 94]))
+        def check(props):
+            self.assertEqual(props, {
+                91 : dict(prop1=("one", "fake1"), prop2=("two", "fake2")),
+                92 : {},
+                93 : dict(prop1=("three", "fake3")),
+                94 : {} })
+        d.addCallback(check)
+        return d
+
     def test_getBuildset_incomplete_None(self):
         d = self.insertTestData([
             fakedb.Buildset(id=91, sourcestampsetid=234, complete=0,
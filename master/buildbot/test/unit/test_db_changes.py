@@ -20,6 +20,7 @@ from twisted.trial import unittest
 from twisted.internet import defer, task
 from buildbot.changes.changes import Change
 from buildbot.db import changes
+from buildbot.process import cache
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
 from buildbot.util import epoch2datetime
@@ -520,3 +521,116 @@ class TestChangesConnectorComponent(
                         { 'notest' : ('no', 'Change') })
         d.addCallback(check)
         return d
+
+    def test_getChanges(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=8),
+        ] + self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges([14, 99, 13, 8]))
+        def check(changes):
+            # in the order requested, with None for the missing change
+            self.assertEqual([ c and c['changeid'] for c in changes ],
+                             [14, None, 13, 8])
+            self.assertEqual(changes[0], self.change14_dict)
+            self.assertEqual(sorted(changes[2]['files']),
+                        sorted(['master/README.txt', 'slave/README.txt']))
+            self.assertEqual(changes[2]['properties'],
+                        { 'notest' : ('no', 'Change') })
+            self.assertEqual(changes[3]['files'], [])
+        d.addCallback(check)
+        return d
+
+    def test_getChanges_many(self):
+        # more changes than fit in one batch
+        d = self.insertTestData([ fakedb.Change(changeid=i)
+                                  for i in range(1, 251) ])
+        d.addCallback(lambda _ :
+                self.db.changes.getChanges(range(1, 251)))
+        def check(changes):
+            self.assertEqual([ c['changeid'] for c in changes ],
+                             range(1, 251))
+        d.addCallback(check)
+        return d
+
+    def useRealCaches(self):
+        self.db.master.caches = cache.CacheManager()
+        self.db.master.caches.config = dict(chdicts=10)
+        self.db.changes = changes.ChangesConnectorComponent(self.db)
+
+    @defer.inlineCallbacks
+    def test_getChanges_cached(self):
+        self.useRealCaches()
+        yield self.insertTestData(self.change13_rows + self.change14_rows)
+        ch13 = yield self.db.changes.getChange(13)
+
+        # change 13 comes from the cache, and change 14 is added to it
+        changes = yield self.db.changes.getChanges([13, 14])
+        self.assertIdentical(changes[0], ch13)
+        self.assertEqual(changes[1], self.change14_dict)
+        self.db.changes.getChange.cache.miss_fn = \
+                lambda key : self.fail("looked up %r" % (key,))
+        ch14 = yield self.db.changes.getChange(14)
+        self.assertIdentical(ch14, changes[1])
+
+        # when every change is cached, the database is not queried
+        self.patch(self.db.pool, 'do', lambda thd : self.fail("queried"))
+        changes = yield self.db.changes.getChanges([14, 13])
+        self.assertEqual([ c['changeid'] for c in changes ], [14, 13])
+
+    @defer.inlineCallbacks
+    def test_getRecentChanges_cached(self):
+        self.useRealCaches()
+        yield self.insertTestData(self.change13_rows + self.change14_rows)
+        ch13 = yield self.db.changes.getChange(13)
+        changes = yield self.db.changes.getRecentChanges(5)
+        self.assertIdentical(changes[0], ch13)
+        self.assertEqual(changes[1], self.change14_dict)
+
+    def test_getChanges_empty(self):
+        d = self.db.changes.getChanges([])
+        def check(changes):
+            self.assertEqual(changes, [])
+        d.addCallback(check)
+        return d
+
+    def test_getChangesSince(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=8),
+            fakedb.Change(changeid=9),
+        ] + self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChangesSince(8))
+        def check(changes):
+            changeids = [ c['changeid'] for c in changes ]
+            self.assertEqual(changeids, [9, 13, 14])
+            self.assertEqual(changes[2], self.change14_dict)
+            self.assertEqual(sorted(changes[1]['files']),
+                        sorted(['master/README.txt', 'slave/README.txt']))
+            self.assertEqual(changes[1]['properties'],
+                        { 'notest' : ('no', 'Change') })
+            self.assertEqual(changes[0]['files'], [])
+        d.addCallback(check)
+        return d
+
+    def test_getChangesSince_limit(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=8),
+            fakedb.Change(changeid=9),
+        ] + self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChangesSince(0, limit=3))
+        def check(changes):
+            changeids = [ c['changeid'] for c in changes ]
+            self.assertEqual(changeids, [8, 9, 13])
+        d.addCallback(check)
+        return d
+
+    def test_getChangesSince_empty(self):
+        d = self.insertTestData(self.change13_rows + self.change14_rows)
+        d.addCallback(lambda _ :
+                self.db.changes.getChangesSince(14))
+        def check(changes):
+            self.assertEqual(changes, [])
+        d.addCallback(check)
+        return d
@@ -85,3 +85,48 @@ class DBConnector(db.RealDatabaseMixin, unittest.TestCase):
     def test_setup_check_version_good(self):
         self.db.model.is_current = lambda : defer.succeed(True)
         return self.startService(check_version=True)
+
+    @defer.inlineCallbacks
+    def test_setup_replica(self):
+        self.master.config.db['db_replica_url'] = 'sqlite://'
+        self.master.config.db['db_replica_max_lag'] = 2
+        yield self.startService()
+        self.assertEqual(self.db.pool.replica.engine.dialect.name, 'sqlite')
+        self.assertEqual(self.db.pool.max_lag, 2)
+
+        self.master.config.db['db_replica_max_lag'] = 3
+        yield self.db.reconfigService(self.master.config)
+        self.assertEqual(self.db.pool.max_lag, 3)
+
+    @defer.inlineCallbacks
+    def test_setup_slow_query_threshold(self):
+        self.master.config.db['db_slow_query_threshold'] = 2
+        yield self.startService()
+        self.assertEqual(self.db.pool.slow_query_threshold, 2)
+
+        self.master.config.db['db_slow_query_threshold'] = None
+        yield self.db.reconfigService(self.master.config)
+        self.assertEqual(self.db.pool.slow_query_threshold, None)
+
+    @defer.inlineCallbacks
+    def test_setup_lane_reservations(self):
+        self.master.config.db['db_replica_url'] = 'sqlite://'
+        self.master.config.db['db_lane_reservations'] = dict(critical=1)
+        yield self.startService()
+        # sqlite in-memory databases use only one thread
+        for p in self.db.pool, self.db.pool.replica:
+            self.assertEqual(p.q.limits,
+                    dict(critical=1, normal=1, background=1))
+
+        self.db.pool.max = self.db.pool.replica.max = 4
+        self.master.config.db['db_lane_reservations'] = dict(critical=1,
+                                                             normal=2)
+        yield self.db.reconfigService(self.master.config)
+        for p in self.db.pool, self.db.pool.replica:
+            self.assertEqual(p.q.limits,
+                    dict(critical=4, normal=3, background=1))
+
+    @defer.inlineCallbacks
+    def test_setup_no_replica(self):
+        yield self.startService()
+        self.assertEqual(self.db.pool.replica, None)
@@ -0,0 +1,69 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import sqlalchemy as sa
+from twisted.trial import unittest
+from buildbot.test.util import migration
+
+class Migration(migration.MigrateTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        return self.setUpMigrateTest()
+
+    def tearDown(self):
+        return self.tearDownMigrateTest()
+
+    def test_empty_migration(self):
+        def setup_thd(conn):
+            metadata = sa.MetaData()
+            metadata.bind = conn
+
+            # only the id of the buildrequests table is referenced
+            buildrequests = sa.Table('buildrequests', metadata,
+                sa.Column('id', sa.Integer,  primary_key=True),
+            )
+            buildrequests.create()
+            conn.execute(buildrequests.insert(), dict(id=10))
+
+        def verify_thd(conn):
+            metadata = sa.MetaData()
+            metadata.bind = conn
+
+            unclaims = sa.Table('buildrequest_unclaims', metadata,
+                                autoload=True)
+
+            # table starts empty
+            res = conn.execute(unclaims.select())
+            self.assertEqual(res.fetchall(), [])
+
+            # and the ids are assigned in order
+            conn.execute(unclaims.insert(),
+                    dict(brid=10, unclaimed_at=1000))
+            conn.execute(unclaims.insert(),
+                    dict(brid=10, unclaimed_at=1001))
+            res = conn.execute(sa.select([ unclaims.c.id, unclaims.c.brid ],
+                    order_by=[ unclaims.c.unclaimed_at ]))
+            rows = res.fetchall()
+            self.assertEqual([ r.brid for r in rows ], [ 10, 10 ])
+            self.assertTrue(rows[0].id < rows[1].id)
+
+            insp = sa.engine.reflection.Inspector.from_engine(conn)
+            self.assertEqual(
+                sorted([ i['name'] for i in
+                         insp.get_indexes('buildrequest_unclaims') ]),
+                [ 'buildrequest_unclaims_brid',
+                  'buildrequest_unclaims_unclaimed_at' ])
+
+        return self.do_test_migration(24, 25, setup_thd, verify_thd)
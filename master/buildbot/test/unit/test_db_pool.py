@@ -15,10 +15,13 @@
 
 import os
 import time
+import threading
 import sqlalchemy as sa
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.python import context, log, threadpool
 from buildbot.db import pool
+from buildbot.process import metrics
 from buildbot.test.util import db
 
 class Basic(unittest.TestCase):
@@ -89,6 +92,156 @@ class Basic(unittest.TestCase):
         d.addCallback( lambda r : self.pool.do_with_engine(insert_into_table))
         return d
 
+    def captureLog(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        return events
+
+    @defer.inlineCallbacks
+    def test_do_histograms(self):
+        events = self.captureLog()
+        def thd(conn):
+            return conn.execute("SELECT 1").scalar()
+        route = { pool.ROUTE : ('Changes', 'getThing', True) }
+        yield context.call(route, self.pool.do, thd)
+        yield self.pool.do(thd)
+        hists = [ (e['metric'].histogram, e['metric'].value >= 0)
+                  for e in events
+                  if isinstance(e.get('metric'), metrics.MetricHistogramEvent) ]
+        self.assertEqual(hists, [
+            ('DBThreadPool.lane.normal.wait', True),
+            ('DBThreadPool.wait.Changes.getThing', True),
+            ('DBThreadPool.execute.Changes.getThing', True),
+            ('DBThreadPool.lane.normal.wait', True),
+            ('DBThreadPool.wait.unknown', True),
+            ('DBThreadPool.execute.unknown', True),
+        ])
+
+    @defer.inlineCallbacks
+    def test_do_lane(self):
+        events = self.captureLog()
+        def thd(conn):
+            return conn.execute("SELECT 1").scalar()
+        lane = { pool.LANE : 'critical' }
+        res = yield context.call(lane, self.pool.do, thd)
+        self.assertEqual(res, 1)
+        lanes = [ e['metric'].counter for e in events
+                  if isinstance(e.get('metric'), metrics.MetricCountEvent) ]
+        self.assertEqual(lanes, [ 'DBThreadPool.lane.critical.queued' ] * 2)
+
+    @defer.inlineCallbacks
+    def test_do_slow_query(self):
+        events = self.captureLog()
+        self.pool.slow_query_threshold = 0.01
+        def slow(conn):
+            time.sleep(0.02)
+            return conn.execute("SELECT 1").scalar()
+        def fast(conn):
+            return conn.execute("SELECT 2").scalar()
+        yield self.pool.do(slow)
+        yield self.pool.do(fast)
+        msgs = [ ' '.join(e['message']) for e in events
+                 if ' '.join(e['message']).startswith('slow') ]
+        self.assertEqual(len(msgs), 1)
+        self.assertTrue(msgs[0].startswith('slow database query in unknown:'))
+        if hasattr(sa, 'event'):
+            self.assertTrue(msgs[0].endswith('\n  SELECT 1'))
+
+    @defer.inlineCallbacks
+    def test_do_slow_query_error(self):
+        events = self.captureLog()
+        self.pool.slow_query_threshold = 0
+        def fail(conn):
+            conn.execute("SELECT 1")
+            raise RuntimeError("oh noes")
+        yield self.assertFailure(self.pool.do(fail), RuntimeError)
+        msgs = [ ' '.join(e['message']) for e in events
+                 if ' '.join(e['message']).startswith('slow') ]
+        self.assertEqual(len(msgs), 1)
+
+
+class LaneQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.q = pool.LaneQueue(3, dict(critical=1, normal=1))
+
+    @defer.inlineCallbacks
+    def test_threadpool_queue(self):
+        # DBThreadPool replaces ThreadPool's private work queue, q, with a
+        # LaneQueue; this pins down what that relies on: ThreadPool creates
+        # q, queues (context, function, args, kwargs, onResult) tuples on it,
+        # and its threads take work from it
+        self.assertTrue(hasattr(threadpool.ThreadPool(), 'q'))
+        engine = sa.create_engine('sqlite://')
+        engine.optimal_thread_pool_size = 1
+        dbpool = pool.DBThreadPool(engine)
+        self.addCleanup(dbpool.shutdown)
+        self.assertIsInstance(dbpool.q, pool.LaneQueue)
+        items = []
+        put = dbpool.q.put
+        def record(item):
+            items.append(item)
+            put(item)
+        dbpool.q.put = record
+        def thd(conn):
+            return conn.execute("SELECT 1").scalar()
+        res = yield context.call({ pool.LANE : 'critical' }, dbpool.do, thd)
+        self.assertEqual(res, 1)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(len(items[0]), 5)
+        self.assertEqual(items[0][0][pool.LANE], 'critical')
+
+    def item(self, name, lane=None):
+        ctx = {}
+        if lane:
+            ctx[pool.LANE] = lane
+        return (ctx, name, (), {}, None)
+
+    def test_limits(self):
+        self.assertEqual(self.q.limits,
+                         dict(critical=3, normal=2, background=1))
+        # every lane can use at least one thread
+        self.q.setLimits(1, dict(critical=1, normal=1))
+        self.assertEqual(self.q.limits,
+                         dict(critical=1, normal=1, background=1))
+
+    def test_priority(self):
+        self.q.put(self.item('b1', 'background'))
+        self.q.put(self.item('n1'))
+        self.q.put(self.item('b2', 'background'))
+        self.q.put(self.item('c1', 'critical'))
+        self.q.put(self.item('n2', 'bogus'))
+        self.assertEqual((self.q.qsize(), self.q.depth('normal')), (5, 2))
+        self.assertEqual([ self.q.get()[1] for i in range(5) ],
+                         [ 'c1', 'n1', 'n2', 'b1', 'b2' ])
+
+    def test_stop(self):
+        self.q.put(self.item('n1'))
+        self.q.put(threadpool.WorkerStop)
+        self.assertIdentical(self.q.get(), threadpool.WorkerStop)
+        self.assertEqual(self.q.get()[1], 'n1')
+
+    def test_reservations(self):
+        # with two other threads busy, only critical work can start
+        self.q.running.update([ 'thread1', 'thread2' ])
+        self.q.put(self.item('b1', 'background'))
+        self.q.put(self.item('n1'))
+        got = []
+        thd = threading.Thread(target=lambda : got.append(self.q.get()))
+        thd.start()
+        thd.join(0.1)
+        self.assertEqual(got, [])
+
+        self.q.put(self.item('c1', 'critical'))
+        thd.join(1)
+        self.assertEqual([ i[1] for i in got ], [ 'c1' ])
+
+        # the thread running c1 is busy too, so normal work can start once
+        # both of the others finish
+        self.q.running.difference_update([ 'thread1', 'thread2' ])
+        self.assertEqual(self.q.get()[1], 'n1')
+
 
 class Stress(unittest.TestCase):
 
@@ -129,6 +282,96 @@ class Stress(unittest.TestCase):
     del test_inserts
 
 
+class Replica(unittest.TestCase):
+
+    # the primary and the replica are two SQLite files that are not actually
+    # replicated, so each read shows which was used
+
+    def setUp(self):
+        self.pool = self.makePool('primary')
+        self.pool.setReplica(self.makePool('replica'), 10)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        for name in 'primary', 'replica':
+            os.unlink('%s.sqlite' % name)
+
+    def makePool(self, name):
+        if os.path.exists('%s.sqlite' % name):
+            os.unlink('%s.sqlite' % name)
+        engine = sa.create_engine('sqlite:///%s.sqlite' % name)
+        engine.execute("CREATE TABLE test (name text)")
+        engine.execute("INSERT INTO test VALUES ('%s')" % name)
+        engine.optimal_thread_pool_size = 1
+        return pool.DBThreadPool(engine)
+
+    def do(self, route):
+        def thd(conn):
+            return conn.execute("SELECT name FROM test").scalar()
+        if route is None:
+            return self.pool.do(thd)
+        return context.call({ pool.ROUTE : route }, self.pool.do, thd)
+
+    @defer.inlineCallbacks
+    def test_read(self):
+        name = yield self.do(('Changes', 'getThing', True))
+        self.assertEqual(name, 'replica')
+
+    @defer.inlineCallbacks
+    def test_write(self):
+        name = yield self.do(('Changes', 'addThing', False))
+        self.assertEqual(name, 'primary')
+
+    @defer.inlineCallbacks
+    def test_read_after_write(self):
+        yield self.do(('Buildsets', 'addThing', False))
+        # every component reads from the primary after a write, since writes
+        # by one component change the tables read by others
+        name = yield self.do(('Buildsets', 'getThing', True))
+        self.assertEqual(name, 'primary')
+        name = yield self.do(('BuildRequests', 'getThing', True))
+        self.assertEqual(name, 'primary')
+
+        # until the replica has caught up
+        self.pool._lastWrite -= 10
+        name = yield self.do(('BuildRequests', 'getThing', True))
+        self.assertEqual(name, 'replica')
+
+    @defer.inlineCallbacks
+    def test_read_after_slow_write(self):
+        self.pool.max_lag = 0.2
+        def slowWrite(conn):
+            time.sleep(0.3)
+            return conn.execute("SELECT name FROM test").scalar()
+        d = context.call({ pool.ROUTE : ('Buildsets', 'addThing', False) },
+                         self.pool.do, slowWrite)
+        # reads during the write go to the primary
+        name = yield self.do(('BuildRequests', 'getThing', True))
+        self.assertEqual(name, 'primary')
+        yield d
+        # as do reads for max_lag after it finishes, even though the write
+        # was queued longer ago than that
+        name = yield self.do(('BuildRequests', 'getThing', True))
+        self.assertEqual(name, 'primary')
+
+    @defer.inlineCallbacks
+    def test_unknown(self):
+        # calls from outside the components go to the primary, but do not
+        # count as writes
+        name = yield self.do(None)
+        self.assertEqual(name, 'primary')
+        name = yield self.do(('Users', 'getThing', True))
+        self.assertEqual(name, 'replica')
+
+    @defer.inlineCallbacks
+    def test_shutdown(self):
+        yield self.do(('Changes', 'getThing', True))
+        replica = self.pool.replica
+        self.assertTrue(replica.running)
+        self.pool.shutdown()
+        self.assertFalse(replica.running)
+
+
 class BasicWithDebug(Basic):
 
     # same thing, but with debug=True
@@ -14,7 +14,9 @@
 # Copyright Buildbot Team Members
 
 from twisted.trial import unittest
+from twisted.internet import defer
 from buildbot.db import sourcestamps
+from buildbot.process import cache
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
 
@@ -210,3 +212,81 @@ class TestSourceStampsConnectorComponent(
             self.assertEqual(ssdict, None)
         d.addCallback(check)
         return d
+
+    def test_getSourceStampsForSets(self):
+        d = self.insertTestData([
+            fakedb.Change(changeid=16),
+            fakedb.Change(changeid=19),
+            fakedb.Patch(id=99, patch_base64='aGVsbG8sIHdvcmxk',
+                patch_author='bar', patch_comment='foo', subdir='/foo',
+                patchlevel=3),
+            fakedb.SourceStampSet(id=234),
+            fakedb.SourceStampSet(id=235),
+            fakedb.SourceStampSet(id=236),
+            fakedb.SourceStamp(id=234, sourcestampsetid=234, codebase='a'),
+            fakedb.SourceStamp(id=235, sourcestampsetid=234, codebase='b',
+                patchid=99),
+            fakedb.SourceStamp(id=236, sourcestampsetid=235, codebase='a'),
+            fakedb.SourceStampChange(sourcestampid=234, changeid=16),
+            fakedb.SourceStampChange(sourcestampid=236, changeid=16),
+            fakedb.SourceStampChange(sourcestampid=236, changeid=19),
+        ])
+        d.addCallback(lambda _ :
+                self.db.sourcestamps.getSourceStampsForSets([234, 235, 236]))
+        def check(sslists):
+            self.assertEqual(sorted(sslists.keys()), [234, 235, 236])
+            self.assertEqual(
+                sorted([ (ss['ssid'], ss['codebase'], ss['changeids'],
+                          ss['patch_body'])
+                         for ss in sslists[234] ]),
+                [ (234, 'a', set([16]), None),
+                  (235, 'b', set([]), 'hello, world') ])
+            self.assertEqual(
+                [ (ss['ssid'], ss['changeids']) for ss in sslists[235] ],
+                [ (236, set([16, 19])) ])
+            self.assertEqual(sslists[236], [])
+        d.addCallback(check)
+        return d
+
+    @defer.inlineCallbacks
+    def test_getSourceStampsForSets_cached(self):
+        self.db.master.caches = cache.CacheManager()
+        self.db.master.caches.config = dict(sssetdicts=10, ssdicts=10)
+        self.db.sourcestamps = \
+                sourcestamps.SourceStampsConnectorComponent(self.db)
+        yield self.insertTestData([
+            fakedb.SourceStampSet(id=234),
+            fakedb.SourceStampSet(id=235),
+            fakedb.SourceStamp(id=234, sourcestampsetid=234),
+            fakedb.SourceStamp(id=235, sourcestampsetid=235),
+        ])
+        sslist234 = yield self.db.sourcestamps.getSourceStamps(234)
+
+        # set 234 comes from the cache, and set 235 and its sourcestamp are
+        # added to the caches
+        sslists = yield self.db.sourcestamps.getSourceStampsForSets([234, 235])
+        self.assertIdentical(sslists[234], sslist234)
+        self.assertEqual([ ss['ssid'] for ss in sslists[235] ], [235])
+        self.patch(self.db.pool, 'do', lambda thd : self.fail("queried"))
+        sslist235 = yield self.db.sourcestamps.getSourceStamps(235)
+        self.assertIdentical(sslist235, sslists[235])
+        ssdict = yield self.db.sourcestamps.getSourceStamp(235)
+        self.assertIdentical(ssdict, sslists[235][0])
+
+    def test_getSourceStamps(self):
+        d = self.insertTestData([
+            fakedb.SourceStampSet(id=234),
+            fakedb.SourceStamp(id=234, sourcestampsetid=234, branch='br',
+                revision='rv', repository='rep', codebase='cb',
+                project='prj'),
+        ])
+        d.addCallback(lambda _ :
+                self.db.sourcestamps.getSourceStamps(234))
+        def check(sslist):
+            self.assertEqual(sslist, [ dict(ssid=234, branch='br',
+                revision='rv', sourcestampsetid=234, repository='rep',
+                codebase='cb', project='prj', patch_body=None,
+                patch_level=None, patch_subdir=None, patch_author=None,
+                patch_comment=None, changeids=set([])) ])
+        d.addCallback(check)
+        return d
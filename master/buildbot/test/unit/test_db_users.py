@@ -13,8 +13,10 @@
 #
 # Copyright Buildbot Team Members
 
+import mock
 import sqlalchemy as sa
 from twisted.trial import unittest
+from twisted.internet import defer
 from buildbot.db import users
 from buildbot.test.util import connector_component
 from buildbot.test.fake import fakedb
@@ -448,6 +450,19 @@ class TestUsersConnectorComponent(connector_component.ConnectorComponentMixin,
         d.addCallback(check1)
         return d
 
+    def test_updateUser_invalidates(self):
+        invalidate = self.db.master.caches.invalidate = \
+                mock.Mock(return_value=defer.succeed(None))
+        d = self.insertTestData(self.user1_rows)
+        d.addCallback(lambda _ : self.db.users.updateUser(
+                uid=1, attr_type='IPv9', attr_data='abcd.1234'))
+        d.addCallback(lambda _ : self.db.users.removeUser(1))
+        def check(_):
+            self.assertEqual(invalidate.call_args_list,
+                    [ (('usdicts', 1), {}), (('usdicts', 1), {}) ])
+        d.addCallback(check)
+        return d
+
     def test_removeNoMatch(self):
         d = self.insertTestData(self.user1_rows)
         def check(_):
@@ -19,7 +19,7 @@ import signal
 from twisted.internet import defer, reactor, task
 from twisted.trial import unittest
 from twisted.python import log
-from buildbot import master, monkeypatches, config
+from buildbot import master, monkeypatches, config, notifier
 from buildbot.util import subscription
 from buildbot.db import connector
 from buildbot.test.util import dirs, compat, misc, logging
@@ -211,6 +211,66 @@ class Subscriptions(dirs.DirsMixin, unittest.TestCase):
         # assert the notification sub was called correctly
         cb.assert_called_with(938593, 999)
 
+    @defer.inlineCallbacks
+    def test_addChange_notifications(self):
+        self.master.config.db['db_poll_interval'] = 60
+        self.master.notifications = mock.Mock()
+        self.patch(self.master, 'pollDatabaseChanges',
+                mock.Mock(return_value=defer.succeed(None)))
+        self.master.db = mock.Mock()
+        self.master.db.changes.addChange.return_value = defer.succeed(14)
+        self.master.db.changes.getChange.return_value = defer.succeed({})
+        self.patch(changes.Change, 'fromChdict',
+                classmethod(lambda cls, master, chdict :
+                                defer.succeed(mock.Mock(number=14))))
+        cb = mock.Mock()
+        self.master.subscribeToChanges(cb)
+
+        yield self.master.addChange()
+
+        # the change is delivered by polling, which starts immediately
+        self.assertFalse(cb.called)
+        self.master.pollDatabaseChanges.assert_called_with()
+        self.master.notifications.send.assert_called_with('change',
+                                                          changeid=14)
+
+    @defer.inlineCallbacks
+    def test_addBuildset_notifications(self):
+        self.master.config.db['db_poll_interval'] = 60
+        self.master.notifications = mock.Mock()
+        self.master.db = mock.Mock()
+        self.master.db.buildsets.addBuildset.return_value = \
+            defer.succeed((938593, dict(a=19)))
+        cb = mock.Mock()
+        self.master.subscribeToBuildRequests(cb)
+
+        yield self.master.addBuildset(ssid=999)
+
+        cb.assert_called_with(dict(bsid=938593, brid=19, buildername='a'))
+        self.master.notifications.send.assert_called_with('buildrequest',
+                bsid=938593, brid=19, buildername='a')
+        # the next database poll will not deliver it again
+        self.assertEqual(self.master._notified_brids, set([19]))
+
+    def test_notificationReceived_change(self):
+        self.patch(self.master, 'pollDatabaseChanges',
+                mock.Mock(return_value=defer.Deferred()))
+        self.master.notificationReceived('change', dict(changeid=14))
+        self.master.notificationReceived('change', dict(changeid=15))
+        # the second poll waits for the first to finish
+        self.assertEqual(self.master.pollDatabaseChanges.call_count, 1)
+
+    def test_notificationReceived_buildrequest(self):
+        cb = mock.Mock()
+        self.master.subscribeToBuildRequests(cb)
+        self.master.notificationReceived('buildrequest',
+                dict(bsid=938593, brid=19, buildername='a'))
+        cb.assert_called_with(dict(bsid=938593, brid=19, buildername='a'))
+
+    def test_notificationReceived_unknown(self):
+        # unknown kinds of notification are ignored
+        self.master.notificationReceived('unknown', {})
+
 class StartupAndReconfig(dirs.DirsMixin, logging.LoggingMixin, unittest.TestCase):
 
     def setUp(self):
@@ -352,6 +412,17 @@ class StartupAndReconfig(dirs.DirsMixin, logging.LoggingMixin, unittest.TestCase
         self.assertRaises(config.ConfigErrors, lambda :
                 self.master.reconfigService(new))
 
+    @defer.inlineCallbacks
+    def test_reconfigService_db_replica_url_changed(self):
+        old = self.master.config = config.MasterConfig()
+        yield self.master.reconfigService(old)
+
+        new = config.MasterConfig()
+        new.db['db_replica_url'] = 'bbbb'
+
+        self.assertRaises(config.ConfigErrors, lambda :
+                self.master.reconfigService(new))
+
     def test_reconfigService_start_polling(self):
         loopingcall = mock.Mock()
         self.patch(task, 'LoopingCall', lambda fn : loopingcall)
@@ -381,6 +452,30 @@ class StartupAndReconfig(dirs.DirsMixin, logging.LoggingMixin, unittest.TestCase
         db_loop.stop.assert_called()
         self.assertEqual(self.master.db_loop, None)
 
+    @defer.inlineCallbacks
+    def test_reconfigService_notifications(self):
+        old = self.master.config = config.MasterConfig()
+        yield self.master.reconfigService(old)
+
+        hub = notifier.LoopbackHub()
+        new = config.MasterConfig()
+        new.notifications = transport = notifier.LoopbackTransport(hub)
+        yield self.master.reconfigService(new)
+        self.assertIdentical(self.master.notifications, transport)
+        self.assertIdentical(transport.parent, self.master)
+        self.assertIdentical(transport.master, self.master)
+
+        # an equivalent transport is left alone
+        newer = config.MasterConfig()
+        newer.notifications = notifier.LoopbackTransport(hub)
+        yield self.master.reconfigService(newer)
+        self.assertIdentical(self.master.notifications, transport)
+
+        yield self.master.reconfigService(old)
+        self.assertEqual(self.master.notifications, None)
+        self.assertEqual(transport.parent, None)
+        self.assertEqual(transport.master, None)
+
 
 class Polling(dirs.DirsMixin, misc.PatcherMixin, unittest.TestCase):
 
@@ -487,6 +582,46 @@ class Polling(dirs.DirsMixin, misc.PatcherMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_pollDatabaseChanges_pages(self):
+        self.patch(master.BuildMaster, 'CHANGE_POLL_PAGE_SIZE', 2)
+        self.db.insertTestData([
+            fakedb.Object(id=53, name=self.master_name,
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+        ] + [ fakedb.Change(changeid=n) for n in range(10, 16) ])
+        self.patch(self.db.changes, 'getChangesSince',
+                mock.Mock(wraps=self.db.changes.getChangesSince))
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 11, 12, 13, 14, 15 ])
+            self.assertEqual(self.db.changes.getChangesSince.call_args_list,
+                    [ ((10,), dict(limit=2)), ((12,), dict(limit=2)),
+                      ((14,), dict(limit=2)) ])
+            self.db.state.assertState(53, last_processed_change=15)
+        d.addCallback(check)
+        return d
+
+    def test_pollDatabaseChanges_gap(self):
+        self.db.insertTestData([
+            fakedb.Object(id=53, name=self.master_name,
+                          class_name='buildbot.master.BuildMaster'),
+            fakedb.ObjectState(objectid=53, name='last_processed_change',
+                               value_json='10'),
+            fakedb.Change(changeid=10),
+            fakedb.Change(changeid=11),
+            fakedb.Change(changeid=13),
+        ])
+        d = self.master.pollDatabaseChanges()
+        def check(_):
+            # 12 may not be committed yet, so 13 must wait
+            self.assertEqual([ ch.number for ch in self.gotten_changes],
+                             [ 11 ])
+            self.db.state.assertState(53, last_processed_change=11)
+        d.addCallback(check)
+        return d
+
     def test_pollDatabaseChanges_nothing_new(self):
         self.db.insertTestData([
             fakedb.Object(id=53, name='master',
@@ -527,6 +662,147 @@ class Polling(dirs.DirsMixin, misc.PatcherMixin, unittest.TestCase):
         d.addCallback(check)
         return d
 
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_delta(self):
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        self.db.buildrequests.fakeClaimBuildRequest(12)
+        yield self.master.pollDatabaseBuildRequests()
+
+        # later polls do not fetch all of the unclaimed requests
+        self.patch(self.db.buildrequests, 'getBuildRequests', mock.Mock())
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=13, buildsetid=9, buildername='thirteen'),
+        ])
+        self.db.buildrequests.fakeUnclaimBuildRequest(12)
+        yield self.master.pollDatabaseBuildRequests()
+        yield self.master.pollDatabaseBuildRequests()
+
+        self.assertFalse(self.db.buildrequests.getBuildRequests.called)
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=12, buildername='twelve'),
+            dict(bsid=9, brid=13, buildername='thirteen'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_notified(self):
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        self.master.notificationReceived('buildrequest',
+                dict(bsid=9, brid=11, buildername='eleventy'))
+
+        # the poll does not deliver the notified request again
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=12, buildername='twelve'),
+        ])
+        self.assertEqual(self.master._notified_brids, set())
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_notified_unclaimed(self):
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+        ])
+        self.master.notificationReceived('buildrequest',
+                dict(bsid=9, brid=11, buildername='eleventy'))
+        self.db.buildrequests.fakeClaimBuildRequest(11)
+        self.db.buildrequests.fakeUnclaimBuildRequest(11)
+
+        # the request was unclaimed since it was notified, so is delivered
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=11, buildername='eleventy'),
+        ])
+
+    def test_notificationReceived_buildrequest_already_polled(self):
+        # requests the poll has passed are not remembered
+        self.master._last_seen_brid = 20
+        self.master.notificationReceived('buildrequest',
+                dict(bsid=9, brid=11, buildername='eleventy'))
+        self.assertEqual(self.master._notified_brids, set())
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_submitted_at(self):
+        # the distributor uses submitted_at to spot unclaimed requests that
+        # are older than the builder's oldest request
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy',
+                                submitted_at=1300305712),
+        ])
+        self.db.buildrequests.fakeClaimBuildRequest(11)
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.buildrequests.fakeUnclaimBuildRequest(11)
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy',
+                 submitted_at=epoch2datetime(1300305712)),
+        ])
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_missing_brid(self):
+        clock = task.Clock()
+        self.patch(master, 'reactor', clock)
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=11, buildsetid=9, buildername='eleventy'),
+        ])
+        yield self.master.pollDatabaseBuildRequests()
+
+        # 13 is committed before 12 and 14
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=13, buildsetid=9, buildername='thirteen'),
+        ])
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.master._missing_brids, { 12 : 0 })
+
+        clock.advance(10)
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=12, buildsetid=9, buildername='twelve'),
+        ])
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.master._missing_brids, {})
+
+        self.assertEqual(self.gotten_buildrequest_additions, [
+            dict(bsid=9, brid=11, buildername='eleventy'),
+            dict(bsid=9, brid=13, buildername='thirteen'),
+            dict(bsid=9, brid=12, buildername='twelve'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_missing_brid_timeout(self):
+        clock = task.Clock()
+        self.patch(master, 'reactor', clock)
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.insertTestData([
+            fakedb.BuildRequest(id=13, buildsetid=9, buildername='thirteen'),
+        ])
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(sorted(self.master._missing_brids), range(1, 13))
+
+        clock.advance(self.master.MISSING_BUILDREQUEST_TIMEOUT + 1)
+        yield self.master.pollDatabaseBuildRequests()
+        self.assertEqual(self.master._missing_brids, {})
+
+    @defer.inlineCallbacks
+    def test_pollDatabaseBuildRequests_prunes_unclaims(self):
+        clock = task.Clock()
+        clock.advance(self.master.RECLAIM_BUILD_INTERVAL)
+        self.patch(master, 'reactor', clock)
+        self.patch(self.db.buildrequests, 'pruneBuildRequestUnclaims',
+                mock.Mock(return_value=defer.succeed(None)))
+        yield self.master.pollDatabaseBuildRequests()
+        yield self.master.pollDatabaseBuildRequests()
+        self.db.buildrequests.pruneBuildRequestUnclaims.assert_called_once_with(
+                self.master.UNCLAIM_JOURNAL_AGE)
+
     def test_pollDatabaseBuildRequests_incremental(self):
         d = defer.succeed(None)
         def insert1(_):
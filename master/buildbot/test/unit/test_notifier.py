@@ -0,0 +1,207 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from buildbot import notifier
+from buildbot.util import eventual
+
+class FakeMaster(object):
+
+    def __init__(self):
+        self.received = []
+        self.waiting = None
+
+    def notificationReceived(self, kind, msg):
+        self.received.append((kind, msg))
+        if self.waiting:
+            d, self.waiting = self.waiting, None
+            d.callback(None)
+
+    def waitForNotification(self):
+        self.waiting = defer.Deferred()
+        return self.waiting
+
+
+class TestLoopbackTransport(unittest.TestCase):
+
+    def setUp(self):
+        hub = notifier.LoopbackHub()
+        self.masters = []
+        self.transports = []
+        for i in range(3):
+            master = FakeMaster()
+            transport = notifier.LoopbackTransport(hub)
+            transport.master = master
+            transport.startService()
+            self.masters.append(master)
+            self.transports.append(transport)
+
+    @defer.inlineCallbacks
+    def test_send(self):
+        self.transports[0].send('change', changeid=13)
+        # delivery is not immediate
+        self.assertEqual(self.masters[1].received, [])
+        yield eventual.flushEventualQueue()
+        self.assertEqual([ m.received for m in self.masters ],
+                [ [], [('change', dict(changeid=13))],
+                      [('change', dict(changeid=13))] ])
+
+    @defer.inlineCallbacks
+    def test_send_stopped(self):
+        yield self.transports[2].stopService()
+        self.transports[0].send('change', changeid=13)
+        yield eventual.flushEventualQueue()
+        self.assertEqual([ m.received for m in self.masters ],
+                [ [], [('change', dict(changeid=13))], [] ])
+
+    def test_messageReceived_error(self):
+        self.masters[0].notificationReceived = mock.Mock(
+                side_effect=RuntimeError('oops'))
+        self.transports[0].messageReceived(dict(kind='change', changeid=13))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    def test_compare(self):
+        hub = notifier.LoopbackHub()
+        self.assertEqual(notifier.LoopbackTransport(hub),
+                         notifier.LoopbackTransport(hub))
+        self.assertNotEqual(notifier.LoopbackTransport(hub),
+                            notifier.LoopbackTransport(notifier.LoopbackHub()))
+
+
+class TestBrokerTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.socket = os.path.abspath('broker.sock')
+        self.masters = []
+        self.transports = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for transport in self.transports:
+            if transport.running:
+                yield transport.stopService()
+        # let the connections close
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, None)
+        yield d
+
+    def makeTransport(self, listen=False, secret='sekrit'):
+        master = FakeMaster()
+        transport = notifier.BrokerTransport(
+                connect='unix:path=%s' % self.socket, secret=secret,
+                listen=listen and 'unix:%s' % self.socket or None)
+        transport.retryDelay = 0.01
+        transport.master = master
+        self.masters.append(master)
+        self.transports.append(transport)
+        return transport
+
+    @defer.inlineCallbacks
+    def waitForConnections(self):
+        for i in range(100):
+            if None not in [ t.connection for t in self.transports ]:
+                break
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+
+    @defer.inlineCallbacks
+    def test_send(self):
+        for i in range(3):
+            self.makeTransport(listen=(i == 0)).startService()
+        yield self.waitForConnections()
+
+        d = defer.gatherResults([ self.masters[0].waitForNotification(),
+                                  self.masters[2].waitForNotification() ])
+        self.transports[1].send('buildrequest', bsid=5, brid=19,
+                                buildername='a')
+        yield d
+
+        msg = dict(bsid=5, brid=19, buildername='a')
+        self.assertEqual([ m.received for m in self.masters ],
+                [ [('buildrequest', msg)], [], [('buildrequest', msg)] ])
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        # the broker is not running yet, so the client retries
+        client = self.makeTransport()
+        client.startService()
+        broker = self.makeTransport(listen=True)
+        broker.startService()
+        yield self.waitForConnections()
+
+        d = self.masters[0].waitForNotification()
+        broker.send('change', changeid=13)
+        yield d
+        self.assertEqual(self.masters[0].received,
+                [('change', dict(changeid=13))])
+
+    @defer.inlineCallbacks
+    def test_bad_secret(self):
+        self.makeTransport(listen=True).startService()
+        self.makeTransport().startService()
+        yield self.waitForConnections()
+
+        intruder = notifier.BrokerTransport(
+                connect='unix:path=%s' % self.socket, secret='guess')
+        intruder.retryDelay = 10
+        intruder.startService()
+        self.transports.append(intruder)
+        for i in range(100):
+            if intruder.connection is not None:
+                break
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+
+        # the intruder's messages are not relayed, nor is it sent any
+        intruder.send('buildrequest', bsid=5, brid=19, buildername='a')
+        d = self.masters[0].waitForNotification()
+        self.transports[1].send('change', changeid=13)
+        yield d
+        self.assertEqual(self.masters[0].received,
+                [('change', dict(changeid=13))])
+
+        # and it is disconnected
+        for i in range(100):
+            if intruder.connection is None:
+                break
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+        self.assertIdentical(intruder.connection, None)
+
+    def test_secretsMatch(self):
+        self.assertTrue(notifier._secretsMatch(u'sekrit', 'sekrit'))
+        self.assertFalse(notifier._secretsMatch('sekrat', 'sekrit'))
+        self.assertFalse(notifier._secretsMatch('sek', 'sekrit'))
+        self.assertFalse(notifier._secretsMatch(None, 'sekrit'))
+
+    def test_send_disconnected(self):
+        transport = self.makeTransport()
+        # without a connection, messages are dropped
+        transport.send('change', changeid=13)
+
+    def test_compare(self):
+        self.assertEqual(notifier.BrokerTransport('unix:path=x', 's'),
+                         notifier.BrokerTransport('unix:path=x', 's'))
+        self.assertNotEqual(notifier.BrokerTransport('unix:path=x', 's'),
+                            notifier.BrokerTransport('unix:path=x', 't'))
+        self.assertNotEqual(notifier.BrokerTransport('unix:path=x', 's'),
+                            notifier.BrokerTransport('unix:path=x', 's',
+                                                     listen='unix:x'))
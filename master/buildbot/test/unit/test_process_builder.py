@@ -408,6 +408,30 @@ class TestRebuild(BuilderMixin, unittest.TestCase):
                                                           properties = {})
 
 
+class TestResubmit(BuilderMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_resubmit_buildreqs(self):
+        yield self.makeBuilder()
+        self.db.insertTestData([
+            fakedb.SourceStampSet(id=21),
+            fakedb.SourceStamp(id=21, sourcestampsetid=21),
+            fakedb.Buildset(id=11, sourcestampsetid=21),
+            fakedb.BuildRequest(id=111, buildsetid=11, buildername='bldr'),
+            fakedb.BuildRequestClaim(brid=111,
+                        objectid=fakedb.FakeBuildRequestsComponent.MASTER_ID,
+                        claimed_at=1300103810),
+        ])
+        build = mock.Mock()
+        build.requests = [ mock.Mock(id=111) ]
+        yield self.bldr._resubmit_buildreqs(build)
+        brdict = yield self.db.buildrequests.getBuildRequest(111)
+        self.assertFalse(brdict['claimed'])
+        # the unclaimed request may now be the builder's oldest
+        self.assertEqual(self.master.botmaster.buildRequestsChangedFor,
+                         ['bldr'])
+
+
 class TestReconfig(BuilderMixin, unittest.TestCase):
     """Tests that a reconfig properly updates all attributes"""
 
@@ -13,7 +13,9 @@
 #
 # Copyright Buildbot Team Members
 
+import mock
 from twisted.trial import unittest
+from twisted.internet import defer
 from buildbot.test.fake import fakedb, fakemaster
 from buildbot.process import buildrequest
 
@@ -69,6 +71,66 @@ class TestBuildRequest(unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_fromBrdicts(self):
+        master = fakemaster.make_master()
+        master.db = fakedb.FakeDBConnector(self)
+        master.db.insertTestData([
+            fakedb.Change(changeid=13, branch='trunk', revision='9283',
+                        repository='svn://...', project='world-domination'),
+            fakedb.Change(changeid=14, branch='trunk', revision='9284',
+                        repository='svn://...', project='world-domination'),
+            fakedb.SourceStampSet(id=234),
+            fakedb.SourceStamp(id=234, sourcestampsetid=234, branch='trunk',
+                        revision='9284', repository='svn://...',
+                        project='world-domination'),
+            fakedb.SourceStampChange(sourcestampid=234, changeid=13),
+            fakedb.SourceStampChange(sourcestampid=234, changeid=14),
+            fakedb.SourceStampSet(id=235),
+            fakedb.SourceStamp(id=235, sourcestampsetid=235, branch='trunk',
+                        revision='9280', repository='svn://...',
+                        project='world-domination'),
+            fakedb.Buildset(id=539, reason='triggered', sourcestampsetid=234),
+            fakedb.BuildsetProperty(buildsetid=539, property_name='x',
+                        property_value='[1, "X"]'),
+            fakedb.Buildset(id=540, reason='forced', sourcestampsetid=235),
+            fakedb.BuildRequest(id=288, buildsetid=539, buildername='bldr'),
+            fakedb.BuildRequest(id=289, buildsetid=540, buildername='bldr'),
+            fakedb.BuildRequest(id=290, buildsetid=539, buildername='other'),
+        ])
+        # the changes are fetched together, not one at a time
+        self.patch(master.db.changes, 'getChange', mock.Mock())
+        getChanges = mock.Mock(wraps=master.db.changes.getChanges)
+        self.patch(master.db.changes, 'getChanges', getChanges)
+        d = master.db.buildrequests.getBuildRequests()
+        d.addCallback(lambda brdicts :
+                    buildrequest.BuildRequest.fromBrdicts(master,
+                        sorted(brdicts, key=lambda brd : brd['brid'])))
+        def check(breqs):
+            self.assertEqual([ (br.id, br.bsid, br.reason, br.buildername)
+                               for br in breqs ],
+                [ (288, 539, 'triggered', 'bldr'),
+                  (289, 540, 'forced', 'bldr'),
+                  (290, 539, 'triggered', 'other') ])
+            self.assertEqual([ ch.number for ch in breqs[0].source.changes],
+                             [13, 14])
+            self.assertEqual(breqs[1].source.ssid, 235)
+            self.assertEqual(breqs[1].source.changes, ())
+            self.assertEqual(breqs[2].properties.getProperty('x'), 1)
+            self.assertEqual(breqs[1].properties.getProperty('x'), None)
+            self.assertFalse(master.db.changes.getChange.called)
+            getChanges.assert_called_once_with([13, 14])
+        d.addCallback(check)
+        return d
+
+    def test_fromBrdicts_empty(self):
+        master = fakemaster.make_master()
+        master.db = fakedb.FakeDBConnector(self)
+        d = buildrequest.BuildRequest.fromBrdicts(master, [])
+        def check(breqs):
+            self.assertEqual(breqs, [])
+        d.addCallback(check)
+        return d
+
     def test_fromBrdict_submittedAt_NULL(self):
         master = fakemaster.make_master()
         master.db = fakedb.FakeDBConnector(self)
@@ -343,4 +405,23 @@ class TestBuildRequest(unittest.TestCase):
         self.assertFalse(mergeable, "Request containing different codebases " +
                                     "should never be able to merge")
 
+    @defer.inlineCallbacks
+    def test_cancelBuildRequest(self):
+        master = fakemaster.make_master()
+        master.db = fakedb.FakeDBConnector(self)
+        master.maybeBuildsetComplete = lambda bsid : defer.succeed(None)
+        master.db.insertTestData([
+            fakedb.SourceStampSet(id=234),
+            fakedb.SourceStamp(id=234, sourcestampsetid=234),
+            fakedb.Buildset(id=539, sourcestampsetid=234),
+            fakedb.BuildRequest(id=288, buildsetid=539, buildername='bldr'),
+        ])
+        brdict = yield master.db.buildrequests.getBuildRequest(288)
+        br = yield buildrequest.BuildRequest.fromBrdict(master, brdict)
+        yield br.cancelBuildRequest()
+        brdict = yield master.db.buildrequests.getBuildRequest(288)
+        self.assertTrue(brdict['complete'])
+        # the builder's oldest request may have changed
+        self.assertEqual(master.botmaster.buildRequestsChangedFor, ['bldr'])
+
 
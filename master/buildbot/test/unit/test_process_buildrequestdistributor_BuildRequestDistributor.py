@@ -19,10 +19,9 @@ from twisted.internet import defer, reactor
 from twisted.python import failure
 from buildbot.test.util import compat
 from buildbot.test.fake import fakedb, fakemaster
-from buildbot.process import buildrequestdistributor
+from buildbot.process import buildrequestdistributor, builder, metrics
 from buildbot.util import epoch2datetime
 from buildbot.util.eventual import fireEventually
-from buildbot.db import buildrequests
 
 def nth_slave(n):
     def pick_nth_by_name(lst):
@@ -37,6 +36,11 @@ class SkipSlavesThatCantGetLock(buildrequestdistributor.BasicBuildChooser):
         buildrequestdistributor.BasicBuildChooser.__init__(self, *args, **kwargs)
         self.rejectedSlaves = None  # disable this feature
 
+class TwoArgumentBuildChooser(buildrequestdistributor.BasicBuildChooser):
+    """A chooser with the documented (bldr, master) constructor"""
+    def __init__(self, bldr, master):
+        buildrequestdistributor.BasicBuildChooser.__init__(self, bldr, master)
+
 class Test(unittest.TestCase):
 
     def setUp(self):
@@ -47,6 +51,7 @@ class Test(unittest.TestCase):
             return sorted(builders, lambda b1,b2 : cmp(b1.name, b2.name))
         self.master = self.botmaster.master = mock.Mock(name='master')
         self.master.config.prioritizeBuilders = prioritizeBuilders
+        self.master.config.multiMaster = False
         self.master.db = fakedb.FakeDBConnector(self)
         self.brd = buildrequestdistributor.BuildRequestDistributor(self.botmaster)
         self.brd.startService()
@@ -108,6 +113,7 @@ class Test(unittest.TestCase):
 
             bldr.slaves = []
             bldr.getAvailableSlaves = lambda : [ s for s in bldr.slaves if s.isAvailable ]
+            bldr.config.slavenames = []
 
     def removeBuilder(self, name):
         del self.builders[name]
@@ -180,14 +186,17 @@ class Test(unittest.TestCase):
         self.brd.maybeStartBuildsOn(['bldr3', 'bldr2'])
         def check(_):
             # bldr3 gets invoked twice, since it's considered to have started
-            # already when the first call to maybeStartBuildsOn returns
+            # already when the first call to maybeStartBuildsOn returns; the
+            # same goes for bldr2, as builders are worked on in parallel
             self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
-                    ['bldr3', 'bldr1', 'bldr2', 'bldr3'])
+                    ['bldr3', 'bldr1', 'bldr2', 'bldr3', 'bldr2'])
             self.checkAllCleanedUp()
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
     def test_maybeStartBuildsOn_builders_missing(self):
+        # work on one builder at a time, so the others are still pending
+        self.brd.maxParallelBuilders = 1
         self.useMock_maybeStartBuildsOnBuilder()
         self.addBuilders(['bldr1', 'bldr2', 'bldr3'])
         self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3'])
@@ -201,6 +210,111 @@ class Test(unittest.TestCase):
         self.quiet_deferred.addCallback(check)
         return self.quiet_deferred
 
+    def useDeferred_maybeStartBuildsOnBuilder(self, slavenames):
+        # sets up builders whose maybeStartBuildsOnBuilder calls do not
+        # finish until the test fires them
+        self.addBuilders(slavenames.keys())
+        for name, slaves in slavenames.iteritems():
+            self.builders[name].config.slavenames = slaves
+        self.maybeStartBuildsOnBuilder_calls = []
+        self.maybeStartBuildsOnBuilder_ds = {}
+        def maybeStartBuildsOnBuilder(bldr):
+            self.maybeStartBuildsOnBuilder_calls.append(bldr.name)
+            d = self.maybeStartBuildsOnBuilder_ds[bldr.name] = defer.Deferred()
+            return d
+        self.brd._maybeStartBuildsOnBuilder = maybeStartBuildsOnBuilder
+
+    def finishBuilder(self, name):
+        self.maybeStartBuildsOnBuilder_ds.pop(name).callback(None)
+
+    def test_maybeStartBuildsOn_parallel_builders(self):
+        self.useDeferred_maybeStartBuildsOnBuilder(dict(bldr1=['s1'],
+                bldr2=['s1', 's2'], bldr3=['s2'], bldr4=['s3']))
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3', 'bldr4'])
+        # bldr2 shares a slave with bldr1, and bldr3 may not take bldr2's
+        # slave before it
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr4'])
+        self.finishBuilder('bldr4')
+        self.finishBuilder('bldr1')
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr4', 'bldr2'])
+        self.finishBuilder('bldr2')
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr4', 'bldr2', 'bldr3'])
+        self.finishBuilder('bldr3')
+        def check(_):
+            self.checkAllCleanedUp()
+            self.assertEqual(self.brd._activeBuilders, {})
+        d.addCallback(check)
+        return d
+
+    def test_maybeStartBuildsOn_maxParallelBuilders(self):
+        self.brd.maxParallelBuilders = 2
+        self.useDeferred_maybeStartBuildsOnBuilder(dict(bldr1=['s1'],
+                bldr2=['s2'], bldr3=['s3']))
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2', 'bldr3'])
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr2'])
+        self.finishBuilder('bldr2')
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr2', 'bldr3'])
+        self.finishBuilder('bldr1')
+        self.finishBuilder('bldr3')
+        d.addCallback(lambda _ : self.checkAllCleanedUp())
+        return d
+
+    def test_maybeStartBuildsOn_added_while_waiting(self):
+        self.useDeferred_maybeStartBuildsOnBuilder(dict(bldr1=['s1'],
+                bldr2=['s1'], bldr3=['s2']))
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls, ['bldr1'])
+        # a builder that is added while the loop waits starts right away
+        self.brd.maybeStartBuildsOn(['bldr3'])
+        self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
+                         ['bldr1', 'bldr3'])
+        self.finishBuilder('bldr1')
+        self.finishBuilder('bldr3')
+        self.finishBuilder('bldr2')
+        d.addCallback(lambda _ : self.checkAllCleanedUp())
+        return d
+
+    def test_maybeStartBuildsOn_metrics(self):
+        self.patch(metrics.MetricCountEvent, 'log', mock.Mock())
+        self.patch(metrics.MetricTimeEvent, 'log', mock.Mock())
+        self.useDeferred_maybeStartBuildsOnBuilder(dict(bldr1=['s1'],
+                bldr2=['s1']))
+        d = self.quiet_deferred
+        self.brd.maybeStartBuildsOn(['bldr1', 'bldr2'])
+        self.finishBuilder('bldr1')
+        self.finishBuilder('bldr2')
+        def check(_):
+            counts = [ (c[0][0], c[0][1])
+                       for c in metrics.MetricCountEvent.log.call_args_list ]
+            self.assertEqual(counts, [
+                ('BuildRequestDistributor.pending_builders', 2),
+                ('BuildRequestDistributor.pending_builders', 1),
+                ('BuildRequestDistributor.active_builders', 1),
+                ('BuildRequestDistributor.active_builders', 0),
+                ('BuildRequestDistributor.pending_builders', 0),
+                ('BuildRequestDistributor.active_builders', 1),
+                ('BuildRequestDistributor.active_builders', 0),
+            ])
+            timers = [ c[0][0]
+                       for c in metrics.MetricTimeEvent.log.call_args_list
+                       if c[0] ]
+            self.assertEqual(timers, [
+                'BuildRequestDistributor.bldr1.wait',
+                'BuildRequestDistributor.bldr1.time',
+                'BuildRequestDistributor.bldr2.wait',
+                'BuildRequestDistributor.bldr2.time',
+            ])
+        d.addCallback(check)
+        return d
+
     def do_test_sortBuilders(self, prioritizeBuilders, oldestRequestTimes,
             expected, returnDeferred=False):
         self.useMock_maybeStartBuildsOnBuilder()
@@ -259,6 +373,88 @@ class Test(unittest.TestCase):
                 dict(bldr1=1, bldr2=1, bldr3=1),
                 ['bldr1', 'bldr2', 'bldr3'])
 
+    @defer.inlineCallbacks
+    def test_sortBuilders_default_remembers_times(self):
+        yield self.do_test_sortBuilders(None,
+                dict(bldr1=777, bldr2=999, bldr3=888),
+                ['bldr1', 'bldr3', 'bldr2'])
+        # the times are not looked up again
+        for bldr in self.builders.values():
+            bldr.getOldestRequestTime = lambda : self.fail("looked up")
+        self.brd._oldestRequestTimes['bldr2'] = epoch2datetime(555)
+        result = yield self.brd._sortBuilders(['bldr1', 'bldr2', 'bldr3'])
+        self.assertEqual(result, ['bldr2', 'bldr1', 'bldr3'])
+
+    def do_test_buildRequestAdded(self, oldest, submitted_at, exp_oldest,
+                                  buildername='bldr1'):
+        # the request is never looked up
+        self.master.db.buildrequests.getBuildRequest = \
+                lambda brid : self.fail("looked up")
+        if oldest is not None:
+            oldest = epoch2datetime(oldest)
+        self.brd._oldestRequestTimes['bldr1'] = oldest
+        notif = dict(bsid=11, brid=10, buildername=buildername)
+        if submitted_at is not None:
+            notif['submitted_at'] = epoch2datetime(submitted_at)
+        self.brd._buildRequestAdded(notif)
+        if isinstance(exp_oldest, int):
+            exp_oldest = epoch2datetime(exp_oldest)
+        self.assertEqual(self.brd._oldestRequestTimes.get('bldr1', 'unknown'),
+                         exp_oldest)
+
+    def test_buildRequestAdded_newer(self):
+        self.do_test_buildRequestAdded(1000, 2000, 1000)
+
+    def test_buildRequestAdded_older(self):
+        self.do_test_buildRequestAdded(1000, 500, 500)
+
+    def test_buildRequestAdded_new_request(self):
+        # without submitted_at, the request is brand new
+        self.do_test_buildRequestAdded(1000, None, 1000)
+
+    def test_buildRequestAdded_no_requests(self):
+        # the builder's time must be looked up again
+        self.do_test_buildRequestAdded(None, 2000, 'unknown')
+
+    def test_buildRequestAdded_other_builder(self):
+        self.do_test_buildRequestAdded(1000, 500, 1000, buildername='bldr2')
+
+    @defer.inlineCallbacks
+    def test_sortBuilders_multiMaster_refreshes_times(self):
+        # another master may have claimed the oldest requests
+        self.master.config.multiMaster = True
+        yield self.do_test_sortBuilders(None,
+                dict(bldr1=777, bldr2=999, bldr3=888),
+                ['bldr1', 'bldr3', 'bldr2'])
+        self.builders['bldr1'].getOldestRequestTime = \
+                lambda : epoch2datetime(1111)
+        yield self.brd._maybeStartBuildsOn(['bldr1'])
+        self.assertEqual(self.brd._oldestRequestTimes['bldr1'],
+                         epoch2datetime(1111))
+        yield self.quiet_deferred
+
+    @defer.inlineCallbacks
+    def test_buildRequestsChanged(self):
+        yield self.do_test_sortBuilders(None,
+                dict(bldr1=777, bldr2=999, bldr3=888),
+                ['bldr1', 'bldr3', 'bldr2'])
+        # bldr1's oldest request was cancelled, or bldr2's was unclaimed
+        self.builders['bldr1'].getOldestRequestTime = \
+                lambda : epoch2datetime(1111)
+        self.builders['bldr2'].getOldestRequestTime = \
+                lambda : epoch2datetime(555)
+        self.brd.buildRequestsChanged('bldr1')
+        self.brd.buildRequestsChanged('bldr2')
+        result = yield self.brd._sortBuilders(['bldr1', 'bldr2', 'bldr3'])
+        self.assertEqual(result, ['bldr2', 'bldr3', 'bldr1'])
+
+    def test_queue_updates(self):
+        queue = self.brd._queues['A'] = mock.Mock(name='queue')
+        self.brd._buildRequestAdded(dict(bsid=11, brid=10, buildername='A'))
+        queue.add.assert_called_with(10)
+        self.brd.buildRequestsChanged('A')
+        queue.invalidate.assert_called_with()
+
     @compat.usesFlushLoggedErrors
     def test_sortBuilders_custom_exception(self):
         self.useMock_maybeStartBuildsOnBuilder()
@@ -288,7 +484,7 @@ class Test(unittest.TestCase):
         def maybeStartBuildsOnBuilder(bldr):
             d = oldMSBOB(bldr)
 
-            stop_d = self.brd.stopService()
+            stop_d = self.stop_d = self.brd.stopService()
             stop_d.addCallback(lambda _ :
                     self.maybeStartBuildsOnBuilder_calls.append('(stopped)'))
 
@@ -299,13 +495,15 @@ class Test(unittest.TestCase):
 
         # start both builds; A should start and complete *before* the service stops,
         # and B should not run.
+        quiet_d = self.quiet_deferred
         self.brd.maybeStartBuildsOn(['A', 'B'])
 
         def check(_):
             self.assertEqual(self.maybeStartBuildsOnBuilder_calls,
                     ['A', 'finished', '(stopped)'])
-        self.quiet_deferred.addCallback(check)
-        return self.quiet_deferred
+        d = defer.gatherResults([ quiet_d, self.stop_d ])
+        d.addCallback(check)
+        return d
 
 
 class TestMaybeStartBuilds(unittest.TestCase):
@@ -352,9 +550,10 @@ class TestMaybeStartBuilds(unittest.TestCase):
         if self.brd.running:
             return self.brd.stopService()
 
-    def createBuilder(self, name):
-        bldr = mock.Mock(name=name)
+    def createBuilder(self, name, spec=None):
+        bldr = mock.Mock(name=name, spec=spec)
         bldr.name = name
+        bldr.config = mock.Mock(name='config')
         self.botmaster.builders[name] = bldr
 
         def maybeStartBuild(slave, builds):
@@ -429,6 +628,34 @@ class TestMaybeStartBuilds(unittest.TestCase):
         yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
                 exp_claims=[10], exp_builds=[('test-slave1', [10])])
 
+    @defer.inlineCallbacks
+    def test_oldestRequestTime_updated(self):
+        self.master.config.mergeRequests = False
+        self.addSlaves({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="A",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="A",
+                submitted_at=135000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[10], exp_builds=[('test-slave1', [10])])
+        self.assertEqual(self.brd._oldestRequestTimes['A'],
+                         epoch2datetime(135000))
+
+    @defer.inlineCallbacks
+    def test_oldestRequestTime_unclaimed(self):
+        self.addSlaves({'test-slave1':1})
+        self.bldr.maybeStartBuild = lambda slave, builds : defer.succeed(False)
+        self.brd._oldestRequestTimes['A'] = epoch2datetime(135000)
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="A",
+                submitted_at=130000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[], exp_builds=[])
+        self.assertNotIn('A', self.brd._oldestRequestTimes)
+
     @defer.inlineCallbacks
     def test_sorted_by_submit_time(self):
         self.master.config.mergeRequests = False
@@ -582,6 +809,20 @@ class TestMaybeStartBuilds(unittest.TestCase):
             ('test-slave2', 11),
             ('test-slave2', 12)])
 
+    @mock.patch('buildbot.process.buildrequestdistributor.BuildRequestDistributor.BuildChooser', TwoArgumentBuildChooser)
+    @defer.inlineCallbacks
+    def test_two_argument_chooser(self):
+        self.addSlaves({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="A",
+                submitted_at=130000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[10], exp_builds=[('test-slave1', [10])])
+        # and the chooser was given the builder's queue
+        bc = self.brd.createBuildChooser(self.bldr, self.master)
+        self.assertIdentical(bc.queue, self.brd._queues['A'])
+
     @mock.patch('random.choice', nth_slave(-1))
     @defer.inlineCallbacks
     def test_limited_by_canStartWithSlavebuilder(self):
@@ -762,17 +1003,20 @@ class TestMaybeStartBuilds(unittest.TestCase):
     @defer.inlineCallbacks
     def test_claim_race(self):
         # fake a race condition on the buildrequests table
-        old_claimBuildRequests = self.master.db.buildrequests.claimBuildRequests
-        def claimBuildRequests(brids):
+        old_tryClaimBuildRequests = \
+                self.master.db.buildrequests.tryClaimBuildRequests
+        def tryClaimBuildRequests(brids):
             # first, ensure this only happens the first time
-            self.master.db.buildrequests.claimBuildRequests = old_claimBuildRequests
+            self.master.db.buildrequests.tryClaimBuildRequests = \
+                    old_tryClaimBuildRequests
             # claim brid 10 for some other master
             assert 10 in brids
             self.master.db.buildrequests.fakeClaimBuildRequest(10, 136000,
                     objectid=9999) # some other objectid
-            # ..and fail
-            return defer.fail(buildrequests.AlreadyClaimedError())
-        self.master.db.buildrequests.claimBuildRequests = claimBuildRequests
+            # ..and only claim the rest
+            return old_tryClaimBuildRequests(brids)
+        self.master.db.buildrequests.tryClaimBuildRequests = \
+                tryClaimBuildRequests
 
         self.addSlaves({'test-slave1':1, 'test-slave2':1})
         rows = self.base_rows + [
@@ -785,6 +1029,77 @@ class TestMaybeStartBuilds(unittest.TestCase):
                 exp_claims=[11], exp_builds=[('test-slave1', [11])])
 
 
+    def raceClaims(self, brids_elsewhere):
+        # claim the given brids for another master just before claiming
+        old_tryClaimBuildRequests = \
+                self.master.db.buildrequests.tryClaimBuildRequests
+        def tryClaimBuildRequests(brids):
+            self.master.db.buildrequests.tryClaimBuildRequests = \
+                    old_tryClaimBuildRequests
+            for brid in brids_elsewhere:
+                self.master.db.buildrequests.fakeClaimBuildRequest(brid,
+                        136000, objectid=9999)
+            return old_tryClaimBuildRequests(brids)
+        self.master.db.buildrequests.tryClaimBuildRequests = \
+                tryClaimBuildRequests
+
+    @mock.patch('random.choice', nth_slave(0))
+    @defer.inlineCallbacks
+    def test_claim_race_merged_request(self):
+        # a merged request claimed elsewhere is left out of the build
+        self.raceClaims([11])
+        self.bldr.getMergeRequestsFn = lambda : lambda bldr, br1, br2 : True
+        self.addSlaves({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="A",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="A",
+                submitted_at=135000),
+            fakedb.BuildRequest(id=12, buildsetid=11, buildername="A",
+                submitted_at=136000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[10, 12], exp_builds=[('test-slave1', [10, 12])])
+
+    @mock.patch('random.choice', nth_slave(0))
+    @defer.inlineCallbacks
+    def test_claim_race_chosen_request(self):
+        # if the chosen request is claimed elsewhere, the requests merged
+        # with it are given back, and then chosen again
+        self.raceClaims([10])
+        self.bldr.getMergeRequestsFn = lambda : lambda bldr, br1, br2 : True
+        self.addSlaves({'test-slave1':1})
+        rows = self.base_rows + [
+            fakedb.BuildRequest(id=10, buildsetid=11, buildername="A",
+                submitted_at=130000),
+            fakedb.BuildRequest(id=11, buildsetid=11, buildername="A",
+                submitted_at=135000),
+            fakedb.BuildRequest(id=12, buildsetid=11, buildername="A",
+                submitted_at=136000),
+        ]
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[11, 12], exp_builds=[('test-slave1', [11, 12])])
+
+    @defer.inlineCallbacks
+    def test_claims_batched(self):
+        yield self.master.db.insertTestData(self.base_rows + [
+            fakedb.BuildRequest(id=id, buildsetid=11, buildername="A")
+            for id in (10, 11, 12) ])
+        self.master.db.buildrequests.fakeClaimBuildRequest(11, 136000,
+                objectid=9999)
+        tryClaimBuildRequests = mock.Mock(
+            wraps=self.master.db.buildrequests.tryClaimBuildRequests)
+        self.master.db.buildrequests.tryClaimBuildRequests = \
+                tryClaimBuildRequests
+        # two builders are being worked on, so their claims are made together
+        self.brd._activeBuilders = dict(A=set(), B=set())
+        claimed = yield defer.gatherResults([
+            self.brd._claimBuildRequests([10, 11]),
+            self.brd._claimBuildRequests([12]) ])
+        self.assertEqual(claimed, [ [10], [12] ])
+        tryClaimBuildRequests.assert_called_once_with([10, 11, 12])
+        self.brd._activeBuilders = {}
+
     # nextSlave
 
     @defer.inlineCallbacks
@@ -1039,3 +1354,161 @@ class TestMaybeStartBuilds(unittest.TestCase):
         ]
         yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
                 exp_claims=[], exp_builds=[])
+
+    @mock.patch('random.choice', nth_slave(0))
+    @defer.inlineCallbacks
+    def test_mergeRequests_default_by_group(self):
+        # the default mergeRequests function only sees requests for the
+        # same branch, so the others are never turned into BuildRequests
+        self.bldr = self.createBuilder('A', spec=builder.Builder)
+        self.bldr.getMergeRequestsFn = \
+                lambda : builder.Builder._defaultMergeRequestFn
+        rows = []
+        for bsid, branch in [ (30, 'b1'), (31, 'b2'), (32, 'b1') ]:
+            rows += [
+                fakedb.SourceStampSet(id=bsid),
+                fakedb.SourceStamp(id=bsid, sourcestampsetid=bsid,
+                    branch=branch),
+                fakedb.Buildset(id=bsid, sourcestampsetid=bsid, reason='foo'),
+                fakedb.BuildRequest(id=bsid - 11, buildsetid=bsid,
+                    buildername='A', submitted_at=1300305712 + bsid),
+            ]
+        self.addSlaves({'test-slave1':1})
+
+        fetched = []
+        getBuildRequestForBrdict = \
+            buildrequestdistributor.BasicBuildChooser._getBuildRequestForBrdict
+        def wrap(chooser, brdict):
+            fetched.append(brdict['brid'])
+            return getBuildRequestForBrdict(chooser, brdict)
+        self.patch(buildrequestdistributor.BasicBuildChooser,
+                   '_getBuildRequestForBrdict', wrap)
+
+        yield self.do_test_maybeStartBuildsOnBuilder(rows=rows,
+                exp_claims=[19, 21],
+                exp_builds=[ ('test-slave1', [19, 21]) ])
+        self.assertEqual(sorted(set(fetched)), [19, 21])
+
+
+class TestBuildRequestQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.master = mock.Mock(name='master')
+        self.master.db = fakedb.FakeDBConnector(self)
+        self.queue = buildrequestdistributor.BuildRequestQueue(self.master, 'A')
+
+    def insertBuildset(self, bsid, sourcestamps, patch=False):
+        rows = [ fakedb.SourceStampSet(id=bsid),
+                 fakedb.Buildset(id=bsid, sourcestampsetid=bsid) ]
+        if patch:
+            rows.append(fakedb.Patch(id=bsid))
+        for i, (codebase, branch) in enumerate(sourcestamps):
+            rows.append(fakedb.SourceStamp(id=bsid * 10 + i,
+                sourcestampsetid=bsid, codebase=codebase, branch=branch,
+                patchid=patch and bsid or None))
+        return self.master.db.insertTestData(rows)
+
+    def brdict(self, brid, bsid):
+        return dict(brid=brid, buildsetid=bsid)
+
+    def breq(self, brid, bsid):
+        breq = mock.Mock(name='breq')
+        breq.id, breq.bsid = brid, bsid
+        return breq
+
+    @defer.inlineCallbacks
+    def test_getMergeCandidates(self):
+        yield self.insertBuildset(1, [ ('a', 'master'), ('b', 'master') ])
+        yield self.insertBuildset(2, [ ('b', 'master'), ('a', 'master') ])
+        yield self.insertBuildset(3, [ ('a', 'master'), ('b', 'other') ])
+        yield self.insertBuildset(4, [ ('a', 'master') ])
+        brdicts = [ self.brdict(10, 1), self.brdict(11, 2),
+                    self.brdict(12, 3), self.brdict(13, 4),
+                    self.brdict(14, 1) ]
+        self.queue.update(brdicts)
+        candidates = yield self.queue.getMergeCandidates(self.breq(10, 1),
+                                                         brdicts)
+        self.assertEqual([ brd['brid'] for brd in candidates ], [10, 11, 14])
+
+    @defer.inlineCallbacks
+    def test_getMergeCandidates_patch(self):
+        yield self.insertBuildset(1, [ ('', 'master') ], patch=True)
+        yield self.insertBuildset(2, [ ('', 'master') ], patch=True)
+        yield self.insertBuildset(3, [ ('', 'master') ])
+        brdicts = [ self.brdict(10, 1), self.brdict(11, 2),
+                    self.brdict(12, 3), self.brdict(13, 1) ]
+        candidates = yield self.queue.getMergeCandidates(self.breq(10, 1),
+                                                         brdicts)
+        self.assertEqual([ brd['brid'] for brd in candidates ], [10, 13])
+
+    @defer.inlineCallbacks
+    def test_keys_looked_up_once(self):
+        yield self.insertBuildset(1, [ ('', 'master') ])
+        brdicts = [ self.brdict(10, 1), self.brdict(11, 1) ]
+        yield self.queue.getMergeCandidates(self.breq(10, 1), brdicts)
+        self.master.db.buildsets.getBuildset = mock.Mock()
+        candidates = yield self.queue.getMergeCandidates(self.breq(11, 1),
+                                                         brdicts)
+        self.assertEqual([ brd['brid'] for brd in candidates ], [10, 11])
+        self.assertFalse(self.master.db.buildsets.getBuildset.called)
+
+    @defer.inlineCallbacks
+    def test_update_forgets(self):
+        yield self.insertBuildset(1, [ ('', 'master') ])
+        yield self.insertBuildset(2, [ ('', 'other') ])
+        brdicts = [ self.brdict(10, 1), self.brdict(11, 2) ]
+        yield self.queue.getMergeCandidates(self.breq(10, 1), brdicts)
+        self.queue.update(brdicts[:1])
+        self.assertEqual(self.queue.keys.keys(), [10])
+        self.assertEqual(self.queue.bsKeys.keys(), [1])
+        self.assertEqual(len(self.queue.groups), 1)
+
+    def insertRequests(self, *requests):
+        # requests are (brid, submitted_at) pairs, in buildset 1
+        return self.master.db.insertTestData([
+            fakedb.BuildRequest(id=brid, buildsetid=1, buildername='A',
+                                submitted_at=submitted_at)
+            for brid, submitted_at in requests ])
+
+    def getUnclaimedBrids(self):
+        d = self.queue.getUnclaimedBrdicts()
+        d.addCallback(lambda brdicts : [ brd['brid'] for brd in brdicts ])
+        return d
+
+    @defer.inlineCallbacks
+    def test_getUnclaimedBrdicts_incremental(self):
+        yield self.insertBuildset(1, [ ('', 'master') ])
+        yield self.insertRequests((10, 1300000200), (11, 1300000100))
+        brids = yield self.getUnclaimedBrids()
+        self.assertEqual(brids, [11, 10])
+        # from now on, the requests are kept up to date without reloading
+        self.patch(self.master.db.buildrequests, 'getBuildRequests',
+                   lambda **kw : self.fail("reloaded"))
+        yield self.insertRequests((12, 1300000150), (13, 1300000300))
+        yield self.master.db.insertTestData([
+            fakedb.BuildRequestClaim(brid=13, objectid=99,
+                                     claimed_at=1300000400) ])
+        self.queue.add(12)
+        self.queue.add(13) # already claimed elsewhere
+        self.queue.remove(11)
+        brids = yield self.getUnclaimedBrids()
+        self.assertEqual(brids, [12, 10])
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        yield self.insertBuildset(1, [ ('', 'master') ])
+        yield self.insertRequests((10, 1300000200))
+        brids = yield self.getUnclaimedBrids()
+        self.assertEqual(brids, [10])
+        # a request that was not added is not seen until the queue reloads
+        yield self.insertRequests((11, 1300000100))
+        brids = yield self.getUnclaimedBrids()
+        self.assertEqual(brids, [10])
+        self.queue.invalidate()
+        brids = yield self.getUnclaimedBrids()
+        self.assertEqual(brids, [11, 10])
+
+    def test_add_before_load(self):
+        # requests added before the queue is loaded are fetched with the rest
+        self.queue.add(10)
+        self.assertEqual(self.queue.added, set())
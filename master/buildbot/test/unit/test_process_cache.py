@@ -13,18 +13,28 @@
 #
 # Copyright Buildbot Team Members
 
+import os
 import mock
+import shutil
 from twisted.trial import unittest
-from buildbot.process import cache
+from twisted.internet import defer
+from buildbot.process import cache, sharedcache
+
+class Value(dict):
+    # a weakref-able value
+    def __init__(self, v):
+        dict.__init__(self, v=v)
 
 class CacheManager(unittest.TestCase):
 
     def setUp(self):
         self.caches = cache.CacheManager()
 
-    def make_config(self, **kwargs):
+    def make_config(self, eviction={}, **kwargs):
         cfg = mock.Mock()
         cfg.caches = kwargs
+        cfg.cacheEviction = eviction
+        cfg.sharedCache = None
         return cfg
 
     def test_get_cache_idempotency(self):
@@ -45,9 +55,143 @@ class CacheManager(unittest.TestCase):
             self.assertEqual((foo_cache.max_size, bar_cache.max_size),
                             (5, 6))
 
+    @defer.inlineCallbacks
+    def test_reconfigService_eviction(self):
+        foo_cache = self.caches.get_cache("foo", None)
+        yield self.caches.reconfigService(self.make_config(
+                eviction=dict(foo=dict(policy='2q', max_bytes=1000, ttl=60),
+                              bar=dict(policy='lru', max_bytes=None, ttl=5)),
+                foo=5, bar=6))
+        bar_cache = self.caches.get_cache("bar", None, sizeof=len)
+        self.assertEqual((foo_cache.policy, foo_cache.max_bytes,
+                          foo_cache.ttl), ('2q', 1000, 60))
+        self.assertEqual((bar_cache.max_bytes, bar_cache.ttl,
+                          bar_cache.sizeof), (None, 5, len))
+
+        # and back to the defaults
+        yield self.caches.reconfigService(self.make_config())
+        self.assertEqual((foo_cache.policy, foo_cache.max_bytes,
+                          foo_cache.ttl), ('lru', None, None))
+
     def test_get_metrics(self):
         self.caches.get_cache("foo", None)
         self.assertIn('foo', self.caches.get_metrics())
         metric = self.caches.get_metrics()['foo']
         for k in 'hits', 'refhits', 'misses', 'max_size':
             self.assertIn(k, metric)
+
+    def test_get_metrics_shared(self):
+        self.caches.get_cache("foo", None, shared=True)
+        self.caches.get_cache("bar", None)
+        metrics = self.caches.get_metrics()
+        for k in 'shared_hits', 'shared_misses', 'shared_hit_rate':
+            self.assertIn(k, metrics['foo'])
+            self.assertNotIn(k, metrics['bar'])
+
+    @defer.inlineCallbacks
+    def test_get_metrics_bytes(self):
+        yield self.caches.reconfigService(self.make_config(
+                eviction=dict(foo=dict(max_bytes=1000))))
+        c = self.caches.get_cache("foo",
+                lambda key : defer.succeed(Value(key)), sizeof=lambda v : 10)
+        self.caches.get_cache("bar", None)
+        yield c.get(1)
+        metrics = self.caches.get_metrics()
+        self.assertEqual((metrics['foo']['bytes'], metrics['foo']['max_bytes']),
+                         (10, 1000))
+        self.assertNotIn('bytes', metrics['bar'])
+
+
+class SharedTier(unittest.TestCase):
+
+    def setUp(self):
+        self.caches = cache.CacheManager()
+        self.store = sharedcache.DirectorySharedCache(
+                os.path.abspath('shared'))
+        self.store.startService()
+        self.calls = []
+
+    def tearDown(self):
+        self.store.stopService()
+        if os.path.exists('shared'):
+            shutil.rmtree('shared')
+
+    def miss_fn(self, key):
+        self.calls.append(key)
+        return defer.succeed(Value(key * 2))
+
+    def make_config(self, **kwargs):
+        cfg = mock.Mock()
+        cfg.caches = {}
+        cfg.cacheEviction = {}
+        cfg.sharedCache = kwargs.get('sharedCache', self.store)
+        return cfg
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        yield self.caches.reconfigService(self.make_config())
+        c = self.caches.get_cache("foo", self.miss_fn, shared=True)
+        res = yield c.get('a')
+        self.assertEqual(res, dict(v='aa'))
+
+        # another master, sharing the store, does not call its miss function
+        other = cache.CacheManager()
+        yield other.reconfigService(self.make_config())
+        other_calls = []
+        def other_miss_fn(key):
+            other_calls.append(key)
+            return defer.succeed(Value('other'))
+        oc = other.get_cache("foo", other_miss_fn, shared=True)
+        res = yield oc.get('a')
+        self.assertEqual((res, other_calls), (dict(v='aa'), []))
+
+        metrics = other.get_metrics()['foo']
+        self.assertEqual((metrics['misses'], metrics['shared_hits'],
+                          metrics['shared_misses']), (1, 1, 0))
+        metrics = self.caches.get_metrics()['foo']
+        self.assertEqual((metrics['shared_hits'], metrics['shared_misses'],
+                          metrics['shared_hit_rate']), (0, 1, 0.0))
+
+    @defer.inlineCallbacks
+    def test_not_shared(self):
+        yield self.caches.reconfigService(self.make_config())
+        c = self.caches.get_cache("foo", self.miss_fn)
+        yield c.get('a')
+        found = yield self.store.lookup("foo", 'a')
+        self.assertEqual(found[1], None)
+
+    @defer.inlineCallbacks
+    def test_no_store(self):
+        yield self.caches.reconfigService(self.make_config(sharedCache=None))
+        c = self.caches.get_cache("foo", self.miss_fn, shared=True)
+        res = yield c.get('a')
+        self.assertEqual((res, self.calls), (dict(v='aa'), ['a']))
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        yield self.caches.reconfigService(self.make_config())
+        c = self.caches.get_cache("foo", self.miss_fn, shared=True)
+        res = yield c.get('a')
+        yield self.caches.invalidate("foo", 'a')
+        # the miss function is called again, even though the old value is
+        # still referenced
+        res2 = yield c.get('a')
+        self.assertNotIdentical(res, res2)
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    @defer.inlineCallbacks
+    def test_lookup_error(self):
+        yield self.caches.reconfigService(self.make_config())
+        self.store.lookup = mock.Mock(side_effect=RuntimeError('oops'))
+        c = self.caches.get_cache("foo", self.miss_fn, shared=True)
+        res = yield c.get('a')
+        self.assertEqual(res, dict(v='aa'))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    @defer.inlineCallbacks
+    def test_reconfigService_store(self):
+        yield self.caches.reconfigService(self.make_config())
+        self.assertIdentical(self.store.parent, self.caches)
+        yield self.caches.reconfigService(self.make_config(sharedCache=None))
+        self.assertEqual(self.caches.shared_cache, None)
+        self.assertEqual(self.store.parent, None)
@@ -123,6 +123,34 @@ class TestMetricTimeEvent(TestMetricBase):
         report = self.observer.asDict()
         self.assertEquals(report['timers']['foo_time'], sum(data)/float(len(data)))
 
+class TestMetricHistogramEvent(TestMetricBase):
+    def testManualEvent(self):
+        metrics.MetricHistogramEvent.log('foo_hist', 0.003)
+        report = self.observer.asDict()
+        hist = report['histograms']['foo_hist']
+        self.assertEquals((hist['count'], hist['max'], hist['p50']),
+                          (1, 0.003, 0.003))
+
+    def testPercentiles(self):
+        for i in range(90):
+            metrics.MetricHistogramEvent.log('foo_hist', 0.0015)
+        for i in range(9):
+            metrics.MetricHistogramEvent.log('foo_hist', 0.15)
+        metrics.MetricHistogramEvent.log('foo_hist', 70)
+        hist = self.observer.getHandler(metrics.MetricHistogramEvent) \
+                .get('foo_hist')
+        self.assertEquals(hist.count, 100)
+        self.assertAlmostEqual(hist.mean, (90*0.0015 + 9*0.15 + 70) / 100)
+        # percentiles are reported as the bound of their bucket
+        self.assertEquals(hist.percentile(50), 0.002)
+        self.assertEquals(hist.percentile(90), 0.002)
+        self.assertEquals(hist.percentile(99), 0.2)
+        self.assertEquals(hist.percentile(100), 70)
+
+    def testEmpty(self):
+        hist = metrics.Histogram()
+        self.assertEquals((hist.mean, hist.percentile(50)), (0, 0))
+
 class TestPeriodicChecks(TestMetricBase):
     def testPeriodicCheck(self):
         # fake out that there's no garbage (since we can't rely on Python
@@ -225,6 +253,18 @@ class TestReports(unittest.TestCase):
         self.assertEquals("Timer time_foo: 1", handler.report())
         self.assertEquals({"timers": {"time_foo": 1}}, handler.asDict())
 
+    def testMetricHistogramReport(self):
+        handler = metrics.MetricHistogramHandler(None)
+        handler.handle({}, metrics.MetricHistogramEvent('hist_foo', 1))
+
+        self.assertEquals("Histogram hist_foo: count=1 mean=1 p50=1 p90=1 "
+                          "p99=1 max=1", handler.report())
+        buckets = [ (b, b == 1 and 1 or 0)
+                    for b in metrics.Histogram.BOUNDS + (None,) ]
+        self.assertEquals({"histograms": {"hist_foo":
+                    dict(count=1, mean=1, max=1, p50=1, p90=1, p99=1,
+                         buckets=buckets)}}, handler.asDict())
+
     def testMetricAlarmReport(self):
         handler = metrics.MetricAlarmHandler(None)
         handler.handle({}, metrics.MetricAlarmEvent('alarm_foo', msg='Uh oh', level=metrics.ALARM_WARN))
@@ -0,0 +1,176 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from buildbot.process import sharedcache
+from buildbot.test.util import dirs
+from buildbot.util import epoch2datetime
+
+class SharedCacheTests(object):
+    # tests for the versioning in SharedCache, run against each store
+
+    @defer.inlineCallbacks
+    def test_lookup_missing(self):
+        version, value = yield self.store.lookup('chdicts', 13)
+        self.assertEqual(value, None)
+        self.assertNotEqual(version, None)
+
+    @defer.inlineCallbacks
+    def test_store_lookup(self):
+        chdict = dict(changeid=13, files=['a'],
+                      when_timestamp=epoch2datetime(1000))
+        version, value = yield self.store.lookup('chdicts', 13)
+        yield self.store.store('chdicts', 13, version, chdict)
+        version2, value = yield self.store.lookup('chdicts', 13)
+        self.assertEqual((version2, value), (version, chdict))
+
+    @defer.inlineCallbacks
+    def test_keys_distinct(self):
+        version, value = yield self.store.lookup('chdicts', 13)
+        yield self.store.store('chdicts', 13, version, 'ch13')
+        version, value = yield self.store.lookup('ssdicts', 13)
+        self.assertEqual(value, None)
+        version, value = yield self.store.lookup('chdicts', '13')
+        self.assertEqual(value, None)
+
+    @defer.inlineCallbacks
+    def test_invalidate(self):
+        version, value = yield self.store.lookup('usdicts', 7)
+        yield self.store.store('usdicts', 7, version, 'old')
+        yield self.store.invalidate('usdicts', 7)
+        version2, value = yield self.store.lookup('usdicts', 7)
+        self.assertNotEqual(version2, version)
+        self.assertEqual(value, None)
+
+    @defer.inlineCallbacks
+    def test_invalidate_race(self):
+        # a reader looks up the key before a write, and stores the value it
+        # read from the database after the write has invalidated the key
+        version, value = yield self.store.lookup('usdicts', 7)
+        yield self.store.invalidate('usdicts', 7)
+        yield self.store.store('usdicts', 7, version, 'stale')
+        version, value = yield self.store.lookup('usdicts', 7)
+        self.assertEqual(value, None)
+        yield self.store.store('usdicts', 7, version, 'fresh')
+        version, value = yield self.store.lookup('usdicts', 7)
+        self.assertEqual(value, 'fresh')
+
+    @defer.inlineCallbacks
+    def test_invalidate_missing(self):
+        yield self.store.invalidate('usdicts', 7)
+        version, value = yield self.store.lookup('usdicts', 7)
+        self.assertEqual(value, None)
+        self.assertNotEqual(version, None)
+
+
+class DirectorySharedCache(SharedCacheTests, dirs.DirsMixin,
+                           unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = os.path.abspath('shared')
+        self.setUpDirs(self.basedir)
+        self.store = sharedcache.DirectorySharedCache(self.basedir)
+        self.store._reactor = task.Clock()
+        self.store.startService()
+
+    def tearDown(self):
+        self.store.stopService()
+        self.tearDownDirs()
+
+    @defer.inlineCallbacks
+    def test_add(self):
+        res = yield self.store._add('k', 'v1')
+        self.assertTrue(res)
+        res = yield self.store._add('k', 'v2')
+        self.assertFalse(res)
+        found = yield self.store._getMultiple([ 'k', 'x' ])
+        self.assertEqual(found, dict(k='v1'))
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(self.basedir), [ 'k' ])
+
+    def test_compare(self):
+        self.assertEqual(sharedcache.DirectorySharedCache('x'),
+                         sharedcache.DirectorySharedCache('x'))
+        self.assertNotEqual(sharedcache.DirectorySharedCache('x'),
+                            sharedcache.DirectorySharedCache('y'))
+
+
+class FakeMemCacheProtocol(object):
+    # emulates the parts of MemCacheProtocol used by MemcachedSharedCache
+
+    def __init__(self):
+        self.data = {}
+
+    def getMultiple(self, keys):
+        return defer.succeed(dict([ (k, (0, self.data.get(k)))
+                                    for k in keys ]))
+
+    def add(self, key, value):
+        if key in self.data:
+            return defer.succeed(False)
+        self.data[key] = value
+        return defer.succeed(True)
+
+    def set(self, key, value):
+        self.data[key] = value
+        return defer.succeed(True)
+
+    def increment(self, key):
+        if key not in self.data:
+            return defer.succeed(False)
+        self.data[key] = str(int(self.data[key]) + 1)
+        return defer.succeed(int(self.data[key]))
+
+
+class MemcachedSharedCache(SharedCacheTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store = sharedcache.MemcachedSharedCache()
+        self.store._reactor = task.Clock()
+        self.store.protocol = FakeMemCacheProtocol()
+
+    @defer.inlineCallbacks
+    def test_disconnected(self):
+        self.store.protocol = None
+        version, value = yield self.store.lookup('chdicts', 13)
+        # the version is unknown, so nothing may be stored
+        self.assertEqual((version, value), (None, None))
+        yield self.store.store('chdicts', 13, version, 'x')
+        yield self.store.invalidate('chdicts', 13)
+
+    def test_connect_failure(self):
+        clock = self.store._reactor
+        self.store.protocol = None
+        self.store.retryDelay = 5
+        cc = mock.Mock()
+        cc.return_value.connectTCP.side_effect = \
+                lambda host, port : defer.fail(RuntimeError('refused'))
+        self.patch(sharedcache.protocol, 'ClientCreator', cc)
+        self.store.startService()
+        self.assertEqual(cc.return_value.connectTCP.call_count, 1)
+        clock.advance(5)
+        self.assertEqual(cc.return_value.connectTCP.call_count, 2)
+        self.store.stopService()
+        clock.advance(5)
+        self.assertEqual(cc.return_value.connectTCP.call_count, 2)
+
+    def test_compare(self):
+        self.assertEqual(sharedcache.MemcachedSharedCache('h', 1),
+                         sharedcache.MemcachedSharedCache('h', 1))
+        self.assertNotEqual(sharedcache.MemcachedSharedCache('h', 1),
+                            sharedcache.MemcachedSharedCache('h', 2))
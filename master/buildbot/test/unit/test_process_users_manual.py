@@ -37,7 +37,7 @@ class ManualUsersMixin(object):
             self.caches = mock.Mock(name="caches")
             self.caches.get_cache = self.get_cache
 
-        def get_cache(self, cache_name, miss_fn):
+        def get_cache(self, cache_name, miss_fn, shared=False):
             c = mock.Mock(name=cache_name)
             c.get = miss_fn
             return c
@@ -62,6 +62,12 @@ class TestUpgradeMaster(dirs.DirsMixin, misc.StdoutAssertionsMixin,
             self.calls.append('upgradeDatabase')
         self.patch(upgrade_master, 'upgradeDatabase', upgradeDatabase)
 
+        def upgradeBuildSummaries(config, master_cfg):
+            self.assertIsInstance(master_cfg, config_module.MasterConfig)
+            self.calls.append('upgradeBuildSummaries')
+        self.patch(upgrade_master, 'upgradeBuildSummaries',
+                   upgradeBuildSummaries)
+
     # tests
 
     def test_upgradeMaster_success(self):
@@ -256,3 +262,25 @@ class TestUpgradeMasterFunctions(dirs.DirsMixin, misc.StdoutAssertionsMixin,
         setup.asset_called_with(check_version=False, verbose=False)
         upgrade.assert_called()
         self.assertWasQuiet()
+
+    def test_upgradeBuildSummaries(self):
+        os.mkdir(os.path.join('test', 'bldr'))
+        master_cfg = config_module.MasterConfig()
+        master_cfg.builders = [ mock.Mock(builddir='bldr') ]
+        master_cfg.builders[0].name = 'bldr'
+        upgrade_master.upgradeBuildSummaries(mkconfig(basedir='test'),
+                                             master_cfg)
+        self.assertTrue(os.path.exists(
+                        os.path.join('test', 'bldr', 'builds.sqlite')))
+        self.assertInStdout('upgrading build summaries')
+        self.assertInStdout('bldr: 0 builds summarized')
+
+    def test_upgradeBuildSummaries_disabled(self):
+        os.mkdir(os.path.join('test', 'bldr'))
+        master_cfg = config_module.MasterConfig()
+        master_cfg.buildSummaryBackend = None
+        master_cfg.builders = [ mock.Mock(builddir='bldr') ]
+        upgrade_master.upgradeBuildSummaries(mkconfig(basedir='test'),
+                                             master_cfg)
+        self.assertEqual(os.listdir(os.path.join('test', 'bldr')), [])
+        self.assertWasQuiet()
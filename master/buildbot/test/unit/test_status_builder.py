@@ -0,0 +1,149 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import mock
+from twisted.trial import unittest
+from buildbot.status import builder, master
+from buildbot.test.fake import fakemaster
+from buildbot.test.util import dirs
+
+class TestNextBuildNumber(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+        self.builder = builder.BuilderStatus('bldr', None,
+                                             fakemaster.make_master(), None)
+        self.builder.basedir = os.path.abspath('bldr')
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def writeFile(self, name, contents=''):
+        with open(os.path.join('bldr', name), 'w') as f:
+            f.write(contents)
+
+    def readNextBuildNumber(self):
+        with open(os.path.join('bldr', 'next_build_number')) as f:
+            return int(f.read())
+
+    def test_empty(self):
+        self.builder.determineNextBuildNumber()
+        self.assertEqual(self.builder.nextBuildNumber, 0)
+        self.assertEqual(self.readNextBuildNumber(), 0)
+
+    def test_scan(self):
+        for name in ('3', '10', '10-stdio', 'builder'):
+            self.writeFile(name)
+        self.builder.determineNextBuildNumber()
+        self.assertEqual(self.builder.nextBuildNumber, 11)
+        self.assertEqual(self.readNextBuildNumber(), 11)
+
+    def test_saved(self):
+        self.writeFile('next_build_number', '20\n')
+        self.builder.determineNextBuildNumber()
+        self.assertEqual(self.builder.nextBuildNumber, 20)
+
+    def test_saved_stale(self):
+        self.writeFile('next_build_number', '20\n')
+        self.writeFile('20')
+        self.writeFile('21')
+        self.builder.determineNextBuildNumber()
+        self.assertEqual(self.builder.nextBuildNumber, 22)
+        self.assertEqual(self.readNextBuildNumber(), 22)
+
+    def test_saved_corrupt(self):
+        self.writeFile('next_build_number', 'xx')
+        self.writeFile('4')
+        self.builder.determineNextBuildNumber()
+        self.assertEqual(self.builder.nextBuildNumber, 5)
+
+    def test_newBuild_saves(self):
+        self.builder.determineNextBuildNumber()
+        self.builder.newBuild()
+        self.builder.newBuild()
+        self.assertEqual(self.readNextBuildNumber(), 2)
+
+class TestLazyPickle(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('basedir')
+        self.master = fakemaster.make_master()
+        self.master.basedir = os.path.abspath('basedir')
+        self.status = master.Status(self.master)
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def makeSavedBuilder(self):
+        b = self.status.builderAdded('bldr', 'bldr')
+        b.addPointEvent(['first'])
+        b.addPointEvent(['second'])
+        b.saveYourself()
+
+    def test_builderAdded_does_not_load(self):
+        self.makeSavedBuilder()
+        self.patch(builder, 'loads', mock.Mock())
+        b = self.status.builderAdded('bldr', 'bldr')
+        self.assertFalse(builder.loads.called)
+        self.assertEqual(b.lazyPickle,
+                os.path.join(self.master.basedir, 'bldr', 'builder'))
+
+    def test_events_loaded_on_access(self):
+        self.makeSavedBuilder()
+        b = self.status.builderAdded('bldr', 'bldr')
+        self.assertEqual(b.getEvent(-1).text, ['second'])
+        self.assertEqual(b.lazyPickle, None)
+        b.addPointEvent(['third'])
+        self.assertEqual([ e.text for e in b.events ],
+                [ ['builder', 'created'], ['first'], ['second'], ['third'] ])
+
+    def test_saveYourself_unloaded(self):
+        self.makeSavedBuilder()
+        b = self.status.builderAdded('bldr', 'bldr')
+        b.saveYourself()
+        b = self.status.builderAdded('bldr', 'bldr')
+        self.assertEqual(b.getEvent(-1).text, ['second'])
+
+    def test_new_builder(self):
+        b = self.status.builderAdded('bldr', 'bldr')
+        self.assertEqual(b.lazyPickle, None)
+        self.assertEqual(b.getEvent(-1).text, ['builder', 'created'])
+
+    def test_pickle_read_outside_lock(self):
+        self.makeSavedBuilder()
+        b = self.status.builderAdded('bldr', 'bldr')
+        locked = []
+        real_open, real_loads = open, builder.loads
+        class File(object):
+            def __init__(self, f):
+                self.f = f
+            def read(self):
+                locked.append(('read', builder._unpickleLock.locked()))
+                return self.f.read()
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                self.f.close()
+        def loads(data):
+            locked.append(('loads', builder._unpickleLock.locked()))
+            return real_loads(data)
+        builder.open = lambda fn, mode : File(real_open(fn, mode))
+        self.addCleanup(delattr, builder, 'open')
+        self.patch(builder, 'loads', loads)
+        self.assertEqual(b.getEvent(-1).text, ['second'])
+        self.assertEqual(locked, [ ('read', False), ('loads', True) ])
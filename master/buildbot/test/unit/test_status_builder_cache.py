@@ -16,6 +16,8 @@
 import os
 from mock import Mock
 from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import threadpool
 from buildbot.status import builder, master
 from buildbot.test.fake import fakemaster
 
@@ -71,3 +73,98 @@ class TestBuildStatus(unittest.TestCase):
                              'propval%d' % build.number)
             self.assertEqual(b.buildCache.hits, hits+1)
             hits = hits + 1
+
+    def testSetCacheSize(self):
+        b = self.setupBuilder('builder_1')
+        b.setCacheSize(5, policy='2q', max_bytes=10**6)
+        for cache in (b.buildCache, b.buildAsyncCache):
+            self.assertEqual((cache.max_size, cache.policy, cache.max_bytes),
+                             (5, '2q', 10**6))
+
+    def testBuildSize(self):
+        b = self.setupBuilder('builder_1')
+        build = b.newBuild()
+        size = builder.buildSize(build)
+        for i in range(10):
+            build.addStepWithName('step%d' % i)
+        # the steps are counted along with their contents
+        self.assertTrue(builder.buildSize(build) >
+                        size + 10 * builder.estimateSize(build.getSteps()[0]))
+
+    def makeBuilds(self, b, count):
+        builds = []
+        for i in xrange(count):
+            build = b.newBuild()
+            build.setProperty('propkey', 'propval%d' % i, 'test')
+            build.buildStarted(build)
+            build.buildFinished()
+            builds.append(build)
+        return builds
+
+    def reloadBuilder(self, b):
+        # forget all of the builds in memory, so they must come from disk
+        b2 = self.setupBuilder('builder_1')
+        b2.basedir = b.basedir
+        b2.determineNextBuildNumber()
+        return b2
+
+    @defer.inlineCallbacks
+    def testGetBuildAsync(self):
+        b = self.setupBuilder('builder_1')
+        self.makeBuilds(b, 3)
+        b = self.reloadBuilder(b)
+        build = yield b.getBuildAsync(1)
+        self.assertEqual(build.number, 1)
+        self.assertEqual(build.getProperty('propkey'), 'propval1')
+        # the synchronous cache gets the same object
+        self.assertIdentical(b.getBuild(1), build)
+        build2 = yield b.getBuildAsync(-2)
+        self.assertIdentical(build2, build)
+
+    @defer.inlineCallbacks
+    def testGetBuildAsync_sharesSyncCache(self):
+        b = self.setupBuilder('builder_1')
+        self.makeBuilds(b, 3)
+        b = self.reloadBuilder(b)
+        build = b.getBuild(0)
+        build2 = yield b.getBuildAsync(0)
+        self.assertIdentical(build2, build)
+
+    @defer.inlineCallbacks
+    def testGetBuildAsync_missing(self):
+        b = self.setupBuilder('builder_1')
+        self.makeBuilds(b, 3)
+        b = self.reloadBuilder(b)
+        os.unlink(os.path.join(b.basedir, '1'))
+        build = yield b.getBuildAsync(1)
+        self.assertEqual(build, None)
+        build = yield b.getBuildAsync(10)
+        self.assertEqual(build, None)
+
+    @defer.inlineCallbacks
+    def testGetBuildAsync_loadPool(self):
+        b = self.setupBuilder('builder_1')
+        self.makeBuilds(b, 3)
+        b = self.reloadBuilder(b)
+        b.status = Mock()
+        b.status.loadPool = pool = threadpool.ThreadPool(minthreads=0,
+                                                         maxthreads=1)
+        pool.start()
+        self.addCleanup(pool.stop)
+        d1 = b.getBuildAsync(2)
+        d2 = b.getBuildAsync(2)
+        builds = yield defer.gatherResults([d1, d2])
+        self.assertEqual(builds[0].number, 2)
+        self.assertIdentical(builds[0], builds[1])
+        self.assertEqual(b.buildAsyncCache.misses, 1)
+
+    @defer.inlineCallbacks
+    def testGenerateFinishedBuildsAsync(self):
+        b = self.setupBuilder('builder_1')
+        self.makeBuilds(b, 5)
+        b = self.reloadBuilder(b)
+        builds = yield b.generateFinishedBuildsAsync(num_builds=2)
+        self.assertEqual([ build.number for build in builds ], [4, 3])
+        builds = yield b.generateFinishedBuildsAsync(max_buildnum=2,
+            filter_fn=lambda build : build.getProperty('propkey') != 'propval1')
+        self.assertEqual([ build.number for build in builds ], [2, 0])
@@ -0,0 +1,448 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import sqlite3
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from buildbot import sourcestamp
+from buildbot.status import buildsummary, builder
+from buildbot.test.fake import fakemaster
+from buildbot.test.util import dirs
+
+def mkSummary(number, **kwargs):
+    summary = dict(number=number, reason='because', results=0,
+            text=['build', 'successful'], started=10.0, finished=20.0,
+            slavename='sl', blamelist=['me'],
+            sourcestamps=[dict(branch=None, revision='abc', repository='',
+                               codebase='', project='')],
+            properties=[['buildnumber', number, 'Build']],
+            steps=[dict(name='compile', text=['compile'], results=[0, []],
+                        started=11.0, finished=19.0)],
+            logs=['%d-log-compile-stdio' % number])
+    summary.update(kwargs)
+    return summary
+
+class StoreTests(dirs.DirsMixin):
+
+    backend = None
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+        self.store = buildsummary.openStore(self.backend, 'bldr')
+
+    def tearDown(self):
+        self.store.close()
+        self.tearDownDirs()
+
+    def reopen(self):
+        self.store.close()
+        self.store = buildsummary.openStore(self.backend, 'bldr')
+
+    def test_addBuild_getBuild(self):
+        self.store.addBuild(mkSummary(3))
+        self.assertEqual(self.store.getBuild(3), mkSummary(3))
+
+    def test_getBuild_missing(self):
+        self.assertEqual(self.store.getBuild(3), None)
+        self.assertFalse(self.store.hasBuild(3))
+
+    def test_getBuild_fields(self):
+        self.store.addBuild(mkSummary(3))
+        self.assertEqual(self.store.getBuild(3, fields=['results', 'text']),
+                         dict(results=0, text=['build', 'successful']))
+
+    def test_getBuild_bad_field(self):
+        self.store.addBuild(mkSummary(3))
+        self.assertRaises(KeyError,
+                lambda : self.store.getBuild(3, fields=['log']))
+
+    def test_addBuild_replaces(self):
+        self.store.addBuild(mkSummary(3))
+        self.store.addBuild(mkSummary(3, results=2))
+        self.reopen()
+        self.assertEqual(self.store.getBuild(3, fields=['results']),
+                         dict(results=2))
+
+    def test_persistent(self):
+        self.store.addBuild(mkSummary(3))
+        self.store.addBuild(mkSummary(4))
+        self.reopen()
+        self.assertEqual(self.store.getBuild(3), mkSummary(3))
+        self.assertEqual(self.store.getBuild(4), mkSummary(4))
+
+    @defer.inlineCallbacks
+    def test_removeBuildsBefore(self):
+        for n in range(5):
+            self.store.addBuild(mkSummary(n))
+        d = self.store.removeBuildsBefore(3)
+        # the summaries are gone before the store is updated
+        self.assertEqual([ self.store.hasBuild(n) for n in range(5) ],
+                         [ False, False, False, True, True ])
+        yield d
+        self.assertEqual([ self.store.hasBuild(n) for n in range(5) ],
+                         [ False, False, False, True, True ])
+        self.reopen()
+        self.assertEqual([ self.store.hasBuild(n) for n in range(5) ],
+                         [ False, False, False, True, True ])
+        self.assertEqual(self.store.getBuild(4), mkSummary(4))
+
+    def addFindBuilds(self):
+        for n, branch, results, finished in [ (0, 'a', 0, 10.0),
+                                              (1, 'b', 2, 20.0),
+                                              (2, 'a', 2, 30.0),
+                                              (3, None, 0, 40.0) ]:
+            ss = [ dict(branch=branch, revision='r%d' % n, repository='',
+                        codebase='', project='') ]
+            self.store.addBuild(mkSummary(n, sourcestamps=ss,
+                                          results=results, finished=finished))
+
+    def test_getBuildNumbers(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.getBuildNumbers(), set([0, 1, 2, 3]))
+
+    def test_getBuildNumbers_range(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.getBuildNumbers(min_buildnum=1,
+                                                    max_buildnum=2),
+                         set([1, 2]))
+
+    def test_getLogs(self):
+        self.store.addBuild(mkSummary(1))
+        self.store.addBuild(mkSummary(2, logs=[]))
+        self.assertEqual(self.store.getLogs([1, 2, 3]),
+                         { 1 : ['1-log-compile-stdio'], 2 : [] })
+
+    def test_findBuilds_limit(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(branches=['a'], limit=1),
+                [ dict(number=2) ])
+        self.assertEqual(self.store.findBuilds(limit=10),
+                [ dict(number=n) for n in (3, 2, 1, 0) ])
+
+    def test_findBuilds_all(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(),
+                [ dict(number=n) for n in (3, 2, 1, 0) ])
+
+    def test_findBuilds_branches(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(branches=['a', None]),
+                [ dict(number=n) for n in (3, 2, 0) ])
+
+    def test_findBuilds_results(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(results=[2]),
+                [ dict(number=n) for n in (2, 1) ])
+        self.assertEqual(self.store.findBuilds(results=[]), [])
+
+    def test_findBuilds_finished_before(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(finished_before=30.0),
+                [ dict(number=n) for n in (1, 0) ])
+
+    def test_findBuilds_max_buildnum(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(max_buildnum=1),
+                [ dict(number=n) for n in (1, 0) ])
+
+    def test_findBuilds_combined_fields(self):
+        self.addFindBuilds()
+        self.assertEqual(self.store.findBuilds(branches=['a'], results=[2],
+                                               fields=['finished', 'reason']),
+                [ dict(number=2, finished=30.0, reason='because') ])
+
+    @defer.inlineCallbacks
+    def test_findBuilds_after_remove(self):
+        self.addFindBuilds()
+        yield self.store.removeBuildsBefore(2)
+        self.assertEqual(self.store.findBuilds(branches=['a']),
+                [ dict(number=2) ])
+
+class TestSQLiteBuildSummaryStore(StoreTests, unittest.TestCase):
+
+    backend = 'sqlite'
+
+    def test_adds_logs_column(self):
+        self.store.close()
+        os.unlink(os.path.join('bldr', 'builds.sqlite'))
+        conn = sqlite3.connect(os.path.join('bldr', 'builds.sqlite'))
+        conn.execute("CREATE TABLE builds (number INTEGER PRIMARY KEY,"
+                " version INTEGER NOT NULL, reason TEXT, results INTEGER,"
+                " text TEXT, started REAL, finished REAL, slavename TEXT,"
+                " blamelist TEXT, sourcestamps TEXT, properties TEXT,"
+                " steps TEXT)")
+        conn.execute("INSERT INTO builds (number, version) VALUES (3, 1)")
+        conn.commit()
+        conn.close()
+        self.store = buildsummary.openStore(self.backend, 'bldr')
+        self.assertEqual(self.store.getBuild(3, fields=['logs']),
+                         dict(logs=None))
+        self.store.addBuild(mkSummary(4))
+        self.assertEqual(self.store.getBuild(4), mkSummary(4))
+
+class TestJSONLinesBuildSummaryStore(StoreTests, unittest.TestCase):
+
+    backend = 'jsonl'
+
+    def test_corrupt_line(self):
+        self.store.addBuild(mkSummary(3))
+        self.store.close()
+        with open(os.path.join('bldr', 'builds.jsonl'), 'ab') as f:
+            f.write('{"number": 4, "vers\n')
+        self.store = buildsummary.openStore(self.backend, 'bldr')
+        self.assertTrue(self.store.hasBuild(3))
+        self.assertFalse(self.store.hasBuild(4))
+
+    @defer.inlineCallbacks
+    def test_removeBuildsBefore_in_thread(self):
+        for n in range(5):
+            self.store.addBuild(mkSummary(n))
+        calls = []
+        def deferToThread(fn, *args):
+            calls.append((fn, args, defer.Deferred()))
+            return calls[-1][2]
+        self.patch(buildsummary.threads, 'deferToThread', deferToThread)
+        done = self.store.removeBuildsBefore(3)
+        # builds are added and removed while the thread copies the file
+        self.store.addBuild(mkSummary(3, results=2))
+        self.store.addBuild(mkSummary(5))
+        self.store.removeBuildsBefore(4)
+        fn, args, d = calls[0]
+        self.assertEqual(fn, self.store._copyLines)
+        self.assertEqual([ n for off, n in args[1] ], [3, 4])
+        d.callback(fn(*args))
+        yield done
+        self.assertEqual(self.store.getBuildNumbers(), set([4, 5]))
+        self.assertEqual(self.store.getBuild(5), mkSummary(5))
+        # and the second rewrite drops the lines of build 3
+        fn, args, d = calls[1]
+        self.assertEqual([ n for off, n in args[1] ], [4, 5])
+        d.callback(fn(*args))
+        self.reopen()
+        self.assertEqual(self.store.getBuildNumbers(), set([4, 5]))
+        self.assertEqual(self.store.getBuild(4), mkSummary(4))
+        self.assertEqual(len(open(os.path.join('bldr',
+                                               'builds.jsonl')).readlines()),
+                         2)
+
+class TestMigrateBuilder(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+        self.store = buildsummary.openStore('jsonl', 'bldr')
+
+    def tearDown(self):
+        self.store.close()
+        self.tearDownDirs()
+
+    def test_migrateBuilder(self):
+        for f in ('1', '2', '3', '2-stdio', 'builder'):
+            open(os.path.join('bldr', f), 'w').close()
+        self.store.addBuild(mkSummary(1))
+        bldr = builder.BuilderStatus('bldr', None, fakemaster.make_master(),
+                                     None)
+        loaded = []
+        def loadBuild(number):
+            loaded.append(number)
+            if number == 3:
+                raise RuntimeError("corrupt")
+            return builder.BuildStatus(bldr, None, number)
+        migrated, failed = buildsummary.migrateBuilder(self.store, 'bldr',
+                                                       loadBuild)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertEqual((migrated, failed), (1, [3]))
+        self.assertEqual(loaded, [2, 3])
+        self.assertEqual(self.store.getBuild(2, fields=['number', 'steps']),
+                         dict(number=2, steps=[]))
+
+class TestBuilderStatusSummaries(unittest.TestCase):
+
+    def setupBuilder(self, backend='sqlite'):
+        m = fakemaster.make_master()
+        m.config.buildSummaryBackend = backend
+        b = builder.BuilderStatus(buildername='bldr', category=None,
+                                  master=m, description=None)
+        b.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(b.basedir)
+        b.determineNextBuildNumber()
+        b.currentBigState = 'idle'
+        b.status = 'idle'
+        return b
+
+    def runBuild(self, b):
+        build = b.newBuild()
+        build.setText(['done'])
+        build.buildStarted(build)
+        build.buildFinished()
+        return build
+
+    def test_buildFinished_adds_summary(self):
+        b = self.setupBuilder()
+        self.runBuild(b)
+        store = b.getSummaryStore()
+        self.assertEqual(store.getBuild(0, fields=['number', 'text']),
+                         dict(number=0, text=['done']))
+
+    def test_getBuildSummary_negative(self):
+        b = self.setupBuilder()
+        self.runBuild(b)
+        self.runBuild(b)
+        self.assertEqual(b.getBuildSummary(-1, fields=['number']),
+                         dict(number=1))
+
+    def test_getBuildSummary_fills_store(self):
+        b = self.setupBuilder(backend=None)
+        self.runBuild(b)
+        b.master.config.buildSummaryBackend = 'jsonl'
+        self.assertEqual(b.getSummaryStore().getBuild(0), None)
+        self.assertEqual(b.getBuildSummary(0, fields=['text']),
+                         dict(text=['done']))
+        self.assertEqual(b.getSummaryStore().getBuild(0, fields=['text']),
+                         dict(text=['done']))
+
+    def test_getBuildSummary_missing(self):
+        b = self.setupBuilder()
+        self.assertEqual(b.getBuildSummary(5), None)
+
+    def test_disabled(self):
+        b = self.setupBuilder(backend=None)
+        self.runBuild(b)
+        self.assertEqual(b.getSummaryStore(), None)
+        self.assertFalse(os.path.exists(os.path.join(b.basedir,
+                                                     'builds.sqlite')))
+
+class TestBuilderStatusIndex(unittest.TestCase):
+
+    def setupBuilder(self):
+        m = fakemaster.make_master()
+        b = builder.BuilderStatus(buildername='bldr', category=None,
+                                  master=m, description=None)
+        b.basedir = os.path.abspath(self.mktemp())
+        os.mkdir(b.basedir)
+        b.determineNextBuildNumber()
+        b.currentBigState = 'idle'
+        b.status = 'idle'
+        return b
+
+    def makeBuilds(self, b, branches):
+        for branch in branches:
+            build = b.newBuild()
+            build.setSourceStamps([ sourcestamp.SourceStamp(branch=branch) ])
+            build.buildStarted(build)
+            build.buildFinished()
+
+    def reloadBuilder(self, b):
+        b2 = self.setupBuilder()
+        b2.basedir = b.basedir
+        b2.determineNextBuildNumber()
+        b2.loadBuildFromFile = mock.Mock(wraps=b2.loadBuildFromFile)
+        return b2
+
+    def loaded(self, b):
+        return sorted([ call[0][0]
+                        for call in b.loadBuildFromFile.call_args_list ])
+
+    def test_generateFinishedBuilds_skips_unindexed(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b', 'b'])
+        b = self.reloadBuilder(b)
+        builds = list(b.generateFinishedBuilds(branches=['a']))
+        self.assertEqual([ build.number for build in builds ], [2, 0])
+        self.assertEqual(self.loaded(b), [0, 2])
+
+    def test_generateFinishedBuilds_max_search(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a'] + ['b'] * 10)
+        b = self.reloadBuilder(b)
+        # builds skipped using the index do not count toward max_search
+        builds = list(b.generateFinishedBuilds(branches=['a'], max_search=1))
+        self.assertEqual([ build.number for build in builds ], [0])
+
+    def test_generateFinishedBuilds_fills_index(self):
+        b = self.setupBuilder()
+        b.master.config.buildSummaryBackend = None
+        self.makeBuilds(b, ['a', 'b', 'a'])
+        b = self.reloadBuilder(b)
+        builds = list(b.generateFinishedBuilds(branches=['b']))
+        self.assertEqual([ build.number for build in builds ], [1])
+        self.assertEqual(self.loaded(b), [0, 1, 2])
+        self.assertEqual(b.getSummaryStore().getBuildNumbers(),
+                         set([0, 1, 2]))
+
+        b = self.reloadBuilder(b)
+        builds = list(b.generateFinishedBuilds(branches=['b']))
+        self.assertEqual([ build.number for build in builds ], [1])
+        self.assertEqual(self.loaded(b), [1])
+
+    def test_generateFinishedBuilds_num_builds(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b', 'b'])
+        b = self.reloadBuilder(b)
+        store = b.getSummaryStore()
+        store.findBuilds = mock.Mock(wraps=store.findBuilds)
+        store.getBuildNumbers = mock.Mock(wraps=store.getBuildNumbers)
+        builds = list(b.generateFinishedBuilds(branches=['a'], num_builds=1))
+        self.assertEqual([ build.number for build in builds ], [2])
+        # only the most recent match, and the numbers above it, are queried
+        self.assertEqual(store.findBuilds.call_args[1]['limit'], 1)
+        store.getBuildNumbers.assert_called_once_with(min_buildnum=2,
+                                                      max_buildnum=4)
+
+    def test_generateFinishedBuilds_pages(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b', 'a'])
+        b = self.reloadBuilder(b)
+        store = b.getSummaryStore()
+        store.findBuilds = mock.Mock(wraps=store.findBuilds)
+        builds = list(b.generateFinishedBuilds(branches=['a'], num_builds=2,
+                filter_fn=lambda build : build.number != 4))
+        self.assertEqual([ build.number for build in builds ], [2, 0])
+        # the first page of two builds was not enough
+        self.assertEqual([ (call[1]['max_buildnum'], call[1]['limit'])
+                           for call in store.findBuilds.call_args_list ],
+                         [ (4, 2), (1, 2) ])
+
+    @defer.inlineCallbacks
+    def test_generateFinishedBuildsAsync(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b', 'b'])
+        b = self.reloadBuilder(b)
+        b._unpickleBuild = mock.Mock(wraps=b._unpickleBuild)
+        builds = yield b.generateFinishedBuildsAsync(branches=['a'],
+                                                     num_builds=1)
+        self.assertEqual([ build.number for build in builds ], [2])
+        self.assertEqual([ call[0][0]
+                           for call in b._unpickleBuild.call_args_list ], [2])
+
+    def test_eventGenerator_branches(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b'])
+        b = self.reloadBuilder(b)
+        builds = [ e.number for e in b.eventGenerator(branches=['b'])
+                   if isinstance(e, builder.BuildStatus) ]
+        self.assertEqual(builds, [3, 1])
+        self.assertEqual(self.loaded(b), [1, 3])
+
+    def test_eventGenerator_pages(self):
+        b = self.setupBuilder()
+        self.makeBuilds(b, ['a', 'b', 'a', 'b'])
+        b = self.reloadBuilder(b)
+        b.eventPageSize = 1
+        builds = [ e.number for e in b.eventGenerator(branches=['b'])
+                   if isinstance(e, builder.BuildStatus) ]
+        self.assertEqual(builds, [3, 1])
+        self.assertEqual(self.loaded(b), [1, 3])
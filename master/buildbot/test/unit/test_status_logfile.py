@@ -16,19 +16,23 @@
 from __future__ import with_statement
 
 import os
+import gzip
+import __builtin__
 import cStringIO, cPickle
 import mock
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task
 from buildbot.status import logfile
+from buildbot.util import eventual
 from buildbot.test.util import dirs
-from buildbot import config
+from buildbot import config, util
 
 class TestLogFileProducer(unittest.TestCase):
     def make_static_logfile(self, contents):
         "make a fake logfile with the given contents"
         lf = mock.Mock()
         lf.getFile = lambda : cStringIO.StringIO(contents)
+        lf._mapFile = lambda : None
         lf.waitUntilFinished = lambda : defer.succeed(None) # already finished
         lf.runEntries = []
         return lf
@@ -48,6 +52,24 @@ class TestLogFileProducer(unittest.TestCase):
     # Remainder of LogFileProduer has a wacky interface that's not
     # well-defined, so it's not tested yet
 
+class TestSplitLines(unittest.TestCase):
+
+    def do_test(self, texts):
+        self.assertEqual(list(logfile.splitLines(texts)),
+                         "".join(texts).split("\n"))
+
+    def test_empty(self):
+        self.do_test([])
+
+    def test_one_text(self):
+        self.do_test(['a\nb\n\nc'])
+
+    def test_trailing_newline(self):
+        self.do_test(['a\n', 'b\n'])
+
+    def test_split_lines(self):
+        self.do_test(['a', 'b\nc', '', 'd', '\n', '\ne'])
+
 class TestLogFile(unittest.TestCase, dirs.DirsMixin):
 
     def setUp(self):
@@ -108,6 +130,12 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.pickle_and_restore()
         self.assertTrue(self.logfile.hasContents())
 
+    def test_hasContents_blk(self):
+        self.delete_logfile()
+        with open(os.path.join(self.basedir, '123-stdio.blk'), "w") as f:
+            f.write("hi")
+        self.assertTrue(self.logfile.hasContents())
+
     def test_hasContents_bz2(self):
         self.delete_logfile()
         with open(os.path.join(self.basedir, '123-stdio.bz2'), "w") as f:
@@ -168,7 +196,7 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         d = self.logfile.compressLog()
         def check(_):
             self.assertTrue(
-                    os.path.exists(os.path.join(self.basedir, '123-stdio.bz2')))
+                    os.path.exists(os.path.join(self.basedir, '123-stdio.blk')))
             fp = self.logfile.getFile()
             fp.seek(0, 0)
             self.assertEqual(fp.read(), '13:0hello, world,')
@@ -272,6 +300,84 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.assertRaises(RuntimeError,
                 lambda : self.do_test_addEntry([(0, 'x')], ''))
 
+    def test_addEntry_buffered(self):
+        self.logfile.chunkSize = 6
+        self.logfile.flushInterval = 60
+        self.logfile.addEntry(0, 'hello, ')
+        self.logfile.addEntry(1, 'world')
+        # merged chunks are not written until the buffer is flushed
+        self.assertEqual(os.path.getsize(self.logfile.getFilename()), 0)
+        self.assertEqual(self.logfile.pendingLength, 7)
+        self.logfile.writeBufferSize = 10
+        self.logfile.addEntry(0, '!')
+        self.assertEqual(self.logfile.pendingChunks, [])
+        fp = self.logfile.openfile
+        fp.seek(0, 0)
+        self.assertEqual(fp.read(), '7:0hello,,2:0 ,6:1world,')
+
+    def test_addEntry_buffered_flushInterval(self):
+        self.patch(util, 'now', lambda : 100.0)
+        self.logfile.lastFlush = 99.5
+        self.logfile.addEntry(0, 'x')
+        self.logfile.addEntry(1, 'y')
+        self.assertEqual(self.logfile.pendingLength, 1)
+        self.patch(util, 'now', lambda : 101.0)
+        self.logfile.addEntry(0, 'z')
+        self.assertEqual(self.logfile.pendingLength, 0)
+        self.assertEqual(self.logfile.lastFlush, 101.0)
+
+    def test_addEntry_buffered_flushTimer(self):
+        clock = task.Clock()
+        self.patch(self.logfile, '_reactor', clock)
+        self.patch(util, 'now', clock.seconds)
+        self.logfile.lastFlush = 0
+        self.logfile.addEntry(0, 'x')
+        self.logfile.addEntry(1, 'y')
+        self.assertEqual(self.logfile.pendingLength, 1)
+        # the buffer is flushed after flushInterval, even though no more
+        # entries arrive
+        clock.advance(0.5)
+        self.assertEqual(self.logfile.pendingLength, 1)
+        clock.advance(0.5)
+        self.assertEqual(self.logfile.pendingLength, 0)
+        self.assertEqual(self.logfile.runEntries, [])
+        self.assertEqual(self.logfile.flushTimer, None)
+        fp = self.logfile.openfile
+        fp.seek(0, 0)
+        self.assertEqual(fp.read(), '2:0x,2:1y,')
+
+    def test_addEntry_buffered_flushTimer_cancelled(self):
+        clock = task.Clock()
+        self.patch(self.logfile, '_reactor', clock)
+        self.patch(util, 'now', clock.seconds)
+        self.logfile.lastFlush = 0
+        self.logfile.addEntry(0, 'x')
+        self.logfile.addEntry(1, 'y')
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        self.logfile.finish()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_addEntry_buffered_read(self):
+        self.logfile.addEntry(0, 'hello')
+        self.logfile.addEntry(1, 'world')
+        # readers see buffered chunks
+        self.assertEqual(self.logfile.getText(), 'helloworld')
+        self.assertEqual(self.logfile.getLineCount(), 1)
+
+    def test_finish_fsync(self):
+        self.config.logFsync = True
+        self.patch(os, 'fsync', mock.Mock())
+        self.logfile.addEntry(0, 'hello')
+        self.logfile.finish()
+        d = self.logfile.syncing
+        def check(_):
+            self.assertEqual(os.fsync.call_count, 1)
+            self.assertEqual(self.logfile.syncing, None)
+            self.assertEqual(open(self.logfile.getFilename()).read(),
+                             '6:0hello,')
+        d.addCallback(check)
+        return d
+
     def test_addEntry_watchers(self):
         watcher = mock.Mock(name='watcher')
         self.logfile.watchers.append(watcher)
@@ -309,6 +415,293 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
         self.logfile.addHeader('hed')
         addEntry.assert_called_with(2, 'hed')
 
+    def add_lines(self):
+        # 'line N\n' is 7 bytes, so lines are split across 5-byte chunks
+        self.logfile.chunkSize = 5
+        self.logfile.addEntry(logfile.HEADER, 'head\n')
+        for i in range(1, 6):
+            self.logfile.addEntry(0, 'line %d\n' % i)
+        self.logfile.addEntry(1, 'err\npartial')
+
+    def test_index(self):
+        self.logfile.addEntry(logfile.HEADER, 'hi\n')
+        self.logfile.addEntry(0, 'a\nb\n')
+        self.logfile.addEntry(1, 'c')
+        self.logfile.finish()
+        idx = self.logfile.getIndex()
+        self.assertEqual([ idx[i] for i in range(len(idx)) ], [
+            (3, 3, 2, 0, 1, 0, 0),
+            (10, 4, 0, 1, 2, 0, 0),
+            (18, 1, 1, 3, 0, 4, 2),
+        ])
+        self.assertEqual(idx.getNewlineCount(), 3)
+        self.assertEqual(idx.getNewlineCount(textLines=True), 2)
+        self.assertTrue(os.path.exists(self.logfile.getIndexFilename()))
+
+    def test_index_findLine(self):
+        self.add_lines()
+        self.logfile.finish()
+        idx = self.logfile.getIndex()
+        self.assertEqual(idx.findLine(0), 0)
+        self.assertEqual(idx.findLine(3), 4)
+        self.assertEqual(idx.findLine(100), len(idx))
+        # without the header line, line 3 begins in the 'line 4' chunks
+        self.assertEqual(idx.findLine(3, textLines=True), 6)
+
+    def test_getLineCount(self):
+        self.add_lines()
+        self.assertEqual(self.logfile.getLineCount(), 8)
+        self.logfile.addEntry(1, '\n')
+        self.logfile.finish()
+        self.assertEqual(self.logfile.getLineCount(), 8)
+
+    def test_getLineChunks(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True)),
+                'line 2\nline 3\n')
+
+    def test_getLineChunks_textLines(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.assertEqual(self.logfile.getLineCount(textLines=True), 7)
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True,
+                                                   textLines=True)),
+                'line 3\nline 4\n')
+        self.assertEqual(
+                ''.join(self.logfile.getTailChunks(2, onlyText=True,
+                                                   textLines=True)),
+                'err\npartial')
+
+    def test_getLineChunks_textLines_unindexed(self):
+        self.add_lines()
+        self.logfile.finish()
+        os.unlink(self.logfile.getIndexFilename())
+        self.pickle_and_restore()
+        self.patch(logfile.LogChunkIndex, 'build',
+                   classmethod(lambda cls, fn, f : None))
+        self.assertEqual(self.logfile.getLineCount(textLines=True), 7)
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(0, 2, onlyText=True,
+                                                   textLines=True)),
+                'line 1\nline 2\n')
+
+    def test_getIndex_old_version(self):
+        self.add_lines()
+        self.logfile.finish()
+        f = open(self.logfile.getIndexFilename(), "r+b")
+        f.write(logfile.LogChunkIndex.HEADER.pack("BBLI", 1))
+        f.close()
+        self.pickle_and_restore()
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True,
+                                                   textLines=True)),
+                'line 3\nline 4\n')
+        # the index is rebuilt in the current format
+        d = self.logfile.indexing
+        def check(_):
+            idx = self.logfile.getIndex()
+            self.assertNotEqual(idx, None)
+            self.logfile._releaseReader(idx)
+        d.addCallback(check)
+        return d
+
+    def test_getLineChunks_unfinished(self):
+        self.add_lines()
+        self.assertEqual(list(self.logfile.getLineChunks(6)),
+                [ (1, 'err\np'), (1, 'artia'), (1, 'l') ])
+
+    def test_getLineChunks_channels(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(0, 7, channels=[1, 2],
+                                                   onlyText=True)),
+                'head\nerr\n')
+
+    def test_getTailChunks(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.assertEqual(
+                ''.join(self.logfile.getTailChunks(2, onlyText=True)),
+                'err\npartial')
+        self.assertEqual(
+                ''.join(self.logfile.getTailChunks(100, onlyText=True)),
+                self.logfile.getTextWithHeaders())
+
+    def test_index_readers_closed(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.pickle_and_restore()
+        loaded = []
+        load = logfile.LogChunkIndex.load
+        def record(cls, fn):
+            idx = load(fn)
+            loaded.append(idx)
+            return idx
+        self.patch(logfile.LogChunkIndex, 'load', classmethod(record))
+        self.logfile.getLineCount()
+        self.logfile.getTextLength()
+        ''.join(self.logfile.getLineChunks(2, 4, onlyText=True))
+        ''.join(self.logfile.getTextRangeChunks(0, 5))
+        self.assertEqual([ idx.f.closed for idx in loaded ], [ True ] * 4)
+
+    def test_getIndex_upgrade(self):
+        self.add_lines()
+        self.logfile.finish()
+        expected = list(self.logfile.getIndex())
+        os.unlink(self.logfile.getIndexFilename())
+        self.pickle_and_restore()
+        # the log is scanned while the index is built in a thread
+        self.assertEqual(self.logfile.getIndex(), None)
+        self.assertNotEqual(self.logfile.indexing, None)
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True)),
+                'line 2\nline 3\n')
+        d = self.logfile.indexing
+        def check(_):
+            # and the rebuilt index was saved
+            self.assertEqual(self.logfile.indexing, None)
+            self.assertTrue(os.path.exists(self.logfile.getIndexFilename()))
+            idx = self.logfile.getIndex()
+            self.assertEqual(list(idx), expected)
+            self.logfile._releaseReader(idx)
+            self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True)),
+                'line 2\nline 3\n')
+        d.addCallback(check)
+        return d
+
+    def test_buildIndex_compressed(self):
+        self.add_lines()
+        self.logfile.finish()
+        expected = list(self.logfile.getIndex())
+        self.config.logCompressionMethod = 'bz2'
+        d = self.logfile.compressLog()
+        def rebuild(_):
+            os.unlink(self.logfile.getIndexFilename())
+            self.pickle_and_restore()
+            seeks = []
+            f = self.logfile.getFile()
+            seek = f.seek
+            def recordSeek(pos, whence=0):
+                seeks.append((pos, whence))
+                return seek(pos, whence)
+            f.seek = recordSeek
+            fn = self.logfile.getIndexFilename()
+            idx = logfile.LogChunkIndex.build(fn, f)
+            f.close()
+            self.assertEqual(list(idx), expected)
+            idx.close()
+            # the data is read forward, from the start
+            self.assertEqual(seeks, [ (0, 0) ])
+        d.addCallback(rebuild)
+        return d
+
+    def test_buildIndex_truncated(self):
+        self.add_lines()
+        self.logfile.finish()
+        expected = list(self.logfile.getIndex())
+        fn = self.logfile.getFilename()
+        data = open(fn).read()
+        f = open(fn, "w")
+        f.write(data[:-3])
+        f.close()
+        idx = logfile.LogChunkIndex.build(self.logfile.getIndexFilename(),
+                                           open(fn))
+        # the last, truncated chunk is not indexed
+        self.assertEqual(list(idx), expected[:-1])
+        idx.close()
+
+    def test_getIndex_unavailable(self):
+        self.add_lines()
+        self.logfile.finish()
+        os.unlink(self.logfile.getIndexFilename())
+        self.pickle_and_restore()
+        self.patch(logfile.LogChunkIndex, 'build',
+                   classmethod(lambda cls, fn, f : None))
+        self.assertEqual(
+                ''.join(self.logfile.getLineChunks(2, 4, onlyText=True)),
+                'line 2\nline 3\n')
+        self.assertEqual(self.logfile.getLineCount(), 8)
+
+    def test_getLineChunks_compressed(self):
+        self.add_lines()
+        self.logfile.finish()
+        self.config.logCompressionMethod = 'bz2'
+        d = self.logfile.compressLog()
+        def check(_):
+            self.assertEqual(
+                ''.join(self.logfile.getTailChunks(3, onlyText=True)),
+                'line 5\nerr\npartial')
+        d.addCallback(check)
+        return d
+
+    def test_getChunkBuffers(self):
+        self.logfile.addStdout('hello\n')
+        self.logfile.addHeader('header\n')
+        self.logfile.addStderr('world\n')
+        self.logfile.finish()
+        chunks = list(self.logfile.getChunkBuffers())
+        self.assertEqual([ type(text) for _, text in chunks ], [buffer] * 3)
+        self.assertEqual([ (channel, str(text)) for channel, text in chunks ],
+                [ (0, 'hello\n'), (2, 'header\n'), (1, 'world\n') ])
+        self.assertEqual([ str(text) for text in
+                           self.logfile.getChunkBuffers([logfile.STDERR],
+                                                        onlyText=True) ],
+                         [ 'world\n' ])
+
+    def test_getChunkBuffers_unfinished(self):
+        self.logfile.addStdout('hello\n')
+        self.logfile.addStderr('world\n')
+        # the second entry has not been merged yet
+        self.assertEqual([ str(text) for text in
+                           self.logfile.getChunkBuffers(onlyText=True) ],
+                         [ 'hello\n', 'world\n' ])
+
+    def test_getChunkBuffers_compressed(self):
+        self.logfile.addStdout('hello\n')
+        self.logfile.finish()
+        self.config.logCompressionMethod = 'gz'
+        d = self.logfile.compressLog()
+        def check(_):
+            self.assertEqual(list(self.logfile.getChunkBuffers()),
+                             [ (0, 'hello\n') ])
+        d.addCallback(check)
+        return d
+
+    def test_subscribeConsumer_mapped(self):
+        self.logfile.addStdout('hello')
+        self.logfile.addStderr('world')
+        self.logfile.finish()
+        consumer = mock.Mock()
+        self.logfile.subscribeConsumer(consumer)
+        d = eventual.flushEventualQueue()
+        def check(_):
+            self.assertEqual([ args[0][0] for args
+                               in consumer.writeChunk.call_args_list ],
+                             [ (0, 'hello'), (1, 'world') ])
+        d.addCallback(check)
+        return d
+
+    def test_mapFile_empty(self):
+        self.logfile.finish()
+        self.assertEqual(self.logfile._mapFile(), None)
+        self.assertEqual(self.logfile.getText(), '')
+
+    def test_readlines(self):
+        self.logfile.chunkSize = 4
+        self.logfile.addStdout('one\ntw')
+        self.logfile.addHeader('header\n')
+        self.logfile.addStdout('o\n\nthree')
+        self.logfile.addStderr('err\n')
+        self.logfile.addStdout('four')
+        self.logfile.finish()
+        self.assertEqual(self.logfile.readlines(),
+                         [ 'one\n', 'two\n', '\n', 'threefour' ])
+
     def do_test_compressLog(self, ext, expect_comp=True):
         self.logfile.openfile.write('xyz' * 1000)
         self.logfile.finish()
@@ -324,13 +717,180 @@ class TestLogFile(unittest.TestCase, dirs.DirsMixin):
 
     def test_compressLog_gz(self):
         self.config.logCompressionMethod = 'gz'
-        return self.do_test_compressLog('.gz')
+        return self.do_test_compressLog('.blk')
 
     def test_compressLog_bz2(self):
         self.config.logCompressionMethod = 'bz2'
-        return self.do_test_compressLog('.bz2')
+        return self.do_test_compressLog('.blk')
 
     def test_compressLog_none(self):
         self.config.logCompressionMethod = None
         return self.do_test_compressLog('', expect_comp=False)
 
+    def writeIncrementally(self):
+        self.patch(logfile.LogBlockCompressor, 'BLOCKSIZE', 100)
+        self.config.logCompressionLimit = 200
+        self.logfile.chunkSize = 50
+        self.logfile.writeBufferSize = 50
+        text = ''.join([ 'line %d\n' % i for i in range(100) ])
+        for i in range(0, len(text), 10):
+            self.logfile.addEntry(0, text[i:i+10])
+        return text
+
+    @defer.inlineCallbacks
+    def test_compressLog_incremental(self):
+        text = self.writeIncrementally()
+        # compression started, in a thread, once the log reached the limit
+        compressor = self.logfile.compressor
+        yield self.logfile.compressing.run(defer.succeed, None)
+        self.assertTrue(compressor.blocks)
+        self.logfile.finish()
+        yield self.logfile.compressLog()
+        self.assertTrue(os.path.exists(
+            os.path.join(self.basedir, '123-stdio.blk')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.basedir, '123-stdio.blk.tmp')))
+        self.assertEqual(self.logfile.getText(), text)
+
+    @defer.inlineCallbacks
+    def test_compressLog_incremental_without_compressLog(self):
+        # finish puts the compressed log in place by itself, so nothing is
+        # left behind if compressLog is never called
+        text = self.writeIncrementally()
+        self.logfile.finish()
+        yield self.logfile.compressing.run(defer.succeed, None)
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         [ '123-stdio.blk', '123-stdio.idx' ])
+        self.assertEqual(self.logfile.getText(), text)
+
+    @defer.inlineCallbacks
+    def test_compressLog_incremental_failed(self):
+        text = self.writeIncrementally()
+        yield self.logfile.compressing.run(defer.succeed, None)
+        def fail(data):
+            raise IOError("disk full")
+        self.logfile.compressor.write = fail
+        self.logfile.addEntry(0, 'more\n')
+        self.logfile.finish()
+        yield self.logfile.compressLog()
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        # the whole log was compressed instead
+        self.assertFalse(os.path.exists(
+            os.path.join(self.basedir, '123-stdio')))
+        self.assertEqual(self.logfile.getText(), text + 'more\n')
+
+    def test_stale_compressed_removed(self):
+        tmp = os.path.join(self.basedir, '456-stdio.blk.tmp')
+        open(tmp, 'w').close()
+        logfile.LogFile(self.build_step_status, 'testlf', '456-stdio')
+        self.assertFalse(os.path.exists(tmp))
+
+    def test_compressLog_old_gz(self):
+        self.logfile.addEntry(0, 'hello, world')
+        self.logfile.finish()
+        self.delete_logfile()
+        gz = gzip.GzipFile(os.path.join(self.basedir, '123-stdio.gz'), 'w')
+        gz.write('13:0hello, world,')
+        gz.close()
+        self.assertEqual(self.logfile.getText(), 'hello, world')
+
+class TestLogBlockFile(unittest.TestCase, dirs.DirsMixin):
+
+    def setUp(self):
+        self.setUpDirs('basedir')
+        self.filename = os.path.join('basedir', 'log.blk')
+        self.data = ''.join([ chr(i % 256) * 7 for i in range(1000) ])
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def write(self, method, blocksize=1000):
+        self.patch(logfile.LogBlockCompressor, 'BLOCKSIZE', blocksize)
+        c = logfile.LogBlockCompressor(self.filename, method)
+        for i in range(0, len(self.data), 333):
+            c.write(self.data[i:i+333])
+        c.close()
+        return logfile.LogBlockFile(self.filename)
+
+    def test_read_all_bz2(self):
+        f = self.write('bz2')
+        self.assertEqual(f.read(), self.data)
+        self.assertEqual(f.tell(), len(self.data))
+        self.assertEqual(f.read(), '')
+
+    def test_read_all_gz(self):
+        f = self.write('gz')
+        self.assertEqual(len(f.blocks), 7)
+        self.assertEqual(f.read(), self.data)
+
+    def test_read_empty(self):
+        self.data = ''
+        f = self.write('gz')
+        self.assertEqual(f.read(), '')
+
+    def test_seek_read(self):
+        f = self.write('gz')
+        f.seek(1990)
+        self.assertEqual(f.read(20), self.data[1990:2010])
+        f.seek(-10, 2)
+        self.assertEqual(f.read(), self.data[-10:])
+        f.seek(5)
+        f.seek(5, 1)
+        self.assertEqual(f.read(3000), self.data[10:3010])
+
+    def test_read_decompresses_needed_blocks(self):
+        f = self.write('gz')
+        decompressed = []
+        decompress = f.decompress
+        def tracking_decompress(data):
+            decompressed.append(data)
+            return decompress(data)
+        f.decompress = tracking_decompress
+        f.seek(6500)
+        self.assertEqual(f.read(100), self.data[6500:6600])
+        self.assertEqual(len(decompressed), 1)
+
+    def test_not_a_container(self):
+        with open(self.filename, "w") as f:
+            f.write("13:0hello, world,")
+        self.assertRaises(IOError, lambda : logfile.LogBlockFile(self.filename))
+
+    def assertOpenFails(self):
+        opened = []
+        def recordOpen(*args):
+            f = realOpen(*args)
+            opened.append(f)
+            return f
+        realOpen = open
+        self.patch(__builtin__, 'open', recordOpen)
+        self.assertRaises(IOError, lambda : logfile.LogBlockFile(self.filename))
+        # and the file was closed
+        self.assertEqual([ f.closed for f in opened ], [ True ])
+
+    def test_bad_header_closed(self):
+        with open(self.filename, "w") as f:
+            f.write("BB")
+        self.assertOpenFails()
+
+    def test_bad_magic_closed(self):
+        with open(self.filename, "w") as f:
+            f.write("13:0hello, world,")
+        self.assertOpenFails()
+
+    def test_truncated_closed(self):
+        self.write('gz').f.close()
+        with open(self.filename, "r+") as f:
+            f.truncate(os.path.getsize(self.filename) - 3)
+        self.assertOpenFails()
+
+    def test_truncated_index_closed(self):
+        self.write('gz').f.close()
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        footer = logfile.LogBlockCompressor.FOOTER
+        indexOffset, count, magic = footer.unpack(data[-footer.size:])
+        # drop the end of the index, but keep the footer
+        with open(self.filename, "wb") as f:
+            f.write(data[:indexOffset + 5] + data[-footer.size:])
+        self.assertOpenFails()
+
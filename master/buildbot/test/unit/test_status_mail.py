@@ -189,8 +189,8 @@ class TestMailNotifier(unittest.TestCase):
         build = FakeBuildStatus()
         build.builder = Mock()
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, SUCCESS))
-        
+        return self.assertNoMailSent(mn, build, SUCCESS)
+
     def test_buildsetFinished_sends_email(self):
         fakeBuildMessage = Mock()
         mn = MailNotifier('from@example.org',
@@ -201,7 +201,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.buildMessage = fakeBuildMessage
 
         builder1 = Mock()
-        builder1.getBuild = lambda number: build1
+        builder1.getBuildAsync = lambda number: defer.succeed(build1)
         builder1.name = "Builder1"
 
         build1 = FakeBuildStatus()
@@ -211,7 +211,7 @@ class TestMailNotifier(unittest.TestCase):
         build1.getBuilder.return_value = builder1
 
         builder2 = Mock()
-        builder2.getBuild = lambda number: build2
+        builder2.getBuildAsync = lambda number: defer.succeed(build2)
         builder2.name = "Builder2"
 
         build2 = FakeBuildStatus()
@@ -259,7 +259,7 @@ class TestMailNotifier(unittest.TestCase):
 
 
         def fakeGetBuild(number):
-            return build
+            return defer.succeed(build)
 
         def fakeGetBuilder(buildername):
             if buildername == builder.name:
@@ -270,7 +270,7 @@ class TestMailNotifier(unittest.TestCase):
             return defer.succeed([{"buildername":"Builder", "brid":1}])
 
         builder = Mock()
-        builder.getBuild = fakeGetBuild
+        builder.getBuildAsync = fakeGetBuild
         builder.name = "Builder"
 
         build = FakeBuildStatus()
@@ -321,7 +321,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.customMesg = fakeCustomMessage
         
         def fakeGetBuild(number):
-            return build
+            return defer.succeed(build)
         
         def fakeGetBuilder(buildername):
             if buildername == builder.name: 
@@ -343,7 +343,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.master = self
 
         builder = Mock()
-        builder.getBuild = fakeGetBuild
+        builder.getBuildAsync = fakeGetBuild
         builder.name = "Builder"
         
         build = FakeBuildStatus()
@@ -389,7 +389,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.customMesg = fakeCustomMessage
         
         def fakeGetBuild(number):
-            return build
+            return defer.succeed(build)
         
         def fakeGetBuilder(buildername):
             if buildername == builder.name: 
@@ -411,7 +411,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.master = self
 
         builder = Mock()
-        builder.getBuild = fakeGetBuild
+        builder.getBuildAsync = fakeGetBuild
         builder.name = "Builder"
         
         build = FakeBuildStatus()
@@ -444,7 +444,7 @@ class TestMailNotifier(unittest.TestCase):
         build.builder = Mock()
         build.builder.category = 'slow'
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, SUCCESS))
+        return self.assertNoMailSent(mn, build, SUCCESS)
 
     def run_simple_test_sends_email_for_mode(self, mode, result):
         mock_method = Mock()
@@ -511,62 +511,79 @@ class TestMailNotifier(unittest.TestCase):
     def test_buildFinished_mode_passing_for_exception(self):
         self.run_simple_test_ignores_email_for_mode("passing", EXCEPTION)
 
+    def assertNoMailSent(self, mn, build, results):
+        d = mn.buildFinished('dummyBuilder', build, results)
+        d.addCallback(self.assertEqual, None)
+        return d
+
     def test_buildFinished_mode_failing_ignores_successful_build(self):
         mn = MailNotifier('from@example.org', mode=("failing",))
 
         build = FakeBuildStatus(name="build")
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, SUCCESS))
+        return self.assertNoMailSent(mn, build, SUCCESS)
 
     def test_buildFinished_mode_passing_ignores_failed_build(self):
         mn = MailNotifier('from@example.org', mode=("passing",))
 
         build = FakeBuildStatus(name="build")
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, FAILURE))
+        return self.assertNoMailSent(mn, build, FAILURE)
 
     def test_buildFinished_mode_problem_ignores_successful_build(self):
         mn = MailNotifier('from@example.org', mode=("problem",))
 
         build = FakeBuildStatus(name="build")
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, SUCCESS))
+        return self.assertNoMailSent(mn, build, SUCCESS)
 
     def test_buildFinished_mode_problem_ignores_two_failed_builds_in_sequence(self):
         mn = MailNotifier('from@example.org', mode=("problem",))
 
         build = FakeBuildStatus(name="build")
         old_build = FakeBuildStatus(name="old_build")
-        build.getPreviousBuild.return_value = old_build
+        build.getPreviousBuildAsync.return_value = defer.succeed(old_build)
         old_build.getResults.return_value = FAILURE
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, FAILURE))
+        return self.assertNoMailSent(mn, build, FAILURE)
 
     def test_buildFinished_mode_change_ignores_first_build(self):
         mn = MailNotifier('from@example.org', mode=("change",))
 
         build = FakeBuildStatus(name="build")
-        build.getPreviousBuild.return_value = None
-
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, FAILURE))
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, SUCCESS))
+        build.getPreviousBuildAsync.side_effect = \
+                lambda : defer.succeed(None)
 
+        d = self.assertNoMailSent(mn, build, FAILURE)
+        d.addCallback(lambda _ : self.assertNoMailSent(mn, build, SUCCESS))
+        return d
 
     def test_buildFinished_mode_change_ignores_same_result_in_sequence(self):
         mn = MailNotifier('from@example.org', mode=("change",))
 
         build = FakeBuildStatus(name="build")
         old_build = FakeBuildStatus(name="old_build")
-        build.getPreviousBuild.return_value = old_build
+        build.getPreviousBuildAsync.return_value = defer.succeed(old_build)
         old_build.getResults.return_value = FAILURE
 
         build2 = FakeBuildStatus(name="build2")
         old_build2 = FakeBuildStatus(name="old_build2")
-        build2.getPreviousBuild.return_value = old_build2
+        build2.getPreviousBuildAsync.return_value = defer.succeed(old_build2)
         old_build2.getResults.return_value = SUCCESS
 
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build, FAILURE))
-        self.assertEqual(None, mn.buildFinished('dummyBuilder', build2, SUCCESS))
+        d = self.assertNoMailSent(mn, build, FAILURE)
+        d.addCallback(lambda _ : self.assertNoMailSent(mn, build2, SUCCESS))
+        return d
+
+    def test_buildFinished_custom_previousBuildGetter(self):
+        old_build = FakeBuildStatus(name="old_build")
+        old_build.getResults.return_value = FAILURE
+        mn = MailNotifier('from@example.org', mode=("change",),
+                          previousBuildGetter=lambda build : old_build)
+
+        build = FakeBuildStatus(name="build")
+
+        return self.assertNoMailSent(mn, build, FAILURE)
 
     def test_buildMessage_addLogs(self):
         mn = MailNotifier('from@example.org', mode=("change",), addLogs=True)
@@ -617,7 +634,7 @@ class TestMailNotifier(unittest.TestCase):
         mn.sendMessage = Mock()
 
         def fakeGetBuild(number):
-            return build
+            return defer.succeed(build)
         def fakeGetBuilder(buildername):
             if buildername == builder.name:
                 return builder
@@ -626,7 +643,7 @@ class TestMailNotifier(unittest.TestCase):
             return defer.succeed([{"buildername":"Builder", "brid":1}])
 
         builder = Mock()
-        builder.getBuild = fakeGetBuild
+        builder.getBuildAsync = fakeGetBuild
         builder.name = "Builder"
 
         build = FakeBuildStatus(name="build")
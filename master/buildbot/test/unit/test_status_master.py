@@ -48,6 +48,19 @@ class TestStatus(unittest.TestCase):
         d.addCallback(check)
         return d
 
+    def test_loadPool(self):
+        m = mock.Mock(name='master')
+        status = master.Status(m)
+        status.startService()
+        pool = status.loadPool
+        self.assertTrue(pool.started)
+        d = status.stopService()
+        def check(_):
+            self.assertTrue(pool.joined)
+            self.assertEqual(status.loadPool, None)
+        d.addCallback(check)
+        return d
+
     @defer.inlineCallbacks
     def test_reconfigService(self):
         m = mock.Mock(name='master')
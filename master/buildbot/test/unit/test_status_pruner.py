@@ -0,0 +1,223 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+from __future__ import with_statement
+
+import os
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.python import threadable
+from buildbot.status import builder, pruner
+from buildbot.test.fake import fakemaster
+from buildbot.test.unit.test_status_buildsummary import mkSummary
+from buildbot.test.util import dirs
+
+class TestBuildPruner(dirs.DirsMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.setUpDirs('bldr')
+        self.patch(pruner.BuildPruner, 'batchInterval', 0)
+        m = fakemaster.make_master()
+        m.config.buildSummaryBackend = None
+        self.builder = builder.BuilderStatus('bldr', None, m, None)
+        self.builder.basedir = os.path.abspath('bldr')
+
+    def tearDown(self):
+        store = self.builder.getSummaryStore()
+        if store is not None:
+            store.close()
+        self.tearDownDirs()
+
+    def makeBuilds(self, numbers, logs=('log-compile-stdio',)):
+        for n in numbers:
+            self.writeFile(str(n))
+            for l in logs:
+                self.writeFile('%d-%s' % (n, l))
+        self.builder.nextBuildNumber = max(numbers) + 1
+
+    def writeFile(self, name, contents=''):
+        with open(os.path.join('bldr', name), 'w') as f:
+            f.write(contents)
+
+    def listFiles(self):
+        return sorted([ fn for fn in os.listdir('bldr')
+                        if fn[0].isdigit() ])
+
+    def getState(self):
+        p = self.builder.pruner
+        return p.pruned_builds, p.pruned_logs, p.skipped
+
+    def prune(self, buildHorizon, logHorizon=None):
+        self.builder.master.config.buildHorizon = buildHorizon
+        self.builder.master.config.logHorizon = logHorizon
+        return self.builder.prune()
+
+    @defer.inlineCallbacks
+    def test_prune(self):
+        self.makeBuilds(range(6), logs=['log-compile-stdio',
+                                        'log-compile-stdio.bz2',
+                                        'log-compile-stdio.idx'])
+        yield self.prune(buildHorizon=4, logHorizon=3)
+        self.assertEqual(self.listFiles(), ['2', '3', '3-log-compile-stdio',
+            '3-log-compile-stdio.bz2', '3-log-compile-stdio.idx', '4',
+            '4-log-compile-stdio', '4-log-compile-stdio.bz2',
+            '4-log-compile-stdio.idx', '5', '5-log-compile-stdio',
+            '5-log-compile-stdio.bz2', '5-log-compile-stdio.idx'])
+        with open(os.path.join('bldr', 'prune_horizon')) as f:
+            self.assertEqual(f.read(), '2 3\n')
+
+    @defer.inlineCallbacks
+    def test_prune_from_saved_horizon(self):
+        self.makeBuilds(range(6))
+        self.writeFile('prune_horizon', '2 2\n')
+        yield self.prune(buildHorizon=2)
+        # builds before the saved horizon are assumed to be gone already
+        self.assertEqual(self.listFiles(), ['0', '0-log-compile-stdio',
+            '1', '1-log-compile-stdio', '4', '4-log-compile-stdio',
+            '5', '5-log-compile-stdio'])
+
+    @defer.inlineCallbacks
+    def test_prune_uses_summaries(self):
+        self.builder.master.config.buildSummaryBackend = 'jsonl'
+        self.makeBuilds(range(4), logs=['log-compile-stdio', 'other'])
+        store = self.builder.getSummaryStore()
+        store.addBuild(mkSummary(0, logs=['0-log-compile-stdio']))
+        yield self.prune(buildHorizon=2)
+        # build 0's summary lists its logfiles, so no other files are deleted;
+        # build 1 has no summary, so its logfiles are found by name
+        self.assertEqual(self.listFiles(), ['0-other', '2',
+            '2-log-compile-stdio', '2-other', '3', '3-log-compile-stdio',
+            '3-other'])
+        self.assertFalse(store.hasBuild(0))
+
+    @defer.inlineCallbacks
+    def test_prune_batches(self):
+        self.patch(pruner.BuildPruner, 'batchSize', 2)
+        self.makeBuilds(range(10))
+        d = self.prune(buildHorizon=7)
+        # a second prune while the first is running extends the horizon
+        self.assertIdentical(self.prune(buildHorizon=2), d)
+        yield d
+        self.assertEqual(self.listFiles(), ['8', '8-log-compile-stdio',
+                                            '9', '9-log-compile-stdio'])
+        self.assertEqual((self.builder.pruner.pruned_builds,
+                          self.builder.pruner.pruned_logs), (8, 8))
+
+    @defer.inlineCallbacks
+    def test_prune_skips_cached_build(self):
+        self.makeBuilds(range(6))
+        self.builder.buildCache.get(2, val=mock.Mock())
+        yield self.prune(buildHorizon=2)
+        self.assertEqual(self.listFiles(), ['2', '2-log-compile-stdio',
+            '4', '4-log-compile-stdio', '5', '5-log-compile-stdio'])
+        # the horizons pass the skipped build, which is remembered and
+        # pruned next time
+        self.assertEqual(self.getState(), (4, 4, {2 : True}))
+        with open(os.path.join('bldr', 'prune_horizon')) as f:
+            self.assertEqual(f.read(), '4 4\n2 build\n')
+        self.builder.buildCache.cache.clear()
+        yield self.prune(buildHorizon=2)
+        self.assertEqual(self.listFiles(), ['4', '4-log-compile-stdio',
+                                            '5', '5-log-compile-stdio'])
+        self.assertEqual(self.getState(), (4, 4, {}))
+
+    @defer.inlineCallbacks
+    def test_prune_skips_cached_build_logs(self):
+        self.makeBuilds(range(6))
+        self.builder.buildCache.get(2, val=mock.Mock())
+        yield self.prune(buildHorizon=5, logHorizon=2)
+        self.assertEqual(self.listFiles(), ['1', '2', '2-log-compile-stdio',
+            '3', '4', '4-log-compile-stdio', '5', '5-log-compile-stdio'])
+        self.assertEqual(self.getState(), (1, 4, {2 : False}))
+
+    @defer.inlineCallbacks
+    def test_prune_skipped_build_after_restart(self):
+        self.makeBuilds(range(8))
+        self.builder.buildCache.get(2, val=mock.Mock())
+        yield self.prune(buildHorizon=6, logHorizon=4)
+        self.assertEqual(self.getState(), (2, 4, {2 : False}))
+        # a new pruner reads the skipped build from the saved state; it is
+        # now older than the build horizon, so its pickle goes too
+        self.builder.buildCache.cache.clear()
+        self.builder.pruner = None
+        yield self.prune(buildHorizon=4)
+        self.assertEqual(self.listFiles(), ['4', '4-log-compile-stdio',
+            '5', '5-log-compile-stdio', '6', '6-log-compile-stdio',
+            '7', '7-log-compile-stdio'])
+        self.assertEqual(self.getState(), (4, 4, {}))
+
+    @defer.inlineCallbacks
+    def test_prune_lists_logfiles_once(self):
+        self.makeBuilds(range(4), logs=['log-compile-stdio',
+                                        'log-compile-stdio.bz2',
+                                        'log-compile-stdio.idx'])
+        unlinked = []
+        unlink = os.unlink
+        def recordUnlink(path):
+            unlinked.append(os.path.basename(path))
+            unlink(path)
+        self.patch(pruner.os, 'unlink', recordUnlink)
+        yield self.prune(buildHorizon=3)
+        self.assertEqual(self.listFiles(), ['1', '1-log-compile-stdio',
+            '1-log-compile-stdio.bz2', '1-log-compile-stdio.idx', '2',
+            '2-log-compile-stdio', '2-log-compile-stdio.bz2',
+            '2-log-compile-stdio.idx', '3', '3-log-compile-stdio',
+            '3-log-compile-stdio.bz2', '3-log-compile-stdio.idx'])
+        # each of build 0's files is deleted once, without adding suffixes
+        # to names that already have them
+        self.assertEqual(sorted([ fn for fn in unlinked
+                                  if fn.startswith('0') ]),
+            [ '0', '0-log-compile-stdio', '0-log-compile-stdio.blk',
+              '0-log-compile-stdio.blk.tmp', '0-log-compile-stdio.bz2',
+              '0-log-compile-stdio.gz', '0-log-compile-stdio.idx',
+              '0-log-compile-stdio.idx.tmp' ])
+
+    @defer.inlineCallbacks
+    def test_prune_lists_directory_once(self):
+        self.patch(pruner.BuildPruner, 'batchSize', 2)
+        self.makeBuilds(range(10))
+        self.writeFile('prune_horizon', '0 0\n')
+        listdir = mock.Mock(wraps=os.listdir)
+        self.patch(pruner.os, 'listdir', listdir)
+        yield self.prune(buildHorizon=2)
+        self.assertEqual(listdir.call_count, 1)
+        self.assertEqual(self.listFiles(), ['8', '8-log-compile-stdio',
+                                            '9', '9-log-compile-stdio'])
+
+    @defer.inlineCallbacks
+    def test_prune_reads_summaries_in_thread(self):
+        self.builder.master.config.buildSummaryBackend = 'sqlite'
+        self.makeBuilds(range(4))
+        store = self.builder.getSummaryStore()
+        for n in range(4):
+            store.addBuild(mkSummary(n))
+        threads = []
+        getLogs = store.getLogs
+        def recordThread(numbers):
+            threads.append(threadable.isInIOThread())
+            return getLogs(numbers)
+        self.patch(store, 'getLogs', recordThread)
+        self.patch(store, 'getBuild', mock.Mock())
+        yield self.prune(buildHorizon=2)
+        self.assertEqual(self.listFiles(), ['2', '2-log-compile-stdio',
+                                            '3', '3-log-compile-stdio'])
+        self.assertEqual(threads, [ False ])
+        self.assertFalse(store.getBuild.called)
+
+    def test_prune_no_horizon(self):
+        self.makeBuilds(range(6))
+        self.assertEqual(self.prune(buildHorizon=None), None)
+        self.assertEqual(len(self.listFiles()), 12)
@@ -0,0 +1,243 @@
+# This file is part of Buildbot.  Buildbot is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright Buildbot Team Members
+
+import os
+import re
+import mock
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, error
+from twisted.python import failure
+from buildbot import config
+from buildbot.status import logfile
+from buildbot.status.web import logs
+from buildbot.status.web.base import createJinjaEnv
+from buildbot.test.fake.web import FakeRequest
+from buildbot.test.util import dirs
+
+class TestParseByteRange(unittest.TestCase):
+
+    def test_range(self):
+        self.assertEqual(logs.parseByteRange('bytes=10-19', 100), (10, 20))
+
+    def test_range_past_end(self):
+        self.assertEqual(logs.parseByteRange('bytes=90-199', 100), (90, 100))
+
+    def test_open_range(self):
+        self.assertEqual(logs.parseByteRange('bytes=10-', 100), (10, 100))
+
+    def test_suffix(self):
+        self.assertEqual(logs.parseByteRange('bytes=-10', 100), (90, 100))
+
+    def test_multiple(self):
+        self.assertEqual(logs.parseByteRange('bytes=1-2,5-6', 100), None)
+
+    def test_other_unit(self):
+        self.assertEqual(logs.parseByteRange('lines=1-2', 100), None)
+
+    def test_garbage(self):
+        self.assertEqual(logs.parseByteRange('bytes=x-y', 100), None)
+
+    def test_unsatisfiable(self):
+        self.assertRaises(ValueError,
+                lambda : logs.parseByteRange('bytes=100-', 100))
+
+class TestTextLog(unittest.TestCase, dirs.DirsMixin):
+
+    def setUp(self):
+        self.setUpDirs('basedir')
+        step = mock.Mock(name='build_step_status')
+        step.build.builder.basedir = os.path.abspath('basedir')
+        self.logfile = logfile.LogFile(step, 'stdio', '1-stdio')
+        self.logfile.master = mock.Mock()
+        self.logfile.master.config = config.MasterConfig()
+        self.logfile.chunkSize = 10
+        self.logfile.addHeader('running\n')
+        for i in range(1, 21):
+            self.logfile.addStdout('line %d\n' % i)
+        self.logfile.finish()
+
+    def tearDown(self):
+        self.tearDownDirs()
+
+    def render(self, asText=False, args={}, headers={}):
+        req = FakeRequest(args)
+        req.method = 'GET'
+        req.getHeader = lambda name : headers.get(name)
+        req.childLink = lambda name : name
+        req.prepath = ['builders', 'b', 'builds', '1', 'steps', 's', 'logs',
+                       'stdio']
+        req.site.buildbot_service.templates = createJinjaEnv()
+        resource = logs.TextLog(self.logfile)
+        resource.asText = asText
+        d = req.test_render(resource)
+        d.addCallback(lambda _ : req)
+        return d
+
+    def getPreText(self, req):
+        pre = req.written[req.written.index('<pre>'):
+                          req.written.index('</pre>')]
+        return re.sub('<[^>]*>', '', pre)
+
+    def test_text(self):
+        d = self.render(asText=True)
+        def check(req):
+            self.assertEqual(req.written, self.logfile.getText())
+        d.addCallback(check)
+        return d
+
+    def test_text_tail(self):
+        d = self.render(asText=True, args={'tail' : ['2']})
+        def check(req):
+            self.assertEqual(req.written, 'line 19\nline 20\n')
+        d.addCallback(check)
+        return d
+
+    def test_text_lines(self):
+        # the header is omitted from the text, and from its line numbers
+        d = self.render(asText=True, args={'lines' : ['1-3']})
+        def check(req):
+            self.assertEqual(req.written, 'line 1\nline 2\nline 3\n')
+        d.addCallback(check)
+        return d
+
+    def test_text_lines_open(self):
+        d = self.render(asText=True, args={'lines' : ['19-']})
+        def check(req):
+            self.assertEqual(req.written, 'line 19\nline 20\n')
+        d.addCallback(check)
+        return d
+
+    def test_text_lines_invalid(self):
+        d = self.render(asText=True, args={'lines' : ['3-1']})
+        def check(req):
+            req.setResponseCode.assert_called_with(400)
+            self.assertIn('Invalid log range', req.written)
+        d.addCallback(check)
+        return d
+
+    def test_text_range(self):
+        d = self.render(asText=True, headers={'range' : 'bytes=7-13'})
+        def check(req):
+            self.assertEqual(req.written, 'line 2\n')
+            req.setResponseCode.assert_called_with(206)
+            req.setHeader.assert_any_call('content-range', 'bytes 7-13/151')
+        d.addCallback(check)
+        return d
+
+    def test_text_range_unsatisfiable(self):
+        d = self.render(asText=True, headers={'range' : 'bytes=500-'})
+        def check(req):
+            self.assertEqual(req.written, '')
+            req.setResponseCode.assert_called_with(416)
+        d.addCallback(check)
+        return d
+
+    def test_html_lines(self):
+        d = self.render(args={'lines' : ['3-4']})
+        def check(req):
+            self.assertEqual(self.getPreText(req), 'line 2\nline 3\n')
+            self.assertIn('<span class="stdout">', req.written)
+            self.assertIn('href="?lines=1-2"', req.written)
+            self.assertIn('href="?lines=5-6"', req.written)
+            self.assertIn('href="text?lines=3-4"', req.written)
+        d.addCallback(check)
+        return d
+
+    def test_html_tail(self):
+        d = self.render(args={'tail' : ['1']})
+        def check(req):
+            self.assertEqual(self.getPreText(req), 'line 20\n')
+            self.assertTrue(req.written.endswith('</html>'))
+        d.addCallback(check)
+        return d
+
+    def test_text_streamed(self):
+        # the transport pauses the producer whenever it has a chunk buffered
+        self.patch(logs.ChunkProducer, 'BATCHSIZE', 100)
+        req = FakeRequest({'lines' : ['1-']})
+        req.method = 'GET'
+        req.getHeader = lambda name : None
+        writes = []
+        def registerProducer(producer, streaming):
+            self.assertTrue(streaming)
+            def write(data):
+                writes.append(data)
+                producer.pauseProducing()
+                reactor.callLater(0, producer.resumeProducing)
+            req.write = write
+        req.registerProducer = registerProducer
+        resource = logs.TextLog(self.logfile)
+        resource.asText = True
+        d = req.test_render(resource)
+        def check(_):
+            self.assertEqual(''.join(writes), self.logfile.getText())
+            # one chunk was written each time the producer was resumed
+            self.assertEqual(len(writes), len(list(
+                self.logfile.getChunks(logfile.TEXT_CHANNELS))))
+            req.unregisterProducer.assert_called_with()
+        d.addCallback(check)
+        return d
+
+    def test_text_stopped(self):
+        req = FakeRequest({'lines' : ['1-']})
+        req.method = 'GET'
+        req.getHeader = lambda name : None
+        producers = []
+        req.registerProducer = lambda p, streaming : producers.append(p)
+        resource = logs.TextLog(self.logfile)
+        resource.asText = True
+        resource.render(req)
+        # the client goes away before anything is sent
+        producers[0].stopProducing()
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        def check(_):
+            self.assertEqual(req.written, '')
+            self.assertFalse(req.finished)
+            self.assertEqual(producers[0].chunks, None)
+        d.addCallback(check)
+        return d
+
+    def test_text_disconnected(self):
+        self.patch(logs.ChunkProducer, 'BATCHSIZE', 1)
+        req = FakeRequest({'lines' : ['1-']})
+        req.method = 'GET'
+        req.getHeader = lambda name : None
+        notifyFinish = defer.Deferred()
+        req.notifyFinish = lambda : notifyFinish
+        producers = []
+        req.registerProducer = lambda p, streaming : producers.append(p)
+        writes = []
+        def write(data):
+            writes.append(data)
+            if len(writes) == 2:
+                # the client goes away in the middle of the log
+                notifyFinish.errback(failure.Failure(error.ConnectionLost()))
+        req.write = write
+        resource = logs.TextLog(self.logfile)
+        resource.asText = True
+        resource.render(req)
+        d = defer.Deferred()
+        reactor.callLater(0.1, d.callback, None)
+        def check(_):
+            self.assertEqual(len(writes), 2)
+            self.assertFalse(req.finished)
+            req.unregisterProducer.assert_called_once_with()
+            # and nothing holds on to the request or the log
+            self.assertEqual(producers[0].req, None)
+            self.assertEqual(producers[0].chunks, None)
+            self.assertEqual(resource.req, None)
+        d.addCallback(check)
+        return d
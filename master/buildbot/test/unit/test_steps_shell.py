@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import re
+import mock
 import textwrap
 from twisted.trial import unittest
 from buildbot.steps import shell
@@ -571,6 +572,22 @@ class WarningCountingShellCommand(steps.BuildStepMixin, unittest.TestCase):
         self.expectLogfile("warnings (2)", "scary: foo\nscary: bar\n")
         return self.runStep()
 
+    def test_lines_split_across_chunks(self):
+        self.setupStep(shell.WarningCountingShellCommand(command=['make']))
+        self.expectCommands(
+            ExpectShell(workdir='wkdir', usePTY='slave-config',
+                        command=["make"])
+            + ExpectShell.log('stdio', stdout='normal\nwar')
+            + ExpectShell.log('stdio', stderr='ning: spl')
+            + ExpectShell.log('stdio', stdout='it\nwarning: whole\n')
+            + 0
+        )
+        self.expectOutcome(result=WARNINGS, status_text=["'make'", "warnings"])
+        self.expectProperty("warnings-count", 2)
+        self.expectLogfile("warnings (2)",
+                           "warning: split\nwarning: whole\n")
+        return self.runStep()
+
     def test_maxWarnCount(self):
         self.setupStep(shell.WarningCountingShellCommand(command=['make'],
             maxWarnCount=9))
@@ -781,6 +798,124 @@ class WarningCountingShellCommand(steps.BuildStepMixin, unittest.TestCase):
         self.assertEqual(we(step, line, re.match(pat, line)),
                 (exp_file, exp_lineNo, exp_text))
 
+class CombinePatterns(unittest.TestCase):
+
+    def test_search_and_match(self):
+        r = shell.combinePatterns(['b+', re.compile('d$')], ['x'])
+        self.assertTrue(r.search('abbc'))
+        self.assertTrue(r.search('cd'))
+        self.assertTrue(r.search('xyz'))
+        # match patterns are anchored
+        self.assertFalse(r.search('axe'))
+
+    def test_flags(self):
+        self.assertEqual(shell.combinePatterns([re.compile('a', re.I)]), None)
+        self.assertEqual(shell.combinePatterns(['(?i)a', 'b']), None)
+
+    def test_backreferences(self):
+        self.assertEqual(shell.combinePatterns([r'(a)\1', 'b']), None)
+        self.assertEqual(shell.combinePatterns(['(?P<x>a)(?P=x)']), None)
+
+    def test_duplicate_groups(self):
+        self.assertEqual(shell.combinePatterns(['(?P<x>a)', '(?P<x>b)']),
+                         None)
+
+    def test_empty(self):
+        self.assertEqual(shell.combinePatterns([]), None)
+
+    def test_many_groups(self):
+        # Python's re supports only 100 groups in an expression
+        r = shell.combinePatterns([ '(w%d)' % i for i in range(150) ],
+                                  [ '(x%d)' % i for i in range(150) ])
+        self.assertTrue(r.search('aw0'))
+        self.assertTrue(r.search('aw149'))
+        self.assertTrue(r.search('x149z'))
+        self.assertFalse(r.search('ax149'))
+
+    def test_too_many_groups_in_one_pattern(self):
+        self.assertEqual(shell.combinePatterns(['(a)' * 150]), None)
+
+class WarningCountingSuppressions(unittest.TestCase):
+
+    def setUp(self):
+        self.step = shell.WarningCountingShellCommand(command=['make'])
+
+    def test_isSuppressed(self):
+        self.step.addSuppression([
+            ('a\.c', 'unused', None, None),
+            ('a\.c', None, 10, 20),
+            ('b\.c', None, None, None),
+            (None, 'deprecated', 5, 5),
+            (None, '(?i)SHADOW', None, None),
+        ])
+        self.assertTrue(self.step.isSuppressed('a.c', 1, 'unused x'))
+        self.assertFalse(self.step.isSuppressed('a.c', 1, 'used x'))
+        self.assertTrue(self.step.isSuppressed('a.c', 15, 'used x'))
+        self.assertTrue(self.step.isSuppressed('b.c', None, 'anything'))
+        self.assertTrue(self.step.isSuppressed('c.c', 5, 'deprecated'))
+        self.assertFalse(self.step.isSuppressed('c.c', 6, 'deprecated'))
+        self.assertTrue(self.step.isSuppressed('c.c', 6, 'x shadows y'))
+        # a warning without a file matches every file regexp
+        self.assertTrue(self.step.isSuppressed(None, 1, 'unused'))
+
+    def test_isSuppressed_cached(self):
+        fileRe = mock.Mock()
+        fileRe.pattern = 'a\.c'
+        fileRe.flags = 0
+        fileRe.match.return_value = True
+        self.step.addSuppression([(fileRe, 'x', None, None),
+                                  (fileRe, 'y', None, None)])
+        self.assertTrue(self.step.isSuppressed('a.c', 1, 'x'))
+        self.assertTrue(self.step.isSuppressed('a.c', 2, 'y'))
+        self.assertFalse(self.step.isSuppressed('a.c', 2, 'z'))
+        self.assertEqual(fileRe.match.call_count, 1)
+
+    def test_isSuppressed_after_addSuppression(self):
+        self.step.addSuppression([('a\.c', 'x', None, None)])
+        self.assertFalse(self.step.isSuppressed('a.c', 1, 'y'))
+        self.step.addSuppression([('a\.c', 'y', None, None)])
+        self.assertTrue(self.step.isSuppressed('a.c', 1, 'y'))
+
+    def test_findWarnings(self):
+        lines = [
+            "make: Entering directory `src'",
+            "a.c:1: warning: unused variable",
+            "a.c:2: warning: something else",
+            "make: Leaving directory `src'",
+            "a.c:3: warning: unused variable",
+            "not a warning",
+        ]
+        self.step.warningExtractor = \
+                shell.WarningCountingShellCommand.warnExtractFromRegexpGroups
+        self.step.warningPattern = '(.*):([0-9]+): warning: (.*)'
+        self.step.addSuppression([('src/a\.c', 'unused', None, None)])
+        self.assertEqual(self.step.findWarnings(lines),
+                         [ "a.c:2: warning: something else",
+                           "a.c:3: warning: unused variable" ])
+        self.assertEqual(self.step.warnCount, 2)
+        self.assertEqual(self.step.directoryStack, [])
+
+    def test_findWarnings_many_groups(self):
+        lines = [
+            "make: Entering directory `src'",
+            "f7.c:1: warning: unused u7 variable",
+            "f7.c:2: warning: unused u8 variable",
+            "g.c:3: warning: unused u7 variable",
+            "make: Leaving directory `src'",
+        ]
+        self.step.warningExtractor = \
+                shell.WarningCountingShellCommand.warnExtractFromRegexpGroups
+        self.step.warningPattern = '(.*):([0-9]+): warning: (.*)'
+        # more groups between them than one expression can hold
+        self.step.addSuppression([ ('src/(f%d)\.c' % i, 'unused (u%d) ' % i,
+                                    None, None) for i in range(150) ])
+        self.step.addSuppression([ (None, '(never%d)' % i, None, None)
+                                   for i in range(150) ])
+        self.assertEqual(self.step.findWarnings(lines),
+                         [ "f7.c:2: warning: unused u8 variable",
+                           "g.c:3: warning: unused u7 variable" ])
+        self.assertEqual(self.step.warnCount, 2)
+
 class Compile(steps.BuildStepMixin, unittest.TestCase):
 
     def setUp(self):
@@ -14,6 +14,7 @@
 # Copyright Buildbot Team Members
 
 import datetime
+import cPickle
 
 from twisted.trial import unittest
 
@@ -116,6 +117,12 @@ class TimeFunctions(unittest.TestCase):
                          datetime.timedelta(0))
         self.assertEqual(util.UTC.tzname(), "UTC")
 
+    def test_UTC_pickle(self):
+        dt = util.epoch2datetime(1300000000)
+        dt2 = cPickle.loads(cPickle.dumps(dt, 2))
+        self.assertEqual(dt2, dt)
+        self.assertIdentical(dt2.tzinfo, util.UTC)
+
     def test_epoch2datetime(self):
         self.assertEqual(util.epoch2datetime(0),
                 datetime.datetime(1970, 1, 1, 0, 0, 0, tzinfo=util.UTC))
@@ -17,7 +17,7 @@ import string
 import random
 import gc
 from twisted.trial import unittest
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.python import failure
 from buildbot.util import lru
 
@@ -240,12 +240,162 @@ class LRUCacheTest(unittest.TestCase):
         self.lru.put('p', set(['P2P2']))
         self.assertEqual(self.lru.get('p'), set(['P2P2']))
 
+    def test_peek(self):
+        self.lru.get('a')
+        self.assertEqual(self.lru.peek('a'), short('a'))
+        self.lru.miss_fn = lambda key : self.fail("miss function called")
+        self.assertEqual(self.lru.peek('b'), None)
+        self.assertEqual((self.lru.hits, self.lru.misses), (1, 2))
+
+    def test_add(self):
+        self.lru.add('a', set(['new-a']))
+        self.lru.add('b', None) # ignored
+        self.lru.miss_fn = long
+        self.assertEqual(self.lru.get('a'), set(['new-a']))
+        self.assertEqual(self.lru.get('b'), long('b'))
+        self.lru.add('a', set(['newer-a']))
+        self.assertEqual(self.lru.get('a'), set(['newer-a']))
+        self.lru.inv()
+
     def test_put_nonexistent_key(self):
         self.assertEqual(self.lru.get('p'), short('p'))
         self.lru.put('q', set(['new-q']))
         self.assertEqual(self.lru.get('p'), set(['PPP']))
         self.assertEqual(self.lru.get('q'), set(['QQQ'])) # not updated
 
+    def test_remove(self):
+        res_a = self.lru.get('a')
+        self.lru.get('b')
+        self.lru.get('a')
+        self.lru.remove('a')
+        self.lru.remove('z') # not present
+        self.lru.inv()
+        # the miss function is called, even though res_a is still referenced
+        self.lru.miss_fn = long
+        self.check_result(self.lru.get('a'), long('a'), exp_refhits=0)
+        self.assertNotIdentical(self.lru.get('a'), res_a)
+        self.check_result(self.lru.get('b'), short('b'))
+        self.lru.inv()
+
+
+    def test_max_bytes(self):
+        # every value costs its length, and the budget holds four
+        self.lru = lru.LRUCache(short, 10, sizeof=len, max_bytes=4)
+        for c in 'abc':
+            self.lru.get(c)
+        self.lru.miss_fn = lambda k : set(k * 3)
+        self.lru.get('d')   # cost 1
+        self.lru.get('xy')  # cost 2; 'a' and 'b' are evicted
+        self.assertEqual(sorted(self.lru.keys()), [ 'c', 'd', 'xy' ])
+        self.assertEqual(self.lru.total_bytes, 4)
+        self.lru.inv()
+
+    def test_max_bytes_put(self):
+        self.lru = lru.LRUCache(short, 10, sizeof=len, max_bytes=3)
+        self.lru.get('a')
+        self.lru.get('b')
+        self.lru.put('b', set([ 'x', 'y' ]))
+        self.assertEqual(self.lru.total_bytes, 3)
+        self.lru.put('b', set([ 'x', 'y', 'z' ]))
+        self.assertEqual(self.lru.keys(), [ 'b' ])
+        self.lru.inv()
+
+    def test_max_bytes_oversized(self):
+        # a value larger than the budget is returned, but not kept
+        self.lru = lru.LRUCache(short, 10, sizeof=lambda v : 100,
+                                max_bytes=50)
+        self.check_result(self.lru.get('a'), short('a'), 0, 1)
+        self.assertEqual(self.lru.keys(), [])
+        self.assertEqual(self.lru.total_bytes, 0)
+        self.lru.inv()
+
+    def test_ttl(self):
+        clock = task.Clock()
+        self.lru._time = clock.seconds
+        self.lru.set_eviction(ttl=10)
+        res = self.lru.get('a')
+        clock.advance(5)
+        self.check_result(self.lru.get('a'), short('a'), 1, 1)
+        clock.advance(5)
+        # the entry has expired, even though it is still referenced
+        self.lru.miss_fn = long
+        self.check_result(self.lru.get('a'), long('a'), 1, 2, 0)
+        self.assertNotIdentical(self.lru.get('a'), res)
+        self.lru.inv()
+
+    def test_ttl_refresh_on_put(self):
+        clock = task.Clock()
+        self.lru._time = clock.seconds
+        self.lru.set_eviction(ttl=10)
+        self.lru.get('a')
+        clock.advance(8)
+        self.lru.put('a', set(['A2']))
+        clock.advance(8)
+        self.assertEqual(self.lru.get('a'), set(['A2']))
+
+    def test_ttl_weakref(self):
+        clock = task.Clock()
+        self.lru._time = clock.seconds
+        self.lru.set_eviction(ttl=10)
+        res = self.lru.get('a')
+        for c in 'bcd':
+            self.lru.get(c)
+        gc.collect()
+        # 'a' is still found through its weak reference, until it expires
+        self.check_result(self.lru.get('a'), res, exp_refhits=1)
+        clock.advance(10)
+        self.lru.miss_fn = long
+        self.check_result(self.lru.get('a'), long('a'), exp_refhits=1)
+
+    def test_2q_scan_resistance(self):
+        self.lru = lru.LRUCache(short, 8, policy='2q')
+        # 'a' and 'b' are referenced again after leaving probation, so they
+        # enter the main queue
+        for c in 'abcdefghij':
+            self.lru.get(c)
+        for c in 'ab':
+            self.lru.get(c)
+        self.lru.inv()
+        # a scan of keys used only once does not evict them
+        for c in 'klmnopqrstuvwxyz':
+            self.lru.get(c)
+        self.lru.inv()
+        hits = self.lru.hits
+        self.lru.get('a')
+        self.lru.get('b')
+        self.assertEqual(self.lru.hits, hits + 2)
+
+    def test_2q_fuzz(self):
+        self.lru = lru.LRUCache(short, 10, policy='2q')
+        chars = list(string.lowercase * 40)
+        random.shuffle(chars)
+        for i, c in enumerate(chars):
+            res = self.lru.get(c)
+            self.check_result(res, short(c))
+            self.assertTrue(len(self.lru.keys()) <= 10)
+        self.lru.inv()
+
+    def test_set_eviction_policy(self):
+        self.lru.set_eviction(policy='2q')
+        for c in 'abc':
+            self.lru.get(c)
+        self.lru.inv()
+        self.lru.set_eviction(policy='lru')
+        self.lru.inv()
+        self.assertEqual(sorted(self.lru.keys()), [ 'a', 'b', 'c' ])
+        self.assertRaises(ValueError, self.lru.set_eviction, policy='mru')
+
+    def test_set_eviction_max_bytes(self):
+        for c in 'abc':
+            self.lru.get(c)
+        self.lru.sizeof = len
+        self.lru.set_eviction(max_bytes=2)
+        self.assertEqual(sorted(self.lru.keys()), [ 'b', 'c' ])
+        self.lru.inv()
+        self.lru.set_eviction()
+        self.assertEqual((self.lru.sizes, self.lru.total_bytes), ({}, 0))
+        self.lru.inv()
+
 
 class AsyncLRUCacheTest(unittest.TestCase):
 
@@ -574,3 +724,39 @@ class AsyncLRUCacheTest(unittest.TestCase):
         self.assertEqual((yield self.lru.get('p')), short('p'))
         self.lru.put('p', set(['P2P2']))
         self.assertEqual((yield self.lru.get('p')), set(['P2P2']))
+
+    @defer.inlineCallbacks
+    def test_max_bytes(self):
+        self.lru = lru.AsyncLRUCache(self.short_miss_fn, 10, sizeof=len,
+                                     max_bytes=2)
+        for c in 'abc':
+            yield self.lru.get(c)
+        self.assertEqual(sorted(self.lru.keys()), [ 'b', 'c' ])
+        self.lru.inv()
+
+
+class EstimateSize(unittest.TestCase):
+
+    def test_containers(self):
+        small = lru.estimateSize(dict(a=[1, 2]))
+        big = lru.estimateSize(dict(a=[1, 2], b=range(1000)))
+        self.assertTrue(big > small + 1000)
+
+    def test_shared(self):
+        # objects referenced twice are counted once
+        l = range(1000)
+        self.assertTrue(lru.estimateSize([l, l]) < lru.estimateSize(l) * 2)
+
+    def test_instance(self):
+        class Step(object):
+            pass
+        class Build(object):
+            pass
+        step = Step()
+        step.logs = [ 'x' * 1000 ]
+        build = Build()
+        build.steps = [ step ]
+        # the build's instance dictionary is counted, but not the step's
+        self.assertTrue(lru.estimateSize(build) < 1000)
+        self.assertTrue(lru.estimateSize(step) > 1000)
+        self.assertTrue(lru.estimateSize([step]) > 1000)
@@ -165,6 +165,10 @@ class UTC(datetime.tzinfo):
 
     def tzname(self):
         return "UTC"
+
+    def __reduce__(self):
+        # pickle as a reference to the singleton below
+        return "UTC"
 UTC = UTC()
 
 def epoch2datetime(epoch):
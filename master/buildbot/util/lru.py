@@ -19,21 +19,59 @@ from twisted.python import log
 from twisted.internet import defer
 from collections import deque
 from collections import defaultdict
+import sys
+import time
+
+
+def estimateSize(obj):
+    """
+    Estimate the memory used by a value, in bytes.  Dictionaries, lists,
+    tuples and sets are counted along with their contents, and other objects
+    along with the contents of their instance dictionaries; objects referred
+    to from an instance dictionary are counted without their contents, so
+    that the estimate does not wander off into the rest of the process.
+    """
+    seen = set()
+    size = 0
+    # (object, whether to count the contents of its instance dictionary)
+    stack = [ (obj, True) ]
+    while stack:
+        o, follow = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o, 0)
+        if isinstance(o, dict):
+            for k, v in o.iteritems():
+                stack.append((k, follow))
+                stack.append((v, follow))
+        elif isinstance(o, (list, tuple, set, frozenset, deque)):
+            stack.extend([ (v, follow) for v in o ])
+        elif follow and isinstance(getattr(o, '__dict__', None), dict):
+            stack.append((o.__dict__, False))
+    return size
 
 
 class LRUCache(object):
     """
-    A least-recently-used cache, with a fixed maximum size.
+    A least-recently-used cache, with a fixed maximum size.  The cache can
+    also be limited by the estimated size of its values in bytes, can expire
+    entries after a fixed time, and can use the 2Q eviction policy instead of
+    plain LRU.
 
     See buildbot manual for more information.
     """
 
     __slots__ = ('max_size max_queue miss_fn queue cache weakrefs '
-                 'refcount hits refhits misses'.split())
+                 'refcount hits refhits misses policy max_bytes ttl sizeof '
+                 'sizes total_bytes expires probation probation_keys ghosts '
+                 'ghost_keys _time'.split())
     sentinel = object()
     QUEUE_SIZE_FACTOR = 10
+    POLICIES = ('lru', '2q')
 
-    def __init__(self, miss_fn, max_size=50):
+    def __init__(self, miss_fn, max_size=50, sizeof=estimateSize,
+                 policy='lru', max_bytes=None, ttl=None):
         self.max_size = max_size
         self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
         self.queue = deque()
@@ -43,10 +81,28 @@ class LRUCache(object):
         self.refcount = defaultdict(lambda : 0)
         self.miss_fn = miss_fn
 
+        self.sizeof = sizeof
+        self.sizes = {}
+        self.total_bytes = 0
+        self.expires = {}
+        self._time = time.time # for tests
+
+        # for the 2Q policy: keys seen once, in FIFO order, and keys recently
+        # evicted from there
+        self.probation = deque()
+        self.probation_keys = set()
+        self.ghosts = deque()
+        self.ghost_keys = set()
+
+        self.policy = 'lru'
+        self.max_bytes = self.ttl = None
+        self.set_eviction(policy=policy, max_bytes=max_bytes, ttl=ttl)
+
     def put(self, key, value):
         if key in self.cache:
-            self.cache[key] = value
+            self._store(key, value)
             self.weakrefs[key] = value
+            self._purge()
         elif key in self.weakrefs:
             self.weakrefs[key] = value
 
@@ -60,13 +116,55 @@ class LRUCache(object):
 
         result = self.miss_fn(key, **miss_fn_kwargs)
         if result is not None:
-            self.cache[key] = result
+            self._store(key, result)
             self.weakrefs[key] = result
             self._ref_key(key)
             self._purge()
 
         return result
 
+    def peek(self, key):
+        """Return the cached value for a key, or None if it is not cached,
+        without calling the miss function; for callers that fetch the missing
+        values of many keys together"""
+        try:
+            return self._get_hit(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+    def add(self, key, value):
+        """Cache a value that was fetched without the miss function, as if the
+        miss function had returned it"""
+        if value is None:
+            return
+        if key in self.cache:
+            self.put(key, value)
+            return
+        self._store(key, value)
+        self.weakrefs[key] = value
+        self._ref_key(key)
+        self._purge()
+
+    def remove(self, key):
+        """Remove a key, if present, so that the next get calls the miss
+        function"""
+        if key in self.cache:
+            if key in self.probation_keys:
+                self.probation_keys.remove(key)
+                self.probation = deque([ k for k in self.probation
+                                         if k != key ])
+            else:
+                del self.refcount[key]
+                self.queue = deque([ k for k in self.queue if k != key ])
+            self._forget(key)
+        self.expires.pop(key, None)
+        self.ghost_keys.discard(key)
+        try:
+            del self.weakrefs[key]
+        except KeyError:
+            pass
+
     def keys(self):
         return self.cache.keys()
 
@@ -78,12 +176,59 @@ class LRUCache(object):
         self.max_queue = max_size * self.QUEUE_SIZE_FACTOR
         self._purge()
 
+    def set_eviction(self, policy='lru', max_bytes=None, ttl=None):
+        """
+        Set the eviction policy, either C{'lru'} or C{'2q'}; the limit on the
+        total estimated size of the cached values, in bytes; and the time in
+        seconds after which entries expire.  Limits of None are disabled.
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("unknown cache policy %r" % (policy,))
+
+        if policy != self.policy:
+            # keys on probation join the main queue as the least recently
+            # used
+            for k in reversed(self.probation):
+                self.queue.appendleft(k)
+                self.refcount[k] = 1
+            self.probation.clear()
+            self.probation_keys.clear()
+            self.ghosts.clear()
+            self.ghost_keys.clear()
+            self.policy = policy
+
+        if max_bytes != self.max_bytes:
+            self.max_bytes = max_bytes
+            self.sizes.clear()
+            self.total_bytes = 0
+            if max_bytes is not None:
+                for k, v in self.cache.iteritems():
+                    self._store(k, v)
+
+        if ttl != self.ttl:
+            self.ttl = ttl
+            self.expires.clear()
+            if ttl is not None:
+                expires = self._time() + ttl
+                for k in self.cache:
+                    self.expires[k] = expires
+
+        self._purge()
+
     def inv(self):
         global inv_failed
 
-        # the keys of the queue and cache should be identical
+        # the keys of the queue and probation should be those of the cache
         cache_keys = set(self.cache.keys())
         queue_keys = set(self.queue)
+        if queue_keys & self.probation_keys:
+            log.msg("INV: keys both queued and on probation:",
+                    queue_keys & self.probation_keys)
+            inv_failed = True
+        if set(self.probation) != self.probation_keys:
+            log.msg("INV: probation keys differ")
+            inv_failed = True
+        queue_keys |= self.probation_keys
         if queue_keys - cache_keys:
             log.msg("INV: uncached keys in queue:", queue_keys - cache_keys)
             inv_failed = True
@@ -102,8 +247,53 @@ class LRUCache(object):
             log.msg("      got:", sorted(self.refcount.items()))
             inv_failed = True
 
+        # sizes are recorded for every cached key, if they are needed
+        if self.max_bytes is not None:
+            if set(self.sizes) != cache_keys:
+                log.msg("INV: sized keys differ from cached keys")
+                inv_failed = True
+            if sum(self.sizes.values()) != self.total_bytes:
+                log.msg("INV: total_bytes is wrong")
+                inv_failed = True
+
+    def _store(self, key, value, fresh=True):
+        """Store a value in the cache, recording its size and expiry time."""
+        self.cache[key] = value
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            self.total_bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+        if self.ttl is not None and (fresh or key not in self.expires):
+            expires = self.expires
+            expires[key] = self._time() + self.ttl
+            # expiry times are kept while the value is weakly referenced, so
+            # drop those whose values have gone
+            if len(expires) > self.max_queue:
+                for k in expires.keys():
+                    if k not in self.cache and k not in self.weakrefs:
+                        del expires[k]
+
+    def _forget(self, key):
+        """Drop a key from the cache, after it has left the queues."""
+        del self.cache[key]
+        if key in self.sizes:
+            self.total_bytes -= self.sizes.pop(key)
+        if key in self.expires and key not in self.weakrefs:
+            del self.expires[key]
+
     def _ref_key(self, key):
         """Record a reference to the argument key."""
+        if self.policy == '2q' and key not in self.refcount:
+            # keys enter the main queue only if they are referenced again
+            # soon after being evicted from probation
+            if key in self.probation_keys:
+                return
+            if key not in self.ghost_keys:
+                self.probation.append(key)
+                self.probation_keys.add(key)
+                return
+            self.ghost_keys.remove(key)
+
         queue = self.queue
         refcount = self.refcount
 
@@ -125,6 +315,12 @@ class LRUCache(object):
 
     def _get_hit(self, key):
         """Try to do a value lookup from the existing cache entries."""
+        if self.expires:
+            expires = self.expires.get(key)
+            if expires is not None and expires <= self._time():
+                self.remove(key)
+                raise KeyError(key)
+
         try:
             result = self.cache[key]
             self.hits += 1
@@ -135,32 +331,47 @@ class LRUCache(object):
 
         result = self.weakrefs[key]
         self.refhits += 1
-        self.cache[key] = result
+        self._store(key, result, fresh=False)
         self._ref_key(key)
+        self._purge()
         return result
 
     def _purge(self):
         """
-        Trim the cache down to max_size by evicting the
-        least-recently-used entries.
+        Trim the cache down to max_size, and to max_bytes if that is set, by
+        evicting entries according to the policy.
         """
-        if len(self.cache) <= self.max_size:
+        cache = self.cache
+        max_size = self.max_size
+        max_bytes = self.max_bytes
+        if len(cache) <= max_size and (max_bytes is None
+                                       or self.total_bytes <= max_bytes):
             return
 
-        cache = self.cache
         refcount = self.refcount
         queue = self.queue
-        max_size = self.max_size
-
-        # purge least recently used entries, using refcount to count entries
-        # that appear multiple times in the queue
-        while len(cache) > max_size:
-            refc = 1
-            while refc:
-                k = queue.popleft()
-                refc = refcount[k] = refcount[k] - 1
-            del cache[k]
-            del refcount[k]
+        probation = self.probation
+
+        while cache and (len(cache) > max_size or
+                (max_bytes is not None and self.total_bytes > max_bytes)):
+            # under 2Q, a quarter of the cache is given to keys on probation
+            if probation and (len(probation) > max_size // 4
+                              or not refcount):
+                k = probation.popleft()
+                self.probation_keys.remove(k)
+                self.ghosts.append(k)
+                self.ghost_keys.add(k)
+                while len(self.ghosts) > max(1, max_size // 2):
+                    self.ghost_keys.discard(self.ghosts.popleft())
+            else:
+                # purge least recently used entries, using refcount to count
+                # entries that appear multiple times in the queue
+                refc = 1
+                while refc:
+                    k = queue.popleft()
+                    refc = refcount[k] = refcount[k] - 1
+                del refcount[k]
+            self._forget(k)
 
 
 class AsyncLRUCache(LRUCache):
@@ -171,8 +382,8 @@ class AsyncLRUCache(LRUCache):
 
     __slots__ = ['concurrent']
 
-    def __init__(self, miss_fn, max_size=50):
-        LRUCache.__init__(self, miss_fn, max_size=max_size)
+    def __init__(self, miss_fn, max_size=50, **kwargs):
+        LRUCache.__init__(self, miss_fn, max_size=max_size, **kwargs)
         self.concurrent = {}
 
     def get(self, key, **miss_fn_kwargs):
@@ -202,7 +413,7 @@ class AsyncLRUCache(LRUCache):
 
         def handle_result(result):
             if result is not None:
-                self.cache[key] = result
+                self._store(key, result)
                 self.weakrefs[key] = result
 
                 # reference the key once, possibly standing in for multiple
@@ -0,0 +1,158 @@
+#! /usr/bin/python
+
+"""
+Benchmark the warning scanner used by WarningCountingShellCommand (and so by
+the Compile and Test steps) on a synthetic gcc/clang build log, with a large
+suppressions list.
+
+The scanner is compared to a straightforward implementation that tries every
+pattern, and every suppression, against every line; both must find the same
+warnings.
+
+Usage: benchmark_warnings.py [--lines N] [--suppressions N] [--repeat N]
+"""
+
+import re
+import sys
+import time
+import random
+import optparse
+
+from buildbot.steps import shell
+
+DIRS = [ 'common-src', 'server-src', 'client-src', 'amar-src', 'ndmp-src' ]
+FILES = [ 'file%03d.c' % i for i in range(200) ]
+MESSAGES = [
+    "unused variable 'x%d'",
+    "comparison between signed and unsigned integer expressions (%d)",
+    "implicit declaration of function 'f%d'",
+    "'%d' may be used uninitialized in this function",
+    "format '%%s' expects type 'char *', but argument %d has type 'int'",
+    "declaration of 'tmp%d' shadows a previous local",
+]
+
+def makeLog(lines, rand):
+    log = []
+    stack = []
+    while len(log) < lines:
+        r = rand.random()
+        if r < 0.02 and len(stack) < 3:
+            d = rand.choice(DIRS)
+            stack.append(d)
+            log.append("make[%d]: Entering directory `/build/%s'"
+                       % (len(stack), d))
+        elif r < 0.04 and stack:
+            log.append("make[%d]: Leaving directory `/build/%s'"
+                       % (len(stack), stack.pop()))
+        elif r < 0.14:
+            f = rand.choice(FILES)
+            msg = rand.choice(MESSAGES) % rand.randint(0, 99)
+            if rand.random() < 0.5:
+                # gcc
+                log.append("%s:%d: warning: %s" % (f, rand.randint(1, 5000), msg))
+            else:
+                # clang
+                log.append("%s:%d:%d: warning: %s [-Wsomething]"
+                           % (f, rand.randint(1, 5000), rand.randint(1, 80), msg))
+        else:
+            f = rand.choice(FILES)
+            log.append("gcc -DHAVE_CONFIG_H -I. -I../common-src -g -O2 "
+                       "-Wall -c -o %s %s" % (f.replace('.c', '.o'), f))
+    return log
+
+def makeSuppressions(count, rand):
+    supps = []
+    for i in range(count):
+        f = "%s/%s" % (rand.choice(DIRS), rand.choice(FILES))
+        msg = re.escape(rand.choice(MESSAGES) % rand.randint(0, 99))
+        if rand.random() < 0.3:
+            start = rand.randint(1, 4000)
+            supps.append((f, msg, start, start + rand.randint(0, 500)))
+        else:
+            supps.append((f, msg, None, None))
+    return supps
+
+def extractor(step, line, match):
+    return match.group(1), match.group(2), match.group(3)
+
+def makeStep(suppressions):
+    step = shell.WarningCountingShellCommand(command=['make'],
+            warningPattern=r"([^:\s]+):([0-9]+):(?:[0-9]+:)? warning: (.*)",
+            warningExtractor=extractor)
+    step.addSuppression(suppressions)
+    return step
+
+def referenceFindWarnings(step, lines):
+    # try every pattern and suppression against every line
+    wre = re.compile(step.warningPattern)
+    enterRe = re.compile(step.directoryEnterPattern)
+    leaveRe = re.compile(step.directoryLeavePattern)
+    warnings = []
+    for line in lines:
+        match = enterRe.search(line)
+        if match:
+            step.directoryStack.append(match.group(1))
+            continue
+        if step.directoryStack and leaveRe.search(line):
+            step.directoryStack.pop()
+            continue
+        match = wre.match(line)
+        if not match:
+            continue
+        file, lineNo, text = step.warningExtractor(step, line, match)
+        lineNo = lineNo and int(lineNo)
+        if file and step.directoryStack:
+            file = "%s/%s" % ('/'.join(step.directoryStack), file)
+        for fileRe, warnRe, start, end in step.suppressions:
+            if not (file == None or fileRe == None or fileRe.match(file)):
+                continue
+            if not (warnRe == None or warnRe.search(text)):
+                continue
+            if not ((start == None and end == None) or
+                    (lineNo != None and start <= lineNo and end >= lineNo)):
+                continue
+            break
+        else:
+            warnings.append(line)
+    return warnings
+
+def timeit(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip().split("\n")[-1])
+    parser.add_option("--lines", type="int", default=200000)
+    parser.add_option("--suppressions", type="int", default=2000)
+    parser.add_option("--repeat", type="int", default=3)
+    opts, args = parser.parse_args()
+
+    rand = random.Random(0)
+    log = makeLog(opts.lines, rand)
+    suppressions = makeSuppressions(opts.suppressions, rand)
+    print "%d lines, %d suppressions" % (len(log), len(suppressions))
+
+    def runReference():
+        return referenceFindWarnings(makeStep(suppressions), log)
+    def runScanner():
+        return makeStep(suppressions).findWarnings(log)
+
+    ref_time, ref_warnings = timeit(runReference, opts.repeat)
+    print "reference: %.3fs, %d warnings" % (ref_time, len(ref_warnings))
+    scan_time, scan_warnings = timeit(runScanner, opts.repeat)
+    print "scanner:   %.3fs, %d warnings" % (scan_time, len(scan_warnings))
+
+    if scan_warnings != ref_warnings:
+        print "MISMATCH: the scanner and the reference found different warnings"
+        return 1
+    print "speedup:   %.1fx" % (ref_time / scan_time)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())